@@ -0,0 +1,100 @@
+import os
+import sys
+import gin
+import time
+import torch
+import logging
+import accelerate
+from source import models
+from source import configs
+from source import datasets
+from source import checkpoints
+from source import evaluation
+from source.utils import misc
+
+
+def main():
+    config = configs.load_config(rank=0, world_size=1)
+
+    accelerator = accelerate.Accelerator()
+    torch.backends.cudnn.benchmark = True  # Improves training speed.
+    torch.backends.cuda.matmul.allow_tf32 = False  # Improves numerical accuracy.
+    torch.backends.cudnn.allow_tf32 = False  # Improves numerical accuracy.
+    torch.backends.cuda.matmul.allow_fp16_reduced_precision_reduction = False  # Improves numerical accuracy.
+
+    # setup logger
+    logging.basicConfig(
+        format="%(asctime)s: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        force=True,
+        handlers=[
+            logging.StreamHandler(sys.stdout),
+            logging.FileHandler(os.path.join(config.exp_path, 'log_bake.txt'))
+        ],
+        level=logging.INFO,
+    )
+    sys.excepthook = misc.handle_exception
+    logger = accelerate.logging.get_logger(__name__)
+    logger.info(config)
+    logger.info(accelerator.state, main_process_only=False)
+
+    # Set random seed.
+    accelerate.utils.set_seed(config.seed, device_specific=True)
+    # setup model
+    model = models.Model(config=config)
+    model.eval()
+    assert any(isinstance(m, models.PropMLP) for m in model.modules()), 'Baking requires proposal networks'
+
+    test_dataset = datasets.load_dataset('test', config)
+
+    model = accelerator.prepare(model)
+    step = checkpoints.restore_checkpoint(config.ckpt_dir, accelerator, logger)
+    assert step > 0, f'No checkpoint found in {config.ckpt_dir}'
+    logger.info(f'Baking the proposal networks of checkpoint at step {step}.')
+
+    # Use more samples for evaluation, as eval.py.
+    model.num_prop_samples = int(model.num_prop_samples * config.eval_sample_multipler)
+    model.num_nerf_samples = int(model.num_nerf_samples * config.eval_sample_multipler)
+    num_eval = min(test_dataset.size, config.eval_dataset_limit)
+
+    start_time = time.time()
+    psnr_before = evaluation.evaluate_psnr(model, accelerator, test_dataset, config, logger)
+    render_time_before = (time.time() - start_time) / num_eval
+
+    accelerator.unwrap_model(model).bake_proposals(config.bake_resolution)
+
+    start_time = time.time()
+    psnr_after = evaluation.evaluate_psnr(model, accelerator, test_dataset, config, logger)
+    render_time_after = (time.time() - start_time) / num_eval
+
+    # Save the baked checkpoint as a new experiment, which loads with the same config.
+    bake_path = os.path.join(config.exp_path, 'baked')
+    if accelerator.is_main_process:
+        misc.makedirs(bake_path)
+    accelerator.wait_for_everyone()
+    checkpoints.save_checkpoint(os.path.join(bake_path, 'checkpoints'), accelerator, step,
+                                config.checkpoints_total_limit)
+
+    results = {
+        'resolution': f'{config.bake_resolution}',
+        'psnr': f'{psnr_before:.4f} -> {psnr_after:.4f} ({psnr_after - psnr_before:+.4f})',
+        'render_time': f'{render_time_before:.3f}s -> {render_time_after:.3f}s',
+    }
+    if accelerator.is_main_process:
+        with misc.open_file(os.path.join(bake_path, f'bake_{step}.txt'), 'w') as f:
+            for name, result in results.items():
+                f.write(f'{name}: {result}\n')
+                logger.info(f'{name}: {result}')
+    logger.info(f'Baked checkpoint saved to {bake_path}.')
+
+
+if __name__ == '__main__':
+    import argparse
+    p = argparse.ArgumentParser()
+    p.add_argument('-c', '--config', nargs='+', help="Path to gin config files")
+    p.add_argument('-p', '--param', nargs='+', help="Command line parameter override")
+    args = p.parse_args()
+
+    gin.parse_config_files_and_bindings(args.config, args.param, skip_unknown=True)
+    with gin.config_scope('eval'):  # Use the same scope as eval.py
+        main()
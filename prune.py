@@ -0,0 +1,122 @@
+import os
+import sys
+import gin
+import time
+import torch
+import logging
+import accelerate
+import numpy as np
+from source import models
+from source import configs
+from source import datasets
+from source import checkpoints
+from source import evaluation
+from source.utils import misc
+
+
+def main():
+    config = configs.load_config(rank=0, world_size=1)
+
+    accelerator = accelerate.Accelerator()
+    torch.backends.cudnn.benchmark = True  # Improves training speed.
+    torch.backends.cuda.matmul.allow_tf32 = False  # Improves numerical accuracy.
+    torch.backends.cudnn.allow_tf32 = False  # Improves numerical accuracy.
+    torch.backends.cuda.matmul.allow_fp16_reduced_precision_reduction = False  # Improves numerical accuracy.
+
+    # setup logger
+    logging.basicConfig(
+        format="%(asctime)s: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        force=True,
+        handlers=[
+            logging.StreamHandler(sys.stdout),
+            logging.FileHandler(os.path.join(config.exp_path, 'log_prune.txt'))
+        ],
+        level=logging.INFO,
+    )
+    sys.excepthook = misc.handle_exception
+    logger = accelerate.logging.get_logger(__name__)
+    logger.info(config)
+    logger.info(accelerator.state, main_process_only=False)
+
+    # Set random seed.
+    accelerate.utils.set_seed(config.seed, device_specific=True)
+    # setup model
+    model = models.Model(config=config)
+    model.eval()
+    assert isinstance(model.nerf, models.StrokeField), 'Pruning requires a stroke field'
+
+    train_dataset = datasets.load_dataset('train', config)
+    test_dataset = datasets.load_dataset('test', config)
+
+    model = accelerator.prepare(model)
+    step = checkpoints.restore_checkpoint(config.ckpt_dir, accelerator, logger)
+    assert step > 0, f'No checkpoint found in {config.ckpt_dir}'
+    stroke_field = accelerator.unwrap_model(model).nerf
+    num_strokes = stroke_field.stroke_step.item()
+    logger.info(f'Pruning checkpoint at step {step} with {num_strokes} strokes.')
+
+    # Use more samples for evaluation, as eval.py.
+    model.num_prop_samples = int(model.num_prop_samples * config.eval_sample_multipler)
+    model.num_nerf_samples = int(model.num_nerf_samples * config.eval_sample_multipler)
+
+    start_time = time.time()
+    psnr_before = evaluation.evaluate_psnr(model, accelerator, test_dataset, config, logger)
+    render_time_before = (time.time() - start_time) / min(test_dataset.size, config.eval_dataset_limit)
+
+    # Measure the stroke contributions over evenly spaced training views.
+    contributions = 0
+    view_indices = np.linspace(0, train_dataset.size - 1, min(config.prune_num_views, train_dataset.size))
+    for i, idx in enumerate(np.round(view_indices).astype(int)):
+        logger.info(f'Measuring contributions of view {i + 1}/{len(view_indices)}')
+        batch = accelerate.utils.send_to_device(train_dataset.generate_ray_batch(idx), accelerator.device)
+        contributions = contributions + models.stroke_contributions(model, accelerator, batch, config)
+
+    # Merge near-duplicate strokes, then drop the strokes with a low contribution.
+    keep = torch.ones(num_strokes, dtype=torch.bool, device=contributions.device)
+    if config.prune_merge_distance > 0:
+        keep, contributions = stroke_field.merge_strokes(contributions, config.prune_merge_distance)
+    num_merged = num_strokes - keep.sum().item()
+    keep &= contributions >= config.prune_min_contribution * contributions.mean()
+    keep_indices = torch.nonzero(keep).squeeze(1)
+    # Store the contributions as the importance order for level-of-detail rendering.
+    stroke_field.stroke_importance[:num_strokes] = contributions
+    stroke_field.compact_strokes(keep_indices)
+    logger.info(f'Merged {num_merged} strokes, dropped {num_strokes - num_merged - keep_indices.shape[0]} strokes, '
+                f'{keep_indices.shape[0]}/{num_strokes} strokes left.')
+
+    start_time = time.time()
+    psnr_after = evaluation.evaluate_psnr(model, accelerator, test_dataset, config, logger)
+    render_time_after = (time.time() - start_time) / min(test_dataset.size, config.eval_dataset_limit)
+
+    # Save the pruned checkpoint as a new experiment, which loads with the same config.
+    prune_path = os.path.join(config.exp_path, 'pruned')
+    if accelerator.is_main_process:
+        misc.makedirs(prune_path)
+    accelerator.wait_for_everyone()
+    checkpoints.save_checkpoint(os.path.join(prune_path, 'checkpoints'), accelerator, step,
+                                config.checkpoints_total_limit)
+
+    results = {
+        'num_strokes': f'{num_strokes} -> {keep_indices.shape[0]}',
+        'psnr': f'{psnr_before:.4f} -> {psnr_after:.4f} ({psnr_after - psnr_before:+.4f})',
+        'render_time': f'{render_time_before:.3f}s -> {render_time_after:.3f}s',
+    }
+    if accelerator.is_main_process:
+        with misc.open_file(os.path.join(prune_path, f'prune_{step}.txt'), 'w') as f:
+            for name, result in results.items():
+                f.write(f'{name}: {result}\n')
+                logger.info(f'{name}: {result}')
+    logger.info(f'Pruned checkpoint saved to {prune_path}.')
+
+
+if __name__ == '__main__':
+    import argparse
+    p = argparse.ArgumentParser()
+    p.add_argument('-c', '--config', nargs='+', help="Path to gin config files")
+    p.add_argument('-p', '--param', nargs='+', help="Command line parameter override")
+    args = p.parse_args()
+
+    gin.parse_config_files_and_bindings(args.config, args.param, skip_unknown=True)
+    with gin.config_scope('eval'):  # Use the same scope as eval.py
+        main()
@@ -163,7 +163,10 @@ def main():
 
         if config.render_progressive_strokes:
             frac = ((idx + 1) / dataset.size) ** 1.5
-            model.nerf.stroke_step_limit = int(math.ceil(model.nerf.max_num_strokes * frac))
+            if config.render_progressive_importance:
+                model.nerf.lod_num_strokes = int(math.ceil(model.nerf.stroke_step.item() * frac))
+            else:
+                model.nerf.stroke_step_limit = int(math.ceil(model.nerf.max_num_strokes * frac))
         rendering = models.render_image(model, accelerator, batch, config)
 
         logger.info(f'Rendered in {(time.time() - eval_start_time):0.3f}s')
@@ -0,0 +1,36 @@
+#!/bin/bash
+# Compare the test metrics of a trained Blender scene evaluated with float32 stroke storage
+# and with half precision storage (PRECISION=float16 or PRECISION=bfloat16), and record the
+# PSNR difference in precision/psnr_diff_$PRECISION.txt.
+
+SCENE=lego
+EXPERIMENT=blender/"$SCENE"
+DATA_ROOT=data/nerf_synthetic
+DATA_DIR="$DATA_ROOT"/"$SCENE"
+PRECISION=${PRECISION:-float16}
+PREDS_DIR=exp/"$EXPERIMENT"/test_preds
+
+for DTYPE in float32 "$PRECISION"; do
+  accelerate launch eval.py \
+    --gin_configs=configs/blender.gin \
+    --gin_bindings="Config.data_dir = '${DATA_DIR}'" \
+    --gin_bindings="Config.exp_name = '${EXPERIMENT}'" \
+    --gin_bindings="Config.factor = 4" \
+    --gin_bindings="StrokeField.stroke_storage_dtype = '${DTYPE}'"
+  mkdir -p "$PREDS_DIR"/precision/"$DTYPE"
+  cp "$PREDS_DIR"/metric_*.txt "$PREDS_DIR"/precision/"$DTYPE"/
+done
+
+for DTYPE in float32 "$PRECISION"; do
+  echo "$DTYPE:"
+  cat "$PREDS_DIR"/precision/"$DTYPE"/metric_avg_*.txt
+done
+
+# Record the per-image PSNR difference of the half precision storage against float32.
+python - "$PREDS_DIR"/precision "$PRECISION" <<'PY' | tee "$PREDS_DIR"/precision/psnr_diff_"$PRECISION".txt
+import glob, sys
+import numpy as np
+load = lambda dtype: np.loadtxt(glob.glob(f'{sys.argv[1]}/{dtype}/metric_psnr_*.txt')[0], ndmin=1)
+diff = load(sys.argv[2]) - load('float32')
+print(f'{sys.argv[2]} - float32 psnr: mean {diff.mean():+.4f} dB, max abs {np.abs(diff).max():.4f} dB')
+PY
@@ -0,0 +1,12 @@
+#!/bin/bash
+
+SCENE=lego
+EXPERIMENT=blender/"$SCENE"
+DATA_ROOT=data/nerf_synthetic
+DATA_DIR="$DATA_ROOT"/"$SCENE"
+
+accelerate launch prune.py \
+  --gin_configs=configs/blender.gin \
+  --gin_bindings="Config.data_dir = '${DATA_DIR}'" \
+  --gin_bindings="Config.exp_name = '${EXPERIMENT}'" \
+  --gin_bindings="Config.factor = 4"
@@ -122,6 +122,7 @@ class Config:
 
     # Render configs
     render_progressive_strokes: bool = False  # If True, render strokes progressively.
+    render_progressive_importance: bool = False  # If True, add strokes by importance instead of insertion order.
     render_progressive_sample_multipler: float = 12.  # Multiplier for the number of samples.
     render_progressive_render_chunk_size_divisor: int = 8  # Divisor for render chunk size.
     render_factor: int = 1  # The downsample factor of rendered images, -1 for not used.
@@ -143,11 +144,20 @@ class Config:
     render_spline_degree: int = 5  # Polynomial degree of B-spline interpolation.
     render_spline_smoothness: float = .03  # B-spline smoothing factor, 0 for exact interpolation of keyframes.
     render_spline_interpolate_exposure: bool = False  # Interpolate per-frame exposure value from spline keyframes.
-    
+
+    # Prune configs
+    prune_num_views: int = 20  # The number of training views to measure the stroke contributions on.
+    prune_min_contribution: float = 0.05  # Drop strokes contributing less than this fraction of the mean.
+    prune_merge_distance: float = 0.0  # Merge strokes whose normalized parameters differ by less, disabled if 0.
+
+    # Bake configs
+    bake_resolution: int = 128  # The grid resolution of the baked proposal densities.
+
     # Texture render configs
-    stroke_texture: str = 'none'  # The texture type to use, one of ['none', 'image'].
+    stroke_texture: str = 'none'  # The texture type to use, one of ['none', 'image', 'atlas'].
     texture_image_size: tuple[int, int] = (256, 256)  # The resolution of the stroke texture.
     texture_image_path: str = ''  # The path to the stroke texture image.
+    texture_atlas_paths: tuple[str, ...] = ()  # The paths to the brush textures of the 'atlas' texture.
 
 
 def load_config(rank: int, world_size: int) -> Config:
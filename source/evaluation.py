@@ -0,0 +1,25 @@
+import accelerate
+import numpy as np
+from source import models
+from source.utils import image as image_utils
+
+
+def evaluate_psnr(model, accelerator, dataset, config, logger):
+    """Average PSNR over the first eval_dataset_limit images of the dataset."""
+    psnrs = []
+    num_eval = min(dataset.size, config.eval_dataset_limit)
+    for idx in range(num_eval):
+        batch = accelerate.utils.send_to_device(dataset.generate_ray_batch(idx), accelerator.device)
+        rendering = models.render_image(model, accelerator, batch, config, verbose=False)
+        rgb = rendering['rgb'].cpu().numpy()
+        rgb_gt = batch['rgb'].cpu().numpy()
+        if config.eval_quantize_metrics:
+            # Same as eval.py, metrics of the 8-bit images.
+            rgb = np.round(rgb * 255) / 255
+        if config.eval_crop_borders > 0:
+            crop_fn = lambda x, c=config.eval_crop_borders: x[c:-c, c:-c]
+            rgb = crop_fn(rgb)
+            rgb_gt = crop_fn(rgb_gt)
+        psnrs.append(float(image_utils.mse_to_psnr(np.mean((rgb - rgb_gt)**2))))
+        logger.info(f'Image {idx + 1}/{num_eval}: psnr = {psnrs[-1]:.4f}')
+    return float(np.mean(psnrs))
@@ -1,5 +1,6 @@
 import accelerate
 import gin
+import itertools
 import math
 import torch
 import torch.nn as nn
@@ -12,7 +13,10 @@ from source.utils import stepfun
 from source.utils import render
 from source.utils import training as train_utils
 from source.gridencoder import GridEncoder
-from source.strokelib import get_stroke, compose_strokes
+from source.strokelib import get_stroke, get_stroke_bounds, get_stroke_compose, compose_strokes, compact_stroke_pairs, make_row_offsets
+from source.strokelib import compose_strokes_chunked, compose_transmittance, merge_over_composition
+from source.strokelib import stroke_alpha_band, build_stroke_grid_from_params, query_stroke_grid
+from source.strokelib import cull_spheres_to_rays
 from source import textures
 
 
@@ -33,6 +37,115 @@ def _warp_coords(warp_fn, coords, bbox_size=2.0, no_warp=False):
     return coords
 
 
+def _interp_voxel_grid(values, grid_min, grid_max, coords, fill_value):
+    """Trilinearly interpolate a voxel grid of shape [R, R, R, C] at coords of shape [..., 3].
+
+    Coords outside [grid_min, grid_max] get fill_value of shape [C]. The interpolation is written
+    with gathers so that it stays differentiable w.r.t. the coords to any order.
+    """
+    res = values.shape[0]
+    u = (coords - grid_min) / (grid_max - grid_min) * (res - 1)
+    inside = ((u >= 0) & (u <= res - 1)).all(-1)
+    u = u.clamp(0, res - 1)
+    u0 = u.detach().floor().clamp(max=res - 2).long()
+    w1 = u - u0
+    w0 = 1 - w1
+    flat_values = values.reshape(-1, values.shape[-1])
+    result = 0
+    for dx in (0, 1):
+        for dy in (0, 1):
+            for dz in (0, 1):
+                index = ((u0[..., 0] + dx) * res + u0[..., 1] + dy) * res + u0[..., 2] + dz
+                weight = (w1[..., 0] if dx else w0[..., 0]) * (w1[..., 1] if dy else w0[..., 1]) * \
+                    (w1[..., 2] if dz else w0[..., 2])
+                result = result + weight[..., None] * flat_values[index]
+    return torch.where(inside[..., None], result, fill_value)
+
+
+def _scatter_rays(parts, num_rays, fill=None, num_samples=None):
+    """Scatter the per ray values of subsets of the rays back into the order of the whole batch.
+
+    Args:
+        parts: list of (ray_indices, values), the indices of disjoint subsets of the rays and dicts
+            of their per ray tensors, all with the same keys.
+        num_rays: the number of rays of the whole batch.
+        fill: optional dict of per ray tensors of the whole batch, the values of the rays in no
+            subset. Rays in no subset are zero if it is None or lacks a key.
+        num_samples: optional, the number of samples to pad the per sample tensors of ray histories
+            to, with empty intervals at the last distance for 'sdist' and with zeros otherwise.
+    """
+    result = {}
+    for k, v in parts[0][1].items():
+        if not torch.is_tensor(v) or k == 'hash_levelwise_mean':
+            result[k] = v  # Not a per ray value.
+            continue
+        values = [p[1][k] for p in parts]
+        if num_samples is not None and v.dim() > 1:
+            size = num_samples + 1 if k == 'sdist' else num_samples
+            values = [
+                torch.cat([value, (value[:, -1:] if k == 'sdist' else torch.zeros_like(value[:, :1])).expand(
+                    (-1, size - value.shape[1]) + value.shape[2:])], dim=1) if value.shape[1] < size else value
+                for value in values
+            ]
+        shape = (num_rays, ) + values[0].shape[1:]
+        if fill is not None and k in fill and fill[k].shape == shape:
+            result[k] = fill[k].to(v.dtype, copy=True)
+        else:
+            result[k] = v.new_zeros(shape)
+        for (ray_indices, _), value in zip(parts, values):
+            result[k][ray_indices] = value
+    return result
+
+
+def _close_pairs(x, max_distance, chunk_size=4096):
+    """Find all pairs of rows of x whose largest coordinate difference is at most max_distance.
+
+    Rows are bucketed into a grid of cell size max_distance over the three coordinates with the
+    largest spread, so that only rows in the same or neighboring cells are compared.
+
+    Args:
+        x: [N, D], the points.
+        max_distance: float, the largest difference of close points in every coordinate.
+        chunk_size: the number of points whose candidates are compared at a time.
+
+    Returns:
+        neighbors: list of the indices of the close points of each point, excluding itself,
+            grouped by point in ascending order.
+        offsets: list of N + 1 offsets of the close points of each point into neighbors.
+    """
+    num_points = x.shape[0]
+    if num_points == 0:
+        return [], [0]
+    key_dims = torch.argsort(x.std(dim=0).nan_to_num(0.0), descending=True)[:3]
+    cells = torch.floor((x[:, key_dims] - x[:, key_dims].min(dim=0).values) / max(max_distance, 1e-12)).long() + 1
+    # Hash the cells with room for the neighbors on both sides.
+    extent = cells.max(dim=0).values + 2
+    strides = [int(torch.prod(extent[i + 1:]).item()) for i in range(len(key_dims))]
+    hash_fn = lambda c: sum(c[:, i] * strides[i] for i in range(len(key_dims)))
+    order = torch.argsort(hash_fn(cells))
+    sorted_hashes = hash_fn(cells)[order]
+
+    pairs = []
+    for offset in itertools.product([-1, 0, 1], repeat=len(key_dims)):
+        neighbor_hashes = hash_fn(cells + torch.tensor(offset, dtype=torch.long))
+        start = torch.searchsorted(sorted_hashes, neighbor_hashes)
+        count = torch.searchsorted(sorted_hashes, neighbor_hashes, right=True) - start
+        for p in range(0, num_points, chunk_size):
+            block_start, block_count = start[p:p + chunk_size], count[p:p + chunk_size]
+            i = torch.repeat_interleave(torch.arange(p, p + block_count.shape[0]), block_count)
+            # The candidates of each point are the consecutive sorted points of its neighbor cell.
+            first = torch.repeat_interleave(block_start - torch.cumsum(block_count, 0) + block_count, block_count)
+            j = order[first + torch.arange(i.shape[0])]
+            close = ((x[i] - x[j]).abs().max(dim=-1).values <= max_distance) & (i != j)
+            pairs.append(torch.stack([i[close], j[close]], dim=-1))
+
+    pairs = torch.cat(pairs) if pairs else torch.zeros(0, 2, dtype=torch.long)
+    pairs = pairs[torch.argsort(pairs[:, 0] * num_points + pairs[:, 1])]
+    counts = torch.bincount(pairs[:, 0], minlength=num_points)
+    offsets = torch.cat([torch.zeros(1, dtype=torch.long), torch.cumsum(counts, dim=0)])
+    return pairs[:, 1].tolist(), offsets.tolist()
+
+
 def _unwarp_coords(warp_fn, coords, bbox_size=2.0, no_warp=False):
     if no_warp:
         pass
@@ -49,6 +162,34 @@ def _unwarp_coords(warp_fn, coords, bbox_size=2.0, no_warp=False):
     return coords
 
 
+def _unwarp_bounding_spheres(warp_fn, center, radius, bbox_size=2.0):
+    """Conservative unwarped bounding spheres of spheres in the warped [-1, 1] space."""
+    if warp_fn is None:
+        bound = bbox_size / 2
+        return center * bound, radius * bound
+    elif warp_fn == 'contract':
+        center, radius = center * 2.0, radius * 2.0  # [-1, 1] to contracted [-2, 2]
+        # Contraction keeps the direction of points and is monotonic in their norm, so the sphere
+        # unwarps into a spherical sector between the inverse contracted norms.
+        inv_contract_norm = lambda s: torch.where(s <= 1, s, 1 / (2 - s).clamp_min(0))
+        dist = torch.linalg.norm(center, dim=-1)
+        norm_min = inv_contract_norm((dist - radius).clamp_min(0))
+        norm_max = inv_contract_norm(dist + radius)
+        cos_angle = torch.where(radius < dist, (1 - (radius / dist.clamp_min(1e-12))**2).clamp_min(0).sqrt(), -1)
+        offset = cos_angle.clamp_min(0) * (norm_min + norm_max) / 2
+        sector_radius = torch.maximum((norm_min**2 + offset**2 - 2 * norm_min * offset * cos_angle).sqrt(),
+                                      (norm_max**2 + offset**2 - 2 * norm_max * offset * cos_angle).sqrt())
+        sector_center = torch.nn.functional.normalize(center, dim=-1) * offset[..., None]
+        sector_radius = sector_radius.nan_to_num(torch.inf)
+        sector_center = torch.where(torch.isinf(sector_radius)[..., None], 0, sector_center)
+        inside = dist + radius <= 1  # Contraction is the identity inside the unit ball
+        center = torch.where(inside[..., None], center, sector_center)
+        radius = torch.where(inside, radius, sector_radius)
+        return center, radius
+    else:
+        raise NotImplementedError(f'Unknown warp function {warp_fn}')
+
+
 @gin.configurable
 class Model(nn.Module):
     """A mip-Nerf360 model containing all MLPs."""
@@ -73,6 +214,18 @@ class Model(nn.Module):
     prop_desired_grid_size = [512, 2048]  # The desired grid size for each proposal level.
     error_field_grid_size: int = 256  # The resolution of the error fields.
     use_directional_error_field: bool = False  # If True, error field has error value (rgb).
+    error_field_type: str = 'mlp'  # 'mlp' trains the hash-grid ErrorMLP, 'grid' accumulates residuals in a voxel grid.
+    use_occupancy_grid: bool = False  # If True, only sample the rays where they overlap the stroke bounds in eval.
+    use_fused_rendering: bool = False  # If True, compute the weights, rgb, acc and depth of a level in one op.
+    early_termination: bool = False  # If True, drop transparent rays between levels and sample saturated ones less in eval.
+    termination_acc_eps: float = 1e-3  # Rays with a lower proposal opacity are dropped and render as background.
+    saturation_acc: float = 0.99  # Rays with a higher proposal opacity ...
+    saturation_span: float = 0.02  # ... and 98% of it within this normalized distance are saturated.
+    saturated_sample_frac: float = 0.25  # The fraction of the final samples of the saturated rays.
+    adaptive_sampling: bool = False  # If True, spread the final samples over the rays by their proposal weights in eval.
+    adaptive_min_samples: int = 4  # The fewest final samples of a ray with adaptive sampling.
+    adaptive_max_mult: float = 4.0  # The most final samples of a ray, relative to num_nerf_samples.
+    adaptive_num_buckets: int = 8  # The number of sample counts, rays with the same count are rendered together.
 
     def __init__(self, config=None, **kwargs):
         super().__init__()
@@ -83,8 +236,12 @@ class Model(nn.Module):
         # Construct MLPs. WARNING: Construction order may matter, if MLP weights are
         # being regularized.
         self.nerf = StrokeField(config) if self.use_stroke_field else NerfMLP()
-        self.error_field = ErrorMLP(grid_disired_resolution=self.error_field_grid_size,
-                                    disable_rgb=not self.use_directional_error_field)
+        if self.error_field_type == 'grid':
+            assert not self.use_directional_error_field, 'The residual error grid is not directional'
+            self.error_field = ResidualErrorGrid(warp_fn=self.nerf.warp_fn, bbox_size=self.nerf.bbox_size)
+        else:
+            self.error_field = ErrorMLP(grid_disired_resolution=self.error_field_grid_size,
+                                        disable_rgb=not self.use_directional_error_field)
         if self.single_mlp:
             self.prop = self.nerf
         elif self.single_prop:
@@ -94,12 +251,70 @@ class Model(nn.Module):
                 self.register_module(
                     f'prop_mlp_{i}',
                     PropMLP(grid_disired_resolution=self.prop_desired_grid_size[i]))
+        if self.use_occupancy_grid:
+            assert self.use_stroke_field, 'The occupancy grid is built from the stroke bounds'
+            self.occupancy_grid = OccupancyGrid(warp_fn=self.nerf.warp_fn, bbox_size=self.nerf.bbox_size)
         self.train_frac = 1.0
 
     def step_update(self, cur_step, max_step, *args, **kwargs):
         self.train_frac = cur_step / max_step
         if hasattr(self.nerf, 'step_update'):
             self.nerf.step_update(cur_step, max_step, *args, **kwargs, error_field=self.error_field)
+        if self.use_occupancy_grid:
+            # Strokes move or reset every step, rebuild their bounds at the next eval.
+            self.occupancy_grid.occupancy_key = None
+
+    @torch.no_grad()
+    def update_occupancy_grid(self, batch):
+        """Rebuild the occupancy grid if the strokes or the sample radius changed since the last build."""
+        stroke_field = self.nerf
+        stroke_step = stroke_field.stroke_step.item()
+        if stroke_field.stroke_step_limit is not None:
+            stroke_step = min(stroke_step, stroke_field.stroke_step_limit)
+        sdf_delta = stroke_field.current_sdf_delta(stroke_step)
+        # Sample radii grow linearly along the rays, see render.cast_rays.
+        radius_max = (batch['radii'] * batch['far']).max().item()
+        key = (stroke_step, sdf_delta)
+        grid_key = self.occupancy_grid.occupancy_key
+        if grid_key is None or grid_key[0] != key or grid_key[1] < radius_max:
+            # Leave some margin on the radius for eval, as for the stroke index.
+            band_radius = radius_max if self.training else radius_max * 1.5
+            aabb_min, aabb_max = get_stroke_bounds(stroke_field.shape_type, stroke_field.shape_params[:stroke_step],
+                                                   sdf_delta, band_radius, stroke_field.use_laplace_transform,
+                                                   stroke_field.inv_scale_radius, stroke_field.stroke_index_alpha_eps)
+            self.occupancy_grid.update(aabb_min, aabb_max)
+            self.occupancy_grid.occupancy_key = (key, band_radius)
+
+    @torch.no_grad()
+    def bake_proposals(self, resolution):
+        """Bake the proposal networks into density grids, which replace them in eval mode."""
+        for module in self.modules():
+            if isinstance(module, PropMLP):
+                module.bake_density(resolution)
+
+    @torch.no_grad()
+    def update_error_field(self, batch, renderings, ray_history):
+        """Accumulate the photometric residuals of a training batch into the residual error grid."""
+        if self.error_field_type != 'grid':
+            return
+        residual = torch.square(renderings[-1]['rgb'] - batch['rgb'][..., :3]).sum(-1).clamp(0.0, 1.0)
+        # The strokes explain the part of the residual covered by their opacity, spread along their weights.
+        final = ray_history[-1]
+        splats = [(final['coord'], final['weights'] * residual[..., None], True)]
+        # The rest, e.g. of rays through missing geometry, is spread along the first level, whose
+        # proposal weights cover the whole ray, or evenly along the final samples without proposals.
+        unexplained = residual * (1 - renderings[-1]['acc'].clamp(0.0, 1.0))
+        if len(ray_history) > 1:
+            first = ray_history[0]
+            mlp = self.prop if self.single_mlp or self.single_prop else self.prop_mlp_0
+            acc = first['weights'].sum(dim=-1, keepdim=True)
+            spread = torch.where(acc > 0, first['weights'] / acc.clamp_min(1e-12), 1 / first['weights'].shape[-1])
+            coords = _unwarp_coords(mlp.warp_fn, first['coord'], mlp.bbox_size)
+            splats.append((coords, spread * unexplained[..., None], False))
+        else:
+            num_samples = final['weights'].shape[-1]
+            splats.append((final['coord'], (unexplained[..., None] / num_samples).expand_as(final['weights']), True))
+        self.error_field.accumulate(splats)
 
     def forward(self, batch, compute_extras):
         """The mip-NeRF Model.
@@ -112,9 +327,6 @@ class Model(nn.Module):
             renderings: list of rendering result of each layer, [*(rgb, distance, acc)]
             ray_history: list of ray history of each layer
         """
-        device = batch['origins'].device
-        rand = self.training  # Random for training, and deterministic for eval
-
         # Define the mapping from normalized to metric ray distance.
         _, s_to_t = coord.construct_ray_warps(self.raydist_fn, batch['near'], batch['far'],
                                               self.power_transform_lambda)
@@ -128,11 +340,27 @@ class Model(nn.Module):
             torch.full_like(batch['far'], init_s_far)
         ], -1)
         weights = torch.ones_like(batch['near'])
+        occupied_frac = 1.0
+        if self.use_occupancy_grid and not self.training:
+            # Start from the occupied steps of each ray instead of the whole ray. Training keeps the whole
+            # rays, so that the proposal and error fields still see the empty space new strokes go to.
+            self.update_occupancy_grid(batch)
+            sdist, weights, occupied_frac = self.occupancy_grid.ray_intervals(batch['origins'], batch['directions'],
+                                                                              s_to_t)
         prod_num_samples = 1
 
+        # In eval, the flat ray chunks of render_image can be compacted between the levels. Chunks without
+        # rays are rendered as is, compaction always keeps at least one ray in every level.
+        num_rays = batch['near'].shape[0]
+        compact = (self.early_termination or self.adaptive_sampling) and not self.training and \
+            batch['near'].dim() == 2 and num_rays > 0
+        full_batch, full_s_to_t = batch, s_to_t
+        ray_indices = torch.arange(num_rays, device=batch['near'].device)  # The rays still being rendered.
+
         ray_history = []
         renderings = []
         error = None
+        empty_rendering = None
         for i_level in range(self.num_levels):
             is_prop = i_level < (self.num_levels - 1)
             if is_prop and self.num_prop_samples == 0:
@@ -152,100 +380,39 @@ class Model(nn.Module):
             # Record the product of the number of samples seen so far.
             prod_num_samples *= num_samples
 
-            # After the first level (where dilation would be a no-op) optionally
-            # dilate the interval weights along each ray slightly so that they're
-            # overestimates, which can reduce aliasing.
-            use_dilation = self.dilation_bias > 0 or self.dilation_multiplier > 0
-            if i_level > 0 and use_dilation:
-                sdist, weights = stepfun.max_dilate_weights(sdist,
-                                                            weights,
-                                                            dilation,
-                                                            domain=(init_s_near, init_s_far),
-                                                            renormalize=True)
-                sdist = sdist[..., 1:-1]
-                weights = weights[..., 1:-1]
-
-            # A slightly more stable way to compute weights. If the distance
-            # between adjacent intervals is zero then its weight is fixed to 0.
-            logits_resample = torch.where(sdist[..., 1:] > sdist[..., :-1],
-                                          torch.log(weights + self.resample_padding),
-                                          torch.full_like(sdist[..., :-1], -torch.inf))
-
-            # Draw sampled intervals from each ray's current weights.
-            sdist = stepfun.sample_intervals(rand,
-                                             sdist,
-                                             logits_resample,
-                                             num_samples,
-                                             single_jitter=self.single_jitter,
-                                             domain=(init_s_near, init_s_far))
-
-            # Optimization will usually go nonlinear if you propagate gradients
-            # through sampling.
-            if self.stop_level_grad:
-                sdist = sdist.detach()
-
-            # Convert normalized distances to metric distances.
-            tdist = s_to_t(sdist)
-
-            # Cast our rays, by turning our distance intervals into Gaussians.
-            coords, radius, ts = render.cast_rays(tdist, batch['origins'], batch['directions'], batch['radii'])
-
-            # Push our Gaussians through one of our two MLPs.
-            mlp = (self.prop if self.single_prop else
-                   self.get_submodule(f'prop_mlp_{i_level}')) if is_prop else self.nerf
-            ray_results = mlp(
-                coords,
-                radius,
-                viewdirs=batch['viewdirs'] if self.use_viewdirs else None,
-            )
-            if self.config.gradient_scaling:
-                ray_results['rgb'], ray_results['density'] = train_utils.GradientScaler.apply(
-                    ray_results['rgb'], ray_results['density'], ts.mean(dim=-1))
-
-            # Get the alpha compositing weights used by volumetric rendering (and losses).
-            weights = render.compute_alpha_weights(
-                ray_results['density'],
-                tdist,
-                batch['directions'],
-                opaque_background=self.opaque_background,
-            )[0]
-
-            # Define or sample the background color for each ray.
-            if not rand or self.bg_intensity_range[0] == self.bg_intensity_range[1]:
-                # If rendering is deterministic, use the endpoint of the range.
-                bg_rgbs = self.bg_intensity_range[1]
+            # The first level only samples the occupied part of the rays, at the same density of samples.
+            level_num_samples = max(int(math.ceil(num_samples * occupied_frac)), 2)
+            occupied_frac = 1.0
+
+            if compact and not is_prop and self.num_prop_samples > 0 and self.adaptive_sampling:
+                # Spread the final samples over the rays, the same total as num_samples for every ray.
+                groups = self._adaptive_sample_groups(weights, level_num_samples)
+            elif compact and not is_prop and self.num_prop_samples > 0:
+                # Rays saturated in a tiny interval by the proposal weights need fewer final samples.
+                saturated = self._saturated_rays(sdist, weights)
+                groups = [(~saturated, level_num_samples),
+                          (saturated, max(int(math.ceil(level_num_samples * self.saturated_sample_frac)), 2))]
             else:
-                # Sample RGB values from the range for each ray.
-                minval = self.bg_intensity_range[0]
-                maxval = self.bg_intensity_range[1]
-                bg_rand_t = torch.rand(weights.shape[:-1] + (3, ), device=device)
-                bg_rgbs = bg_rand_t * (maxval - minval) + minval
-
-            # Render each ray.
-            rendering = render.volumetric_rendering(ray_results['rgb'],
-                                                    weights,
-                                                    tdist,
-                                                    bg_rgbs,
-                                                    batch['far'],
-                                                    compute_extras,
-                                                    extras={
-                                                        k: v
-                                                        for k, v in ray_results.items()
-                                                        if k.startswith('normals')
-                                                    })
-
-            if compute_extras:
-                # Collect some rays to visualize directly. By naming these quantities
-                # with `ray_` they get treated differently downstream --- they're
-                # treated as bags of rays, rather than image chunks.
-                n = self.config.vis_num_rays
-                rendering['ray_sdist'] = sdist.reshape([-1, sdist.shape[-1]])[:n, :]
-                rendering['ray_weights'] = (weights.reshape([-1, weights.shape[-1]])[:n, :])
-                rgb = ray_results['rgb']
-                rendering['ray_rgbs'] = (rgb.reshape((-1, ) + rgb.shape[-2:]))[:n, :, :]
+                groups = [(None, level_num_samples)]
+
+            level_parts = []
+            for group, group_num_samples in groups:
+                if group is not None and not group.any():
+                    continue
+                select = (lambda v: v) if group is None else (lambda v, g=group: v[g])
+                group_batch = tree_map(select, batch)
+                group_s_to_t = s_to_t if group is None else coord.construct_ray_warps(
+                    self.raydist_fn, group_batch['near'], group_batch['far'], self.power_transform_lambda)[1]
+                group_sdist, tdist, coords, radius, group_weights, ray_results, rendering = self._render_level(
+                    i_level, group_batch, select(sdist), select(weights), group_num_samples, dilation, group_s_to_t,
+                    compute_extras)
+                level_parts.append((select(ray_indices), group_sdist, group_weights, ray_results, rendering))
 
             # Compute errors for the first level sampling.
-            if i_level == 0 or self.num_prop_samples == 0:
+            if (i_level == 0 or self.num_prop_samples == 0) and self.error_field_type == 'grid':
+                # The residual grid is only looked up, it is not trained by a loss.
+                error = (group_weights * self.error_field.sample_error(coords)).sum(dim=-1).unsqueeze(-1)
+            elif i_level == 0 or self.num_prop_samples == 0:
                 error_field_results = self.error_field(coords, radius)
                 error_weights = render.compute_alpha_weights(
                     error_field_results['density'],
@@ -258,17 +425,52 @@ class Model(nn.Module):
                     error = (error_weights[..., None] * error_values).sum(dim=-2)
                 else:
                     error = error_weights.sum(dim=-1).unsqueeze(-1)
-            if not is_prop:
-                rendering['error'] = error
-                ray_results['error_density'] = error_field_results['density']
-                ray_results['error_rgb'] = error_field_results['rgb']
 
+            for _, part_sdist, part_weights, ray_results, _ in level_parts:
+                ray_results['sdist'] = part_sdist.clone()
+                ray_results['weights'] = part_weights.clone()
+            if len(groups) == 1 and level_parts[0][0].shape[0] == num_rays:
+                ray_indices, sdist, weights, ray_results, rendering = level_parts[0]
+            else:
+                # Scatter the results of the rendered rays back into the order of the batch.
+                if empty_rendering is None:
+                    empty_rendering = self._render_empty_rays(full_batch, full_s_to_t, compute_extras)
+                rendering = _scatter_rays([(p[0], p[4]) for p in level_parts], num_rays, empty_rendering)
+                # Pad to the same number of samples for every chunk, even if no ray got the most samples.
+                ray_results = _scatter_rays([(p[0], p[3]) for p in level_parts],
+                                            num_rays,
+                                            num_samples=max(n for _, n in groups))
+                ray_indices, sdist, weights = level_parts[0][:3]  # Only the final level is split into groups.
             renderings.append(rendering)
-            ray_results['sdist'] = sdist.clone()
-            ray_results['weights'] = weights.clone()
             ray_history.append(ray_results)
 
+            if compact and is_prop and self.early_termination:
+                # Drop the rays that are transparent under the proposal weights, they render as background.
+                keep = weights.sum(dim=-1) >= self.termination_acc_eps
+                # Keep at least one ray so that every level still has something to render.
+                keep[weights.sum(dim=-1).argmax()] = True
+                if not keep.all():
+                    ray_indices, sdist, weights = ray_indices[keep], sdist[keep], weights[keep]
+                    batch = tree_map(lambda v: v[keep], batch)
+                    _, s_to_t = coord.construct_ray_warps(self.raydist_fn, batch['near'], batch['far'],
+                                                          self.power_transform_lambda)
+
+        renderings[-1]['error'] = error
+        if self.error_field_type == 'mlp':
+            ray_history[-1]['error_density'] = error_field_results['density']
+            ray_history[-1]['error_rgb'] = error_field_results['rgb']
+
         if compute_extras:
+            # Collect some rays to visualize directly. By naming these quantities
+            # with `ray_` they get treated differently downstream --- they're
+            # treated as bags of rays, rather than image chunks.
+            n = self.config.vis_num_rays
+            for rendering, ray_results in zip(renderings, ray_history):
+                sdist, weights, rgb = ray_results['sdist'], ray_results['weights'], ray_results['rgb']
+                rendering['ray_sdist'] = sdist.reshape([-1, sdist.shape[-1]])[:n, :]
+                rendering['ray_weights'] = (weights.reshape([-1, weights.shape[-1]])[:n, :])
+                rendering['ray_rgbs'] = (rgb.reshape((-1, ) + rgb.shape[-2:]))[:n, :, :]
+
             # Because the proposal network doesn't produce meaningful colors, for
             # easier visualization we replace their colors with the final average
             # color.
@@ -281,6 +483,160 @@ class Model(nn.Module):
 
         return renderings, ray_history
 
+    def _render_level(self, i_level, batch, sdist, weights, num_samples, dilation, s_to_t, compute_extras):
+        """Resample the intervals of a level from the current weights and render them with its MLP."""
+        rand = self.training  # Random for training, and deterministic for eval
+        init_s_near, init_s_far = 0., 1.
+
+        # After the first level (where dilation would be a no-op) optionally
+        # dilate the interval weights along each ray slightly so that they're
+        # overestimates, which can reduce aliasing.
+        use_dilation = self.dilation_bias > 0 or self.dilation_multiplier > 0
+        if i_level > 0 and use_dilation:
+            sdist, weights = stepfun.max_dilate_weights(sdist,
+                                                        weights,
+                                                        dilation,
+                                                        domain=(init_s_near, init_s_far),
+                                                        renormalize=True)
+            sdist = sdist[..., 1:-1]
+            weights = weights[..., 1:-1]
+
+        # A slightly more stable way to compute weights. If the distance
+        # between adjacent intervals is zero then its weight is fixed to 0.
+        logits_resample = torch.where(sdist[..., 1:] > sdist[..., :-1],
+                                      torch.log(weights + self.resample_padding),
+                                      torch.full_like(sdist[..., :-1], -torch.inf))
+
+        # Draw sampled intervals from each ray's current weights.
+        sdist = stepfun.sample_intervals(rand,
+                                         sdist,
+                                         logits_resample,
+                                         num_samples,
+                                         single_jitter=self.single_jitter,
+                                         domain=(init_s_near, init_s_far))
+
+        # Optimization will usually go nonlinear if you propagate gradients
+        # through sampling.
+        if self.stop_level_grad:
+            sdist = sdist.detach()
+
+        # Convert normalized distances to metric distances.
+        tdist = s_to_t(sdist)
+
+        # Cast our rays, by turning our distance intervals into Gaussians.
+        coords, radius, ts = render.cast_rays(tdist, batch['origins'], batch['directions'], batch['radii'])
+
+        # Push our Gaussians through one of our two MLPs.
+        is_prop = i_level < (self.num_levels - 1)
+        mlp = (self.prop if self.single_prop else
+               self.get_submodule(f'prop_mlp_{i_level}')) if is_prop else self.nerf
+        ray_results = mlp(
+            coords,
+            radius,
+            viewdirs=batch['viewdirs'] if self.use_viewdirs else None,
+        )
+        if self.config.gradient_scaling:
+            ray_results['rgb'], ray_results['density'] = train_utils.GradientScaler.apply(
+                ray_results['rgb'], ray_results['density'], ts.mean(dim=-1))
+
+        # Define or sample the background color for each ray.
+        if not rand or self.bg_intensity_range[0] == self.bg_intensity_range[1]:
+            # If rendering is deterministic, use the endpoint of the range.
+            bg_rgbs = self.bg_intensity_range[1]
+        else:
+            # Sample RGB values from the range for each ray.
+            minval = self.bg_intensity_range[0]
+            maxval = self.bg_intensity_range[1]
+            bg_rand_t = torch.rand(tdist.shape[:-1] + (3, ), device=tdist.device)
+            bg_rgbs = bg_rand_t * (maxval - minval) + minval
+
+        extras = {k: v for k, v in ray_results.items() if k.startswith('normals')}
+        if self.use_fused_rendering and not tdist.requires_grad:
+            # Compute the weights and render each ray in one pass, the distances get no gradients.
+            weights, rendering = render.fused_volumetric_rendering(ray_results['density'],
+                                                                   ray_results['rgb'],
+                                                                   tdist,
+                                                                   batch['directions'],
+                                                                   bg_rgbs,
+                                                                   batch['far'],
+                                                                   compute_extras,
+                                                                   opaque_background=self.opaque_background,
+                                                                   extras=extras)
+        else:
+            # Get the alpha compositing weights used by volumetric rendering (and losses).
+            weights = render.compute_alpha_weights(
+                ray_results['density'],
+                tdist,
+                batch['directions'],
+                opaque_background=self.opaque_background,
+            )[0]
+
+            # Render each ray.
+            rendering = render.volumetric_rendering(ray_results['rgb'],
+                                                    weights,
+                                                    tdist,
+                                                    bg_rgbs,
+                                                    batch['far'],
+                                                    compute_extras,
+                                                    extras=extras)
+        return sdist, tdist, coords, radius, weights, ray_results, rendering
+
+    def _saturated_rays(self, sdist, weights):
+        """Rays whose weights are nearly opaque and concentrated in a tiny normalized distance interval."""
+        acc = weights.sum(dim=-1)
+        span = stepfun.weighted_percentile(sdist, weights / acc.clamp_min(1e-12)[..., None], [1, 99]).diff(dim=-1)
+        return (acc >= self.saturation_acc) & (span[..., 0] <= self.saturation_span)
+
+    def _adaptive_sample_groups(self, weights, num_samples):
+        """Split the rays into groups with the same number of final samples, from their proposal weights.
+
+        A ray needs samples in proportion to its proposal opacity times the perplexity (the effective
+        number of intervals) of its normalized proposal weights. Transparent rays and rays with a single
+        sharp surface get few samples, rays through several surfaces or semi-transparent volumes get many.
+        Every ray gets adaptive_min_samples, and the rest of a budget of num_samples per ray is shared by
+        need. The counts are rounded down to a few geometrically spaced sizes so that each group renders
+        as a dense batch, and the samples lost by rounding promote the rays that lost most to the next size.
+
+        Returns:
+            groups: list of (mask, num_samples) of every size, the masks may be empty.
+        """
+        num_rays = weights.shape[0]
+        min_samples = min(self.adaptive_min_samples, num_samples)
+        max_samples = max(int(math.ceil(num_samples * self.adaptive_max_mult)), num_samples)
+        num_buckets = max(self.adaptive_num_buckets, 1)
+        sizes = sorted({
+            int(round(min_samples * (max_samples / min_samples)**(i / max(num_buckets - 1, 1))))
+            for i in range(num_buckets)
+        })
+        sizes_t = torch.tensor(sizes, dtype=weights.dtype, device=weights.device)
+
+        acc = weights.sum(dim=-1)
+        p = weights / acc.clamp_min(1e-12)[..., None]
+        perplexity = torch.exp(-(p * torch.log(p.clamp_min(1e-12))).sum(dim=-1))
+        need = acc * perplexity
+        budget = num_samples * num_rays
+        counts = min_samples + (budget - min_samples * num_rays) * need / need.sum().clamp_min(1e-12)
+        counts = counts.clamp(max=max_samples)
+        bucket = (torch.searchsorted(sizes_t, counts, right=True) - 1).clamp_min(0)
+
+        # Spend the samples lost by rounding down on the rays that lost the largest fraction of a step.
+        leftover = budget - sizes_t[bucket].sum()
+        promotable = bucket < len(sizes) - 1
+        cost = sizes_t[(bucket + 1).clamp(max=len(sizes) - 1)] - sizes_t[bucket]
+        shortfall = torch.where(promotable, (counts - sizes_t[bucket]) / cost.clamp_min(1), -torch.inf)
+        order = torch.argsort(shortfall, descending=True)
+        promote = promotable[order] & (torch.cumsum(cost[order] * promotable[order], dim=0) <= leftover)
+        bucket[order[promote]] += 1
+        return [(bucket == i, size) for i, size in enumerate(sizes)]
+
+    def _render_empty_rays(self, batch, s_to_t, compute_extras):
+        """The renderings of rays without any weight, for the rays dropped by early termination."""
+        weights = torch.zeros_like(batch['near'])
+        tdist = s_to_t(torch.cat([torch.zeros_like(batch['near']), torch.ones_like(batch['far'])], -1))
+        rgbs = torch.zeros_like(batch['origins'])[..., None, :]
+        return render.volumetric_rendering(rgbs, weights, tdist, self.bg_intensity_range[1], batch['far'],
+                                           compute_extras)
+
 
 @gin.configurable
 class MLP(nn.Module):
@@ -502,6 +858,51 @@ class NerfMLP(MLP):
 class PropMLP(MLP):
     disable_rgb: bool = True  # If True don't output RGB.
     grid_level_dim: int = 1
+    bake_chunk: int = 65536  # The number of grid vertices to bake at once.
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Densities baked at the vertices of a grid over the warped space, empty if not baked.
+        self.register_buffer('baked_density', torch.zeros(0, 0, 0, 1))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved before baking load without the grid, baked ones with their grid resolution
+        key = prefix + 'baked_density'
+        state_dict.setdefault(key, self.baked_density.clone())
+        self.baked_density = self.baked_density.new_empty(state_dict[key].shape)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    @torch.no_grad()
+    def bake_density(self, resolution):
+        """Bake the densities of the network into a grid, which replaces the network for inference.
+
+        The baked densities are dilated by one vertex, so that the grid rather overestimates the
+        densities between the vertices, as the proposal weights should bound the weights of the nerf.
+        """
+        axis = torch.linspace(-1, 1, resolution, device=self.density_layer[0].weight.device)
+        vertices = torch.stack(torch.meshgrid(axis, axis, axis, indexing='ij'), dim=-1).reshape(-1, 3)
+        densities = []
+        for x in torch.split(vertices, self.bake_chunk):
+            raw_density = self.predict_density(x, no_warp=True)[0]
+            densities.append(F.softplus(raw_density.float() + self.density_bias))
+        density = torch.cat(densities).reshape(1, 1, resolution, resolution, resolution)
+        density = F.max_pool3d(density, 3, stride=1, padding=1)
+        self.baked_density = density.reshape(resolution, resolution, resolution, 1)
+
+    def forward(self, coords, radius, viewdirs=None, no_warp=False):
+        if self.training or self.baked_density.numel() == 0:
+            return super().forward(coords, radius, viewdirs, no_warp)
+        # Look up the baked densities instead of evaluating the network.
+        coords_warped = _warp_coords(self.warp_fn, coords, self.bbox_size, no_warp)
+        grid_min = torch.full((3, ), -1.0, device=coords.device)
+        grid_max = torch.full((3, ), 1.0, device=coords.device)
+        fill_value = torch.zeros(1, device=coords.device)
+        density = _interp_voxel_grid(self.baked_density, grid_min, grid_max, coords_warped, fill_value)[..., 0]
+        return dict(coord=coords_warped,
+                    density=density,
+                    rgb=torch.zeros(density.shape + (3, ), device=density.device),
+                    normals=None,
+                    hash_levelwise_mean=None)
 
 
 @gin.configurable
@@ -523,6 +924,131 @@ class ErrorMLP(MLP):
         return density * rgb.squeeze(-1)
 
 
+@gin.configurable
+class ResidualErrorGrid(nn.Module):
+    """A voxel grid of the photometric residuals of training rays, splatted along their samples.
+
+    It has the same sample_error API as ErrorMLP, but is updated by accumulation with exponential
+    decay instead of being trained, which needs no network evaluation or loss in each step.
+    """
+    resolution: int = 64  # The resolution of the grid.
+    decay: float = 0.99  # The decay of the accumulated residuals at every update.
+    bbox_size: float = 4.  # The side length of the bounding box if warp is not used.
+    warp_fn = None  # The warp function used to warp the input coordinates.
+
+    def __init__(self, **kwargs):
+        super().__init__()
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+        self.register_buffer('error_grid', torch.zeros(self.resolution, self.resolution, self.resolution, 1))
+
+    @torch.no_grad()
+    def accumulate(self, splats):
+        """Decay the grid and add the residuals of the rays at their samples.
+
+        Args:
+            splats: list of (coords, values, no_warp), sample coordinates of shape [..., num_samples, 3],
+                the residual to add at each sample of shape [..., num_samples], and whether the
+                coordinates are already warped.
+        """
+        res = self.resolution
+        self.error_grid.mul_(self.decay)
+        for coords, values, no_warp in splats:
+            coords = _warp_coords(self.warp_fn, coords, self.bbox_size, no_warp)
+            # Splat to the nearest grid vertex, vertices span [-1, 1] as in _interp_voxel_grid.
+            vertex = torch.round((coords.reshape(-1, 3) + 1) / 2 * (res - 1)).long()
+            inside = ((vertex >= 0) & (vertex < res)).all(-1)
+            vertex_ids = (vertex[:, 0] * res + vertex[:, 1]) * res + vertex[:, 2]
+            values = values.reshape(-1).float()
+            self.error_grid.view(-1).index_add_(0, vertex_ids[inside], values[inside])
+
+    def sample_error(self, coords, no_warp=False):
+        coords = _warp_coords(self.warp_fn, coords, self.bbox_size, no_warp)
+        grid_min = torch.full((3, ), -1.0, device=coords.device)
+        grid_max = torch.full((3, ), 1.0, device=coords.device)
+        fill_value = torch.zeros(1, device=coords.device)
+        return _interp_voxel_grid(self.error_grid, grid_min, grid_max, coords, fill_value)[..., 0]
+
+
+@gin.configurable
+class OccupancyGrid(nn.Module):
+    """A binary grid of the cells overlapping the stroke bounds, which skips empty space along the rays.
+
+    The grid is dilated by one cell and marching marks the neighbors of occupied steps, so the occupied
+    steps of a ray cover all its samples where strokes are non-zero, up to strokes much smaller than a step.
+    """
+    resolution: int = 128  # The resolution of the grid.
+    num_march_steps: int = 256  # The number of steps to march the rays through the grid.
+    bbox_size: float = 4.  # The side length of the bounding box if warp is not used.
+    warp_fn = None  # The warp function used to warp the input coordinates.
+
+    def __init__(self, **kwargs):
+        super().__init__()
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+        res = self.resolution
+        self.register_buffer('occupancy', torch.ones(res, res, res, dtype=torch.bool), persistent=False)
+        self.occupancy_key = None
+
+    @torch.no_grad()
+    def update(self, aabb_min, aabb_max):
+        """Mark the cells overlapping the given boxes in the warped [-1, 1] space as occupied.
+
+        Args:
+            aabb_min: [num_boxes, 3], lower corners of the boxes.
+            aabb_max: [num_boxes, 3], upper corners of the boxes.
+        """
+        res = self.resolution
+        # Boxes are clamped to the grid, as are the points outside of it when queried.
+        lo = ((aabb_min + 1) / 2 * res).floor().long().clamp(0, res - 1)
+        hi = ((aabb_max + 1) / 2 * res).floor().long().clamp(0, res - 1) + 1
+        # Add each box to a difference array at its corners, its prefix sum counts the boxes of each cell.
+        counts = torch.zeros(res + 1, res + 1, res + 1, dtype=torch.int32, device=aabb_min.device)
+        for corner in range(8):
+            pick = [(corner >> axis) & 1 for axis in range(3)]
+            index = tuple(hi[:, axis] if pick[axis] else lo[:, axis] for axis in range(3))
+            sign = -1 if sum(pick) % 2 else 1
+            counts.index_put_(index, torch.full_like(index[0], sign, dtype=torch.int32), accumulate=True)
+        counts = counts.cumsum(0).cumsum(1).cumsum(2)[:res, :res, :res]
+        occupancy = F.max_pool3d((counts > 0).float()[None, None], 3, stride=1, padding=1)[0, 0]
+        self.occupancy.copy_(occupancy > 0)
+
+    def query(self, coords, no_warp=False):
+        """Whether the cells of the given coordinates are occupied."""
+        coords = _warp_coords(self.warp_fn, coords, self.bbox_size, no_warp)
+        res = self.resolution
+        cell = ((coords + 1) / 2 * res).floor().long().clamp(0, res - 1)
+        return self.occupancy[cell[..., 0], cell[..., 1], cell[..., 2]]
+
+    @torch.no_grad()
+    def ray_intervals(self, origins, directions, s_to_t):
+        """March the rays through the grid and build a step function over their occupied steps.
+
+        Args:
+            origins: [..., 3], ray origins.
+            directions: [..., 3], ray directions.
+            s_to_t: the mapping from normalized to metric ray distance.
+
+        Returns:
+            sdist: [..., num_march_steps + 1], normalized distances of the steps.
+            weights: [..., num_march_steps], weights of the occupied steps, uniform for empty rays.
+            occupied_frac: the largest fraction of occupied steps among the rays.
+        """
+        steps = self.num_march_steps
+        sdist = torch.linspace(0, 1, steps + 1, device=origins.device)
+        sdist = torch.broadcast_to(sdist, origins.shape[:-1] + (steps + 1, ))
+        tdist = s_to_t(sdist)
+        tdist = (tdist[..., 1:] + tdist[..., :-1]) / 2
+        occupied = self.query(origins[..., None, :] + tdist[..., None] * directions[..., None, :]).float()
+        # Strokes smaller than a step may lie between the midpoints of two steps.
+        occupied = F.max_pool1d(occupied.reshape(-1, 1, steps), 3, stride=1, padding=1).reshape(occupied.shape)
+        num_occupied = occupied.sum(dim=-1, keepdim=True)
+        occupied_frac = num_occupied.max().item() / steps if num_occupied.numel() > 0 else 1.0
+        # Rays that miss all strokes only see the background, they keep the full range.
+        weights = torch.where(num_occupied > 0, occupied / num_occupied.clamp_min(1), 1 / steps)
+        return sdist, weights, occupied_frac
+
+
 @gin.configurable
 class StrokeField(nn.Module):
     """A vector stroke field."""
@@ -552,6 +1078,21 @@ class StrokeField(nn.Module):
     max_reset_frac: float = 0.95  # The maximum fraction of training to reset old strokes.
     error_point_samples: int = 30000  # The number of samples to sample the error field.
     step_power: float = 0.5
+    use_stroke_index: bool = False  # If True, only evaluate strokes whose bounds overlap the sample.
+    stroke_index_resolution: int = 32  # The grid resolution of the stroke index.
+    stroke_index_alpha_eps: float = 1e-4  # Alpha below which laplace strokes are treated as empty.
+    use_sparse_strokes: bool = False  # If True, keep only non-zero (sample, stroke) entries in CSR rows.
+    use_fused_strokes: bool = False  # If True, evaluate and composite strokes in one kernel ('over' only).
+    min_transmittance: float = 0.0  # Stop 'over' composition once transmittance drops below it.
+    cull_strokes_per_view: bool = False  # If True, only evaluate the strokes in view when rendering images.
+    use_frozen_cache: bool = False  # If True, bake the frozen strokes into a voxel grid ('over' and rgb colors only).
+    frozen_cache_resolution: int = 128  # The grid resolution of the frozen stroke cache.
+    frozen_cache_chunk: int = 65536  # The number of grid vertices to bake at once.
+    stroke_chunk_size: int = 0  # If > 0, stream strokes in blocks of this size with bounded memory ('over' only).
+    stroke_backend: str = None  # 'native' kernels or 'torch' reference, None prefers 'native' when available.
+    stroke_storage_dtype: str = 'float32'  # 'float16' or 'bfloat16' halve the memory of stroke alphas and colors.
+    lod_num_strokes: int = 0  # If > 0, only render this many of the most important strokes.
+    lod_coverage: float = 1.0  # If < 1, only render the most important strokes covering this fraction of importance.
 
     def __init__(self, config, **kwargs):
         super().__init__()
@@ -560,7 +1101,9 @@ class StrokeField(nn.Module):
 
         self.stroke_fn, self.d_shape, self.d_color, self.shape_param_ranges, \
             self.color_param_ranges, self.shape_param_sampler, self.color_param_sampler = \
-            get_stroke(self.shape_type, self.color_type, self.init_type)
+            get_stroke(self.shape_type, self.color_type, self.init_type, self.stroke_backend,
+                       getattr(torch, self.stroke_storage_dtype))
+        self.stroke_compose_fn = get_stroke_compose(self.shape_type, self.color_type, self.stroke_backend)
         self.shape_params = nn.Parameter(torch.zeros(self.max_num_strokes, self.d_shape),
                                          not config.fix_shape_params)
         self.color_params = nn.Parameter(torch.zeros(self.max_num_strokes, self.d_color),
@@ -570,8 +1113,21 @@ class StrokeField(nn.Module):
         self.register_buffer('stroke_step', torch.tensor(0, dtype=torch.int32))
         self.register_buffer('shape_params_grad', torch.zeros(self.max_num_strokes, self.d_shape))
         self.stroke_texture = textures.get_stroke_texture(config)
+        # Texture of each stroke in the texture atlas, sampled with the other parameters of new strokes
+        self.register_buffer('texture_ids', torch.zeros(self.max_num_strokes, dtype=torch.long)
+                             if isinstance(self.stroke_texture, textures.AtlasTexture) else None)
+        # Accumulated contribution of each stroke, which orders the strokes for level-of-detail rendering
+        self.register_buffer('stroke_importance', torch.zeros(self.max_num_strokes))
         self.stroke_step_limit = None
+        self.stroke_subset = None
         self.last_update_step = 0
+        self.stroke_index = None
+        self.frozen_cache = None
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved before the importance was stored load without importance
+        state_dict.setdefault(prefix + 'stroke_importance', self.stroke_importance.clone())
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def clip_params(self):
         """Clip the parameters to the valid range."""
@@ -607,55 +1163,293 @@ class StrokeField(nn.Module):
                   f', reset {num_resets} strokes')
 
             # Sample a batch of random points and get their errors
+            device = self.shape_params.device
             coords_top = None
-            get_maxgrad_shape_params = lambda _: None
+            shape_params_top = None
             if prev_step > self.init_num_strokes and self.use_error_field:
-                sample_coords = torch.rand((self.error_point_samples, 3),
-                                           device=self.shape_params.device)
+                sample_coords = torch.rand((self.error_point_samples, 3), device=device)
                 sample_coords = sample_coords * 2 - 1  # [0, 1] to range [-1, 1]
                 raw_coords = _unwarp_coords(self.warp_fn, sample_coords, self.bbox_size)
                 errors = error_field.sample_error(raw_coords)
                 errors_top, index_top = torch.topk(errors, k=next_step - prev_step + num_resets, dim=-1)
-                coords_top = sample_coords[index_top].cpu()
+                coords_top = sample_coords[index_top]
             elif prev_step > self.init_num_strokes and self.use_shape_grads:
                 shape_params_grads = self.shape_params_grad[:prev_step].sum(-1)
                 shape_params_grads[reset_indices] = -torch.inf
                 grads_top, index_top = torch.topk(shape_params_grads, 
                                                   k=min(next_step - prev_step + num_resets, 
                                                         prev_step - num_resets))
-                shape_params_top = self.shape_params[index_top]
-                def get_maxgrad_shape_params(idx):
-                    if idx < shape_params_top.shape[0]:
-                        return shape_params_top[idx] + self.shape_params_grad[idx] * self.shape_split_update_rate
-                    return None
-
-            # Sample new parameters for the new strokes.
-            for i in range(prev_step, next_step):
-                error_coord = coords_top[i - prev_step] if coords_top is not None else None
-                shape_params = get_maxgrad_shape_params(i - prev_step)
-                if shape_params is None:
-                    shape_params = self.shape_param_sampler(i, error_coord)
-                color_params = self.color_param_sampler()
-                self.shape_params.data[i] = shape_params.to(self.shape_params.device)
-                self.color_params.data[i] = color_params.to(self.color_params.device)
-                
-            # Also, reset parameters for the old strokes that has zero density.
-            offset = next_step - prev_step
-            for i in reset_indices:
-                error_coord = coords_top[offset] if coords_top is not None else None
-                shape_params = get_maxgrad_shape_params(offset)
-                if shape_params is None:
-                    shape_params = self.shape_param_sampler(next_step, error_coord)
-                color_params = self.color_param_sampler()
-                self.shape_params.data[i] = shape_params.to(self.shape_params.device)
-                self.color_params.data[i] = color_params.to(self.color_params.device)
-                self.density_params[i].fill_(1.0)
-                offset += 1
+                shape_params_top = self.shape_params.data[index_top]
+
+            # Sample parameters for the new strokes, followed by the old strokes that have zero density.
+            update_indices = torch.cat([torch.arange(prev_step, next_step, device=device), reset_indices])
+            update_steps = torch.cat([torch.arange(prev_step, next_step, device=device),
+                                      torch.full((num_resets, ), next_step, device=device)])
+            num_updates = update_indices.shape[0]
+            shape_params = self.shape_param_sampler(num_updates, update_steps, coords_top, device)
+            if shape_params_top is not None:
+                # Split the strokes with the largest shape gradients
+                num_top = shape_params_top.shape[0]
+                shape_params[:num_top] = shape_params_top + \
+                    self.shape_params_grad[:num_top] * self.shape_split_update_rate
+            color_params = self.color_param_sampler(num_updates, device)
+            self.shape_params.data[update_indices] = shape_params
+            self.color_params.data[update_indices] = color_params
+            if self.texture_ids is not None:
+                self.texture_ids[update_indices] = torch.randint(self.stroke_texture.num_textures, (num_updates, ),
+                                                                 device=device)
+            self.density_params.data[reset_indices] = 1.0
 
             self.stroke_step.fill_(next_step)
             self.last_update_step = cur_step
+            # Resetting a frozen stroke changes the frozen contribution.
+            if self.frozen_cache is not None and num_resets > 0 and \
+                    reset_indices.min().item() < self.frozen_cache[0][0]:
+                self.frozen_cache = None
         # Make sure the parameters are in the valid range.
         self.clip_params()
+        self.stroke_index = None
+
+    def current_sdf_delta(self, stroke_step):
+        """The sdf delta of the strokes, annealed from sdf_delta to sdf_delta_eval over training."""
+        if not self.training:
+            return self.sdf_delta_eval
+        stroke_step_frac = min(max(stroke_step / self.max_num_strokes, 0), 1)
+        return self.sdf_delta * (1 - stroke_step_frac) + self.sdf_delta_eval * stroke_step_frac
+
+    def get_stroke_index(self, stroke_step, sdf_delta, radius):
+        """Get the grid index over the bounds of the first stroke_step strokes."""
+        radius_max = radius.max().item() if radius.numel() > 0 else 0.0
+        key = (stroke_step, sdf_delta)
+        if (self.training or self.stroke_index is None or self.stroke_index[0] != key
+                or self.stroke_index[1] < radius_max):
+            # Parameters change every step during training, so only cache the index for eval.
+            # Leave some margin on the radius so the index survives small changes of sample radius.
+            band_radius = radius_max if self.training else radius_max * 1.5
+            sdf_band = stroke_alpha_band(sdf_delta, self.use_laplace_transform,
+                                         self.stroke_index_alpha_eps) * band_radius
+            shape_params = self.shape_params[:stroke_step] if self.stroke_subset is None \
+                else self.shape_params[self.stroke_subset]
+            grid = build_stroke_grid_from_params(self.shape_type, shape_params, sdf_band,
+                                                 self.inv_scale_radius, self.stroke_index_resolution)
+            self.stroke_index = (key, band_radius, grid)
+        return self.stroke_index[2]
+
+    def get_frozen_cache(self, fixed_step, sdf_delta, radius):
+        """Get the baked contribution of the first fixed_step (frozen) strokes."""
+        key = (fixed_step, sdf_delta)
+        if self.frozen_cache is None or self.frozen_cache[0] != key:
+            bake_radius = radius.mean().item() if radius.numel() > 0 else 0.0
+            self.frozen_cache = (key, self.bake_frozen_strokes(fixed_step, sdf_delta, bake_radius))
+        return self.frozen_cache[1]
+
+    @torch.no_grad()
+    def bake_frozen_strokes(self, fixed_step, sdf_delta, radius):
+        """Bake the composited frozen strokes into a voxel grid over their bounds.
+
+        Each vertex stores the 'over' composition state (density, unnormalized color, transmittance)
+        of the frozen strokes, evaluated at a fixed sample radius. Colors are evaluated without
+        view dependence.
+
+        Returns:
+            grid: tuple of (values [R, R, R, 2 + color_dim], grid_min [3], grid_max [3]).
+        """
+        shape_params = self.shape_params[:fixed_step].detach()
+        color_params = self.color_params[:fixed_step].detach()
+        density_params = self.density_params[:fixed_step].detach() * self.density_scale
+        sdf_band = stroke_alpha_band(sdf_delta, self.use_laplace_transform, self.stroke_index_alpha_eps) * radius
+        stroke_index = build_stroke_grid_from_params(self.shape_type, shape_params, sdf_band,
+                                                     self.inv_scale_radius, self.stroke_index_resolution)
+        grid_min = stroke_index.grid_min
+        grid_max = stroke_index.grid_min + stroke_index.cell_size * stroke_index.resolution
+
+        res = self.frozen_cache_resolution
+        axes = [torch.linspace(grid_min[i].item(), grid_max[i].item(), res, device=grid_min.device) for i in range(3)]
+        vertices = torch.stack(torch.meshgrid(*axes, indexing='ij'), dim=-1).reshape(-1, 3)
+        values = []
+        for x in torch.split(vertices, self.frozen_cache_chunk):
+            point_indices, stroke_indices = query_stroke_grid(stroke_index, x)
+            alphas, colors, _, texcoords = self.stroke_fn(
+                x[:, None], torch.full_like(x[:, :1], radius), torch.zeros_like(x), shape_params, color_params,
+                sdf_delta, self.use_laplace_transform, self.inv_scale_radius,
+                True, self.stroke_texture is not None, point_indices, stroke_indices, True)
+            alphas, colors, texcoords, row_offsets, stroke_indices = compact_stroke_pairs(
+                alphas, colors, texcoords, point_indices, stroke_indices, x.shape[0])
+            if self.stroke_texture is not None:
+                footprint = self.texture_footprint(torch.full_like(x[:, 0], radius), shape_params, row_offsets,
+                                                   stroke_indices)
+                texture_ids = self.texture_entry_ids(slice(0, fixed_step), row_offsets, stroke_indices)
+                colors, alphas = self.stroke_texture(texcoords, colors, alphas, footprint, True, texture_ids)
+            density, color = compose_strokes(alphas, colors, density_params, 'over', row_offsets, stroke_indices)
+            transmittance = compose_transmittance(alphas, row_offsets)
+            color_sum = color * (1 + 1e-6 - transmittance)[:, None]
+            values.append(torch.cat([density[:, None], color_sum, transmittance[:, None]], dim=-1))
+        values = torch.cat(values).reshape(res, res, res, -1)
+        return values, grid_min, grid_max
+
+    def lookup_frozen_cache(self, frozen_cache, coords):
+        """Look up the frozen stroke state (density, unnormalized color, transmittance) at coords."""
+        values, grid_min, grid_max = frozen_cache
+        fill_value = torch.zeros(values.shape[-1], device=values.device)
+        fill_value[-1] = 1  # Empty space is fully transmissive
+        state = _interp_voxel_grid(values, grid_min, grid_max, coords, fill_value)
+        return state[..., 0], state[..., 1:-1], state[..., -1]
+
+    def texture_footprint(self, radius, shape_params, row_offsets=None, stroke_indices=None):
+        """Sample radius relative to the size of the strokes, i.e. the sample size in texture coordinates.
+
+        Returns:
+            footprint: footprint of each entry of shape [..., num_samples, num_strokes], or [num_entries] if sparse.
+        """
+        _, _, _, stroke_radius = get_stroke_bounds(self.shape_type, shape_params, inv_scale_radius=self.inv_scale_radius,
+                                                   return_sphere=True)
+        stroke_size = 2 * stroke_radius.clamp_min(1e-6)
+        if row_offsets is None:
+            return radius[..., None] / stroke_size
+        counts = row_offsets[1:] - row_offsets[:-1]
+        point_indices = torch.repeat_interleave(torch.arange(counts.shape[0], device=radius.device), counts)
+        return radius.reshape(-1)[point_indices] / stroke_size[stroke_indices.long()]
+
+    def texture_entry_ids(self, stroke_ids, row_offsets=None, stroke_indices=None):
+        """Atlas texture of each entry for the evaluated strokes, or None without a texture atlas.
+
+        Returns:
+            texture_ids: texture of each entry of shape [num_strokes] broadcastable to dense entries,
+                or [num_entries] if sparse.
+        """
+        if self.texture_ids is None:
+            return None
+        texture_ids = self.texture_ids[stroke_ids]
+        return texture_ids if row_offsets is None else texture_ids[stroke_indices.long()]
+
+    def can_cull_strokes(self):
+        """Whether dropping strokes that cover no sample leaves the composition unchanged.
+
+        Softmax composition counts the missing strokes in its normalizer, so culling changes its result.
+        """
+        return self.composition_type == 'over' or self.composition_type.startswith('max')
+
+    @torch.no_grad()
+    def cull_strokes(self, origins, directions, radii, near, far):
+        """Select the strokes whose bounds may intersect the view of the given rays.
+
+        Returns:
+            stroke_subset: ascending indices of the strokes in view among the current strokes.
+        """
+        stroke_step = self.stroke_step.item()
+        if self.stroke_step_limit is not None:
+            stroke_step = min(stroke_step, self.stroke_step_limit)
+        # Sample radii grow linearly along the rays, see render.cast_rays.
+        radius_max = (radii * far).max().item()
+        _, _, center, radius = get_stroke_bounds(self.shape_type, self.shape_params[:stroke_step], self.sdf_delta_eval,
+                                                 radius_max, self.use_laplace_transform, self.inv_scale_radius,
+                                                 self.stroke_index_alpha_eps, return_sphere=True)
+        center, radius = _unwarp_bounding_spheres(self.warp_fn, center, radius, self.bbox_size)
+        visible = cull_spheres_to_rays(center, radius, origins, directions, near, far)
+        return torch.nonzero(visible).squeeze(1)
+
+    @torch.no_grad()
+    def lod_strokes(self, num_strokes=None, coverage=None):
+        """Select the most important current strokes, by count and by fraction of the total importance.
+
+        Args:
+            num_strokes: keep at most this many strokes, lod_num_strokes if None, all if 0.
+            coverage: keep the fewest strokes whose importance sums to this fraction of the total,
+                lod_coverage if None.
+
+        Returns:
+            stroke_subset: ascending indices of the selected strokes among the current strokes,
+                or None if level of detail is disabled.
+        """
+        num_strokes = self.lod_num_strokes if num_strokes is None else num_strokes
+        coverage = self.lod_coverage if coverage is None else coverage
+        if num_strokes <= 0 and coverage >= 1:
+            return None
+        stroke_step = self.stroke_step.item()
+        if self.stroke_step_limit is not None:
+            stroke_step = min(stroke_step, self.stroke_step_limit)
+        importance = self.stroke_importance[:stroke_step]
+        assert importance.sum() > 0, 'Stroke importance is not computed, run prune.py first'
+        importance_sorted, order = torch.sort(importance, descending=True)
+        num_selected = stroke_step if num_strokes <= 0 else min(stroke_step, num_strokes)
+        if coverage < 1:
+            cum_importance = torch.cumsum(importance_sorted, 0)
+            num_covering = torch.searchsorted(cum_importance, coverage * cum_importance[-1]).item() + 1
+            num_selected = min(num_selected, num_covering)
+        return torch.sort(order[:num_selected]).values
+
+    def set_stroke_subset(self, stroke_subset):
+        """Only evaluate the given ascending stroke indices, or all strokes if None.
+
+        The subset is evaluated as a single group, so all its strokes get gradients, including the ones
+        that would otherwise be fixed by max_opt_strokes.
+        """
+        self.stroke_subset = stroke_subset
+        self.stroke_index = None
+
+    @torch.no_grad()
+    def merge_strokes(self, contributions, merge_distance):
+        """Merge near-duplicate strokes into the one with the largest contribution.
+
+        Strokes are near-duplicates if all their shape and color parameters, normalized by the parameter
+        ranges, differ by at most merge_distance. The merged stroke keeps the shape of the largest one,
+        takes the contribution-weighted color and the sum of the densities.
+
+        Args:
+            contributions: contribution of each current stroke of shape [stroke_step].
+
+        Returns:
+            keep: whether each current stroke is kept of shape [stroke_step], bool.
+            contributions: contributions with the merged strokes added to the kept ones.
+        """
+        stroke_step = self.stroke_step.item()
+        params = torch.cat([self.shape_params[:stroke_step], self.color_params[:stroke_step]], dim=-1).cpu()
+        ranges = list(self.shape_param_ranges) + list(self.color_param_ranges)
+        scale = torch.stack([torch.tensor(p_max - p_min, dtype=torch.float32)
+                             if p_min is not None and p_max is not None else params[:, i].std()
+                             for i, (p_min, p_max) in enumerate(ranges)]).nan_to_num(1.0).clamp_min(1e-6)
+        neighbors, neighbor_offsets = _close_pairs(params / scale, merge_distance)
+
+        contributions = contributions.cpu().clone()
+        merged_into = [-1] * stroke_step
+        for i in torch.argsort(contributions, descending=True).tolist():
+            if merged_into[i] >= 0:
+                continue
+            group = [i] + [j for j in neighbors[neighbor_offsets[i]:neighbor_offsets[i + 1]] if merged_into[j] < 0]
+            for j in group:
+                merged_into[j] = i
+            group = torch.tensor(group, dtype=torch.long)
+            others = group[1:]
+            if others.numel() > 0:
+                weights = contributions[group] / contributions[group].sum().clamp_min(1e-12)
+                self.color_params.data[i] = (weights[:, None].to(self.color_params.device) *
+                                             self.color_params.data[group]).sum(0)
+                self.density_params.data[i] = self.density_params.data[group].sum()
+                contributions[i] = contributions[group].sum()
+        keep = torch.tensor(merged_into, dtype=torch.long) == torch.arange(stroke_step)
+        device = self.shape_params.device
+        return keep.to(device), contributions.to(device)
+
+    @torch.no_grad()
+    def compact_strokes(self, keep_indices):
+        """Keep only the given ascending stroke indices, moved to the front in the same order.
+
+        The freed slots are cleared as before initialization and the stroke step is set to the number
+        of kept strokes, so that only those are evaluated.
+        """
+        num_kept = keep_indices.shape[0]
+        for p, empty_value in [(self.shape_params, 0.0), (self.color_params, 0.0), (self.density_params, 1.0),
+                               (self.shape_params_grad, 0.0), (self.stroke_importance, 0.0)]:
+            kept = p.data[keep_indices].clone()
+            p.data[num_kept:] = empty_value
+            p.data[:num_kept] = kept
+        if self.texture_ids is not None:
+            kept = self.texture_ids[keep_indices].clone()
+            self.texture_ids[num_kept:] = 0
+            self.texture_ids[:num_kept] = kept
+        self.stroke_step.fill_(num_kept)
+        self.stroke_index = None
+        self.frozen_cache = None
 
     def predict_density(self, coords, radius, viewdirs, no_warp=False):
         """Helper function to output density and rgb."""
@@ -668,23 +1462,76 @@ class StrokeField(nn.Module):
         if self.stroke_step_limit is not None:
             stroke_step = min(stroke_step, self.stroke_step_limit)
             fixed_step = min(fixed_step, self.stroke_step_limit)
-        shape_params = self.shape_params[fixed_step:stroke_step]
-        color_params = self.color_params[fixed_step:stroke_step]
-        density_params = self.density_params[fixed_step:stroke_step] * self.density_scale
+        stroke_ids = slice(fixed_step, stroke_step)
+        if self.stroke_subset is not None:
+            # Evaluate the subset as a single group, it is only set for rendering.
+            stroke_ids, fixed_step = self.stroke_subset, 0
+        shape_params = self.shape_params[stroke_ids]
+        color_params = self.color_params[stroke_ids]
+        density_params = self.density_params[stroke_ids] * self.density_scale
 
         # Compute alpha and color for each stroke.
-        if self.training:
-            stroke_step_frac = min(max(stroke_step / self.max_num_strokes, 0), 1)
-            sdf_delta = self.sdf_delta * (1 - stroke_step_frac) + self.sdf_delta_eval * stroke_step_frac
-        else:
-            sdf_delta = self.sdf_delta_eval
+        sdf_delta = self.current_sdf_delta(stroke_step)
+
+        # Stream strokes in fixed-size blocks, carrying the running composite between blocks.
+        if self.stroke_chunk_size > 0:
+            assert self.composition_type == 'over', 'Chunked strokes only support over composition'
+            assert self.texture_ids is None, 'Chunked strokes do not support texture atlases'
+            if fixed_step > 0:
+                shape_params = torch.cat([self.shape_params[:fixed_step].detach(), shape_params])
+                color_params = torch.cat([self.color_params[:fixed_step].detach(), color_params])
+                density_params = torch.cat(
+                    [self.density_params[:fixed_step].detach() * self.density_scale, density_params])
+            density, color = compose_strokes_chunked(
+                self.stroke_fn, coords, radius, viewdirs, shape_params, color_params, density_params, sdf_delta,
+                self.use_laplace_transform, self.inv_scale_radius, self.stroke_chunk_size, self.stroke_texture,
+                fixed_step)
+            return density, color, coords
+
+        # Find candidate (sample, stroke) pairs from the stroke bounds.
+        pairs_fixed, pairs = (), ()
+        if self.use_stroke_index or self.use_sparse_strokes:
+            stroke_index = self.get_stroke_index(stroke_step, sdf_delta, radius)
+            point_indices, stroke_indices = query_stroke_grid(stroke_index, coords.reshape(-1, 3))
+            is_fixed = stroke_indices < fixed_step
+            pairs_fixed = (point_indices[is_fixed], stroke_indices[is_fixed], self.use_sparse_strokes)
+            pairs = (point_indices[~is_fixed], stroke_indices[~is_fixed] - fixed_step, self.use_sparse_strokes)
+
+        # Look up the frozen strokes from the baked cache instead of evaluating them.
+        frozen_cache = None
+        if self.use_frozen_cache and fixed_step > 0 and not self.use_fused_strokes:
+            assert self.composition_type == 'over', 'Frozen stroke cache only supports over composition'
+            # The cache is baked without view directions, which would drop any view-dependent color.
+            assert self.color_type in ('constant_rgb', 'gradient_rgb'), \
+                'Frozen stroke cache only supports view-independent colors'
+            frozen_cache = self.get_frozen_cache(fixed_step, sdf_delta, radius)
+            if self.use_stroke_index or self.use_sparse_strokes:
+                point_indices, stroke_indices = pairs[0], pairs[1]
+
+        # Evaluate and composite all strokes in one pass, without per-stroke intermediates.
+        if self.use_fused_strokes:
+            assert self.composition_type == 'over', 'Fused strokes only support over composition'
+            assert self.stroke_texture is None, 'Fused strokes do not support stroke textures'
+            if fixed_step > 0:
+                shape_params = torch.cat([self.shape_params[:fixed_step].detach(), shape_params])
+                color_params = torch.cat([self.color_params[:fixed_step].detach(), color_params])
+                density_params = torch.cat(
+                    [self.density_params[:fixed_step].detach() * self.density_scale, density_params])
+            candidate_rows = (None, None)
+            if self.use_stroke_index or self.use_sparse_strokes:
+                candidate_rows = (make_row_offsets(point_indices, coords.shape[:-1].numel()), stroke_indices)
+            density, color = self.stroke_compose_fn(
+                coords, radius, viewdirs, shape_params, color_params, density_params, sdf_delta,
+                self.use_laplace_transform, self.inv_scale_radius, *candidate_rows, self.min_transmittance)
+            return density, color, coords
+
         alphas, colors, sdfs, texcoords = self.stroke_fn(
             coords, radius, viewdirs, shape_params, color_params, sdf_delta, 
             self.use_laplace_transform, self.inv_scale_radius, 
-            True, self.stroke_texture is not None)
+            True, self.stroke_texture is not None, *pairs)
 
         # Compute the fixed step strokes.
-        if fixed_step > 0:
+        if fixed_step > 0 and frozen_cache is None:
             with torch.no_grad():
                 shape_params_fixed = self.shape_params[:fixed_step].detach()
                 color_params_fixed = self.color_params[:fixed_step].detach()
@@ -692,21 +1539,60 @@ class StrokeField(nn.Module):
                 alphas_fixed, colors_fixed, sdfs_fixed, texcoords_fixed = self.stroke_fn(
                     coords, radius, viewdirs, shape_params_fixed, color_params_fixed, sdf_delta,
                     self.use_laplace_transform, self.inv_scale_radius, 
-                    True, self.stroke_texture is not None)
-            alphas = torch.cat([alphas_fixed, alphas], dim=-1)
-            colors = torch.cat([colors_fixed, colors], dim=-2)
-            if sdfs is not None:
-                sdfs = torch.cat([sdfs_fixed, sdfs], dim=-1)
-            if texcoords is not None:
-                texcoords = torch.cat([texcoords_fixed, texcoords], dim=-2)
+                    True, self.stroke_texture is not None, *pairs_fixed)
+            if self.use_sparse_strokes:
+                # Restore the (sample, stroke) order of the candidate pairs
+                pair_order = torch.argsort(torch.argsort((~is_fixed).int(), stable=True))
+                alphas = torch.cat([alphas_fixed, alphas])[pair_order]
+                colors = torch.cat([colors_fixed, colors])[pair_order]
+                if texcoords is not None:
+                    texcoords = torch.cat([texcoords_fixed, texcoords])[pair_order]
+            else:
+                alphas = torch.cat([alphas_fixed, alphas], dim=-1)
+                colors = torch.cat([colors_fixed, colors], dim=-2)
+                if sdfs is not None:
+                    sdfs = torch.cat([sdfs_fixed, sdfs], dim=-1)
+                if texcoords is not None:
+                    texcoords = torch.cat([texcoords_fixed, texcoords], dim=-2)
             density_params = torch.cat([density_params_fixed, density_params], dim=-1)
+
+        # Keep only the non-zero entries as CSR rows over the samples.
+        sparse_rows = {}
+        if self.use_sparse_strokes:
+            alphas, colors, texcoords, row_offsets, stroke_indices = compact_stroke_pairs(
+                alphas, colors, texcoords, point_indices, stroke_indices, coords.shape[:-1].numel())
+            sparse_rows = dict(row_offsets=row_offsets, stroke_indices=stroke_indices)
             
-        # Apply texture modulation to colors and alphas.
+        # Apply texture modulation to colors and alphas, with the mip level chosen from the sample footprint.
         if self.stroke_texture is not None:
-            colors, alphas = self.stroke_texture(texcoords, colors, alphas)
+            texture_shape_params = shape_params.detach()
+            texture_stroke_ids = torch.arange(self.max_num_strokes, device=coords.device)[stroke_ids]
+            if fixed_step > 0 and frozen_cache is None:
+                texture_shape_params = torch.cat([shape_params_fixed, texture_shape_params])
+                texture_stroke_ids = torch.cat([torch.arange(fixed_step, device=coords.device), texture_stroke_ids])
+            footprint = self.texture_footprint(radius, texture_shape_params, **sparse_rows)
+            texture_ids = self.texture_entry_ids(texture_stroke_ids, **sparse_rows)
+            colors, alphas = self.stroke_texture(texcoords, colors, alphas, footprint,
+                                                 self.composition_type == 'over', texture_ids)
 
         # Composite strokes to get the final density and color.
-        density, color = compose_strokes(alphas, colors, density_params, self.composition_type)
+        density, color = compose_strokes(alphas, colors, density_params, self.composition_type, **sparse_rows,
+                                         min_transmittance=self.min_transmittance)
+        if frozen_cache is not None:
+            transmittance = compose_transmittance(alphas, **sparse_rows)
+        if self.use_sparse_strokes:
+            density = density.reshape(coords.shape[:-1])
+            color = color.reshape(*coords.shape[:-1], -1)
+
+        # Place the optimized strokes in front of the cached frozen strokes.
+        if frozen_cache is not None:
+            transmittance = transmittance.reshape(coords.shape[:-1])
+            merged_density, merged_color = merge_over_composition(density, color, transmittance,
+                                                                  *self.lookup_frozen_cache(frozen_cache, coords))
+            # The frozen strokes are behind the optimized ones, so they are cut first.
+            reaches_frozen = transmittance >= self.min_transmittance
+            density = torch.where(reaches_frozen, merged_density, density)
+            color = torch.where(reaches_frozen[..., None], merged_color, color)
 
         return density, color, coords
 
@@ -779,6 +1665,16 @@ def render_image(model: Model,
     num_rays = height * width
     batch = {k: v.reshape((num_rays, -1)) for k, v in batch.items() if v is not None}
 
+    # Select the level of detail and cull the strokes out of view once, and skip them for all chunks of this image.
+    stroke_field = accelerator.unwrap_model(model).nerf
+    if isinstance(stroke_field, StrokeField):
+        stroke_subset = stroke_field.lod_strokes()
+        if stroke_field.cull_strokes_per_view and stroke_field.can_cull_strokes():
+            visible = stroke_field.cull_strokes(batch['origins'], batch['directions'], batch['radii'], batch['near'],
+                                                batch['far'])
+            stroke_subset = visible if stroke_subset is None else visible[torch.isin(visible, stroke_subset)]
+        stroke_field.set_stroke_subset(stroke_subset)
+
     global_rank = accelerator.process_index
     chunks = []
     idx0s = tqdm(range(0, num_rays, config.render_chunk_size),
@@ -820,6 +1716,9 @@ def render_image(model: Model,
             chunk_rendering['coord'] = gather(ray_history[-1]['coord'])
         chunks.append(chunk_rendering)
 
+    if isinstance(stroke_field, StrokeField):
+        stroke_field.set_stroke_subset(None)
+
     # Concatenate all chunks within each leaf of a single pytree.
     rendering = {}
     for k in chunks[0].keys():
@@ -848,3 +1747,72 @@ def render_image(model: Model,
 
     model.train()
     return rendering
+
+
+def stroke_contributions(model: Model, accelerator: accelerate.Accelerator, batch, config, verbose=True):
+    """Measure the contribution of each stroke to the pixels of an image (in test mode).
+
+    The contribution of a stroke to a sample is its share of the sample density, weighted by the
+    volume rendering weight of the sample. It is summed over all the samples of the final level.
+    Under "over" composition, the density of a sample is linear in the stroke densities, so the
+    shares are the gradients of the density with respect to the stroke densities times the densities.
+    Occluded strokes, or strokes behind the transmittance cutoff, have a small or zero contribution.
+
+    Args:
+        model: The rendering model, with a stroke field.
+        accelerator: used to unwrap the model.
+        batch: a `Rays` pytree, the rays of the image.
+        config: A Config class.
+
+    Returns:
+        contributions: contribution of each current stroke of shape [stroke_step].
+    """
+    model.eval()
+    stroke_field = accelerator.unwrap_model(model).nerf
+    assert isinstance(stroke_field, StrokeField), 'Stroke contributions require a stroke field'
+
+    height, width = batch['origins'].shape[:2]
+    num_rays = height * width
+    batch = {k: v.reshape((num_rays, -1)) for k, v in batch.items() if v is not None}
+
+    # Evaluate the strokes in view as a single group, so that every stroke gets a gradient. Strokes are
+    # only culled if that leaves the composition unchanged.
+    if stroke_field.can_cull_strokes():
+        stroke_subset = stroke_field.cull_strokes(batch['origins'], batch['directions'], batch['radii'],
+                                                  batch['near'], batch['far'])
+    else:
+        stroke_step = stroke_field.stroke_step.item()
+        if stroke_field.stroke_step_limit is not None:
+            stroke_step = min(stroke_step, stroke_field.stroke_step_limit)
+        stroke_subset = torch.arange(stroke_step, device=stroke_field.density_params.device)
+    stroke_field.set_stroke_subset(stroke_subset)
+    # Only the stroke densities need gradients. With all other parameters frozen, the proposal and
+    # error levels run without building graphs, as under torch.no_grad.
+    density_params = stroke_field.density_params
+    params = list(accelerator.unwrap_model(model).parameters())
+    params_requires_grad = [p.requires_grad for p in params]
+    for p in params:
+        p.requires_grad_(p is density_params)
+
+    contributions = torch.zeros_like(density_params, requires_grad=False)
+    idx0s = tqdm(range(0, num_rays, config.render_chunk_size),
+                 desc="Measuring chunk",
+                 leave=False,
+                 disable=not (accelerator.is_main_process and verbose))
+    try:
+        for idx0 in idx0s:
+            chunk_batch = tree_map(lambda r: r[idx0:idx0 + config.render_chunk_size], batch)
+            with accelerator.autocast():
+                _, ray_history = model(chunk_batch, compute_extras=False)
+            density = ray_history[-1]['density']
+            weights = ray_history[-1]['weights'].detach()
+            sample_weights = torch.where(density > 0, weights / density.detach().clamp_min(1e-10), 0)
+            grad = torch.autograd.grad((density * sample_weights).sum(), density_params, allow_unused=True)[0]
+            if grad is not None:
+                contributions += grad * density_params.detach()
+    finally:
+        for p, requires_grad in zip(params, params_requires_grad):
+            p.requires_grad_(requires_grad)
+        stroke_field.set_stroke_subset(None)
+        model.train()
+    return contributions[:stroke_field.stroke_step.item()]
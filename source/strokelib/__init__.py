@@ -1 +1,5 @@
-from .strokes import get_stroke, compose_strokes
\ No newline at end of file
+from .strokes import get_stroke, get_stroke_bounds, get_stroke_compose, compose_strokes, compact_stroke_pairs, make_row_offsets
+from .strokes import compose_strokes_chunked, compose_transmittance, merge_over_composition, stroke_alpha_band
+from .strokes import volume_render
+from .spatial import StrokeGrid, build_stroke_grid, build_stroke_grid_from_params, query_stroke_grid
+from .spatial import cull_spheres_to_rays
\ No newline at end of file
@@ -1,5 +1,9 @@
 import os
-from torch.utils.cpp_extension import load
+import hashlib
+import torch
+from torch.utils.cpp_extension import load, CUDA_HOME
+
+from .shapes import parse_kernel_spec
 
 _src_path = os.path.dirname(os.path.abspath(__file__))
 
@@ -12,7 +16,7 @@ nvcc_flags = [
 ]
 
 if os.name == "posix":
-    c_flags = ['-O3', '-std=c++17']
+    c_flags = ['-O3', '-std=c++17', '-Wno-unknown-pragmas']
 elif os.name == "nt":
     c_flags = ['/O2', '/std:c++17']
 
@@ -31,16 +35,40 @@ elif os.name == "nt":
             raise RuntimeError("Could not locate a supported Microsoft Visual C++ installation")
         os.environ["PATH"] += ";" + cl_path
 
-_backend = load(name='_strokelib',
+# CPU kernels are always built, CUDA kernels only when a CUDA toolkit is available
+sources = [
+    'strokes_cpu.cpp',
+    'strokes_fused_cpu.cpp',
+    'compositing_cpu.cpp',
+    'volume_rendering_cpu.cpp',
+    'bindings.cpp',
+]
+if torch.cuda.is_available() and CUDA_HOME is not None:
+    sources += [
+        'strokes_forward.cu',
+        'strokes_backward.cu',
+        'strokes_fused.cu',
+        'compositing.cu',
+        'volume_rendering.cu',
+    ]
+    c_flags = c_flags + ['-DWITH_CUDA']
+    nvcc_flags = nvcc_flags + ['-DWITH_CUDA']
+
+# STROKELIB_KERNELS="shape_type:color_type,..." only compiles the listed stroke functions,
+# each selection gets its own build directory so that switching between them does not rebuild.
+name = '_strokelib'
+fn_ids = parse_kernel_spec(os.environ.get('STROKELIB_KERNELS', ''))
+if fn_ids is not None:
+    fn_ids_flag = '-DSTROKELIB_FN_IDS=' + ','.join(str(fn_id) for fn_id in fn_ids)
+    c_flags = c_flags + [fn_ids_flag]
+    nvcc_flags = nvcc_flags + [fn_ids_flag]
+    name += '_' + hashlib.md5(fn_ids_flag.encode()).hexdigest()[:8]
+
+_backend = load(name=name,
                 extra_cflags=c_flags,
                 extra_cuda_cflags=nvcc_flags,
                 extra_include_paths=[os.path.join(_src_path, 'src')],
                 verbose=True,
-                sources=[os.path.join(_src_path, 'src', f) for f in [
-                    'strokes_forward.cu',
-                    'strokes_backward.cu',
-                    'compositing.cu',
-                    'bindings.cpp',
-                ]])
+                sources=[os.path.join(_src_path, 'src', f) for f in sources])
 
 __all__ = ['_backend']
\ No newline at end of file
@@ -0,0 +1,187 @@
+"""Microbenchmark of the stroke functions and their composition.
+
+Sweeps shape types, color types, stroke counts, samples per ray, composition types and
+forward vs forward+backward passes, and reports the throughput, wall time and peak memory of
+each configuration as JSON, e.g.
+
+    python -m source.strokelib.benchmark --shapes ellipsoid cube --strokes 100 500 --output bench.json
+
+Every configuration runs on the backend picked by get_stroke (see STROKELIB_BACKEND and
+STROKELIB_KERNELS), or on the one given by --backend, on CPU or GPU tensors. On the CPU every
+configuration runs in its own process, so that the peak memory is measured per configuration.
+"""
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+import torch
+
+from .shapes import get_stroke_fn_id
+from .strokes import _sdf_dict, _color_dict, _resolve_backend, get_stroke, get_stroke_compose, compose_strokes
+
+_composition_types = ['over', 'over_fused', 'max', 'max_density_weighted', 'softmax', 'softmax_density_weighted']
+
+
+def _synchronize(device: torch.device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def _peak_memory_mb(device: torch.device):
+    """Peak allocated memory on the GPU, or the peak resident memory of the process on the CPU.
+
+    The resident memory peak of a process never goes down, so on the CPU each configuration runs in
+    its own process, see _benchmark_config_in_subprocess.
+    """
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2**20 if sys.platform == 'darwin' else max_rss / 2**10
+
+
+def make_inputs(shape_type: str, color_type: str, num_strokes: int, num_rays: int, num_samples: int,
+                device: torch.device, requires_grad: bool = False, seed: int = 0):
+    """Sample rays and strokes in the 'recon' initialization volume."""
+    torch.manual_seed(seed)
+    _, _, _, _, _, shape_sampler, color_sampler = get_stroke(shape_type, color_type, 'recon', 'torch')
+    t = torch.linspace(0, 1, num_samples, device=device)
+    origins = torch.rand(num_rays, 3, device=device) - 0.5
+    viewdir = torch.nn.functional.normalize(torch.randn(num_rays, 3, device=device), dim=-1)
+    x = origins[:, None, :] + (t[:, None] - 0.5) * viewdir[:, None, :]
+    radius = torch.full((num_rays, num_samples), 0.005, device=device)
+    shape_params = shape_sampler(num_strokes, torch.arange(num_strokes, device=device), device=device)
+    color_params = color_sampler(num_strokes, device=device)
+    density_params = torch.rand(num_strokes, device=device)
+    for p in (shape_params, color_params, density_params):
+        p.requires_grad_(requires_grad)
+    return x, radius, viewdir, shape_params, color_params, density_params
+
+
+def benchmark_config(shape_type: str,
+                     color_type: str,
+                     composition_type: str,
+                     num_strokes: int,
+                     num_samples: int,
+                     backward: bool,
+                     num_rays: int = 1024,
+                     sdf_delta: float = 1.0,
+                     backend: str = None,
+                     device: torch.device = torch.device('cpu'),
+                     warmup: int = 2,
+                     repeat: int = 5):
+    """Time one configuration.
+
+    Returns:
+        result (dict): The configuration, the resolved backend, mean and min wall time per iteration
+            in seconds, points x strokes per second and peak memory in MB.
+    """
+    resolved_backend = _resolve_backend(backend, get_stroke_fn_id(shape_type, color_type))
+    stroke_fn = get_stroke(shape_type, color_type, 'recon', resolved_backend)[0]
+    stroke_compose_fn = get_stroke_compose(shape_type, color_type, resolved_backend)
+    x, radius, viewdir, shape_params, color_params, density_params = make_inputs(
+        shape_type, color_type, num_strokes, num_rays, num_samples, device, backward)
+
+    def run():
+        if composition_type == 'over_fused':
+            density, color = stroke_compose_fn(x, radius, viewdir, shape_params, color_params, density_params,
+                                               sdf_delta)
+        else:
+            alphas, colors, _, _ = stroke_fn(x, radius, viewdir, shape_params, color_params, sdf_delta)
+            density, color = compose_strokes(alphas, colors, density_params, composition_type)
+        if backward:
+            (density.sum() + color.sum()).backward()
+            for p in (shape_params, color_params, density_params):
+                p.grad = None
+
+    with torch.set_grad_enabled(backward):
+        for _ in range(warmup):
+            run()
+        _synchronize(device)
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            _synchronize(device)
+            times.append(time.perf_counter() - start)
+
+    mean_time = sum(times) / len(times)
+    return dict(shape_type=shape_type,
+                color_type=color_type,
+                composition_type=composition_type,
+                num_strokes=num_strokes,
+                num_rays=num_rays,
+                num_samples=num_samples,
+                pass_type='forward_backward' if backward else 'forward',
+                backend=resolved_backend,
+                mean_time=mean_time,
+                min_time=min(times),
+                point_strokes_per_sec=num_rays * num_samples * num_strokes / mean_time,
+                peak_memory_mb=_peak_memory_mb(device))
+
+
+def _benchmark_config_in_subprocess(*args):
+    """Run benchmark_config in a fresh process, so that its peak memory only covers this configuration."""
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1,
+                                                mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(benchmark_config, *args).result()
+
+
+def run_benchmark(shapes, colors, compositions, strokes, samples, passes, num_rays=1024, sdf_delta=1.0,
+                  backend=None, device=torch.device('cpu'), warmup=2, repeat=5):
+    """Run the sweep, configurations that fail (e.g. out of memory) are reported with their error."""
+    results = []
+    config_fn = benchmark_config if device.type == 'cuda' else _benchmark_config_in_subprocess
+    for shape_type, color_type, composition_type, num_strokes, num_samples, pass_type in itertools.product(
+            shapes, colors, compositions, strokes, samples, passes):
+        try:
+            result = config_fn(shape_type, color_type, composition_type, num_strokes, num_samples,
+                               pass_type == 'forward_backward', num_rays, sdf_delta, backend, device, warmup,
+                               repeat)
+        except (AssertionError, RuntimeError) as e:
+            result = dict(shape_type=shape_type, color_type=color_type, composition_type=composition_type,
+                          num_strokes=num_strokes, num_rays=num_rays, num_samples=num_samples,
+                          pass_type=pass_type, error=str(e))
+            if device.type == 'cuda':
+                torch.cuda.empty_cache()
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+    return dict(device=str(device) if device.type == 'cpu' else torch.cuda.get_device_name(device),
+                num_threads=torch.get_num_threads(),
+                torch_version=torch.__version__,
+                platform=platform.platform(),
+                results=results)
+
+
+if __name__ == '__main__':
+    import argparse
+    p = argparse.ArgumentParser()
+    p.add_argument('--shapes', nargs='+', default=list(_sdf_dict), choices=list(_sdf_dict))
+    p.add_argument('--colors', nargs='+', default=list(_color_dict), choices=list(_color_dict))
+    p.add_argument('--compositions', nargs='+', default=_composition_types, choices=_composition_types)
+    p.add_argument('--strokes', nargs='+', type=int, default=[100, 500], help="Numbers of strokes")
+    p.add_argument('--samples', nargs='+', type=int, default=[32, 128], help="Numbers of samples per ray")
+    p.add_argument('--passes', nargs='+', default=['forward', 'forward_backward'],
+                   choices=['forward', 'forward_backward'])
+    p.add_argument('--rays', type=int, default=1024, help="Number of rays")
+    p.add_argument('--sdf_delta', type=float, default=1.0)
+    p.add_argument('--backend', default=None, choices=['native', 'torch'], help="Default: native if available")
+    p.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    p.add_argument('--warmup', type=int, default=2)
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('-o', '--output', default=None, help="Path of the JSON report, default: stdout")
+    args = p.parse_args()
+
+    report = run_benchmark(args.shapes, args.colors, args.compositions, args.strokes, args.samples, args.passes,
+                           args.rays, args.sdf_delta, args.backend, torch.device(args.device), args.warmup,
+                           args.repeat)
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,444 @@
+import math
+import torch
+import torch.nn.functional as F
+
+# Pure PyTorch reference of the stroke evaluation in src/strokes_kernel.h, gradients come from
+# autograd. Where the kernels deliberately stop gradients (unit-space color positions, texture
+# coordinates, the closest curve parameter and the radius scale), the reference detaches too.
+
+
+def _euler_rotation_matrix(angles: torch.Tensor):
+    """Rotation matrices of shape [..., 3, 3] that map unit space to world space (XYZ euler angles)."""
+    sx, sy, sz = torch.sin(angles).unbind(-1)
+    cx, cy, cz = torch.cos(angles).unbind(-1)
+    return torch.stack([
+        torch.stack([cy * cz, sx * sy * cz - cx * sz, sx * sz + cx * sy * cz], dim=-1),
+        torch.stack([cy * sz, cx * cz + sx * sy * sz, cx * sy * sz - sx * cz], dim=-1),
+        torch.stack([-sy, sx * cy, cx * cy], dim=-1),
+    ], dim=-2)
+
+
+def _dot(a: torch.Tensor, b: torch.Tensor):
+    return (a * b).sum(-1)
+
+
+def _length(v: torch.Tensor, eps: float = None):
+    if eps is None:
+        return torch.linalg.vector_norm(v, dim=-1)
+    return torch.sqrt(_dot(v, v) + eps)
+
+
+def _laplace_cdf(s: torch.Tensor):
+    return torch.where(s <= 0, 0.5 * torch.exp(s.clamp_max(0)), 1 - 0.5 * torch.exp(-s.clamp_min(0)))
+
+
+#####################################################################
+# Base Signed Distance Fields
+#####################################################################
+
+
+def _sdf_unit_sphere(p, params):
+    return _length(p, 1e-8) - 1
+
+
+def _sdf_unit_cube(p, params):
+    q = p.abs() - 1
+    return _length(q.clamp_min(0)) + q.amax(-1).clamp_max(0)
+
+
+def _sdf_unit_round_cube(p, params):
+    q = p.abs() - 1
+    return _length(q.clamp_min(0), 1e-8) + q.amax(-1).clamp_max(0) - params[..., 0]
+
+
+def _sdf_unit_capped_torus(p, params):
+    px, py, pz = p[..., 0].abs(), p[..., 1], p[..., 2]
+    s, c = torch.sin(params[..., 0]), torch.cos(params[..., 0])
+    k = torch.where(px * c - py * s > 0, px * s + py * c, torch.sqrt(px * px + py * py + 1e-8))
+    return torch.sqrt((px * px + py * py + pz * pz + 1 - 2 * k).clamp_min(0) + 1e-8) - params[..., 1]
+
+
+def _sdf_unit_capsule(p, params):
+    h = params[..., 0]
+    y = p[..., 1] - torch.minimum(torch.maximum(p[..., 1], -h), h)
+    return torch.sqrt(p[..., 0]**2 + y**2 + p[..., 2]**2 + 1e-8) - 1
+
+
+def _sdf_unit_line(p, params):
+    h, r_diff = params[..., 0], params[..., 1]
+    t = ((p[..., 1] + h) / (2 * h)).clamp(0, 1)
+    r = (1 - r_diff) + 2 * r_diff * t
+    y = p[..., 1] - torch.minimum(torch.maximum(p[..., 1], -h), h)
+    return torch.sqrt(p[..., 0]**2 + y**2 + p[..., 2]**2 + 1e-8) - r
+
+
+def _sdf_unit_triprism(p, params):
+    q = p.abs()
+    side = torch.maximum(q[..., 0] * 0.866025 + p[..., 2] * 0.5, -p[..., 2]) - 0.5
+    return torch.maximum(q[..., 1] - params[..., 0], side)
+
+
+def _sdf_unit_octahedron(p, params):
+    return (p.abs().sum(-1) - 1) * 0.57735027
+
+
+def _sdf_unit_tetrahedron(p, params):
+    x, y, z = p.unbind(-1)
+    return (torch.maximum((x + y).abs() - z, (x - y).abs() + z) - 1) * 0.57735027
+
+
+def _cbrt(x):
+    return torch.sign(x) * x.abs().clamp_min(1e-30).pow(1 / 3)
+
+
+def _sdf_quadratic_bezier(p, params):
+    A, B, C = params[..., 0:3], params[..., 3:6], params[..., 6:9]
+    r1, r2 = params[..., 9], params[..., 10]
+    a = B - A
+    b = A - 2 * B + C
+    c = 2 * a
+    d = A - p
+
+    kk = 1 / _dot(b, b)
+    kx = kk * _dot(a, b)
+    ky = kk * (2 * _dot(a, a) + _dot(d, b)) / 3
+    kz = kk * _dot(d, a)
+    pp = ky - kx * kx
+    q = kx * (2 * kx * kx - 3 * ky) + kz
+    h = q * q + 4 * pp**3
+
+    def dist_sq(t):
+        v = d + (c + b * t[..., None]) * t[..., None]
+        return _dot(v, v)
+
+    # One real root
+    h_sqrt = torch.sqrt(h.clamp_min(0) + 1e-8)
+    t_one = (_cbrt((h_sqrt - q) * 0.5) + _cbrt(-(h_sqrt + q) * 0.5) - kx).clamp(0, 1)
+    dist_one = dist_sq(t_one)
+
+    # Three real roots, the third one is never the closest
+    z = torch.sqrt((-pp).clamp_min(0) + 1e-8)
+    v = torch.acos((q / (pp * z * 2 + 1e-8)).clamp(-1 + 1e-6, 1 - 1e-6)) / 3
+    m = torch.cos(v)
+    n = torch.sin(v) * 1.732050808
+    t_a = ((m + n) * z - kx).clamp(0, 1)
+    t_b = ((-n - m) * z - kx).clamp(0, 1)
+    dist_a, dist_b = dist_sq(t_a), dist_sq(t_b)
+    dist_three = torch.where(dist_b < dist_a, dist_b, dist_a)
+    t_three = torch.where(dist_b < dist_a, t_b, t_a)
+
+    dist = torch.where(h >= 0, dist_one, dist_three)
+    t = torch.where(h >= 0, t_one, t_three)
+    return torch.sqrt(dist + 1e-8) - (r1 + (r2 - r1) * t)
+
+
+def _sdf_sampled_curve(p, points_fn, r1, r2, num_samples=10):
+    """Distance to a curve through its closest point on a polyline of num_samples segments."""
+    ts = torch.arange(num_samples + 1, device=p.device, dtype=p.dtype) / num_samples
+    points = points_fn(ts)  # [..., num_samples + 1, 3]
+    start, end = points[..., :-1, :], points[..., 1:, :]
+    ab = end - start
+    to_start = p[..., None, :] - start
+    t = (_dot(to_start, ab) / _dot(ab, ab)).clamp(0, 1)
+    dist = _length(to_start - t[..., None] * ab)
+    closest = dist.argmin(-1, keepdim=True)
+    t_min = (ts[:-1] * (1 - t) + ts[1:] * t).gather(-1, closest).squeeze(-1).detach()
+    closest_point = points_fn(t_min[..., None]).squeeze(-2)
+    return _length(closest_point - p) - (r1 + (r2 - r1) * t_min)
+
+
+def _sdf_cubic_bezier(p, params):
+    control_points = params[..., :12].unflatten(-1, (4, 3))
+
+    def points_fn(t):
+        u = 1 - t
+        basis = torch.stack([u * u * u, 3 * u * u * t, 3 * u * t * t, t * t * t], dim=-1)
+        return basis @ control_points
+
+    return _sdf_sampled_curve(p, points_fn, params[..., 12], params[..., 13])
+
+
+def _sdf_catmull_rom(p, params):
+    p0, p1, p2, p3 = params[..., :12].unflatten(-1, (4, 3)).unbind(-2)
+    t01 = torch.sqrt(_length(p0 - p1)[..., None] + 1e-8)
+    t12 = torch.sqrt(_length(p1 - p2)[..., None] + 1e-8)
+    t23 = torch.sqrt(_length(p2 - p3)[..., None] + 1e-8)
+    m1 = p2 - p1 + t12 * ((p1 - p0) / t01 - (p2 - p0) / (t01 + t12))
+    m2 = p2 - p1 + t12 * ((p3 - p2) / t23 - (p3 - p1) / (t12 + t23))
+    coeffs = torch.stack([2 * (p1 - p2) + m1 + m2, 3 * (p2 - p1) - 2 * m1 - m2, m1, p1], dim=-2)
+
+    def points_fn(t):
+        basis = torch.stack([t * t * t, t * t, t, torch.ones_like(t)], dim=-1)
+        return basis @ coeffs
+
+    return _sdf_sampled_curve(p, points_fn, params[..., 12], params[..., 13])
+
+
+_base_sdfs = {
+    'unit_sphere': _sdf_unit_sphere,
+    'unit_cube': _sdf_unit_cube,
+    'unit_round_cube': _sdf_unit_round_cube,
+    'unit_capped_torus': _sdf_unit_capped_torus,
+    'unit_capsule': _sdf_unit_capsule,
+    'unit_line': _sdf_unit_line,
+    'unit_triprism': _sdf_unit_triprism,
+    'unit_octahedron': _sdf_unit_octahedron,
+    'unit_tetrahedron': _sdf_unit_tetrahedron,
+    'quadratic_bezier': _sdf_quadratic_bezier,
+    'cubic_bezier': _sdf_cubic_bezier,
+    'catmull_rom': _sdf_catmull_rom,
+}
+
+#####################################################################
+# Texture Coordinates
+#####################################################################
+
+def _permute_multiscale_axis(d, scale):
+    """Order the axes by decreasing scale, as permute_multiscale_axis (up to ties)."""
+    perm = torch.argsort(scale, dim=-1, descending=True)
+    return d.gather(-1, perm.expand(*d.shape[:-1], 3))
+
+
+def _swap_xz_multiscale(p, scale):
+    return torch.where((scale[..., 2] > scale[..., 0])[..., None], p.flip(-1), p)
+
+
+def _texcoord(base_sdf_name, p, shape_params, enable_multiscale):
+    if base_sdf_name == 'unit_sphere':
+        d = F.normalize(p, dim=-1)
+        if enable_multiscale:
+            d = _permute_multiscale_axis(d, shape_params[..., 0:3])
+        u = torch.asin(d[..., 0].clamp(-1, 1)) / math.pi + 0.5
+        v = torch.atan2(d[..., 2], d[..., 1]) / (2 * math.pi) + 0.5
+    elif base_sdf_name in ('unit_cube', 'unit_round_cube'):
+        uvt = p * 0.5 + 0.5
+        if enable_multiscale:
+            uvt = _permute_multiscale_axis(uvt, shape_params[..., 0:3])
+        u = uvt[..., 0].clamp(0, 1)
+        v = uvt[..., 1].clamp(0, 1)
+    elif base_sdf_name in ('unit_capsule', 'unit_line'):
+        h = shape_params[..., 0]
+        if base_sdf_name == 'unit_capsule':
+            u = (p[..., 1] / (h + 1) * 0.5 + 0.5).clamp(0, 1)
+        else:
+            u = ((p[..., 1] + h + 1 - shape_params[..., 1]) / (2 * h + 2)).clamp(0, 1)
+        if enable_multiscale:
+            p = _swap_xz_multiscale(p, shape_params[..., 1:4])
+        v = torch.atan2(p[..., 2], p[..., 0]) / (2 * math.pi) + 0.5
+    else:
+        return torch.zeros(*p.shape[:-1], 2, dtype=p.dtype, device=p.device)
+    return torch.stack([u, v], dim=-1)
+
+
+#####################################################################
+# Color Fields
+#####################################################################
+
+
+def _sh_weights(degree: int, d: torch.Tensor):
+    x, y, z = d.unbind(-1)
+    weights = [torch.full_like(x, 0.28209479177387814)]
+    if degree > 1:
+        weights += [-0.48860251190291987 * y, 0.48860251190291987 * z, -0.48860251190291987 * x]
+    if degree > 2:
+        weights += [
+            1.0925484305920792 * x * y,
+            -1.0925484305920792 * y * z,
+            0.94617469575755997 * z * z - 0.31539156525251999,
+            -1.0925484305920792 * x * z,
+            0.54627421529603959 * (x * x - y * y),
+        ]
+    return torch.stack(weights, dim=-1)
+
+
+def _color(color_id: int, pos: torch.Tensor, viewdir: torch.Tensor, params: torch.Tensor):
+    if color_id == 0:  # constant_rgb
+        return params[..., :3]
+    elif color_id == 1:  # gradient_rgb
+        pos0, pos1, c0, c1 = params.unflatten(-1, (4, 3)).unbind(-2)
+        v1 = pos1 - pos0
+        t = torch.sigmoid(_dot(pos - pos0, v1) / _dot(v1, v1) * 5 - 2.5)[..., None]
+        return c0 * (1 - t) + c1 * t
+    elif color_id in (2, 3):  # constant_sh2, constant_sh3
+        weights = _sh_weights(color_id, viewdir)  # the sh degree equals the color id
+        return torch.sigmoid((weights[..., :, None] * params.unflatten(-1, (-1, 3))).sum(-2))
+    else:
+        assert 0, f'Unknown color id {color_id}'
+
+
+#####################################################################
+# Strokes
+#####################################################################
+
+
+def _stroke_point(x, radius, viewdir, shape_params, color_params, base_sdf_name, enable_translation,
+                  enable_rotation, enable_singlescale, enable_multiscale, color_id, sdf_delta,
+                  use_laplace_transform, inv_scale_radius, return_texcoord):
+    """Evaluate strokes on broadcastable points [..., 3] and parameters [..., num_params]."""
+    # Colors in world space, gradient_rgb is evaluated in unit space below
+    color = _color(color_id, x, viewdir, color_params) if color_id != 1 else None
+
+    # Apply the inverse shape transformation, parameters are read from the end
+    end = shape_params.shape[-1]
+    pos = x
+    if enable_translation:
+        pos = pos - shape_params[..., end - 3:end]
+        end -= 3
+    if enable_rotation:
+        pos = (pos[..., :, None] * _euler_rotation_matrix(shape_params[..., end - 3:end])).sum(-2)
+        end -= 3
+    scale = None
+    if enable_singlescale:
+        scale = shape_params[..., end - 1:end]
+        end -= 1
+    elif enable_multiscale:
+        scale = shape_params[..., end - 3:end]
+        end -= 3
+    if scale is not None:
+        pos = pos / scale
+
+    sdf_fn = _base_sdfs[base_sdf_name]
+    base_params = shape_params[..., :end]
+    sdf = sdf_fn(pos, base_params)
+
+    # Scale radii into unit space along the sdf gradient
+    if inv_scale_radius and scale is not None:
+        if enable_singlescale:
+            radius = radius / scale[..., 0].detach()
+        else:
+            with torch.enable_grad():
+                pos_detached = pos.detach().requires_grad_()
+                sdf_grad, = torch.autograd.grad(sdf_fn(pos_detached, base_params.detach()).sum(), pos_detached)
+            radius = radius * _length(sdf_grad) / _length(sdf_grad * scale.detach()).clamp_min(1e-12)
+
+    # Transform the SDF to compute the blending weight alpha
+    if sdf_delta > 0:
+        s = -sdf * (2.0 if use_laplace_transform else 0.5) / (sdf_delta * radius)
+        alpha = _laplace_cdf(s) if use_laplace_transform else (s + 0.5).clamp(0, 0.9999)
+    else:
+        alpha = (sdf <= 0).to(sdf.dtype)
+
+    if color is None:
+        color = _color(color_id, pos.detach(), viewdir, color_params)
+    color = color.expand(*alpha.shape, color.shape[-1])
+    texcoord = None
+    if return_texcoord:
+        texcoord = _texcoord(base_sdf_name, pos.detach(), shape_params.detach(), enable_multiscale)
+    return alpha, color, sdf, texcoord
+
+
+def stroke_reference(x: torch.Tensor,
+                     radius: torch.Tensor,
+                     viewdir: torch.Tensor,
+                     shape_params: torch.Tensor,
+                     color_params: torch.Tensor,
+                     base_sdf_name: str,
+                     enable_translation: bool,
+                     enable_rotation: bool,
+                     enable_singlescale: bool,
+                     enable_multiscale: bool,
+                     color_id: int,
+                     sdf_delta: float,
+                     use_laplace_transform: bool = False,
+                     inv_scale_radius: bool = False,
+                     no_sdf: bool = True,
+                     return_texcoord: bool = False,
+                     point_indices: torch.Tensor = None,
+                     stroke_indices: torch.Tensor = None,
+                     pair_output: bool = False):
+    """PyTorch reference of _stroke_fn, see its documentation for arguments and outputs."""
+    pre_shape = x.shape[:-1]
+    num_strokes = shape_params.shape[0]
+    x = x.reshape(-1, 3).float()
+    radius = radius.reshape(-1).float()
+    viewdir = viewdir[..., None, :].expand(*pre_shape, 3).reshape(-1, 3).float()
+    shape_params = shape_params.float()
+    color_params = color_params.float()
+    flags = (base_sdf_name, enable_translation, enable_rotation, enable_singlescale, enable_multiscale, color_id,
+             sdf_delta, use_laplace_transform, inv_scale_radius, return_texcoord)
+
+    if point_indices is None:
+        alpha, color, sdf, texcoord = _stroke_point(x[:, None], radius[:, None], viewdir[:, None],
+                                                    shape_params[None], color_params[None], *flags)
+    else:
+        # Only the candidate pairs are evaluated, the rest are left as empty space
+        point_indices, stroke_indices = point_indices.long(), stroke_indices.long()
+        alpha, color, sdf, texcoord = _stroke_point(x[point_indices], radius[point_indices],
+                                                    viewdir[point_indices], shape_params[stroke_indices],
+                                                    color_params[stroke_indices], *flags)
+        if not pair_output:
+            pairs = (point_indices, stroke_indices)
+            dense_shape = (x.shape[0], num_strokes)
+            alpha = alpha.new_zeros(dense_shape).index_put(pairs, alpha)
+            color = color.new_zeros(*dense_shape, color.shape[-1]).index_put(pairs, color)
+            sdf = sdf.new_full(dense_shape, torch.inf).index_put(pairs, sdf)
+            if texcoord is not None:
+                texcoord = texcoord.new_zeros(*dense_shape, 2).index_put(pairs, texcoord)
+
+    if not pair_output:
+        alpha = alpha.reshape(*pre_shape, num_strokes)
+        color = color.reshape(*pre_shape, num_strokes, -1)
+        sdf = sdf.reshape(*pre_shape, num_strokes)
+        texcoord = texcoord.reshape(*pre_shape, num_strokes, 2) if texcoord is not None else None
+    return alpha, color, None if no_sdf else sdf, texcoord
+
+
+#####################################################################
+# Compositing
+#####################################################################
+
+
+def over_composition_reference(alphas: torch.Tensor, colors: torch.Tensor, density_params: torch.Tensor,
+                               min_transmittance: float = 0.0):
+    """PyTorch reference of "over" composition, see compose_strokes.
+
+    density_params is of shape [num_strokes] or broadcastable to alphas.
+    """
+    alphas = alphas.flip(-1)
+    colors = colors.flip(-2)
+    density_params = density_params.flip(-1)
+    trans = torch.cumprod(1 - alphas, dim=-1)
+    trans_exclusive = torch.cat([torch.ones_like(trans[..., :1]), trans[..., :-1]], dim=-1)
+    weights = alphas * trans_exclusive
+    # Strokes are composited until the transmittance behind one drops below min_transmittance
+    reached = trans_exclusive >= min_transmittance
+    weights = torch.where(reached, weights, 0)
+    final_trans = trans.new_ones(trans.shape[:-1])
+    if trans.shape[-1] > 0:
+        final_trans = torch.where(reached, trans, 1).amin(-1)
+    density = (weights * density_params).sum(-1)
+    color = (weights[..., None] * colors).sum(-2) / (1 + 1e-6 - final_trans)[..., None]
+    return density, color.clamp(0, 1)
+
+
+def sparse_over_composition_reference(alphas: torch.Tensor, colors: torch.Tensor, density_params: torch.Tensor,
+                                      row_offsets: torch.Tensor, stroke_indices: torch.Tensor,
+                                      min_transmittance: float = 0.0):
+    """Sparse counterpart of over_composition_reference on CSR rows, rows are padded with empty strokes."""
+    num_points = row_offsets.shape[0] - 1
+    counts = row_offsets[1:] - row_offsets[:-1]
+    row_ids = torch.repeat_interleave(torch.arange(num_points, device=alphas.device), counts)
+    slots = torch.arange(alphas.shape[0], device=alphas.device) - row_offsets[row_ids]
+    padded_shape = (num_points, int(counts.max()) if num_points > 0 and alphas.shape[0] > 0 else 0)
+    pairs = (row_ids, slots)
+    alphas = alphas.new_zeros(padded_shape).index_put(pairs, alphas)
+    colors = colors.new_zeros(*padded_shape, colors.shape[-1]).index_put(pairs, colors)
+    density_params = density_params.new_zeros(padded_shape).index_put(pairs, density_params[stroke_indices.long()])
+    return over_composition_reference(alphas, colors, density_params, min_transmittance)
+
+
+def volume_render_reference(density: torch.Tensor, tdist: torch.Tensor, dir_norms: torch.Tensor,
+                            colors: torch.Tensor, bg_colors: torch.Tensor, opaque_background: bool = False):
+    """PyTorch reference of volume_render, see compute_alpha_weights and volumetric_rendering."""
+    density_delta = density * (tdist[..., 1:] - tdist[..., :-1]) * dir_norms[..., None]
+    if opaque_background:
+        density_delta = torch.cat([density_delta[..., :-1], torch.full_like(density_delta[..., -1:], torch.inf)], -1)
+    alpha = 1 - torch.exp(-density_delta)
+    trans = torch.exp(-torch.cat([torch.zeros_like(density_delta[..., :1]),
+                                  torch.cumsum(density_delta[..., :-1], dim=-1)], dim=-1))
+    weights = alpha * trans
+    acc = weights.sum(-1)
+    color = (weights[..., None] * colors).sum(-2) + (1 - acc[..., None]).clamp_min(0) * bg_colors
+    t_mids = 0.5 * (tdist[..., :-1] + tdist[..., 1:])
+    depth = (weights * t_mids).sum(-1) / acc.clamp_min(torch.finfo(torch.float32).eps)
+    return weights, color, acc, torch.clip(depth, tdist[..., 0], tdist[..., -1])
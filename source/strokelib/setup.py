@@ -1,8 +1,12 @@
 import os
+import sys
 from setuptools import setup
-from torch.utils.cpp_extension import BuildExtension, CUDAExtension
+import torch
+from torch.utils.cpp_extension import BuildExtension, CppExtension, CUDAExtension, CUDA_HOME
 
 _src_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, _src_path)
+from shapes import parse_kernel_spec
 
 nvcc_flags = [
     '-O3', 
@@ -13,7 +17,7 @@ nvcc_flags = [
 ]
 
 if os.name == "posix":
-    c_flags = ['-O3', '-std=c++17']
+    c_flags = ['-O3', '-std=c++17', '-Wno-unknown-pragmas']
 elif os.name == "nt":
     c_flags = ['/O2', '/std:c++17']
 
@@ -32,17 +36,41 @@ elif os.name == "nt":
             raise RuntimeError("Could not locate a supported Microsoft Visual C++ installation")
         os.environ["PATH"] += ";" + cl_path
 
+# CPU kernels are always built, CUDA kernels only when a CUDA toolkit is available
+sources = [
+    'strokes_cpu.cpp',
+    'strokes_fused_cpu.cpp',
+    'compositing_cpu.cpp',
+    'volume_rendering_cpu.cpp',
+    'bindings.cpp',
+]
+if CUDA_HOME is not None:
+    sources += [
+        'strokes_forward.cu',
+        'strokes_backward.cu',
+        'strokes_fused.cu',
+        'compositing.cu',
+        'volume_rendering.cu',
+    ]
+    Extension = CUDAExtension
+    c_flags = c_flags + ['-DWITH_CUDA']
+    nvcc_flags = nvcc_flags + ['-DWITH_CUDA']
+else:
+    Extension = CppExtension
+
+# STROKELIB_KERNELS="shape_type:color_type,..." only compiles the listed stroke functions
+fn_ids = parse_kernel_spec(os.environ.get('STROKELIB_KERNELS', ''))
+if fn_ids is not None:
+    fn_ids_flag = '-DSTROKELIB_FN_IDS=' + ','.join(str(fn_id) for fn_id in fn_ids)
+    c_flags = c_flags + [fn_ids_flag]
+    nvcc_flags = nvcc_flags + [fn_ids_flag]
+
 setup(
     name='strokelib', # package name, import this to use python API
     ext_modules=[
-        CUDAExtension(
+        Extension(
             name='_strokelib', # extension name, import this to use CUDA API
-            sources=[os.path.join(_src_path, 'src', f) for f in [
-                'strokes_forward.cu',
-                'strokes_backward.cu',
-                'compositing.cu',
-                'bindings.cpp',
-            ]],
+            sources=[os.path.join(_src_path, 'src', f) for f in sources],
             extra_compile_args={
                 'cxx': c_flags,
                 'nvcc': nvcc_flags,
@@ -0,0 +1,131 @@
+import torch
+
+# Stroke shape and color definitions. This module only depends on torch, so that the build scripts
+# can import it to map (shape_type, color_type) combinations to the stroke function ids to compile.
+
+_base_sdf_id = {
+    'unit_sphere': 0,
+    'unit_cube': 1,
+    'unit_round_cube': 2,
+    'unit_capped_torus': 3,
+    'unit_capsule': 4,
+    'unit_line': 5,
+    'unit_triprism': 6,
+    'unit_octahedron': 7,
+    'unit_tetrahedron': 8,
+    'quadratic_bezier': 9,
+    'cubic_bezier': 10,
+    'catmull_rom': 11,
+}
+
+def _make_uniform_init_fn(low, high):
+    def _init_fn(scale_min, scale_max, sample_coord):
+        low_ = torch.tensor(low, device=sample_coord.device)
+        high_ = torch.tensor(high, device=sample_coord.device)
+        return low_ + (high_ - low_) * torch.rand(sample_coord.shape[0], len(low), device=sample_coord.device)
+
+    return _init_fn
+
+
+def _make_spline_init_fn(num_control_points, num_radius):
+    def _init_fn(scale_min, scale_max, sample_coord):
+        num, device = sample_coord.shape[0], sample_coord.device
+        scales = torch.rand(num, 1, device=device) * (scale_max - scale_min) + scale_min
+        offsets = torch.rand(num, num_control_points, 3, device=device) - 0.5
+        control_points = sample_coord[:, None, :] + offsets * scales[:, :, None]
+        radius = (0.2 + 0.2 * torch.rand(num, num_radius, device=device)) * scales
+        return torch.cat([control_points.reshape(num, -1), radius], dim=-1)
+    
+    return _init_fn
+
+_sdf_dict = {
+    'sphere': ('unit_sphere', [], None, True, False, True, False),
+    'ellipsoid': ('unit_sphere', [], None, True, True, False, True),
+    'aacube': ('unit_cube', [], None, True, False, True, False),
+    'cube': ('unit_cube', [], None, True, True, True, False),
+    'aabb': ('unit_cube', [], None, True, False, False, True),
+    'obb': ('unit_cube', [], None, True, True, False, True),
+    'roundcube': ('unit_round_cube', [(0, 1)], _make_uniform_init_fn([0.0], [0.8]), True, True, True, False),
+    'roundbox': ('unit_round_cube', [(0, 1)], _make_uniform_init_fn([0.0], [0.8]), True, True, False, True),
+    'cappedtorus':
+    ('unit_capped_torus', [(0, 2 * torch.acos(torch.tensor(0.0))),
+                           (0, None)], _make_uniform_init_fn([0.0, 0.0], [1.0, 1.0]), True, True, True, False),
+    'capsule':
+    ('unit_capsule', [(0.25, None)], _make_uniform_init_fn([0.25], [1.25]), True, True, True, False),
+    'scapsule':
+    ('unit_capsule', [(0.25, None)], _make_uniform_init_fn([0.25], [1.25]), True, True, False, True),
+    'line': ('unit_line', [
+        (0.25, None), (-0.8, 0.8)
+    ], _make_uniform_init_fn([0.25, -0.5], [1.25, 0.5]), True, True, True, False),
+    'triprism': ('unit_triprism', [(0, None)], _make_uniform_init_fn([0.0], [1.0]), True, True, True, False),
+    'octahedron': ('unit_octahedron', [], None, True, True, True, False),
+    'tetrahedron': ('unit_tetrahedron', [], None, True, True, True, False),
+    'quadratic_bezier':
+    ('quadratic_bezier', [(-1, 1), (-1, 1), (-1, 1), 
+                          (-1, 1), (-1, 1), (-1, 1), 
+                          (-1, 1), (-1, 1), (-1, 1), 
+                          (0.001, 0.2), (0.001, 0.2)],
+     _make_spline_init_fn(3, 2), False, False, False, False),
+    'cubic_bezier':
+    ('cubic_bezier', [(-1, 1), (-1, 1), (-1, 1), 
+                      (-1, 1), (-1, 1), (-1, 1), 
+                      (-1, 1), (-1, 1), (-1, 1), 
+                      (-1, 1), (-1, 1), (-1, 1),
+                      (0.001, 0.2), (0.001, 0.2)],
+     _make_spline_init_fn(4, 2), False, False, False, False),
+    'catmull_rom':
+    ('catmull_rom', [(-1, 1), (-1, 1), (-1, 1), 
+                      (-1, 1), (-1, 1), (-1, 1), 
+                      (-1, 1), (-1, 1), (-1, 1), 
+                      (-1, 1), (-1, 1), (-1, 1),
+                      (0.001, 0.2), (0.001, 0.2)],
+     _make_spline_init_fn(4, 2), False, False, False, False),
+}
+
+_color_dict = {
+    'constant_rgb': (0, [(0, 1)] * 3, lambda num, device=None: torch.rand(num, 3, device=device)),
+    'gradient_rgb': (1, [(-1, 1)] * 6 + [(0, 1)] * 6,
+                     lambda num, device=None: torch.cat([torch.rand(num, 6, device=device) - 0.5,
+                                                         torch.rand(num, 6, device=device)], dim=-1)),
+    'constant_sh2': (2, [(None, None)] * 12, lambda num, device=None: torch.randn(num, 12, device=device)),
+    'constant_sh3': (3, [(None, None)] * 27, lambda num, device=None: torch.randn(num, 27, device=device)),
+}
+
+_color_dim = [3, 3, 3, 3]
+
+
+def _make_sdf_id(base_sdf_name: str, enable_translation: bool, enable_rotation: bool,
+                 enable_singlescale: bool, enable_multiscale: bool) -> int:
+    sdf_id = _base_sdf_id[base_sdf_name] << 4
+    if enable_translation:
+        sdf_id = sdf_id | (1 << 0)
+    if enable_rotation:
+        sdf_id = sdf_id | (1 << 1)
+    if enable_singlescale:
+        sdf_id = sdf_id | (1 << 2)
+    if enable_multiscale:
+        sdf_id = sdf_id | (1 << 3)
+    return sdf_id
+
+
+def get_stroke_fn_id(shape_type: str, color_type: str) -> int:
+    """Id of the stroke function of a (shape_type, color_type) combination in the kernel tables."""
+    base_sdf_name, _, _, enable_translation, enable_rotation, enable_singlescale, enable_multiscale = \
+        _sdf_dict[shape_type]
+    sdf_id = _make_sdf_id(base_sdf_name, enable_translation, enable_rotation, enable_singlescale,
+                          enable_multiscale)
+    return sdf_id * len(_color_dict) + _color_dict[color_type][0]
+
+
+def parse_kernel_spec(spec: str):
+    """Parse a comma separated list of "shape_type:color_type" into sorted stroke function ids.
+
+    Returns None for an empty spec, meaning that all stroke functions are compiled.
+    """
+    if not spec or not spec.strip():
+        return None
+    fn_ids = set()
+    for entry in spec.split(','):
+        shape_type, color_type = entry.strip().split(':')
+        fn_ids.add(get_stroke_fn_id(shape_type.strip(), color_type.strip()))
+    return sorted(fn_ids)
@@ -0,0 +1,142 @@
+import torch
+from typing import NamedTuple
+
+from .strokes import _stroke_aabb, stroke_alpha_band
+
+
+class StrokeGrid(NamedTuple):
+    """A uniform grid that lists the strokes overlapping each cell."""
+    grid_min: torch.Tensor  # [3], lower corner of the grid.
+    cell_size: torch.Tensor  # [3], side lengths of a cell.
+    resolution: int  # Number of cells along each axis.
+    cell_offsets: torch.Tensor  # [resolution**3 + 1], start of each cell in cell_strokes.
+    cell_strokes: torch.Tensor  # [num_entries], stroke indices sorted by cell then stroke.
+
+
+@torch.no_grad()
+def build_stroke_grid(aabb_min: torch.Tensor, aabb_max: torch.Tensor, resolution: int = 32):
+    """Bin stroke bounding boxes into a uniform grid over their union.
+
+    Args:
+        aabb_min (torch.Tensor): Lower corners of the strokes of shape [num_strokes, 3].
+        aabb_max (torch.Tensor): Upper corners of the strokes of shape [num_strokes, 3].
+        resolution (int): Number of cells along each axis.
+
+    Returns:
+        grid (StrokeGrid): The stroke grid.
+    """
+    device = aabb_min.device
+    num_strokes = aabb_min.shape[0]
+    num_cells = resolution**3
+    if num_strokes == 0:
+        return StrokeGrid(torch.zeros(3, device=device), torch.ones(3, device=device), resolution,
+                          torch.zeros(num_cells + 1, dtype=torch.long, device=device),
+                          torch.zeros(0, dtype=torch.long, device=device))
+
+    grid_min = aabb_min.amin(0)
+    grid_max = aabb_max.amax(0)
+    cell_size = ((grid_max - grid_min) / resolution).clamp_min(1e-6)
+
+    # Cell range [lo, hi] covered by each stroke
+    lo = ((aabb_min - grid_min) / cell_size).floor().long().clamp(0, resolution - 1)
+    hi = ((aabb_max - grid_min) / cell_size).floor().long().clamp(0, resolution - 1)
+    extent = hi - lo + 1  # [S, 3]
+    counts = extent.prod(-1)
+
+    # Enumerate all (cell, stroke) entries
+    stroke_ids = torch.repeat_interleave(torch.arange(num_strokes, device=device), counts)
+    starts = torch.cumsum(counts, 0) - counts
+    local = torch.arange(stroke_ids.shape[0], device=device) - starts[stroke_ids]
+    ext = extent[stroke_ids]
+    cx = lo[stroke_ids, 0] + local // (ext[:, 1] * ext[:, 2])
+    cy = lo[stroke_ids, 1] + (local // ext[:, 2]) % ext[:, 1]
+    cz = lo[stroke_ids, 2] + local % ext[:, 2]
+    cell_ids = (cx * resolution + cy) * resolution + cz
+
+    order = torch.argsort(cell_ids * num_strokes + stroke_ids)
+    cell_strokes = stroke_ids[order]
+    cell_offsets = torch.zeros(num_cells + 1, dtype=torch.long, device=device)
+    cell_offsets[1:] = torch.cumsum(torch.bincount(cell_ids, minlength=num_cells), 0)
+    return StrokeGrid(grid_min, cell_size, resolution, cell_offsets, cell_strokes)
+
+
+@torch.no_grad()
+def query_stroke_grid(grid: StrokeGrid, x: torch.Tensor):
+    """List the candidate strokes of each point.
+
+    Args:
+        grid (StrokeGrid): The stroke grid.
+        x (torch.Tensor): Point coordinates of shape [num_points, 3].
+
+    Returns:
+        point_indices (torch.Tensor): Point index of each candidate pair of shape [num_pairs], int32.
+        stroke_indices (torch.Tensor): Stroke index of each candidate pair of shape [num_pairs], int32.
+            Pairs are sorted by point and then by stroke.
+    """
+    res = grid.resolution
+    cell = ((x - grid.grid_min) / grid.cell_size).floor().long()
+    inside = ((cell >= 0) & (cell < res)).all(-1)
+    cell = cell.clamp(0, res - 1)
+    cell_ids = (cell[:, 0] * res + cell[:, 1]) * res + cell[:, 2]
+
+    begin = grid.cell_offsets[cell_ids]
+    counts = torch.where(inside, grid.cell_offsets[cell_ids + 1] - begin, 0)
+    point_indices = torch.repeat_interleave(torch.arange(x.shape[0], device=x.device), counts)
+    starts = torch.cumsum(counts, 0) - counts
+    entry = begin[point_indices] + torch.arange(point_indices.shape[0], device=x.device) - starts[point_indices]
+    stroke_indices = grid.cell_strokes[entry]
+    return point_indices.int(), stroke_indices.int()
+
+
+@torch.no_grad()
+def build_stroke_grid_from_params(shape_type: str,
+                                  shape_params: torch.Tensor,
+                                  sdf_band: float,
+                                  inv_scale_radius: bool = False,
+                                  resolution: int = 32):
+    """Build the stroke grid from stroke shape parameters, see _stroke_aabb for the sdf band."""
+    aabb_min, aabb_max = _stroke_aabb(shape_type, shape_params.detach(), sdf_band, inv_scale_radius)
+    return build_stroke_grid(aabb_min, aabb_max, resolution)
+
+
+@torch.no_grad()
+def cull_spheres_to_rays(sphere_center: torch.Tensor,
+                         sphere_radius: torch.Tensor,
+                         origins: torch.Tensor,
+                         directions: torch.Tensor,
+                         near: torch.Tensor,
+                         far: torch.Tensor):
+    """Conservatively test which spheres can be hit by a bundle of rays, e.g. the rays of a view.
+
+    The rays are enclosed by a cone from their mean origin, around their mean direction, which is
+    clipped to the range of distances between near and far.
+
+    Args:
+        sphere_center (torch.Tensor): Sphere centers of shape [num_spheres, 3].
+        sphere_radius (torch.Tensor): Sphere radii of shape [num_spheres].
+        origins (torch.Tensor): Ray origins of shape [num_rays, 3].
+        directions (torch.Tensor): Ray directions of shape [num_rays, 3].
+        near (torch.Tensor): Near distances along the directions of shape [num_rays] or [num_rays, 1].
+        far (torch.Tensor): Far distances along the directions of shape [num_rays] or [num_rays, 1].
+
+    Returns:
+        visible (torch.Tensor): Whether each sphere may be hit of shape [num_spheres], bool.
+    """
+    dir_norm = torch.linalg.norm(directions, dim=-1)
+    dirs = directions / dir_norm[:, None].clamp_min(1e-12)
+    axis = torch.nn.functional.normalize(dirs.mean(0), dim=0)
+    cone_angle = torch.acos((dirs @ axis).amin().clamp(-1, 1))
+    dist_min = (near.reshape(-1) * dir_norm).amin()
+    dist_max = (far.reshape(-1) * dir_norm).amax()
+
+    # Offsetting a ray origin by d moves the hit sphere by d, so inflate the spheres instead
+    origin = origins.mean(0)
+    radius = sphere_radius + torch.linalg.norm(origins - origin, dim=-1).amax()
+    offset = sphere_center - origin
+    dist = torch.linalg.norm(offset, dim=-1)
+    in_range = (dist - radius <= dist_max) & (dist + radius >= dist_min)
+    contains_origin = dist <= radius
+    angle = torch.acos(((offset @ axis) / dist.clamp_min(1e-12)).clamp(-1, 1))
+    angle_radius = torch.asin((radius / dist.clamp_min(1e-12)).clamp(max=1))
+    in_cone = contains_origin | (angle <= cone_angle + angle_radius)
+    return in_range & in_cone
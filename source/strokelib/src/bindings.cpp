@@ -1,12 +1,232 @@
 #include <torch/extension.h>
 
+#include "common.h"
 #include "strokes.h"
 #include "compositing.h"
+#include "volume_rendering.h"
+
+// Dispatch to the CUDA or the CPU implementation based on the device of the input
+#ifdef WITH_CUDA
+#define DISPATCH_DEVICE(fname, x, ...) \
+    if (x.is_cuda())                   \
+        fname##_cuda(__VA_ARGS__);     \
+    else                               \
+        fname##_cpu(__VA_ARGS__)
+#else
+#define DISPATCH_DEVICE(fname, x, ...)                                             \
+    TORCH_CHECK(!x.is_cuda(), #fname ": strokelib is compiled without CUDA support"); \
+    fname##_cpu(__VA_ARGS__)
+#endif
+
+void stroke_forward(at::Tensor alpha_output,
+                    at::Tensor color_output,
+                    at::Tensor sdf_output,
+                    at::Tensor texcoord_output,
+                    const at::Tensor x,
+                    const at::Tensor radius,
+                    const at::Tensor viewdir,
+                    const at::Tensor shape_params,
+                    const at::Tensor color_params,
+                    const at::Tensor point_indices,
+                    const at::Tensor stroke_indices,
+                    const bool pair_output,
+                    const uint32_t sdf_id,
+                    const uint32_t color_id,
+                    const float sdf_delta,
+                    const bool use_laplace_transform,
+                    const bool inv_scale_radius)
+{
+    DISPATCH_DEVICE(stroke_forward, x, alpha_output, color_output, sdf_output, texcoord_output, x, radius,
+                    viewdir, shape_params, color_params, point_indices, stroke_indices, pair_output, sdf_id, color_id,
+                    sdf_delta, use_laplace_transform, inv_scale_radius);
+}
+
+void stroke_backward(at::Tensor grad_shape_params,
+                     at::Tensor grad_color_params,
+                     at::Tensor grad_x,
+                     const at::Tensor grad_alpha,
+                     const at::Tensor grad_color,
+                     const at::Tensor grad_sdf,
+                     const at::Tensor x,
+                     const at::Tensor radius,
+                     const at::Tensor viewdir,
+                     const at::Tensor alpha,
+                     const at::Tensor shape_params,
+                     const at::Tensor color_params,
+                     const at::Tensor point_indices,
+                     const at::Tensor stroke_indices,
+                     const bool pair_output,
+                     const uint32_t sdf_id,
+                     const uint32_t color_id,
+                     const float sdf_delta,
+                     const bool use_laplace_transform,
+                     const bool inv_scale_radius)
+{
+    DISPATCH_DEVICE(stroke_backward, x, grad_shape_params, grad_color_params, grad_x, grad_alpha, grad_color,
+                    grad_sdf, x, radius, viewdir, alpha, shape_params, color_params, point_indices, stroke_indices,
+                    pair_output, sdf_id, color_id, sdf_delta, use_laplace_transform, inv_scale_radius);
+}
+
+void stroke_compose_forward(at::Tensor density_output,
+                            at::Tensor color_output,
+                            const at::Tensor x,
+                            const at::Tensor radius,
+                            const at::Tensor viewdir,
+                            const at::Tensor shape_params,
+                            const at::Tensor color_params,
+                            const at::Tensor density_params,
+                            const at::Tensor row_offsets,
+                            const at::Tensor stroke_indices,
+                            const uint32_t sdf_id,
+                            const uint32_t color_id,
+                            const float sdf_delta,
+                            const bool use_laplace_transform,
+                            const bool inv_scale_radius,
+                            const float min_transmittance)
+{
+    DISPATCH_DEVICE(stroke_compose_forward, x, density_output, color_output, x, radius, viewdir, shape_params,
+                    color_params, density_params, row_offsets, stroke_indices, sdf_id, color_id, sdf_delta,
+                    use_laplace_transform, inv_scale_radius, min_transmittance);
+}
+
+void stroke_compose_backward(at::Tensor grad_shape_params,
+                             at::Tensor grad_color_params,
+                             at::Tensor grad_density_params,
+                             at::Tensor grad_x,
+                             const at::Tensor grad_density_output,
+                             const at::Tensor grad_color_output,
+                             const at::Tensor x,
+                             const at::Tensor radius,
+                             const at::Tensor viewdir,
+                             const at::Tensor shape_params,
+                             const at::Tensor color_params,
+                             const at::Tensor density_params,
+                             const at::Tensor row_offsets,
+                             const at::Tensor stroke_indices,
+                             const uint32_t sdf_id,
+                             const uint32_t color_id,
+                             const float sdf_delta,
+                             const bool use_laplace_transform,
+                             const bool inv_scale_radius,
+                             const float min_transmittance)
+{
+    DISPATCH_DEVICE(stroke_compose_backward, x, grad_shape_params, grad_color_params, grad_density_params, grad_x,
+                    grad_density_output, grad_color_output, x, radius, viewdir, shape_params, color_params,
+                    density_params, row_offsets, stroke_indices, sdf_id, color_id, sdf_delta, use_laplace_transform,
+                    inv_scale_radius, min_transmittance);
+}
+
+void compose_forward(at::Tensor density_output,
+                     at::Tensor color_output,
+                     const at::Tensor alphas,
+                     const at::Tensor colors,
+                     const at::Tensor density_params,
+                     const at::Tensor row_offsets,
+                     const at::Tensor stroke_indices,
+                     const float min_transmittance)
+{
+    DISPATCH_DEVICE(compose_forward, alphas, density_output, color_output, alphas, colors, density_params,
+                    row_offsets, stroke_indices, min_transmittance);
+}
+
+void compose_backward(at::Tensor grad_alphas,
+                      at::Tensor grad_colors,
+                      at::Tensor grad_density_params,
+                      const at::Tensor grad_density_output,
+                      const at::Tensor grad_color_output,
+                      const at::Tensor alphas,
+                      const at::Tensor colors,
+                      const at::Tensor density_params,
+                      const at::Tensor row_offsets,
+                      const at::Tensor stroke_indices,
+                      const float min_transmittance)
+{
+    DISPATCH_DEVICE(compose_backward, alphas, grad_alphas, grad_colors, grad_density_params, grad_density_output,
+                    grad_color_output, alphas, colors, density_params,
+                    row_offsets, stroke_indices, min_transmittance);
+}
+
+void compose_reduce_forward(at::Tensor density_output,
+                            at::Tensor color_output,
+                            const at::Tensor alphas,
+                            const at::Tensor colors,
+                            const at::Tensor density_params,
+                            const at::Tensor row_offsets,
+                            const at::Tensor stroke_indices,
+                            const uint32_t composition_type,
+                            const float inv_temperature)
+{
+    DISPATCH_DEVICE(compose_reduce_forward, alphas, density_output, color_output, alphas, colors, density_params,
+                    row_offsets, stroke_indices, composition_type, inv_temperature);
+}
+
+void compose_reduce_backward(at::Tensor grad_alphas,
+                             at::Tensor grad_colors,
+                             at::Tensor grad_density_params,
+                             const at::Tensor grad_density_output,
+                             const at::Tensor grad_color_output,
+                             const at::Tensor alphas,
+                             const at::Tensor colors,
+                             const at::Tensor density_params,
+                             const at::Tensor row_offsets,
+                             const at::Tensor stroke_indices,
+                             const uint32_t composition_type,
+                             const float inv_temperature)
+{
+    DISPATCH_DEVICE(compose_reduce_backward, alphas, grad_alphas, grad_colors, grad_density_params,
+                    grad_density_output, grad_color_output, alphas, colors, density_params, row_offsets,
+                    stroke_indices, composition_type, inv_temperature);
+}
+
+void volume_render_forward(at::Tensor weights_output,
+                           at::Tensor color_output,
+                           at::Tensor acc_output,
+                           at::Tensor depth_output,
+                           const at::Tensor density,
+                           const at::Tensor tdist,
+                           const at::Tensor dir_norms,
+                           const at::Tensor colors,
+                           const at::Tensor bg_colors,
+                           const bool opaque_background)
+{
+    DISPATCH_DEVICE(volume_render_forward, density, weights_output, color_output, acc_output, depth_output,
+                    density, tdist, dir_norms, colors, bg_colors, opaque_background);
+}
+
+void volume_render_backward(at::Tensor grad_density,
+                            at::Tensor grad_colors,
+                            const at::Tensor grad_weights_output,
+                            const at::Tensor grad_color_output,
+                            const at::Tensor grad_acc_output,
+                            const at::Tensor grad_depth_output,
+                            const at::Tensor density,
+                            const at::Tensor tdist,
+                            const at::Tensor dir_norms,
+                            const at::Tensor colors,
+                            const at::Tensor bg_colors,
+                            const at::Tensor weights,
+                            const bool opaque_background)
+{
+    DISPATCH_DEVICE(volume_render_backward, density, grad_density, grad_colors, grad_weights_output,
+                    grad_color_output, grad_acc_output, grad_depth_output, density, tdist, dir_norms, colors,
+                    bg_colors, weights, opaque_background);
+}
 
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
-    m.def("stroke_forward", &stroke_forward, "stroke_forward (CUDA)");
-    m.def("stroke_backward", &stroke_backward, "stroke_backward (CUDA)");
+    m.def("stroke_forward", &stroke_forward, "stroke_forward (CUDA/CPU)");
+    m.def("stroke_backward", &stroke_backward, "stroke_backward (CUDA/CPU)");
+
+    m.def("stroke_compose_forward", &stroke_compose_forward, "stroke_compose_forward (CUDA/CPU)");
+    m.def("stroke_compose_backward", &stroke_compose_backward, "stroke_compose_backward (CUDA/CPU)");
+
+    m.def("compose_forward", &compose_forward, "compose_forward (CUDA/CPU)");
+    m.def("compose_backward", &compose_backward, "compose_backward (CUDA/CPU)");
+    m.def("compose_reduce_forward", &compose_reduce_forward, "compose_reduce_forward (CUDA/CPU)");
+    m.def("compose_reduce_backward", &compose_reduce_backward, "compose_reduce_backward (CUDA/CPU)");
+
+    m.def("volume_render_forward", &volume_render_forward, "volume_render_forward (CUDA/CPU)");
+    m.def("volume_render_backward", &volume_render_backward, "volume_render_backward (CUDA/CPU)");
 
-    m.def("compose_forward", &compose_forward, "compose_forward (CUDA)");
-    m.def("compose_backward", &compose_backward, "compose_backward (CUDA)");
-}
\ No newline at end of file
+    m.def("has_stroke_fn", [](const uint32_t fn_id) { return fn_id_enabled(fn_id); },
+          "Whether the stroke function of the given id is compiled");
+}
@@ -1,16 +1,22 @@
 #pragma once
 
+#ifdef __CUDACC__
 #include <cuda.h>
 #include <cuda_fp16.h>
 #include <cuda_runtime.h>
+#include <c10/cuda/CUDAGuard.h>
+#else
+#include "host_compat.h"
+#endif
 #include <torch/torch.h>
 #include <torch/extension.h>
-#include <c10/cuda/CUDAGuard.h>
 
 #define CHECK_CUDA(x) TORCH_CHECK(x.device().is_cuda(), #x " must be a CUDA tensor")
+#define CHECK_CPU(x) TORCH_CHECK(x.device().is_cpu(), #x " must be a CPU tensor")
 #define CHECK_CONTIGUOUS(x) TORCH_CHECK(x.is_contiguous(), #x " must be a contiguous tensor")
 #define CHECK_IS_INT(x) TORCH_CHECK(x.scalar_type() == at::ScalarType::Int, #x " must be an int tensor")
-#define CHECK_IS_FLOATING(x) TORCH_CHECK(x.scalar_type() == at::ScalarType::Float || x.scalar_type() == at::ScalarType::Half || x.scalar_type() == at::ScalarType::Double, #x " must be a floating tensor")
+#define CHECK_IS_LONG(x) TORCH_CHECK(x.scalar_type() == at::ScalarType::Long, #x " must be a long tensor")
+#define CHECK_IS_FLOATING(x) TORCH_CHECK(x.scalar_type() == at::ScalarType::Float || x.scalar_type() == at::ScalarType::Half || x.scalar_type() == at::ScalarType::BFloat16 || x.scalar_type() == at::ScalarType::Double, #x " must be a floating tensor")
 #define CHECK_IS_FLOAT(x) TORCH_CHECK(x.scalar_type() == at::ScalarType::Float, #x " must be a float32 tensor")
 #define CHECK_IS_SAME_TYPE(x, y) TORCH_CHECK(x.scalar_type() == y.scalar_type(), #x " and " #y " must have the same type")
 #define CHECK_FLOATING_INPUT(x) \
@@ -21,12 +27,63 @@
     CHECK_CUDA(x);           \
     CHECK_CONTIGUOUS(x);     \
     CHECK_IS_FLOAT(x)
+#define CHECK_FLOATING_CPU_INPUT(x) \
+    CHECK_CPU(x);                   \
+    CHECK_CONTIGUOUS(x);            \
+    CHECK_IS_FLOATING(x)
+#define CHECK_FLOAT_CPU_INPUT(x) \
+    CHECK_CPU(x);                \
+    CHECK_CONTIGUOUS(x);         \
+    CHECK_IS_FLOAT(x)
+#define CHECK_INT_INPUT(x) \
+    CHECK_CUDA(x);         \
+    CHECK_CONTIGUOUS(x);   \
+    CHECK_IS_INT(x)
+#define CHECK_INT_CPU_INPUT(x) \
+    CHECK_CPU(x);              \
+    CHECK_CONTIGUOUS(x);       \
+    CHECK_IS_INT(x)
+#define CHECK_LONG_INPUT(x) \
+    CHECK_CUDA(x);          \
+    CHECK_CONTIGUOUS(x);    \
+    CHECK_IS_LONG(x)
+#define CHECK_LONG_CPU_INPUT(x) \
+    CHECK_CPU(x);               \
+    CHECK_CONTIGUOUS(x);        \
+    CHECK_IS_LONG(x)
+
+// Stroke function ids (sdf_id * NB_COLORS + color_id) to instantiate, given at build time as
+// -DSTROKELIB_FN_IDS=id0,id1,... to compile only the strokes in use. All ids when undefined.
+#ifdef STROKELIB_FN_IDS
+constexpr uint32_t enabled_fn_ids[] = {STROKELIB_FN_IDS};
+#endif
 
+constexpr bool fn_id_enabled(size_t fn_id)
+{
+#ifdef STROKELIB_FN_IDS
+    for (uint32_t enabled_id : enabled_fn_ids)
+        if (enabled_id == fn_id)
+            return true;
+    return false;
+#else
+    return true;
+#endif
+}
+
+// Lookup table of fname<0..N-1>, ids that are not enabled are not instantiated and left as nullptr
 #define DECLARE_INT_TEMPLATE_ARG_LUT(fname)                        \
+    template <size_t N>                                            \
+    static constexpr auto fname##_entry()                          \
+    {                                                              \
+        if constexpr (fn_id_enabled(N))                            \
+            return &fname<N>;                                      \
+        else                                                       \
+            return static_cast<decltype(&fname<0>)>(nullptr);      \
+    }                                                              \
     template <size_t... N>                                         \
     static constexpr auto fname##_lut(std::index_sequence<N...> s) \
     {                                                              \
-        return std::array{(&fname<N>)...};                         \
+        return std::array{fname##_entry<N>()...};                  \
     }
 
 #define MAKE_INT_TEMPLATE_ARG_LUT(fname, N) \
@@ -5,259 +5,368 @@
 #include "common.h"
 #include "helper_math.h"
 #include "compositing.h"
+#include "compositing_kernel.h"
 
-template <int color_dim>
+template <int color_dim, typename scalar_t>
 __global__ void compose_forward_kernel(float *__restrict__ density_output,
                                        float *__restrict__ color_output,
-                                       const float *__restrict__ alphas,
-                                       const float *__restrict__ colors,
+                                       const scalar_t *__restrict__ alphas,
+                                       const scalar_t *__restrict__ colors,
                                        const float *__restrict__ density_params,
+                                       const int64_t *__restrict__ row_offsets,
+                                       const int32_t *__restrict__ stroke_indices,
                                        const int64_t n_points,
-                                       const int64_t n_strokes)
+                                       const int64_t n_strokes,
+                                       const float min_transmittance)
 {
     const uint32_t idx_point = threadIdx.x + blockIdx.x * blockDim.x;
     if (idx_point >= n_points)
         return;
 
-    alphas += idx_point * n_strokes;
-    colors += idx_point * n_strokes * color_dim;
-
-    // Initialize T, density and color
-    float T = 1.0f;
-    float density = 0.0f;
-    float color[color_dim];
-#pragma unroll
-    for (int i = 0; i < color_dim; ++i)
-        color[i] = 0.0f;
-
-    // Compute accumulated density and color
-    for (int idx_stroke = n_strokes - 1; idx_stroke >= 0; --idx_stroke)
-    {
-        const float alpha = alphas[idx_stroke];
-        if (alpha == 0.0f) // skip zero alpha for speedup
-            continue;
-
-        const float weight = alpha * T;
-        T *= (1.0f - alpha);
-        density += density_params[idx_stroke] * weight;
-#pragma unroll
-        for (int i = 0; i < color_dim; ++i)
-            color[i] += colors[idx_stroke * color_dim + i] * weight;
-    }
-
-    // Compute final color
-    float final_color_scale = 1.0f / (1.0f + 1e-6f - T); // 1 / (1 - T_n)
-#pragma unroll
-    for (int i = 0; i < color_dim; ++i)
-        color[i] = clamp(color[i] * final_color_scale, 0.0f, 1.0f);
-
-    // Store density and color
-    density_output[idx_point] = density;
-#pragma unroll
-    for (int i = 0; i < color_dim; ++i)
-        color_output[idx_point * color_dim + i] = color[i];
+    compose_forward_point<color_dim, scalar_t>(density_output,
+                                     color_output,
+                                     alphas,
+                                     colors,
+                                     density_params,
+                                     row_offsets,
+                                     stroke_indices,
+                                     idx_point,
+                                     n_strokes,
+                                     min_transmittance);
 }
 
-template <int color_dim>
-__global__ void compose_backward_kernel(float *__restrict__ grad_alphas,
-                                        float *__restrict__ grad_colors,
+template <int color_dim, typename scalar_t>
+__global__ void compose_backward_kernel(scalar_t *__restrict__ grad_alphas,
+                                        scalar_t *__restrict__ grad_colors,
                                         float *__restrict__ grad_density_params,
                                         const float *__restrict__ grad_density_output,
                                         const float *__restrict__ grad_color_output,
-                                        const float *__restrict__ alphas,
-                                        const float *__restrict__ colors,
+                                        const scalar_t *__restrict__ alphas,
+                                        const scalar_t *__restrict__ colors,
                                         const float *__restrict__ density_params,
+                                        const int64_t *__restrict__ row_offsets,
+                                        const int32_t *__restrict__ stroke_indices,
                                         const int64_t n_points,
-                                        const int64_t n_strokes)
+                                        const int64_t n_strokes,
+                                        const float min_transmittance)
 {
     const uint32_t idx_point = threadIdx.x + blockIdx.x * blockDim.x;
     if (idx_point >= n_points)
         return;
 
-    alphas += idx_point * n_strokes;
-    colors += idx_point * n_strokes * color_dim;
-    grad_alphas += idx_point * n_strokes;
-    grad_colors += idx_point * n_strokes * color_dim;
-
-    // Recompute density and color outputs
-    float T = 1.0f;
-    float density = 0.0f;
-    float color[color_dim];
-#pragma unroll
-    for (int i = 0; i < color_dim; ++i)
-        color[i] = 0.0f;
-    for (int idx_stroke = n_strokes - 1; idx_stroke >= 0; --idx_stroke)
-    {
-        const float alpha = alphas[idx_stroke];
-        if (alpha == 0.0f) // skip zero alpha for speedup
-            continue;
+    compose_backward_point<color_dim, scalar_t>(grad_alphas,
+                                      grad_colors,
+                                      grad_density_params,
+                                      grad_density_output,
+                                      grad_color_output,
+                                      alphas,
+                                      colors,
+                                      density_params,
+                                      row_offsets,
+                                      stroke_indices,
+                                      idx_point,
+                                      n_strokes,
+                                      min_transmittance);
+}
 
-        const float weight = alpha * T;
-        T *= (1.0f - alpha);
-        density += density_params[idx_stroke] * weight;
-#pragma unroll
-        for (int i = 0; i < color_dim; ++i)
-            color[i] += colors[idx_stroke * color_dim + i] * weight;
-    }
+void compose_forward_cuda(at::Tensor density_output,
+                          at::Tensor color_output,
+                          const at::Tensor alphas,
+                          const at::Tensor colors,
+                          const at::Tensor density_params,
+                          const at::Tensor row_offsets,
+                          const at::Tensor stroke_indices,
+                          const float min_transmittance)
+{
+    CHECK_FLOAT_INPUT(density_output);
+    CHECK_FLOAT_INPUT(color_output);
+    CHECK_FLOATING_INPUT(alphas);
+    CHECK_FLOATING_INPUT(colors);
+    CHECK_IS_SAME_TYPE(alphas, colors);
+    CHECK_FLOAT_INPUT(density_params);
+    CHECK_LONG_INPUT(row_offsets);
+    CHECK_INT_INPUT(stroke_indices);
 
-    // Load gradients
-    float dL_ddensity = grad_density_output[idx_point];
-    float dL_dcolor[color_dim];
-    float final_opacity = 1.0f + 1e-6f - T;         // (1 - T_n)
-    float final_color_scale = 1.0f / final_opacity; // 1 / (1 - T_n)
-#pragma unroll
-    for (int i = 0; i < color_dim; ++i)
-    {
-        float scaled_color = color[i] * final_color_scale;
-        bool in_range = 0.0f <= scaled_color && scaled_color <= 1.0f;
-        dL_dcolor[i] = in_range ? grad_color_output[idx_point * color_dim + i] : 0.0f;
-    }
+    const bool is_sparse = row_offsets.numel() > 0;
+    const int64_t n_points = is_sparse ? row_offsets.size(0) - 1 : alphas.size(0);
+    const int64_t n_strokes = density_params.size(0);
+    const int64_t color_dim = colors.size(colors.dim() - 1);
 
-    // Compute accumulated density and color
-    T = 1.0f;
-    float density2 = 0.0f;
-    float color2[color_dim];
-#pragma unroll
-    for (int i = 0; i < color_dim; ++i)
-        color2[i] = 0.0f;
-    for (int idx_stroke = n_strokes - 1; idx_stroke >= 0; --idx_stroke)
-    {
-        const float alpha = alphas[idx_stroke];
+    constexpr int64_t n_threads = 512;
+    const int64_t n_blocks = div_round_up(n_points, n_threads);
 
-        // Calculate gradients for density_params and colors
-        if (alpha > 0.0f)
+    at::cuda::CUDAStream stream = at::cuda::getCurrentCUDAStream();
+    AT_DISPATCH_FLOATING_TYPES_AND2(at::ScalarType::Half, at::ScalarType::BFloat16, alphas.scalar_type(),
+                                    "compose_forward_cuda", [&] {
+        switch (color_dim)
         {
-            const float weight = alpha * T;
-            T *= (1.0f - alpha);
-            density2 += density_params[idx_stroke] * weight;
-#pragma unroll
-            for (int i = 0; i < color_dim; ++i)
-                color2[i] += colors[idx_stroke * color_dim + i] * weight;
-
-            atomicAdd(grad_density_params + idx_stroke, dL_ddensity * weight);
-#pragma unroll
-            for (int i = 0; i < color_dim; ++i)
-                atomicAdd(grad_colors + idx_stroke * color_dim + i, dL_dcolor[i] * final_color_scale * weight);
+        case 1:
+            compose_forward_kernel<1, scalar_t><<<n_blocks, n_threads, 0, stream>>>(
+                density_output.data_ptr<float>(),
+                color_output.data_ptr<float>(),
+                alphas.data_ptr<scalar_t>(),
+                colors.data_ptr<scalar_t>(),
+                density_params.data_ptr<float>(),
+                is_sparse ? row_offsets.data_ptr<int64_t>() : nullptr,
+                is_sparse ? stroke_indices.data_ptr<int32_t>() : nullptr,
+                n_points,
+                n_strokes,
+                min_transmittance);
+            break;
+        case 3:
+            compose_forward_kernel<3, scalar_t><<<n_blocks, n_threads, 0, stream>>>(
+                density_output.data_ptr<float>(),
+                color_output.data_ptr<float>(),
+                alphas.data_ptr<scalar_t>(),
+                colors.data_ptr<scalar_t>(),
+                density_params.data_ptr<float>(),
+                is_sparse ? row_offsets.data_ptr<int64_t>() : nullptr,
+                is_sparse ? stroke_indices.data_ptr<int32_t>() : nullptr,
+                n_points,
+                n_strokes,
+                min_transmittance);
+            break;
+        default:
+            throw std::runtime_error("Unsupported color dimension: " + std::to_string(color_dim));
         }
+    });
+}
+
+void compose_backward_cuda(at::Tensor grad_alphas,
+                           at::Tensor grad_colors,
+                           at::Tensor grad_density_params,
+                           const at::Tensor grad_density_output,
+                           const at::Tensor grad_color_output,
+                           const at::Tensor alphas,
+                           const at::Tensor colors,
+                           const at::Tensor density_params,
+                           const at::Tensor row_offsets,
+                           const at::Tensor stroke_indices,
+                           const float min_transmittance)
+{
+    CHECK_FLOATING_INPUT(grad_alphas);
+    CHECK_FLOATING_INPUT(grad_colors);
+    CHECK_FLOAT_INPUT(grad_density_params);
+    CHECK_FLOAT_INPUT(grad_density_output);
+    CHECK_FLOAT_INPUT(grad_color_output);
+    CHECK_FLOATING_INPUT(alphas);
+    CHECK_FLOATING_INPUT(colors);
+    CHECK_IS_SAME_TYPE(alphas, colors);
+    CHECK_FLOAT_INPUT(density_params);
+    CHECK_LONG_INPUT(row_offsets);
+    CHECK_INT_INPUT(stroke_indices);
+
+    const bool is_sparse = row_offsets.numel() > 0;
+    const int64_t n_points = is_sparse ? row_offsets.size(0) - 1 : alphas.size(0);
+    const int64_t n_strokes = density_params.size(0);
+    const int64_t color_dim = colors.size(colors.dim() - 1);
 
-        // Calculate gradients for alphas
-        float scale_dT_dalpha = 1.0f / max(1.0f - alpha, 1e-6f);
-        float density_suffix = density - density2;
-        float dL_dalpha = dL_ddensity * (T * density_params[idx_stroke] - density_suffix) * scale_dT_dalpha;
+    constexpr int64_t n_threads = 512;
+    const int64_t n_blocks = div_round_up(n_points, n_threads);
 
-        scale_dT_dalpha *= final_color_scale * final_color_scale;
-#pragma unroll
-        for (int i = 0; i < color_dim; ++i)
+    at::cuda::CUDAStream stream = at::cuda::getCurrentCUDAStream();
+    AT_DISPATCH_FLOATING_TYPES_AND2(at::ScalarType::Half, at::ScalarType::BFloat16, alphas.scalar_type(),
+                                    "compose_backward_cuda", [&] {
+        switch (color_dim)
         {
-            float color_suffix = color[i] - color2[i];
-            dL_dalpha += dL_dcolor[i] * (T * colors[idx_stroke * color_dim + i] * (final_opacity - alpha) - color_suffix) * scale_dT_dalpha;
+        case 1:
+            compose_backward_kernel<1, scalar_t><<<n_blocks, n_threads, 0, stream>>>(
+                grad_alphas.data_ptr<scalar_t>(),
+                grad_colors.data_ptr<scalar_t>(),
+                grad_density_params.data_ptr<float>(),
+                grad_density_output.data_ptr<float>(),
+                grad_color_output.data_ptr<float>(),
+                alphas.data_ptr<scalar_t>(),
+                colors.data_ptr<scalar_t>(),
+                density_params.data_ptr<float>(),
+                is_sparse ? row_offsets.data_ptr<int64_t>() : nullptr,
+                is_sparse ? stroke_indices.data_ptr<int32_t>() : nullptr,
+                n_points,
+                n_strokes,
+                min_transmittance);
+            break;
+        case 3:
+            compose_backward_kernel<3, scalar_t><<<n_blocks, n_threads, 0, stream>>>(
+                grad_alphas.data_ptr<scalar_t>(),
+                grad_colors.data_ptr<scalar_t>(),
+                grad_density_params.data_ptr<float>(),
+                grad_density_output.data_ptr<float>(),
+                grad_color_output.data_ptr<float>(),
+                alphas.data_ptr<scalar_t>(),
+                colors.data_ptr<scalar_t>(),
+                density_params.data_ptr<float>(),
+                is_sparse ? row_offsets.data_ptr<int64_t>() : nullptr,
+                is_sparse ? stroke_indices.data_ptr<int32_t>() : nullptr,
+                n_points,
+                n_strokes,
+                min_transmittance);
+            break;
+        default:
+            throw std::runtime_error("Unsupported color dimension: " + std::to_string(color_dim));
         }
-        atomicAdd(grad_alphas + idx_stroke, dL_dalpha);
-    }
+    });
+}
+template <int color_dim, int composition_type, typename scalar_t>
+__global__ void compose_reduce_forward_kernel(float *__restrict__ density_output,
+                                              float *__restrict__ color_output,
+                                              const scalar_t *__restrict__ alphas,
+                                              const scalar_t *__restrict__ colors,
+                                              const float *__restrict__ density_params,
+                                              const int64_t *__restrict__ row_offsets,
+                                              const int32_t *__restrict__ stroke_indices,
+                                              const int64_t n_points,
+                                              const int64_t n_strokes,
+                                              const float inv_temperature)
+{
+    const uint32_t idx_point = threadIdx.x + blockIdx.x * blockDim.x;
+    if (idx_point >= n_points)
+        return;
+
+    compose_reduce_forward_point<color_dim, composition_type, scalar_t>(density_output,
+                                                              color_output,
+                                                              alphas,
+                                                              colors,
+                                                              density_params,
+                                                              row_offsets,
+                                                              stroke_indices,
+                                                              idx_point,
+                                                              n_strokes,
+                                                              inv_temperature);
+}
+
+template <int color_dim, int composition_type, typename scalar_t>
+__global__ void compose_reduce_backward_kernel(scalar_t *__restrict__ grad_alphas,
+                                               scalar_t *__restrict__ grad_colors,
+                                               float *__restrict__ grad_density_params,
+                                               const float *__restrict__ grad_density_output,
+                                               const float *__restrict__ grad_color_output,
+                                               const scalar_t *__restrict__ alphas,
+                                               const scalar_t *__restrict__ colors,
+                                               const float *__restrict__ density_params,
+                                               const int64_t *__restrict__ row_offsets,
+                                               const int32_t *__restrict__ stroke_indices,
+                                               const int64_t n_points,
+                                               const int64_t n_strokes,
+                                               const float inv_temperature)
+{
+    const uint32_t idx_point = threadIdx.x + blockIdx.x * blockDim.x;
+    if (idx_point >= n_points)
+        return;
+
+    compose_reduce_backward_point<color_dim, composition_type, scalar_t>(grad_alphas,
+                                                               grad_colors,
+                                                               grad_density_params,
+                                                               grad_density_output,
+                                                               grad_color_output,
+                                                               alphas,
+                                                               colors,
+                                                               density_params,
+                                                               row_offsets,
+                                                               stroke_indices,
+                                                               idx_point,
+                                                               n_strokes,
+                                                               inv_temperature);
 }
 
-void compose_forward(at::Tensor density_output,
-                     at::Tensor color_output,
-                     const at::Tensor alphas,
-                     const at::Tensor colors,
-                     const at::Tensor density_params)
+void compose_reduce_forward_cuda(at::Tensor density_output,
+                                 at::Tensor color_output,
+                                 const at::Tensor alphas,
+                                 const at::Tensor colors,
+                                 const at::Tensor density_params,
+                                 const at::Tensor row_offsets,
+                                 const at::Tensor stroke_indices,
+                                 const uint32_t composition_type,
+                                 const float inv_temperature)
 {
     CHECK_FLOAT_INPUT(density_output);
     CHECK_FLOAT_INPUT(color_output);
-    CHECK_FLOAT_INPUT(alphas);
-    CHECK_FLOAT_INPUT(colors);
+    CHECK_FLOATING_INPUT(alphas);
+    CHECK_FLOATING_INPUT(colors);
+    CHECK_IS_SAME_TYPE(alphas, colors);
     CHECK_FLOAT_INPUT(density_params);
+    CHECK_LONG_INPUT(row_offsets);
+    CHECK_INT_INPUT(stroke_indices);
 
-    const int64_t n_points = alphas.size(0);
-    const int64_t n_strokes = alphas.size(1);
-    const int64_t color_dim = colors.size(2);
+    const bool is_sparse = row_offsets.numel() > 0;
+    const int64_t n_points = is_sparse ? row_offsets.size(0) - 1 : alphas.size(0);
+    const int64_t n_strokes = density_params.size(0);
+    const int64_t color_dim = colors.size(colors.dim() - 1);
 
     constexpr int64_t n_threads = 512;
     const int64_t n_blocks = div_round_up(n_points, n_threads);
 
     at::cuda::CUDAStream stream = at::cuda::getCurrentCUDAStream();
-    switch (color_dim)
-    {
-    case 1:
-        compose_forward_kernel<1><<<n_blocks, n_threads, 0, stream>>>(
-            density_output.data_ptr<float>(),
-            color_output.data_ptr<float>(),
-            alphas.data_ptr<float>(),
-            colors.data_ptr<float>(),
-            density_params.data_ptr<float>(),
-            n_points,
-            n_strokes);
-        break;
-    case 3:
-        compose_forward_kernel<3><<<n_blocks, n_threads, 0, stream>>>(
-            density_output.data_ptr<float>(),
-            color_output.data_ptr<float>(),
-            alphas.data_ptr<float>(),
-            colors.data_ptr<float>(),
-            density_params.data_ptr<float>(),
-            n_points,
-            n_strokes);
-        break;
-    default:
-        throw std::runtime_error("Unsupported color dimension: " + std::to_string(color_dim));
-    }
+    AT_DISPATCH_FLOATING_TYPES_AND2(at::ScalarType::Half, at::ScalarType::BFloat16, alphas.scalar_type(),
+                                    "compose_reduce_forward_cuda", [&] {
+        dispatch_reduce_composition(color_dim, composition_type, [&](auto color_dim_c, auto composition_type_c) {
+            compose_reduce_forward_kernel<color_dim_c.value, composition_type_c.value, scalar_t>
+                <<<n_blocks, n_threads, 0, stream>>>(
+                density_output.data_ptr<float>(),
+                color_output.data_ptr<float>(),
+                alphas.data_ptr<scalar_t>(),
+                colors.data_ptr<scalar_t>(),
+                density_params.data_ptr<float>(),
+                is_sparse ? row_offsets.data_ptr<int64_t>() : nullptr,
+                is_sparse ? stroke_indices.data_ptr<int32_t>() : nullptr,
+                n_points,
+                n_strokes,
+                inv_temperature);
+        });
+    });
 }
 
-void compose_backward(at::Tensor grad_alphas,
-                      at::Tensor grad_colors,
-                      at::Tensor grad_density_params,
-                      const at::Tensor grad_density_output,
-                      const at::Tensor grad_color_output,
-                      const at::Tensor alphas,
-                      const at::Tensor colors,
-                      const at::Tensor density_params)
+void compose_reduce_backward_cuda(at::Tensor grad_alphas,
+                                  at::Tensor grad_colors,
+                                  at::Tensor grad_density_params,
+                                  const at::Tensor grad_density_output,
+                                  const at::Tensor grad_color_output,
+                                  const at::Tensor alphas,
+                                  const at::Tensor colors,
+                                  const at::Tensor density_params,
+                                  const at::Tensor row_offsets,
+                                  const at::Tensor stroke_indices,
+                                  const uint32_t composition_type,
+                                  const float inv_temperature)
 {
-    CHECK_FLOAT_INPUT(grad_alphas);
-    CHECK_FLOAT_INPUT(grad_colors);
+    CHECK_FLOATING_INPUT(grad_alphas);
+    CHECK_FLOATING_INPUT(grad_colors);
     CHECK_FLOAT_INPUT(grad_density_params);
     CHECK_FLOAT_INPUT(grad_density_output);
     CHECK_FLOAT_INPUT(grad_color_output);
-    CHECK_FLOAT_INPUT(alphas);
-    CHECK_FLOAT_INPUT(colors);
+    CHECK_FLOATING_INPUT(alphas);
+    CHECK_FLOATING_INPUT(colors);
+    CHECK_IS_SAME_TYPE(alphas, colors);
     CHECK_FLOAT_INPUT(density_params);
+    CHECK_LONG_INPUT(row_offsets);
+    CHECK_INT_INPUT(stroke_indices);
 
-    const int64_t n_points = alphas.size(0);
-    const int64_t n_strokes = alphas.size(1);
-    const int64_t color_dim = colors.size(2);
+    const bool is_sparse = row_offsets.numel() > 0;
+    const int64_t n_points = is_sparse ? row_offsets.size(0) - 1 : alphas.size(0);
+    const int64_t n_strokes = density_params.size(0);
+    const int64_t color_dim = colors.size(colors.dim() - 1);
 
     constexpr int64_t n_threads = 512;
     const int64_t n_blocks = div_round_up(n_points, n_threads);
 
     at::cuda::CUDAStream stream = at::cuda::getCurrentCUDAStream();
-    switch (color_dim)
-    {
-    case 1:
-        compose_backward_kernel<1><<<n_blocks, n_threads, 0, stream>>>(
-            grad_alphas.data_ptr<float>(),
-            grad_colors.data_ptr<float>(),
-            grad_density_params.data_ptr<float>(),
-            grad_density_output.data_ptr<float>(),
-            grad_color_output.data_ptr<float>(),
-            alphas.data_ptr<float>(),
-            colors.data_ptr<float>(),
-            density_params.data_ptr<float>(),
-            n_points,
-            n_strokes);
-        break;
-    case 3:
-        compose_backward_kernel<3><<<n_blocks, n_threads, 0, stream>>>(
-            grad_alphas.data_ptr<float>(),
-            grad_colors.data_ptr<float>(),
-            grad_density_params.data_ptr<float>(),
-            grad_density_output.data_ptr<float>(),
-            grad_color_output.data_ptr<float>(),
-            alphas.data_ptr<float>(),
-            colors.data_ptr<float>(),
-            density_params.data_ptr<float>(),
-            n_points,
-            n_strokes);
-        break;
-    default:
-        throw std::runtime_error("Unsupported color dimension: " + std::to_string(color_dim));
-    }
-}
\ No newline at end of file
+    AT_DISPATCH_FLOATING_TYPES_AND2(at::ScalarType::Half, at::ScalarType::BFloat16, alphas.scalar_type(),
+                                    "compose_reduce_backward_cuda", [&] {
+        dispatch_reduce_composition(color_dim, composition_type, [&](auto color_dim_c, auto composition_type_c) {
+            compose_reduce_backward_kernel<color_dim_c.value, composition_type_c.value, scalar_t>
+                <<<n_blocks, n_threads, 0, stream>>>(
+                grad_alphas.data_ptr<scalar_t>(),
+                grad_colors.data_ptr<scalar_t>(),
+                grad_density_params.data_ptr<float>(),
+                grad_density_output.data_ptr<float>(),
+                grad_color_output.data_ptr<float>(),
+                alphas.data_ptr<scalar_t>(),
+                colors.data_ptr<scalar_t>(),
+                density_params.data_ptr<float>(),
+                is_sparse ? row_offsets.data_ptr<int64_t>() : nullptr,
+                is_sparse ? stroke_indices.data_ptr<int32_t>() : nullptr,
+                n_points,
+                n_strokes,
+                inv_temperature);
+        });
+    });
+}
@@ -5,23 +5,50 @@
 
 // density_output: [N_Points], float
 // color_output: [N_Points, D_Color], float
-// alphas: [N_Points, N_Strokes], float
-// colors: [N_Points, N_Strokes, D_Color], float
+// alphas: [N_Points, N_Strokes] or [N_Entries], float
+// colors: [N_Points, N_Strokes, D_Color] or [N_Entries, D_Color], float
 // density_params: [N_Strokes], float
+// row_offsets: [N_Points + 1], long, CSR row offsets of sparse entries, or empty for dense inputs
+// stroke_indices: [N_Entries], int, stroke of each sparse entry, ascending within each row
+// min_transmittance: stop compositing once the transmittance drops below it, 0 composites all strokes
 void compose_forward(at::Tensor density_output,
                      at::Tensor color_output,
                      const at::Tensor alphas,
                      const at::Tensor colors,
-                     const at::Tensor density_params);
+                     const at::Tensor density_params,
+                     const at::Tensor row_offsets,
+                     const at::Tensor stroke_indices,
+                     const float min_transmittance);
 
-// grad_alphas: [N_Points, N_Strokes], float
-// grad_colors: [N_Points, N_Strokes, D_Color], float
+void compose_forward_cuda(at::Tensor density_output,
+                          at::Tensor color_output,
+                          const at::Tensor alphas,
+                          const at::Tensor colors,
+                          const at::Tensor density_params,
+                          const at::Tensor row_offsets,
+                          const at::Tensor stroke_indices,
+                          const float min_transmittance);
+
+void compose_forward_cpu(at::Tensor density_output,
+                         at::Tensor color_output,
+                         const at::Tensor alphas,
+                         const at::Tensor colors,
+                         const at::Tensor density_params,
+                         const at::Tensor row_offsets,
+                         const at::Tensor stroke_indices,
+                         const float min_transmittance);
+
+// grad_alphas: [N_Points, N_Strokes] or [N_Entries], float
+// grad_colors: [N_Points, N_Strokes, D_Color] or [N_Entries, D_Color], float
 // grad_density_params: [N_Strokes], float
 // grad_density_output: [N_Points], float
 // grad_color_output: [N_Points, D_Color], float
-// alphas: [N_Points, N_Strokes], float
-// colors: [N_Points, N_Strokes, D_Color], float
+// alphas: [N_Points, N_Strokes] or [N_Entries], float
+// colors: [N_Points, N_Strokes, D_Color] or [N_Entries, D_Color], float
 // density_params: [N_Strokes], float
+// row_offsets: [N_Points + 1], long, or empty for dense inputs
+// stroke_indices: [N_Entries], int
+// min_transmittance: float, same as in forward
 void compose_backward(at::Tensor grad_alphas,
                       at::Tensor grad_colors,
                       at::Tensor grad_density_params,
@@ -29,4 +56,106 @@ void compose_backward(at::Tensor grad_alphas,
                       const at::Tensor grad_color_output,
                       const at::Tensor alphas,
                       const at::Tensor colors,
-                      const at::Tensor density_params);
+                      const at::Tensor density_params,
+                      const at::Tensor row_offsets,
+                      const at::Tensor stroke_indices,
+                      const float min_transmittance);
+
+void compose_backward_cuda(at::Tensor grad_alphas,
+                           at::Tensor grad_colors,
+                           at::Tensor grad_density_params,
+                           const at::Tensor grad_density_output,
+                           const at::Tensor grad_color_output,
+                           const at::Tensor alphas,
+                           const at::Tensor colors,
+                           const at::Tensor density_params,
+                           const at::Tensor row_offsets,
+                           const at::Tensor stroke_indices,
+                           const float min_transmittance);
+
+void compose_backward_cpu(at::Tensor grad_alphas,
+                          at::Tensor grad_colors,
+                          at::Tensor grad_density_params,
+                          const at::Tensor grad_density_output,
+                          const at::Tensor grad_color_output,
+                          const at::Tensor alphas,
+                          const at::Tensor colors,
+                          const at::Tensor density_params,
+                          const at::Tensor row_offsets,
+                          const at::Tensor stroke_indices,
+                          const float min_transmittance);
+
+// Max and softmax compositions, see ReduceCompositionType in compositing_kernel.h.
+// density_output, color_output, alphas, colors, density_params, row_offsets and stroke_indices
+// are the same as in compose_forward.
+// composition_type: uint32_t, one of ReduceCompositionType
+// inv_temperature: float, scale of the softmax logits
+void compose_reduce_forward(at::Tensor density_output,
+                            at::Tensor color_output,
+                            const at::Tensor alphas,
+                            const at::Tensor colors,
+                            const at::Tensor density_params,
+                            const at::Tensor row_offsets,
+                            const at::Tensor stroke_indices,
+                            const uint32_t composition_type,
+                            const float inv_temperature);
+
+void compose_reduce_forward_cuda(at::Tensor density_output,
+                                 at::Tensor color_output,
+                                 const at::Tensor alphas,
+                                 const at::Tensor colors,
+                                 const at::Tensor density_params,
+                                 const at::Tensor row_offsets,
+                                 const at::Tensor stroke_indices,
+                                 const uint32_t composition_type,
+                                 const float inv_temperature);
+
+void compose_reduce_forward_cpu(at::Tensor density_output,
+                                at::Tensor color_output,
+                                const at::Tensor alphas,
+                                const at::Tensor colors,
+                                const at::Tensor density_params,
+                                const at::Tensor row_offsets,
+                                const at::Tensor stroke_indices,
+                                const uint32_t composition_type,
+                                const float inv_temperature);
+
+// Gradients are the same as in compose_backward, grad_alphas and grad_colors must be zero initialized.
+void compose_reduce_backward(at::Tensor grad_alphas,
+                             at::Tensor grad_colors,
+                             at::Tensor grad_density_params,
+                             const at::Tensor grad_density_output,
+                             const at::Tensor grad_color_output,
+                             const at::Tensor alphas,
+                             const at::Tensor colors,
+                             const at::Tensor density_params,
+                             const at::Tensor row_offsets,
+                             const at::Tensor stroke_indices,
+                             const uint32_t composition_type,
+                             const float inv_temperature);
+
+void compose_reduce_backward_cuda(at::Tensor grad_alphas,
+                                  at::Tensor grad_colors,
+                                  at::Tensor grad_density_params,
+                                  const at::Tensor grad_density_output,
+                                  const at::Tensor grad_color_output,
+                                  const at::Tensor alphas,
+                                  const at::Tensor colors,
+                                  const at::Tensor density_params,
+                                  const at::Tensor row_offsets,
+                                  const at::Tensor stroke_indices,
+                                  const uint32_t composition_type,
+                                  const float inv_temperature);
+
+void compose_reduce_backward_cpu(at::Tensor grad_alphas,
+                                 at::Tensor grad_colors,
+                                 at::Tensor grad_density_params,
+                                 const at::Tensor grad_density_output,
+                                 const at::Tensor grad_color_output,
+                                 const at::Tensor alphas,
+                                 const at::Tensor colors,
+                                 const at::Tensor density_params,
+                                 const at::Tensor row_offsets,
+                                 const at::Tensor stroke_indices,
+                                 const uint32_t composition_type,
+                                 const float inv_temperature);
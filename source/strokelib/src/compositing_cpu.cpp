@@ -0,0 +1,341 @@
+#include <cstdint>
+#include <utility>
+#include <array>
+#include <vector>
+#include "common.h"
+#include "helper_math.h"
+#include "compositing.h"
+#include "compositing_kernel.h"
+#include <ATen/Parallel.h>
+
+template <int color_dim, typename scalar_t>
+void compose_forward_cpu_kernel(float *density_output,
+                                float *color_output,
+                                const scalar_t *alphas,
+                                const scalar_t *colors,
+                                const float *density_params,
+                                const int64_t *row_offsets,
+                                const int32_t *stroke_indices,
+                                const int64_t n_points,
+                                const int64_t n_strokes,
+                                const float min_transmittance)
+{
+    constexpr int64_t grain_size = 64;
+    at::parallel_for(0, n_points, grain_size, [&](int64_t begin, int64_t end) {
+        for (int64_t idx_point = begin; idx_point < end; ++idx_point)
+            compose_forward_point<color_dim, scalar_t>(density_output,
+                                             color_output,
+                                             alphas,
+                                             colors,
+                                             density_params,
+                                             row_offsets,
+                                             stroke_indices,
+                                             idx_point,
+                                             n_strokes,
+                                             min_transmittance);
+    });
+}
+
+template <int color_dim, typename scalar_t>
+void compose_backward_cpu_kernel(scalar_t *grad_alphas,
+                                 scalar_t *grad_colors,
+                                 float *grad_density_params,
+                                 const float *grad_density_output,
+                                 const float *grad_color_output,
+                                 const scalar_t *alphas,
+                                 const scalar_t *colors,
+                                 const float *density_params,
+                                 const int64_t *row_offsets,
+                                 const int32_t *stroke_indices,
+                                 const int64_t n_points,
+                                 const int64_t n_strokes,
+                                 const float min_transmittance)
+{
+    constexpr int64_t grain_size = 64;
+
+    // grad_alphas and grad_colors are owned by a single point, while the gradients
+    // of density_params are reduced from thread-private buffers.
+    const int64_t n_threads = at::get_num_threads();
+    std::vector<float> grad_density_buffer(n_threads * n_strokes, 0.0f);
+
+    at::parallel_for(0, n_points, grain_size, [&](int64_t begin, int64_t end) {
+        float *thread_grad_density_params = grad_density_buffer.data() + at::get_thread_num() * n_strokes;
+        for (int64_t idx_point = begin; idx_point < end; ++idx_point)
+            compose_backward_point<color_dim, scalar_t>(grad_alphas,
+                                              grad_colors,
+                                              thread_grad_density_params,
+                                              grad_density_output,
+                                              grad_color_output,
+                                              alphas,
+                                              colors,
+                                              density_params,
+                                              row_offsets,
+                                              stroke_indices,
+                                              idx_point,
+                                              n_strokes,
+                                              min_transmittance);
+    });
+
+    for (int64_t t = 0; t < n_threads; ++t)
+        for (int64_t i = 0; i < n_strokes; ++i)
+            grad_density_params[i] += grad_density_buffer[t * n_strokes + i];
+}
+
+void compose_forward_cpu(at::Tensor density_output,
+                         at::Tensor color_output,
+                         const at::Tensor alphas,
+                         const at::Tensor colors,
+                         const at::Tensor density_params,
+                         const at::Tensor row_offsets,
+                         const at::Tensor stroke_indices,
+                         const float min_transmittance)
+{
+    CHECK_FLOAT_CPU_INPUT(density_output);
+    CHECK_FLOAT_CPU_INPUT(color_output);
+    CHECK_FLOATING_CPU_INPUT(alphas);
+    CHECK_FLOATING_CPU_INPUT(colors);
+    CHECK_IS_SAME_TYPE(alphas, colors);
+    CHECK_FLOAT_CPU_INPUT(density_params);
+    CHECK_LONG_CPU_INPUT(row_offsets);
+    CHECK_INT_CPU_INPUT(stroke_indices);
+
+    const bool is_sparse = row_offsets.numel() > 0;
+    const int64_t n_points = is_sparse ? row_offsets.size(0) - 1 : alphas.size(0);
+    const int64_t n_strokes = density_params.size(0);
+    const int64_t color_dim = colors.size(colors.dim() - 1);
+
+    AT_DISPATCH_FLOATING_TYPES_AND2(at::ScalarType::Half, at::ScalarType::BFloat16, alphas.scalar_type(),
+                                    "compose_forward_cpu", [&] {
+        switch (color_dim)
+        {
+        case 1:
+            compose_forward_cpu_kernel<1, scalar_t>(
+                density_output.data_ptr<float>(),
+                color_output.data_ptr<float>(),
+                alphas.data_ptr<scalar_t>(),
+                colors.data_ptr<scalar_t>(),
+                density_params.data_ptr<float>(),
+                is_sparse ? row_offsets.data_ptr<int64_t>() : nullptr,
+                is_sparse ? stroke_indices.data_ptr<int32_t>() : nullptr,
+                n_points,
+                n_strokes,
+                min_transmittance);
+            break;
+        case 3:
+            compose_forward_cpu_kernel<3, scalar_t>(
+                density_output.data_ptr<float>(),
+                color_output.data_ptr<float>(),
+                alphas.data_ptr<scalar_t>(),
+                colors.data_ptr<scalar_t>(),
+                density_params.data_ptr<float>(),
+                is_sparse ? row_offsets.data_ptr<int64_t>() : nullptr,
+                is_sparse ? stroke_indices.data_ptr<int32_t>() : nullptr,
+                n_points,
+                n_strokes,
+                min_transmittance);
+            break;
+        default:
+            throw std::runtime_error("Unsupported color dimension: " + std::to_string(color_dim));
+        }
+    });
+}
+
+void compose_backward_cpu(at::Tensor grad_alphas,
+                          at::Tensor grad_colors,
+                          at::Tensor grad_density_params,
+                          const at::Tensor grad_density_output,
+                          const at::Tensor grad_color_output,
+                          const at::Tensor alphas,
+                          const at::Tensor colors,
+                          const at::Tensor density_params,
+                          const at::Tensor row_offsets,
+                          const at::Tensor stroke_indices,
+                          const float min_transmittance)
+{
+    CHECK_FLOATING_CPU_INPUT(grad_alphas);
+    CHECK_FLOATING_CPU_INPUT(grad_colors);
+    CHECK_FLOAT_CPU_INPUT(grad_density_params);
+    CHECK_FLOAT_CPU_INPUT(grad_density_output);
+    CHECK_FLOAT_CPU_INPUT(grad_color_output);
+    CHECK_FLOATING_CPU_INPUT(alphas);
+    CHECK_FLOATING_CPU_INPUT(colors);
+    CHECK_IS_SAME_TYPE(alphas, colors);
+    CHECK_FLOAT_CPU_INPUT(density_params);
+    CHECK_LONG_CPU_INPUT(row_offsets);
+    CHECK_INT_CPU_INPUT(stroke_indices);
+
+    const bool is_sparse = row_offsets.numel() > 0;
+    const int64_t n_points = is_sparse ? row_offsets.size(0) - 1 : alphas.size(0);
+    const int64_t n_strokes = density_params.size(0);
+    const int64_t color_dim = colors.size(colors.dim() - 1);
+
+    AT_DISPATCH_FLOATING_TYPES_AND2(at::ScalarType::Half, at::ScalarType::BFloat16, alphas.scalar_type(),
+                                    "compose_backward_cpu", [&] {
+        switch (color_dim)
+        {
+        case 1:
+            compose_backward_cpu_kernel<1, scalar_t>(
+                grad_alphas.data_ptr<scalar_t>(),
+                grad_colors.data_ptr<scalar_t>(),
+                grad_density_params.data_ptr<float>(),
+                grad_density_output.data_ptr<float>(),
+                grad_color_output.data_ptr<float>(),
+                alphas.data_ptr<scalar_t>(),
+                colors.data_ptr<scalar_t>(),
+                density_params.data_ptr<float>(),
+                is_sparse ? row_offsets.data_ptr<int64_t>() : nullptr,
+                is_sparse ? stroke_indices.data_ptr<int32_t>() : nullptr,
+                n_points,
+                n_strokes,
+                min_transmittance);
+            break;
+        case 3:
+            compose_backward_cpu_kernel<3, scalar_t>(
+                grad_alphas.data_ptr<scalar_t>(),
+                grad_colors.data_ptr<scalar_t>(),
+                grad_density_params.data_ptr<float>(),
+                grad_density_output.data_ptr<float>(),
+                grad_color_output.data_ptr<float>(),
+                alphas.data_ptr<scalar_t>(),
+                colors.data_ptr<scalar_t>(),
+                density_params.data_ptr<float>(),
+                is_sparse ? row_offsets.data_ptr<int64_t>() : nullptr,
+                is_sparse ? stroke_indices.data_ptr<int32_t>() : nullptr,
+                n_points,
+                n_strokes,
+                min_transmittance);
+            break;
+        default:
+            throw std::runtime_error("Unsupported color dimension: " + std::to_string(color_dim));
+        }
+    });
+}
+
+void compose_reduce_forward_cpu(at::Tensor density_output,
+                                at::Tensor color_output,
+                                const at::Tensor alphas,
+                                const at::Tensor colors,
+                                const at::Tensor density_params,
+                                const at::Tensor row_offsets,
+                                const at::Tensor stroke_indices,
+                                const uint32_t composition_type,
+                                const float inv_temperature)
+{
+    CHECK_FLOAT_CPU_INPUT(density_output);
+    CHECK_FLOAT_CPU_INPUT(color_output);
+    CHECK_FLOATING_CPU_INPUT(alphas);
+    CHECK_FLOATING_CPU_INPUT(colors);
+    CHECK_IS_SAME_TYPE(alphas, colors);
+    CHECK_FLOAT_CPU_INPUT(density_params);
+    CHECK_LONG_CPU_INPUT(row_offsets);
+    CHECK_INT_CPU_INPUT(stroke_indices);
+
+    const bool is_sparse = row_offsets.numel() > 0;
+    const int64_t n_points = is_sparse ? row_offsets.size(0) - 1 : alphas.size(0);
+    const int64_t n_strokes = density_params.size(0);
+    const int64_t color_dim = colors.size(colors.dim() - 1);
+
+    float *density_output_ptr = density_output.data_ptr<float>();
+    float *color_output_ptr = color_output.data_ptr<float>();
+    const float *density_params_ptr = density_params.data_ptr<float>();
+    const int64_t *row_offsets_ptr = is_sparse ? row_offsets.data_ptr<int64_t>() : nullptr;
+    const int32_t *stroke_indices_ptr = is_sparse ? stroke_indices.data_ptr<int32_t>() : nullptr;
+
+    AT_DISPATCH_FLOATING_TYPES_AND2(at::ScalarType::Half, at::ScalarType::BFloat16, alphas.scalar_type(),
+                                    "compose_reduce_forward_cpu", [&] {
+        const scalar_t *alphas_ptr = alphas.data_ptr<scalar_t>();
+        const scalar_t *colors_ptr = colors.data_ptr<scalar_t>();
+        dispatch_reduce_composition(color_dim, composition_type, [&](auto color_dim_c, auto composition_type_c) {
+            constexpr int64_t grain_size = 64;
+            at::parallel_for(0, n_points, grain_size, [&](int64_t begin, int64_t end) {
+                for (int64_t idx_point = begin; idx_point < end; ++idx_point)
+                    compose_reduce_forward_point<color_dim_c.value, composition_type_c.value, scalar_t>(
+                        density_output_ptr,
+                        color_output_ptr,
+                        alphas_ptr,
+                        colors_ptr,
+                        density_params_ptr,
+                        row_offsets_ptr,
+                        stroke_indices_ptr,
+                        idx_point,
+                        n_strokes,
+                        inv_temperature);
+            });
+        });
+    });
+}
+
+void compose_reduce_backward_cpu(at::Tensor grad_alphas,
+                                 at::Tensor grad_colors,
+                                 at::Tensor grad_density_params,
+                                 const at::Tensor grad_density_output,
+                                 const at::Tensor grad_color_output,
+                                 const at::Tensor alphas,
+                                 const at::Tensor colors,
+                                 const at::Tensor density_params,
+                                 const at::Tensor row_offsets,
+                                 const at::Tensor stroke_indices,
+                                 const uint32_t composition_type,
+                                 const float inv_temperature)
+{
+    CHECK_FLOATING_CPU_INPUT(grad_alphas);
+    CHECK_FLOATING_CPU_INPUT(grad_colors);
+    CHECK_FLOAT_CPU_INPUT(grad_density_params);
+    CHECK_FLOAT_CPU_INPUT(grad_density_output);
+    CHECK_FLOAT_CPU_INPUT(grad_color_output);
+    CHECK_FLOATING_CPU_INPUT(alphas);
+    CHECK_FLOATING_CPU_INPUT(colors);
+    CHECK_IS_SAME_TYPE(alphas, colors);
+    CHECK_FLOAT_CPU_INPUT(density_params);
+    CHECK_LONG_CPU_INPUT(row_offsets);
+    CHECK_INT_CPU_INPUT(stroke_indices);
+
+    const bool is_sparse = row_offsets.numel() > 0;
+    const int64_t n_points = is_sparse ? row_offsets.size(0) - 1 : alphas.size(0);
+    const int64_t n_strokes = density_params.size(0);
+    const int64_t color_dim = colors.size(colors.dim() - 1);
+
+    const float *grad_density_output_ptr = grad_density_output.data_ptr<float>();
+    const float *grad_color_output_ptr = grad_color_output.data_ptr<float>();
+    const float *density_params_ptr = density_params.data_ptr<float>();
+    const int64_t *row_offsets_ptr = is_sparse ? row_offsets.data_ptr<int64_t>() : nullptr;
+    const int32_t *stroke_indices_ptr = is_sparse ? stroke_indices.data_ptr<int32_t>() : nullptr;
+
+    // The gradients of density_params are reduced from thread-private buffers, as in compose_backward
+    const int64_t n_threads = at::get_num_threads();
+    std::vector<float> grad_density_buffer(n_threads * n_strokes, 0.0f);
+
+    AT_DISPATCH_FLOATING_TYPES_AND2(at::ScalarType::Half, at::ScalarType::BFloat16, alphas.scalar_type(),
+                                    "compose_reduce_backward_cpu", [&] {
+        scalar_t *grad_alphas_ptr = grad_alphas.data_ptr<scalar_t>();
+        scalar_t *grad_colors_ptr = grad_colors.data_ptr<scalar_t>();
+        const scalar_t *alphas_ptr = alphas.data_ptr<scalar_t>();
+        const scalar_t *colors_ptr = colors.data_ptr<scalar_t>();
+        dispatch_reduce_composition(color_dim, composition_type, [&](auto color_dim_c, auto composition_type_c) {
+            constexpr int64_t grain_size = 64;
+            at::parallel_for(0, n_points, grain_size, [&](int64_t begin, int64_t end) {
+                float *thread_grad_density_params = grad_density_buffer.data() + at::get_thread_num() * n_strokes;
+                for (int64_t idx_point = begin; idx_point < end; ++idx_point)
+                    compose_reduce_backward_point<color_dim_c.value, composition_type_c.value, scalar_t>(
+                        grad_alphas_ptr,
+                        grad_colors_ptr,
+                        thread_grad_density_params,
+                        grad_density_output_ptr,
+                        grad_color_output_ptr,
+                        alphas_ptr,
+                        colors_ptr,
+                        density_params_ptr,
+                        row_offsets_ptr,
+                        stroke_indices_ptr,
+                        idx_point,
+                        n_strokes,
+                        inv_temperature);
+            });
+        });
+    });
+
+    float *grad_density_params_ptr = grad_density_params.data_ptr<float>();
+    for (int64_t t = 0; t < n_threads; ++t)
+        for (int64_t i = 0; i < n_strokes; ++i)
+            grad_density_params_ptr[i] += grad_density_buffer[t * n_strokes + i];
+}
@@ -0,0 +1,436 @@
+#pragma once
+#include <cstdint>
+#include <cmath>
+#include <stdexcept>
+#include <string>
+#include <type_traits>
+#include "common.h"
+#include "helper_math.h"
+
+// Per point composition shared by the CUDA kernels and the CPU loops.
+// Strokes are composited front to back, from the highest stroke index to the
+// lowest. The loop stops once the transmittance drops below min_transmittance
+// (min_transmittance = 0 composites all strokes). The backward stops at the same
+// stroke, so that strokes behind the cutoff get no gradient.
+// Alphas and colors (and their gradients) are stored as float, half or bfloat16,
+// while the accumulation and the outputs are always in float. Every entry is owned
+// by a single point, so their gradients are written without atomics.
+
+template <int color_dim, typename scalar_t>
+__device__ inline void compose_forward_point(float *__restrict__ density_output,
+                                             float *__restrict__ color_output,
+                                             const scalar_t *__restrict__ alphas,
+                                             const scalar_t *__restrict__ colors,
+                                             const float *__restrict__ density_params,
+                                             const int64_t *__restrict__ row_offsets,
+                                             const int32_t *__restrict__ stroke_indices,
+                                             const int64_t idx_point,
+                                             const int64_t n_strokes,
+                                             const float min_transmittance)
+{
+    // Entries of this point are either a dense row of all strokes, or a sparse CSR row
+    // of the non-zero strokes in ascending stroke order
+    const int64_t entry_begin = row_offsets ? row_offsets[idx_point] : idx_point * n_strokes;
+    const int64_t entry_end = row_offsets ? row_offsets[idx_point + 1] : entry_begin + n_strokes;
+
+    // Initialize T, density and color
+    float T = 1.0f;
+    float density = 0.0f;
+    float color[color_dim];
+#pragma unroll
+    for (int i = 0; i < color_dim; ++i)
+        color[i] = 0.0f;
+
+    // Compute accumulated density and color
+    for (int64_t idx_entry = entry_end - 1; idx_entry >= entry_begin; --idx_entry)
+    {
+        const float alpha = alphas[idx_entry];
+        if (alpha == 0.0f) // skip zero alpha for speedup
+            continue;
+
+        const int64_t idx_stroke = stroke_indices ? stroke_indices[idx_entry] : idx_entry - entry_begin;
+        const float weight = alpha * T;
+        T *= (1.0f - alpha);
+        density += density_params[idx_stroke] * weight;
+#pragma unroll
+        for (int i = 0; i < color_dim; ++i)
+            color[i] += colors[idx_entry * color_dim + i] * weight;
+
+        // Strokes behind are (almost) fully occluded, stop early
+        if (T < min_transmittance)
+            break;
+    }
+
+    // Compute final color
+    float final_color_scale = 1.0f / (1.0f + 1e-6f - T); // 1 / (1 - T_n)
+#pragma unroll
+    for (int i = 0; i < color_dim; ++i)
+        color[i] = clamp(color[i] * final_color_scale, 0.0f, 1.0f);
+
+    // Store density and color
+    density_output[idx_point] = density;
+#pragma unroll
+    for (int i = 0; i < color_dim; ++i)
+        color_output[idx_point * color_dim + i] = color[i];
+}
+
+template <int color_dim, typename scalar_t>
+__device__ inline void compose_backward_point(scalar_t *__restrict__ grad_alphas,
+                                              scalar_t *__restrict__ grad_colors,
+                                              float *__restrict__ grad_density_params,
+                                              const float *__restrict__ grad_density_output,
+                                              const float *__restrict__ grad_color_output,
+                                              const scalar_t *__restrict__ alphas,
+                                              const scalar_t *__restrict__ colors,
+                                              const float *__restrict__ density_params,
+                                              const int64_t *__restrict__ row_offsets,
+                                              const int32_t *__restrict__ stroke_indices,
+                                              const int64_t idx_point,
+                                              const int64_t n_strokes,
+                                              const float min_transmittance)
+{
+    const int64_t entry_begin = row_offsets ? row_offsets[idx_point] : idx_point * n_strokes;
+    const int64_t entry_end = row_offsets ? row_offsets[idx_point + 1] : entry_begin + n_strokes;
+
+    // Recompute density and color outputs
+    float T = 1.0f;
+    float density = 0.0f;
+    float color[color_dim];
+#pragma unroll
+    for (int i = 0; i < color_dim; ++i)
+        color[i] = 0.0f;
+    for (int64_t idx_entry = entry_end - 1; idx_entry >= entry_begin; --idx_entry)
+    {
+        const float alpha = alphas[idx_entry];
+        if (alpha == 0.0f) // skip zero alpha for speedup
+            continue;
+
+        const int64_t idx_stroke = stroke_indices ? stroke_indices[idx_entry] : idx_entry - entry_begin;
+        const float weight = alpha * T;
+        T *= (1.0f - alpha);
+        density += density_params[idx_stroke] * weight;
+#pragma unroll
+        for (int i = 0; i < color_dim; ++i)
+            color[i] += colors[idx_entry * color_dim + i] * weight;
+
+        // Strokes behind are (almost) fully occluded, stop early
+        if (T < min_transmittance)
+            break;
+    }
+
+    // Load gradients
+    float dL_ddensity = grad_density_output[idx_point];
+    float dL_dcolor[color_dim];
+    float final_opacity = 1.0f + 1e-6f - T;         // (1 - T_n)
+    float final_color_scale = 1.0f / final_opacity; // 1 / (1 - T_n)
+#pragma unroll
+    for (int i = 0; i < color_dim; ++i)
+    {
+        float scaled_color = color[i] * final_color_scale;
+        bool in_range = 0.0f <= scaled_color && scaled_color <= 1.0f;
+        dL_dcolor[i] = in_range ? grad_color_output[idx_point * color_dim + i] : 0.0f;
+    }
+
+    // Compute accumulated density and color
+    T = 1.0f;
+    float density2 = 0.0f;
+    float color2[color_dim];
+#pragma unroll
+    for (int i = 0; i < color_dim; ++i)
+        color2[i] = 0.0f;
+    for (int64_t idx_entry = entry_end - 1; idx_entry >= entry_begin; --idx_entry)
+    {
+        const float alpha = alphas[idx_entry];
+        const int64_t idx_stroke = stroke_indices ? stroke_indices[idx_entry] : idx_entry - entry_begin;
+
+        // Calculate gradients for density_params and colors
+        if (alpha > 0.0f)
+        {
+            const float weight = alpha * T;
+            T *= (1.0f - alpha);
+            density2 += density_params[idx_stroke] * weight;
+#pragma unroll
+            for (int i = 0; i < color_dim; ++i)
+                color2[i] += colors[idx_entry * color_dim + i] * weight;
+
+            atomicAdd(grad_density_params + idx_stroke, dL_ddensity * weight);
+#pragma unroll
+            for (int i = 0; i < color_dim; ++i)
+                grad_colors[idx_entry * color_dim + i] = dL_dcolor[i] * final_color_scale * weight;
+        }
+
+        // Calculate gradients for alphas
+        float scale_dT_dalpha = 1.0f / max(1.0f - alpha, 1e-6f);
+        float density_suffix = density - density2;
+        float dL_dalpha = dL_ddensity * (T * density_params[idx_stroke] - density_suffix) * scale_dT_dalpha;
+
+        scale_dT_dalpha *= final_color_scale * final_color_scale;
+#pragma unroll
+        for (int i = 0; i < color_dim; ++i)
+        {
+            float color_suffix = color[i] - color2[i];
+            dL_dalpha += dL_dcolor[i] * (T * colors[idx_entry * color_dim + i] * (final_opacity - alpha) - color_suffix) * scale_dT_dalpha;
+        }
+        grad_alphas[idx_entry] = dL_dalpha;
+
+        // Strokes behind the forward cutoff do not contribute
+        if (T < min_transmittance)
+            break;
+    }
+}
+
+/////////////////////////////////////////////////////////////////////
+// Max and softmax composition
+/////////////////////////////////////////////////////////////////////
+
+// Compositions that reduce the strokes of a point to one stroke (max) or to a
+// softmax weighted average (softmax), keyed by alpha or by alpha * density.
+// Strokes missing from a sparse row have zero alpha and color.
+enum ReduceCompositionType
+{
+    COMPOSE_MAX = 0,
+    COMPOSE_MAX_DENSITY_WEIGHTED = 1,
+    COMPOSE_SOFTMAX = 2,
+    COMPOSE_SOFTMAX_DENSITY_WEIGHTED = 3,
+    NB_REDUCE_COMPOSITIONS,
+};
+
+template <bool density_weighted>
+__device__ inline float composition_key(const float alpha, const float density_param)
+{
+    return density_weighted ? alpha * density_param : alpha;
+}
+
+// Entry with the largest key, the first one (lowest stroke index) on ties, or -1 for an empty row
+template <bool density_weighted, typename scalar_t>
+__device__ inline int64_t select_max_entry(const scalar_t *__restrict__ alphas,
+                                           const float *__restrict__ density_params,
+                                           const int32_t *__restrict__ stroke_indices,
+                                           const int64_t entry_begin,
+                                           const int64_t entry_end)
+{
+    int64_t idx_max = -1;
+    float key_max = 0.0f;
+    for (int64_t idx_entry = entry_begin; idx_entry < entry_end; ++idx_entry)
+    {
+        const int64_t idx_stroke = stroke_indices ? stroke_indices[idx_entry] : idx_entry - entry_begin;
+        const float key = composition_key<density_weighted>(alphas[idx_entry], density_params[idx_stroke]);
+        if (idx_max < 0 || key > key_max)
+        {
+            idx_max = idx_entry;
+            key_max = key;
+        }
+    }
+    return idx_max;
+}
+
+// Online softmax over the entries of a point in a single pass. Returns the unnormalized
+// density and color sums, the normalizer and the maximum logit they are relative to.
+template <int color_dim, bool density_weighted, typename scalar_t>
+__device__ inline void softmax_accumulate(float &logit_max,
+                                          float &normalizer,
+                                          float &density,
+                                          float *__restrict__ color,
+                                          const scalar_t *__restrict__ alphas,
+                                          const scalar_t *__restrict__ colors,
+                                          const float *__restrict__ density_params,
+                                          const int32_t *__restrict__ stroke_indices,
+                                          const int64_t entry_begin,
+                                          const int64_t entry_end,
+                                          const int64_t n_missing,
+                                          const float inv_temperature)
+{
+    // Missing strokes have zero logits and only contribute to the normalizer
+    logit_max = n_missing > 0 ? 0.0f : -INFINITY;
+    normalizer = float(n_missing);
+    density = 0.0f;
+#pragma unroll
+    for (int i = 0; i < color_dim; ++i)
+        color[i] = 0.0f;
+
+    for (int64_t idx_entry = entry_begin; idx_entry < entry_end; ++idx_entry)
+    {
+        const int64_t idx_stroke = stroke_indices ? stroke_indices[idx_entry] : idx_entry - entry_begin;
+        const float alpha = alphas[idx_entry];
+        const float logit = composition_key<density_weighted>(alpha, density_params[idx_stroke]) * inv_temperature;
+        if (logit > logit_max)
+        {
+            const float scale = expf(logit_max - logit);
+            normalizer *= scale;
+            density *= scale;
+#pragma unroll
+            for (int i = 0; i < color_dim; ++i)
+                color[i] *= scale;
+            logit_max = logit;
+        }
+
+        const float weight = expf(logit - logit_max);
+        normalizer += weight;
+        density += weight * alpha * density_params[idx_stroke];
+#pragma unroll
+        for (int i = 0; i < color_dim; ++i)
+            color[i] += weight * colors[idx_entry * color_dim + i];
+    }
+}
+
+template <int color_dim, int composition_type, typename scalar_t>
+__device__ inline void compose_reduce_forward_point(float *__restrict__ density_output,
+                                                    float *__restrict__ color_output,
+                                                    const scalar_t *__restrict__ alphas,
+                                                    const scalar_t *__restrict__ colors,
+                                                    const float *__restrict__ density_params,
+                                                    const int64_t *__restrict__ row_offsets,
+                                                    const int32_t *__restrict__ stroke_indices,
+                                                    const int64_t idx_point,
+                                                    const int64_t n_strokes,
+                                                    const float inv_temperature)
+{
+    const int64_t entry_begin = row_offsets ? row_offsets[idx_point] : idx_point * n_strokes;
+    const int64_t entry_end = row_offsets ? row_offsets[idx_point + 1] : entry_begin + n_strokes;
+
+    float density = 0.0f;
+    float color[color_dim];
+#pragma unroll
+    for (int i = 0; i < color_dim; ++i)
+        color[i] = 0.0f;
+
+    if constexpr (composition_type == COMPOSE_MAX || composition_type == COMPOSE_MAX_DENSITY_WEIGHTED)
+    {
+        const int64_t idx_entry = select_max_entry<composition_type == COMPOSE_MAX_DENSITY_WEIGHTED>(
+            alphas, density_params, stroke_indices, entry_begin, entry_end);
+        if (idx_entry >= 0)
+        {
+            const int64_t idx_stroke = stroke_indices ? stroke_indices[idx_entry] : idx_entry - entry_begin;
+            density = alphas[idx_entry] * density_params[idx_stroke];
+#pragma unroll
+            for (int i = 0; i < color_dim; ++i)
+                color[i] = colors[idx_entry * color_dim + i];
+        }
+    }
+    else
+    {
+        float logit_max, normalizer;
+        softmax_accumulate<color_dim, composition_type == COMPOSE_SOFTMAX_DENSITY_WEIGHTED>(
+            logit_max, normalizer, density, color, alphas, colors, density_params, stroke_indices, entry_begin,
+            entry_end, n_strokes - (entry_end - entry_begin), inv_temperature);
+        const float inv_normalizer = normalizer > 0.0f ? 1.0f / normalizer : 0.0f;
+        density *= inv_normalizer;
+#pragma unroll
+        for (int i = 0; i < color_dim; ++i)
+            color[i] *= inv_normalizer;
+    }
+
+    density_output[idx_point] = density;
+#pragma unroll
+    for (int i = 0; i < color_dim; ++i)
+        color_output[idx_point * color_dim + i] = color[i];
+}
+
+// Entries are owned by a single point, so only the gradients of density_params are accumulated atomically
+template <int color_dim, int composition_type, typename scalar_t>
+__device__ inline void compose_reduce_backward_point(scalar_t *__restrict__ grad_alphas,
+                                                     scalar_t *__restrict__ grad_colors,
+                                                     float *__restrict__ grad_density_params,
+                                                     const float *__restrict__ grad_density_output,
+                                                     const float *__restrict__ grad_color_output,
+                                                     const scalar_t *__restrict__ alphas,
+                                                     const scalar_t *__restrict__ colors,
+                                                     const float *__restrict__ density_params,
+                                                     const int64_t *__restrict__ row_offsets,
+                                                     const int32_t *__restrict__ stroke_indices,
+                                                     const int64_t idx_point,
+                                                     const int64_t n_strokes,
+                                                     const float inv_temperature)
+{
+    const int64_t entry_begin = row_offsets ? row_offsets[idx_point] : idx_point * n_strokes;
+    const int64_t entry_end = row_offsets ? row_offsets[idx_point + 1] : entry_begin + n_strokes;
+    const float dL_ddensity = grad_density_output[idx_point];
+    const float *dL_dcolor = grad_color_output + idx_point * color_dim;
+
+    if constexpr (composition_type == COMPOSE_MAX || composition_type == COMPOSE_MAX_DENSITY_WEIGHTED)
+    {
+        // The selection is piecewise constant, only the selected stroke gets gradients
+        const int64_t idx_entry = select_max_entry<composition_type == COMPOSE_MAX_DENSITY_WEIGHTED>(
+            alphas, density_params, stroke_indices, entry_begin, entry_end);
+        if (idx_entry < 0)
+            return;
+        const int64_t idx_stroke = stroke_indices ? stroke_indices[idx_entry] : idx_entry - entry_begin;
+        grad_alphas[idx_entry] = dL_ddensity * density_params[idx_stroke];
+        atomicAdd(grad_density_params + idx_stroke, dL_ddensity * alphas[idx_entry]);
+#pragma unroll
+        for (int i = 0; i < color_dim; ++i)
+            grad_colors[idx_entry * color_dim + i] = dL_dcolor[i];
+    }
+    else
+    {
+        constexpr bool density_weighted = composition_type == COMPOSE_SOFTMAX_DENSITY_WEIGHTED;
+
+        // Recompute the normalizer and the density and color outputs
+        float logit_max, normalizer, density;
+        float color[color_dim];
+        softmax_accumulate<color_dim, density_weighted>(
+            logit_max, normalizer, density, color, alphas, colors, density_params, stroke_indices, entry_begin,
+            entry_end, n_strokes - (entry_end - entry_begin), inv_temperature);
+        if (normalizer <= 0.0f)
+            return;
+        const float inv_normalizer = 1.0f / normalizer;
+        density *= inv_normalizer;
+#pragma unroll
+        for (int i = 0; i < color_dim; ++i)
+            color[i] *= inv_normalizer;
+
+        // d(output)/d(logit_s) = w_s * (value_s - output)
+        for (int64_t idx_entry = entry_begin; idx_entry < entry_end; ++idx_entry)
+        {
+            const int64_t idx_stroke = stroke_indices ? stroke_indices[idx_entry] : idx_entry - entry_begin;
+            const float alpha = alphas[idx_entry];
+            const float density_param = density_params[idx_stroke];
+            const float logit = composition_key<density_weighted>(alpha, density_param) * inv_temperature;
+            const float weight = expf(logit - logit_max) * inv_normalizer;
+
+            float dL_dlogit = dL_ddensity * (alpha * density_param - density);
+#pragma unroll
+            for (int i = 0; i < color_dim; ++i)
+            {
+                dL_dlogit += dL_dcolor[i] * (colors[idx_entry * color_dim + i] - color[i]);
+                grad_colors[idx_entry * color_dim + i] = dL_dcolor[i] * weight;
+            }
+            const float dL_dkey = dL_dlogit * weight * inv_temperature;
+
+            grad_alphas[idx_entry] = dL_ddensity * weight * density_param +
+                                     dL_dkey * (density_weighted ? density_param : 1.0f);
+            atomicAdd(grad_density_params + idx_stroke,
+                      dL_ddensity * weight * alpha + (density_weighted ? dL_dkey * alpha : 0.0f));
+        }
+    }
+}
+
+// Call f(color_dim, composition_type) with both as std::integral_constant
+template <typename F>
+inline void dispatch_reduce_composition(const int64_t color_dim, const uint32_t composition_type, F &&f)
+{
+    auto dispatch_composition = [&](auto color_dim_c) {
+        switch (composition_type)
+        {
+        case COMPOSE_MAX:
+            return f(color_dim_c, std::integral_constant<int, COMPOSE_MAX>{});
+        case COMPOSE_MAX_DENSITY_WEIGHTED:
+            return f(color_dim_c, std::integral_constant<int, COMPOSE_MAX_DENSITY_WEIGHTED>{});
+        case COMPOSE_SOFTMAX:
+            return f(color_dim_c, std::integral_constant<int, COMPOSE_SOFTMAX>{});
+        case COMPOSE_SOFTMAX_DENSITY_WEIGHTED:
+            return f(color_dim_c, std::integral_constant<int, COMPOSE_SOFTMAX_DENSITY_WEIGHTED>{});
+        default:
+            throw std::runtime_error("Unsupported composition type: " + std::to_string(composition_type));
+        }
+    };
+    switch (color_dim)
+    {
+    case 1:
+        return dispatch_composition(std::integral_constant<int, 1>{});
+    case 3:
+        return dispatch_composition(std::integral_constant<int, 3>{});
+    default:
+        throw std::runtime_error("Unsupported color dimension: " + std::to_string(color_dim));
+    }
+}
@@ -39,7 +39,11 @@
 #ifndef HELPER_MATH_H
 #define HELPER_MATH_H
 
+#ifdef __CUDACC__
 #include "cuda_runtime.h"
+#else
+#include "host_compat.h"
+#endif
 
 typedef unsigned int uint;
 typedef unsigned short ushort;
@@ -11,6 +11,9 @@
 // viewdir: [N_Points, 3], float
 // shape_params: [N_Strokes, N_ShapeParams], float
 // color_params: [N_Strokes, N_ColorParams], float
+// point_indices: [N_Pairs], int, candidate pairs sorted by point, or empty for all pairs
+// stroke_indices: [N_Pairs], int
+// pair_output: if true, outputs are indexed by candidate pair [N_Pairs, ...] instead of [N_Points, N_Strokes, ...]
 void stroke_forward(at::Tensor alpha_output,
                     at::Tensor color_output,
                     at::Tensor sdf_output,
@@ -20,12 +23,51 @@ void stroke_forward(at::Tensor alpha_output,
                     const at::Tensor viewdir,
                     const at::Tensor shape_params,
                     const at::Tensor color_params,
+                    const at::Tensor point_indices,
+                    const at::Tensor stroke_indices,
+                    const bool pair_output,
                     const uint32_t sdf_id,
                     const uint32_t color_id,
                     const float sdf_delta,
                     const bool use_laplace_transform,
                     const bool inv_scale_radius);
 
+void stroke_forward_cuda(at::Tensor alpha_output,
+                         at::Tensor color_output,
+                         at::Tensor sdf_output,
+                         at::Tensor texcoord_output,
+                         const at::Tensor x,
+                         const at::Tensor radius,
+                         const at::Tensor viewdir,
+                         const at::Tensor shape_params,
+                         const at::Tensor color_params,
+                         const at::Tensor point_indices,
+                         const at::Tensor stroke_indices,
+                         const bool pair_output,
+                         const uint32_t sdf_id,
+                         const uint32_t color_id,
+                         const float sdf_delta,
+                         const bool use_laplace_transform,
+                         const bool inv_scale_radius);
+
+void stroke_forward_cpu(at::Tensor alpha_output,
+                        at::Tensor color_output,
+                        at::Tensor sdf_output,
+                        at::Tensor texcoord_output,
+                        const at::Tensor x,
+                        const at::Tensor radius,
+                        const at::Tensor viewdir,
+                        const at::Tensor shape_params,
+                        const at::Tensor color_params,
+                        const at::Tensor point_indices,
+                        const at::Tensor stroke_indices,
+                        const bool pair_output,
+                        const uint32_t sdf_id,
+                        const uint32_t color_id,
+                        const float sdf_delta,
+                        const bool use_laplace_transform,
+                        const bool inv_scale_radius);
+
 // grad_shape_params: [N_Strokes, N_ShapeParams], float
 // grad_color_params: [N_Strokes, N_ColorParams], float
 // grad_x: [N_Points, 3], float
@@ -35,6 +77,9 @@ void stroke_forward(at::Tensor alpha_output,
 // x: [N_Points, 3], float
 // shape_params: [N_Strokes, N_ShapeParams], float
 // color_params: [N_Strokes, N_ColorParams], float
+// point_indices: [N_Pairs], int, candidate pairs sorted by point, or empty for all pairs
+// stroke_indices: [N_Pairs], int
+// pair_output: if true, outputs are indexed by candidate pair [N_Pairs, ...] instead of [N_Points, N_Strokes, ...]
 void stroke_backward(at::Tensor grad_shape_params,
                      at::Tensor grad_color_params,
                      at::Tensor grad_x,
@@ -47,8 +92,184 @@ void stroke_backward(at::Tensor grad_shape_params,
                      const at::Tensor alpha,
                      const at::Tensor shape_params,
                      const at::Tensor color_params,
+                     const at::Tensor point_indices,
+                     const at::Tensor stroke_indices,
+                     const bool pair_output,
                      const uint32_t sdf_id,
                      const uint32_t color_id,
                      const float sdf_delta,
                      const bool use_laplace_transform,
                      const bool inv_scale_radius);
+
+void stroke_backward_cuda(at::Tensor grad_shape_params,
+                          at::Tensor grad_color_params,
+                          at::Tensor grad_x,
+                          const at::Tensor grad_alpha,
+                          const at::Tensor grad_color,
+                          const at::Tensor grad_sdf,
+                          const at::Tensor x,
+                          const at::Tensor radius,
+                          const at::Tensor viewdir,
+                          const at::Tensor alpha,
+                          const at::Tensor shape_params,
+                          const at::Tensor color_params,
+                          const at::Tensor point_indices,
+                          const at::Tensor stroke_indices,
+                          const bool pair_output,
+                          const uint32_t sdf_id,
+                          const uint32_t color_id,
+                          const float sdf_delta,
+                          const bool use_laplace_transform,
+                          const bool inv_scale_radius);
+
+void stroke_backward_cpu(at::Tensor grad_shape_params,
+                         at::Tensor grad_color_params,
+                         at::Tensor grad_x,
+                         const at::Tensor grad_alpha,
+                         const at::Tensor grad_color,
+                         const at::Tensor grad_sdf,
+                         const at::Tensor x,
+                         const at::Tensor radius,
+                         const at::Tensor viewdir,
+                         const at::Tensor alpha,
+                         const at::Tensor shape_params,
+                         const at::Tensor color_params,
+                         const at::Tensor point_indices,
+                         const at::Tensor stroke_indices,
+                         const bool pair_output,
+                         const uint32_t sdf_id,
+                         const uint32_t color_id,
+                         const float sdf_delta,
+                         const bool use_laplace_transform,
+                         const bool inv_scale_radius);
+
+// Stroke evaluation fused with "over" composition, per-stroke outputs are never stored
+// density_output: [N_Points], float
+// color_output: [N_Points, D_Color], float
+// x: [N_Points, 3], float
+// viewdir: [N_Points, 3], float
+// shape_params: [N_Strokes, N_ShapeParams], float
+// color_params: [N_Strokes, N_ColorParams], float
+// density_params: [N_Strokes], float
+// row_offsets: [N_Points + 1], long, CSR rows of candidate strokes, or empty for all strokes
+// stroke_indices: [N_Entries], int, candidate strokes ascending within each row
+// min_transmittance: stop compositing once the transmittance drops below it, 0 composites all strokes
+void stroke_compose_forward(at::Tensor density_output,
+                            at::Tensor color_output,
+                            const at::Tensor x,
+                            const at::Tensor radius,
+                            const at::Tensor viewdir,
+                            const at::Tensor shape_params,
+                            const at::Tensor color_params,
+                            const at::Tensor density_params,
+                            const at::Tensor row_offsets,
+                            const at::Tensor stroke_indices,
+                            const uint32_t sdf_id,
+                            const uint32_t color_id,
+                            const float sdf_delta,
+                            const bool use_laplace_transform,
+                            const bool inv_scale_radius,
+                            const float min_transmittance);
+
+void stroke_compose_forward_cuda(at::Tensor density_output,
+                                 at::Tensor color_output,
+                                 const at::Tensor x,
+                                 const at::Tensor radius,
+                                 const at::Tensor viewdir,
+                                 const at::Tensor shape_params,
+                                 const at::Tensor color_params,
+                                 const at::Tensor density_params,
+                                 const at::Tensor row_offsets,
+                                 const at::Tensor stroke_indices,
+                                 const uint32_t sdf_id,
+                                 const uint32_t color_id,
+                                 const float sdf_delta,
+                                 const bool use_laplace_transform,
+                                 const bool inv_scale_radius,
+                                 const float min_transmittance);
+
+void stroke_compose_forward_cpu(at::Tensor density_output,
+                                at::Tensor color_output,
+                                const at::Tensor x,
+                                const at::Tensor radius,
+                                const at::Tensor viewdir,
+                                const at::Tensor shape_params,
+                                const at::Tensor color_params,
+                                const at::Tensor density_params,
+                                const at::Tensor row_offsets,
+                                const at::Tensor stroke_indices,
+                                const uint32_t sdf_id,
+                                const uint32_t color_id,
+                                const float sdf_delta,
+                                const bool use_laplace_transform,
+                                const bool inv_scale_radius,
+                                const float min_transmittance);
+
+// grad_shape_params: [N_Strokes, N_ShapeParams], float
+// grad_color_params: [N_Strokes, N_ColorParams], float
+// grad_density_params: [N_Strokes], float
+// grad_x: [N_Points, 3], float
+// grad_density_output: [N_Points], float
+// grad_color_output: [N_Points, D_Color], float
+void stroke_compose_backward(at::Tensor grad_shape_params,
+                             at::Tensor grad_color_params,
+                             at::Tensor grad_density_params,
+                             at::Tensor grad_x,
+                             const at::Tensor grad_density_output,
+                             const at::Tensor grad_color_output,
+                             const at::Tensor x,
+                             const at::Tensor radius,
+                             const at::Tensor viewdir,
+                             const at::Tensor shape_params,
+                             const at::Tensor color_params,
+                             const at::Tensor density_params,
+                             const at::Tensor row_offsets,
+                             const at::Tensor stroke_indices,
+                             const uint32_t sdf_id,
+                             const uint32_t color_id,
+                             const float sdf_delta,
+                             const bool use_laplace_transform,
+                             const bool inv_scale_radius,
+                             const float min_transmittance);
+
+void stroke_compose_backward_cuda(at::Tensor grad_shape_params,
+                                  at::Tensor grad_color_params,
+                                  at::Tensor grad_density_params,
+                                  at::Tensor grad_x,
+                                  const at::Tensor grad_density_output,
+                                  const at::Tensor grad_color_output,
+                                  const at::Tensor x,
+                                  const at::Tensor radius,
+                                  const at::Tensor viewdir,
+                                  const at::Tensor shape_params,
+                                  const at::Tensor color_params,
+                                  const at::Tensor density_params,
+                                  const at::Tensor row_offsets,
+                                  const at::Tensor stroke_indices,
+                                  const uint32_t sdf_id,
+                                  const uint32_t color_id,
+                                  const float sdf_delta,
+                                  const bool use_laplace_transform,
+                                  const bool inv_scale_radius,
+                                  const float min_transmittance);
+
+void stroke_compose_backward_cpu(at::Tensor grad_shape_params,
+                                 at::Tensor grad_color_params,
+                                 at::Tensor grad_density_params,
+                                 at::Tensor grad_x,
+                                 const at::Tensor grad_density_output,
+                                 const at::Tensor grad_color_output,
+                                 const at::Tensor x,
+                                 const at::Tensor radius,
+                                 const at::Tensor viewdir,
+                                 const at::Tensor shape_params,
+                                 const at::Tensor color_params,
+                                 const at::Tensor density_params,
+                                 const at::Tensor row_offsets,
+                                 const at::Tensor stroke_indices,
+                                 const uint32_t sdf_id,
+                                 const uint32_t color_id,
+                                 const float sdf_delta,
+                                 const bool use_laplace_transform,
+                                 const bool inv_scale_radius,
+                                 const float min_transmittance);
\ No newline at end of file
@@ -0,0 +1,321 @@
+#include "strokes.h"
+#include "strokes_kernel.h"
+#include <ATen/Parallel.h>
+#include <algorithm>
+#include <array>
+#include <utility>
+#include <vector>
+
+/////////////////////////////////////////////////////////////////////
+// Forward
+/////////////////////////////////////////////////////////////////////
+
+template <uint32_t id>
+void stroke_forward_cpu_warpper(float *alpha_output,
+                                float *color_output,
+                                float *sdf_output,
+                                float *texcoord_output,
+                                const float *x,
+                                const float *radius,
+                                const float *viewdir,
+                                const float *shape_params,
+                                const float *color_params,
+                                const int32_t *point_indices,
+                                const int32_t *stroke_indices,
+                                const bool pair_output,
+                                const int64_t n_pairs,
+                                const int64_t n_points,
+                                const int64_t n_strokes,
+                                const int64_t n_samples_per_ray,
+                                const int64_t n_shape_params,
+                                const int64_t n_color_params,
+                                const float sdf_delta,
+                                const bool use_laplace_transform,
+                                const bool inv_scale_radius)
+{
+    using Traits = StrokeFnTraits<id>;
+    constexpr int64_t grain_size = 256;
+
+    // Every (point, stroke) pair writes to its own output slot
+    at::parallel_for(0, n_pairs, grain_size, [&](int64_t begin, int64_t end) {
+        for (int64_t idx = begin; idx < end; ++idx)
+        {
+            const int64_t idx_point = point_indices ? point_indices[idx] : idx / n_strokes;
+            const int64_t idx_stroke = stroke_indices ? stroke_indices[idx] : idx % n_strokes;
+            stroke_forward_point<Traits::base_sdf_type,
+                                 Traits::color_type,
+                                 Traits::enable_translation,
+                                 Traits::enable_rotation,
+                                 Traits::enable_singlescale,
+                                 Traits::enable_multiscale>(
+                alpha_output,
+                color_output,
+                sdf_output,
+                texcoord_output,
+                x,
+                radius,
+                viewdir,
+                shape_params,
+                color_params,
+                idx_point,
+                idx_stroke,
+                pair_output ? idx : idx_point * n_strokes + idx_stroke,
+                n_samples_per_ray,
+                n_shape_params,
+                n_color_params,
+                sdf_delta,
+                use_laplace_transform,
+                inv_scale_radius);
+        }
+    });
+}
+
+DECLARE_INT_TEMPLATE_ARG_LUT(stroke_forward_cpu_warpper)
+void stroke_forward_cpu(at::Tensor alpha_output,
+                        at::Tensor color_output,
+                        at::Tensor sdf_output,
+                        at::Tensor texcoord_output,
+                        const at::Tensor x,
+                        const at::Tensor radius,
+                        const at::Tensor viewdir,
+                        const at::Tensor shape_params,
+                        const at::Tensor color_params,
+                        const at::Tensor point_indices,
+                        const at::Tensor stroke_indices,
+                        const bool pair_output,
+                        const uint32_t sdf_id,
+                        const uint32_t color_id,
+                        const float sdf_delta,
+                        const bool use_laplace_transform,
+                        const bool inv_scale_radius)
+{
+    CHECK_FLOAT_CPU_INPUT(alpha_output);
+    CHECK_FLOAT_CPU_INPUT(color_output);
+    CHECK_FLOAT_CPU_INPUT(sdf_output);
+    CHECK_FLOAT_CPU_INPUT(texcoord_output);
+    CHECK_FLOAT_CPU_INPUT(x);
+    CHECK_FLOAT_CPU_INPUT(radius);
+    CHECK_FLOAT_CPU_INPUT(viewdir);
+    CHECK_FLOAT_CPU_INPUT(shape_params);
+    CHECK_FLOAT_CPU_INPUT(color_params);
+    CHECK_INT_CPU_INPUT(point_indices);
+    CHECK_INT_CPU_INPUT(stroke_indices);
+
+    const int64_t n_points = x.size(0);
+    const int64_t n_viewdirs = viewdir.size(0);
+    const int64_t n_samples_per_ray = n_points / n_viewdirs;
+    const int64_t n_strokes = shape_params.size(0);
+    const int64_t n_shape_params = shape_params.size(1);
+    const int64_t n_color_params = color_params.size(1);
+    const bool use_pairs = point_indices.numel() > 0;
+    const int64_t n_pairs = use_pairs ? point_indices.size(0) : n_points * n_strokes;
+
+    constexpr uint32_t num_fn_ids = NB_BASE_SDFS * 16 * NB_COLORS;
+    const uint32_t fn_id = sdf_id * NB_COLORS + color_id;
+    TORCH_CHECK(fn_id < num_fn_ids, "fn_id must be in [0, num_fn_ids]")
+    static const auto fn_table = MAKE_INT_TEMPLATE_ARG_LUT(stroke_forward_cpu_warpper, num_fn_ids);
+    TORCH_CHECK(fn_table[fn_id] != nullptr, "stroke function ", fn_id, " is not compiled, add it to STROKELIB_KERNELS");
+
+    fn_table[fn_id](
+        alpha_output.data_ptr<float>(),
+        color_output.data_ptr<float>(),
+        sdf_output.numel() ? sdf_output.data_ptr<float>() : nullptr,
+        texcoord_output.numel() ? texcoord_output.data_ptr<float>() : nullptr,
+        x.data_ptr<float>(),
+        radius.data_ptr<float>(),
+        viewdir.data_ptr<float>(),
+        shape_params.data_ptr<float>(),
+        color_params.data_ptr<float>(),
+        use_pairs ? point_indices.data_ptr<int32_t>() : nullptr,
+        use_pairs ? stroke_indices.data_ptr<int32_t>() : nullptr,
+        pair_output,
+        n_pairs,
+        n_points,
+        n_strokes,
+        n_samples_per_ray,
+        n_shape_params,
+        n_color_params,
+        sdf_delta,
+        use_laplace_transform,
+        inv_scale_radius);
+}
+
+/////////////////////////////////////////////////////////////////////
+// Backward
+/////////////////////////////////////////////////////////////////////
+
+template <uint32_t id>
+void stroke_backward_cpu_warpper(float *grad_shape_params,
+                                 float *grad_color_params,
+                                 float *grad_x,
+                                 const float *grad_alpha,
+                                 const float *grad_color,
+                                 const float *grad_sdf,
+                                 const float *x,
+                                 const float *radius,
+                                 const float *viewdir,
+                                 const float *alpha,
+                                 const float *shape_params,
+                                 const float *color_params,
+                                 const int32_t *point_indices,
+                                 const int32_t *stroke_indices,
+                                 const bool pair_output,
+                                 const int64_t n_pairs,
+                                 const int64_t n_points,
+                                 const int64_t n_strokes,
+                                 const int64_t n_samples_per_ray,
+                                 const int64_t n_shape_params,
+                                 const int64_t n_color_params,
+                                 const float sdf_delta,
+                                 const bool use_laplace_transform,
+                                 const bool inv_scale_radius)
+{
+    using Traits = StrokeFnTraits<id>;
+    constexpr int64_t grain_size = 16;
+
+    // Points are split among threads so that grad_x is written by a single thread,
+    // while parameter gradients are reduced from thread-private buffers.
+    const int64_t n_threads = at::get_num_threads();
+    const int64_t grad_shape_size = n_strokes * n_shape_params;
+    const int64_t grad_color_size = n_strokes * n_color_params;
+    std::vector<float> grad_shape_buffer(n_threads * grad_shape_size, 0.0f);
+    std::vector<float> grad_color_buffer(n_threads * grad_color_size, 0.0f);
+
+    at::parallel_for(0, n_points, grain_size, [&](int64_t begin, int64_t end) {
+        const int64_t idx_thread = at::get_thread_num();
+        float *thread_grad_shape_params = grad_shape_buffer.data() + idx_thread * grad_shape_size;
+        float *thread_grad_color_params = grad_color_buffer.data() + idx_thread * grad_color_size;
+        auto backward_pair = [&](int64_t idx_point, int64_t idx_stroke, int64_t idx_output) {
+            stroke_backward_point<Traits::base_sdf_type,
+                                  Traits::color_type,
+                                  Traits::enable_translation,
+                                  Traits::enable_rotation,
+                                  Traits::enable_singlescale,
+                                  Traits::enable_multiscale>(
+                thread_grad_shape_params,
+                thread_grad_color_params,
+                grad_x,
+                grad_alpha,
+                grad_color,
+                grad_sdf,
+                x,
+                radius,
+                viewdir,
+                alpha,
+                shape_params,
+                color_params,
+                idx_point,
+                idx_stroke,
+                idx_output,
+                n_samples_per_ray,
+                n_shape_params,
+                n_color_params,
+                sdf_delta,
+                use_laplace_transform,
+                inv_scale_radius);
+        };
+
+        if (point_indices)
+        {
+            // Candidate pairs are sorted by point, find the pairs of this point range
+            const int64_t pair_begin = std::lower_bound(point_indices, point_indices + n_pairs, begin) - point_indices;
+            const int64_t pair_end = std::lower_bound(point_indices, point_indices + n_pairs, end) - point_indices;
+            for (int64_t idx_pair = pair_begin; idx_pair < pair_end; ++idx_pair)
+                backward_pair(point_indices[idx_pair],
+                              stroke_indices[idx_pair],
+                              pair_output ? idx_pair : point_indices[idx_pair] * n_strokes + stroke_indices[idx_pair]);
+        }
+        else
+        {
+            for (int64_t idx_point = begin; idx_point < end; ++idx_point)
+                for (int64_t idx_stroke = 0; idx_stroke < n_strokes; ++idx_stroke)
+                    backward_pair(idx_point, idx_stroke, idx_point * n_strokes + idx_stroke);
+        }
+    });
+
+    for (int64_t t = 0; t < n_threads; ++t)
+    {
+        for (int64_t i = 0; i < grad_shape_size; ++i)
+            grad_shape_params[i] += grad_shape_buffer[t * grad_shape_size + i];
+        for (int64_t i = 0; i < grad_color_size; ++i)
+            grad_color_params[i] += grad_color_buffer[t * grad_color_size + i];
+    }
+}
+
+DECLARE_INT_TEMPLATE_ARG_LUT(stroke_backward_cpu_warpper)
+void stroke_backward_cpu(at::Tensor grad_shape_params,
+                         at::Tensor grad_color_params,
+                         at::Tensor grad_x,
+                         const at::Tensor grad_alpha,
+                         const at::Tensor grad_color,
+                         const at::Tensor grad_sdf,
+                         const at::Tensor x,
+                         const at::Tensor radius,
+                         const at::Tensor viewdir,
+                         const at::Tensor alpha,
+                         const at::Tensor shape_params,
+                         const at::Tensor color_params,
+                         const at::Tensor point_indices,
+                         const at::Tensor stroke_indices,
+                         const bool pair_output,
+                         const uint32_t sdf_id,
+                         const uint32_t color_id,
+                         const float sdf_delta,
+                         const bool use_laplace_transform,
+                         const bool inv_scale_radius)
+{
+    CHECK_FLOAT_CPU_INPUT(grad_shape_params);
+    CHECK_FLOAT_CPU_INPUT(grad_color_params);
+    CHECK_FLOAT_CPU_INPUT(grad_x);
+    CHECK_FLOAT_CPU_INPUT(grad_alpha);
+    CHECK_FLOAT_CPU_INPUT(grad_color);
+    CHECK_FLOAT_CPU_INPUT(grad_sdf);
+    CHECK_FLOAT_CPU_INPUT(x);
+    CHECK_FLOAT_CPU_INPUT(radius);
+    CHECK_FLOAT_CPU_INPUT(viewdir);
+    CHECK_FLOAT_CPU_INPUT(shape_params);
+    CHECK_FLOAT_CPU_INPUT(color_params);
+    CHECK_INT_CPU_INPUT(point_indices);
+    CHECK_INT_CPU_INPUT(stroke_indices);
+
+    const int64_t n_points = x.size(0);
+    const int64_t n_viewdirs = viewdir.size(0);
+    const int64_t n_samples_per_ray = n_points / n_viewdirs;
+    const int64_t n_strokes = shape_params.size(0);
+    const int64_t n_shape_params = shape_params.size(1);
+    const int64_t n_color_params = color_params.size(1);
+    const bool use_pairs = point_indices.numel() > 0;
+    const int64_t n_pairs = use_pairs ? point_indices.size(0) : n_points * n_strokes;
+
+    constexpr uint32_t num_fn_ids = NB_BASE_SDFS * 16 * NB_COLORS;
+    const uint32_t fn_id = sdf_id * NB_COLORS + color_id;
+    TORCH_CHECK(fn_id < num_fn_ids, "fn_id must be in [0, num_fn_ids]")
+    static const auto fn_table = MAKE_INT_TEMPLATE_ARG_LUT(stroke_backward_cpu_warpper, num_fn_ids);
+    TORCH_CHECK(fn_table[fn_id] != nullptr, "stroke function ", fn_id, " is not compiled, add it to STROKELIB_KERNELS");
+
+    fn_table[fn_id](
+        grad_shape_params.data_ptr<float>(),
+        grad_color_params.data_ptr<float>(),
+        grad_x.numel() ? grad_x.data_ptr<float>() : nullptr,
+        grad_alpha.data_ptr<float>(),
+        grad_color.data_ptr<float>(),
+        grad_sdf.numel() ? grad_sdf.data_ptr<float>() : nullptr,
+        x.data_ptr<float>(),
+        radius.data_ptr<float>(),
+        viewdir.data_ptr<float>(),
+        alpha.data_ptr<float>(),
+        shape_params.data_ptr<float>(),
+        color_params.data_ptr<float>(),
+        use_pairs ? point_indices.data_ptr<int32_t>() : nullptr,
+        use_pairs ? stroke_indices.data_ptr<int32_t>() : nullptr,
+        pair_output,
+        n_pairs,
+        n_points,
+        n_strokes,
+        n_samples_per_ray,
+        n_shape_params,
+        n_color_params,
+        sdf_delta,
+        use_laplace_transform,
+        inv_scale_radius);
+}
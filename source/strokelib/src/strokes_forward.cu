@@ -1,6 +1,5 @@
 #include "strokes.h"
-#include "strokes_sdf.h"
-#include "strokes_color.h"
+#include "strokes_kernel.h"
 #include <array>
 #include <utility>
 
@@ -23,6 +22,10 @@ __global__ void stroke_forward_kernel(float *__restrict__ alpha_output,
                                       const float *__restrict__ viewdir,
                                       const float *__restrict__ shape_params,
                                       const float *__restrict__ color_params,
+                                      const int32_t *__restrict__ point_indices,
+                                      const int32_t *__restrict__ stroke_indices,
+                                      const bool pair_output,
+                                      const int64_t n_pairs,
                                       const int64_t n_points,
                                       const int64_t n_strokes,
                                       const int64_t n_samples_per_ray,
@@ -33,79 +36,37 @@ __global__ void stroke_forward_kernel(float *__restrict__ alpha_output,
                                       const bool inv_scale_radius)
 {
     const uint32_t idx_thread = threadIdx.x + blockIdx.x * blockDim.x;
-    const uint32_t idx_point = idx_thread / n_strokes;
-    const uint32_t idx_stroke = idx_thread % n_strokes;
-    if (idx_point >= n_points)
+    if (idx_thread >= n_pairs)
         return;
 
-    alpha_output += idx_thread;
-    color_output += idx_thread * ColorField<color_type>::color_dim;
-    shape_params += idx_stroke * n_shape_params;
-    color_params += idx_stroke * n_color_params;
-
-    float3 pos = ((const float3 *)x)[idx_point];
-    float  radii = radius[idx_point];
-    float3 dir = ColorField<color_type>::use_viewdir ? ((const float3 *)viewdir)[idx_point / n_samples_per_ray]
-                                                     : make_float3(0.0f);
-    if constexpr (!ColorField<color_type>::use_unit_pos)
-    {
-        // Compute the color output with raw pos and color parameters
-        ColorField<color_type>::get_color(color_output, pos, dir, color_params, idx_stroke);
-    }
-
-    // Apply inverse shape transformation if required
-    const float *sp_reverse = shape_params + n_shape_params;
-    pos = inverse_transform<enable_translation,
-                            enable_rotation,
-                            enable_singlescale,
-                            enable_multiscale>(pos, sp_reverse);
-
-    // Query unit space SDF value with shape parameters
-    float sdf_value = BaseSDF<sdf_type>::sdf(pos, shape_params);
-    if (sdf_output)
-        sdf_output[idx_thread] = sdf_value;
-
-    // scale radii if singlescale or multiscale is enabled
-    if (inv_scale_radius) {
-        if constexpr (enable_singlescale) {
-            float scale = sp_reverse[0];
-            radii /= scale;
-        } else if constexpr (enable_multiscale) {
-            // For multiscale transform, we need to find the direction of sdf gradient
-            // and compute the scale factor from this gradient direction
-            float3 sdf_grad = BaseSDF<sdf_type>::grad_sdf(nullptr, 0.0f, pos, shape_params);
-            // Compute the scale factor from the gradient direction
-            float3 scale = *(const float3 *)(sp_reverse);
-            float3 sdf_grad_scaled = sdf_grad * scale;
-            radii /= (length(sdf_grad_scaled) / length(sdf_grad));
-        }
-    }
-
-    // Transform the SDF to compute the blending weight alpha
-    const float sdf_scale = (use_laplace_transform ? 2.0f : 0.5f) / (sdf_delta * radii);
-    float alpha = sdf_delta > 0.0f ? (use_laplace_transform
-                                          ? laplace_cdf(-sdf_value * sdf_scale)
-                                          : clamp(-sdf_value * sdf_scale + 0.5f, 0.0f, 0.9999f))
-                                   : float(sdf_value <= 0.0f);
-    *alpha_output = alpha;
-
-    if constexpr (ColorField<color_type>::use_unit_pos)
-    {
-        if constexpr (ColorField<color_type>::use_viewdir)
-        {
-            // Transform the viewdir to unit space
-            const float *sp_reverse = shape_params + n_shape_params;
-            dir = inverse_transform_direction<enable_rotation, enable_multiscale>(dir, sp_reverse);
-        }
-
-        // Compute the color output with unit pos and color parameters
-        ColorField<color_type>::get_color(color_output, pos, dir, color_params, idx_stroke);
-    }
-
-    if (texcoord_output) {
-        float2 uv = BaseSDF<sdf_type>::texcoord<enable_multiscale>(pos, shape_params);
-        *(float2 *)(texcoord_output + idx_thread * 2) = uv;
-    }
+    // Each thread handles either one candidate pair or one of all (point, stroke) pairs
+    const int64_t idx_point = point_indices ? point_indices[idx_thread] : idx_thread / n_strokes;
+    const int64_t idx_stroke = stroke_indices ? stroke_indices[idx_thread] : idx_thread % n_strokes;
+
+    stroke_forward_point<sdf_type,
+                         color_type,
+                         enable_translation,
+                         enable_rotation,
+                         enable_singlescale,
+                         enable_multiscale>(
+        alpha_output,
+        color_output,
+        sdf_output,
+        texcoord_output,
+        x,
+        radius,
+        viewdir,
+        shape_params,
+        color_params,
+        idx_point,
+        idx_stroke,
+        pair_output ? int64_t(idx_thread) : idx_point * n_strokes + idx_stroke,
+        n_samples_per_ray,
+        n_shape_params,
+        n_color_params,
+        sdf_delta,
+        use_laplace_transform,
+        inv_scale_radius);
 }
 
 template <uint32_t id>
@@ -118,6 +79,10 @@ void stroke_forward_warpper(float *alpha_output,
                             const float *viewdir,
                             const float *shape_params,
                             const float *color_params,
+                            const int32_t *point_indices,
+                            const int32_t *stroke_indices,
+                            const bool pair_output,
+                            const int64_t n_pairs,
                             const int64_t n_points,
                             const int64_t n_strokes,
                             const int64_t n_samples_per_ray,
@@ -127,25 +92,20 @@ void stroke_forward_warpper(float *alpha_output,
                             const bool use_laplace_transform,
                             const bool inv_scale_radius)
 {
-    constexpr uint32_t sdf_id = id / NB_COLORS;
-    constexpr uint32_t color_id = id % NB_COLORS;
-    constexpr ColorType color_type = ColorType(color_id);
-    constexpr BaseSDFType base_sdf_type = BaseSDFType(sdf_id >> 4);
-    constexpr bool enable_translation = (sdf_id & 0b0001) != 0;
-    constexpr bool enable_rotation = (sdf_id & 0b0010) != 0;
-    constexpr bool enable_singlescale = (sdf_id & 0b0100) != 0;
-    constexpr bool enable_multiscale = (sdf_id & 0b1000) != 0;
+    using Traits = StrokeFnTraits<id>;
     constexpr int64_t n_threads = 512;
-    const int64_t n_blocks = div_round_up(n_points * n_strokes, n_threads);
+    const int64_t n_blocks = div_round_up(n_pairs, n_threads);
+    if (n_blocks == 0)
+        return;
 
     at::cuda::CUDAStream stream = at::cuda::getCurrentCUDAStream();
     stroke_forward_kernel<
-        base_sdf_type,
-        color_type,
-        enable_translation,
-        enable_rotation,
-        enable_singlescale,
-        enable_multiscale>
+        Traits::base_sdf_type,
+        Traits::color_type,
+        Traits::enable_translation,
+        Traits::enable_rotation,
+        Traits::enable_singlescale,
+        Traits::enable_multiscale>
         <<<n_blocks, n_threads, 0, stream>>>(
             alpha_output,
             color_output,
@@ -156,6 +116,10 @@ void stroke_forward_warpper(float *alpha_output,
             viewdir,
             shape_params,
             color_params,
+            point_indices,
+            stroke_indices,
+            pair_output,
+            n_pairs,
             n_points,
             n_strokes,
             n_samples_per_ray,
@@ -167,20 +131,23 @@ void stroke_forward_warpper(float *alpha_output,
 }
 
 DECLARE_INT_TEMPLATE_ARG_LUT(stroke_forward_warpper)
-void stroke_forward(at::Tensor alpha_output,
-                    at::Tensor color_output,
-                    at::Tensor sdf_output,
-                    at::Tensor texcoord_output,
-                    const at::Tensor x,
-                    const at::Tensor radius,
-                    const at::Tensor viewdir,
-                    const at::Tensor shape_params,
-                    const at::Tensor color_params,
-                    const uint32_t sdf_id,
-                    const uint32_t color_id,
-                    const float sdf_delta,
-                    const bool use_laplace_transform,
-                    const bool inv_scale_radius)
+void stroke_forward_cuda(at::Tensor alpha_output,
+                         at::Tensor color_output,
+                         at::Tensor sdf_output,
+                         at::Tensor texcoord_output,
+                         const at::Tensor x,
+                         const at::Tensor radius,
+                         const at::Tensor viewdir,
+                         const at::Tensor shape_params,
+                         const at::Tensor color_params,
+                         const at::Tensor point_indices,
+                         const at::Tensor stroke_indices,
+                         const bool pair_output,
+                         const uint32_t sdf_id,
+                         const uint32_t color_id,
+                         const float sdf_delta,
+                         const bool use_laplace_transform,
+                         const bool inv_scale_radius)
 {
     CHECK_FLOAT_INPUT(alpha_output);
     CHECK_FLOAT_INPUT(color_output);
@@ -191,6 +158,8 @@ void stroke_forward(at::Tensor alpha_output,
     CHECK_FLOAT_INPUT(viewdir);
     CHECK_FLOAT_INPUT(shape_params);
     CHECK_FLOAT_INPUT(color_params);
+    CHECK_INT_INPUT(point_indices);
+    CHECK_INT_INPUT(stroke_indices);
 
     const int64_t n_points = x.size(0);
     const int64_t n_viewdirs = viewdir.size(0);
@@ -198,11 +167,14 @@ void stroke_forward(at::Tensor alpha_output,
     const int64_t n_strokes = shape_params.size(0);
     const int64_t n_shape_params = shape_params.size(1);
     const int64_t n_color_params = color_params.size(1);
+    const bool use_pairs = point_indices.numel() > 0;
+    const int64_t n_pairs = use_pairs ? point_indices.size(0) : n_points * n_strokes;
 
     constexpr uint32_t num_fn_ids = NB_BASE_SDFS * 16 * NB_COLORS;
     const uint32_t fn_id = sdf_id * NB_COLORS + color_id;
     TORCH_CHECK(fn_id < num_fn_ids, "fn_id must be in [0, num_fn_ids]")
     static const auto fn_table = MAKE_INT_TEMPLATE_ARG_LUT(stroke_forward_warpper, num_fn_ids);
+    TORCH_CHECK(fn_table[fn_id] != nullptr, "stroke function ", fn_id, " is not compiled, add it to STROKELIB_KERNELS");
 
     fn_table[fn_id](
         alpha_output.data_ptr<float>(),
@@ -214,6 +186,10 @@ void stroke_forward(at::Tensor alpha_output,
         viewdir.data_ptr<float>(),
         shape_params.data_ptr<float>(),
         color_params.data_ptr<float>(),
+        use_pairs ? point_indices.data_ptr<int32_t>() : nullptr,
+        use_pairs ? stroke_indices.data_ptr<int32_t>() : nullptr,
+        pair_output,
+        n_pairs,
         n_points,
         n_strokes,
         n_samples_per_ray,
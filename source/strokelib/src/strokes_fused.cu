@@ -0,0 +1,398 @@
+#include "strokes.h"
+#include "strokes_fused_kernel.h"
+#include <array>
+#include <utility>
+
+/////////////////////////////////////////////////////////////////////
+// Forward
+/////////////////////////////////////////////////////////////////////
+
+template <BaseSDFType sdf_type,
+          ColorType color_type,
+          bool enable_translation,
+          bool enable_rotation,
+          bool enable_singlescale,
+          bool enable_multiscale>
+__global__ void stroke_compose_forward_kernel(float *__restrict__ density_output,
+                                              float *__restrict__ color_output,
+                                              const float *__restrict__ x,
+                                              const float *__restrict__ radius,
+                                              const float *__restrict__ viewdir,
+                                              const float *__restrict__ shape_params,
+                                              const float *__restrict__ color_params,
+                                              const float *__restrict__ density_params,
+                                              const int64_t *__restrict__ row_offsets,
+                                              const int32_t *__restrict__ stroke_indices,
+                                              const int64_t n_points,
+                                              const int64_t n_strokes,
+                                              const int64_t n_samples_per_ray,
+                                              const int64_t n_shape_params,
+                                              const int64_t n_color_params,
+                                              const float sdf_delta,
+                                              const bool use_laplace_transform,
+                                              const bool inv_scale_radius,
+                                              const float min_transmittance)
+{
+    const uint32_t idx_point = threadIdx.x + blockIdx.x * blockDim.x;
+    if (idx_point >= n_points)
+        return;
+
+    stroke_compose_forward_point<sdf_type,
+                                 color_type,
+                                 enable_translation,
+                                 enable_rotation,
+                                 enable_singlescale,
+                                 enable_multiscale>(
+        density_output,
+        color_output,
+        x,
+        radius,
+        viewdir,
+        shape_params,
+        color_params,
+        density_params,
+        row_offsets,
+        stroke_indices,
+        idx_point,
+        n_strokes,
+        n_samples_per_ray,
+        n_shape_params,
+        n_color_params,
+        sdf_delta,
+        use_laplace_transform,
+        inv_scale_radius,
+        min_transmittance);
+}
+
+template <uint32_t id>
+void stroke_compose_forward_warpper(float *density_output,
+                                    float *color_output,
+                                    const float *x,
+                                    const float *radius,
+                                    const float *viewdir,
+                                    const float *shape_params,
+                                    const float *color_params,
+                                    const float *density_params,
+                                    const int64_t *row_offsets,
+                                    const int32_t *stroke_indices,
+                                    const int64_t n_points,
+                                    const int64_t n_strokes,
+                                    const int64_t n_samples_per_ray,
+                                    const int64_t n_shape_params,
+                                    const int64_t n_color_params,
+                                    const float sdf_delta,
+                                    const bool use_laplace_transform,
+                                    const bool inv_scale_radius,
+                                    const float min_transmittance)
+{
+    using Traits = StrokeFnTraits<id>;
+    constexpr int64_t n_threads = 256;
+    const int64_t n_blocks = div_round_up(n_points, n_threads);
+    if (n_blocks == 0)
+        return;
+
+    at::cuda::CUDAStream stream = at::cuda::getCurrentCUDAStream();
+    stroke_compose_forward_kernel<
+        Traits::base_sdf_type,
+        Traits::color_type,
+        Traits::enable_translation,
+        Traits::enable_rotation,
+        Traits::enable_singlescale,
+        Traits::enable_multiscale>
+        <<<n_blocks, n_threads, 0, stream>>>(
+            density_output,
+            color_output,
+            x,
+            radius,
+            viewdir,
+            shape_params,
+            color_params,
+            density_params,
+            row_offsets,
+            stroke_indices,
+            n_points,
+            n_strokes,
+            n_samples_per_ray,
+            n_shape_params,
+            n_color_params,
+            sdf_delta,
+            use_laplace_transform,
+            inv_scale_radius,
+            min_transmittance);
+}
+
+DECLARE_INT_TEMPLATE_ARG_LUT(stroke_compose_forward_warpper)
+void stroke_compose_forward_cuda(at::Tensor density_output,
+                                 at::Tensor color_output,
+                                 const at::Tensor x,
+                                 const at::Tensor radius,
+                                 const at::Tensor viewdir,
+                                 const at::Tensor shape_params,
+                                 const at::Tensor color_params,
+                                 const at::Tensor density_params,
+                                 const at::Tensor row_offsets,
+                                 const at::Tensor stroke_indices,
+                                 const uint32_t sdf_id,
+                                 const uint32_t color_id,
+                                 const float sdf_delta,
+                                 const bool use_laplace_transform,
+                                 const bool inv_scale_radius,
+                                 const float min_transmittance)
+{
+    CHECK_FLOAT_INPUT(density_output);
+    CHECK_FLOAT_INPUT(color_output);
+    CHECK_FLOAT_INPUT(x);
+    CHECK_FLOAT_INPUT(radius);
+    CHECK_FLOAT_INPUT(viewdir);
+    CHECK_FLOAT_INPUT(shape_params);
+    CHECK_FLOAT_INPUT(color_params);
+    CHECK_FLOAT_INPUT(density_params);
+    CHECK_LONG_INPUT(row_offsets);
+    CHECK_INT_INPUT(stroke_indices);
+
+    const int64_t n_points = x.size(0);
+    const int64_t n_viewdirs = viewdir.size(0);
+    const int64_t n_samples_per_ray = n_points / n_viewdirs;
+    const int64_t n_strokes = shape_params.size(0);
+    const int64_t n_shape_params = shape_params.size(1);
+    const int64_t n_color_params = color_params.size(1);
+    const bool use_rows = row_offsets.numel() > 0;
+
+    constexpr uint32_t num_fn_ids = NB_BASE_SDFS * 16 * NB_COLORS;
+    const uint32_t fn_id = sdf_id * NB_COLORS + color_id;
+    TORCH_CHECK(fn_id < num_fn_ids, "fn_id must be in [0, num_fn_ids]")
+    static const auto fn_table = MAKE_INT_TEMPLATE_ARG_LUT(stroke_compose_forward_warpper, num_fn_ids);
+    TORCH_CHECK(fn_table[fn_id] != nullptr, "stroke function ", fn_id, " is not compiled, add it to STROKELIB_KERNELS");
+
+    fn_table[fn_id](
+        density_output.data_ptr<float>(),
+        color_output.data_ptr<float>(),
+        x.data_ptr<float>(),
+        radius.data_ptr<float>(),
+        viewdir.data_ptr<float>(),
+        shape_params.data_ptr<float>(),
+        color_params.data_ptr<float>(),
+        density_params.data_ptr<float>(),
+        use_rows ? row_offsets.data_ptr<int64_t>() : nullptr,
+        use_rows ? stroke_indices.data_ptr<int32_t>() : nullptr,
+        n_points,
+        n_strokes,
+        n_samples_per_ray,
+        n_shape_params,
+        n_color_params,
+        sdf_delta,
+        use_laplace_transform,
+        inv_scale_radius,
+        min_transmittance);
+}
+
+/////////////////////////////////////////////////////////////////////
+// Backward
+/////////////////////////////////////////////////////////////////////
+
+template <BaseSDFType sdf_type,
+          ColorType color_type,
+          bool enable_translation,
+          bool enable_rotation,
+          bool enable_singlescale,
+          bool enable_multiscale>
+__global__ void stroke_compose_backward_kernel(float *__restrict__ grad_shape_params,
+                                               float *__restrict__ grad_color_params,
+                                               float *__restrict__ grad_density_params,
+                                               float *__restrict__ grad_x,
+                                               const float *__restrict__ grad_density_output,
+                                               const float *__restrict__ grad_color_output,
+                                               const float *__restrict__ x,
+                                               const float *__restrict__ radius,
+                                               const float *__restrict__ viewdir,
+                                               const float *__restrict__ shape_params,
+                                               const float *__restrict__ color_params,
+                                               const float *__restrict__ density_params,
+                                               const int64_t *__restrict__ row_offsets,
+                                               const int32_t *__restrict__ stroke_indices,
+                                               const int64_t n_points,
+                                               const int64_t n_strokes,
+                                               const int64_t n_samples_per_ray,
+                                               const int64_t n_shape_params,
+                                               const int64_t n_color_params,
+                                               const float sdf_delta,
+                                               const bool use_laplace_transform,
+                                               const bool inv_scale_radius,
+                                               const float min_transmittance)
+{
+    const uint32_t idx_point = threadIdx.x + blockIdx.x * blockDim.x;
+    if (idx_point >= n_points)
+        return;
+
+    stroke_compose_backward_point<sdf_type,
+                                  color_type,
+                                  enable_translation,
+                                  enable_rotation,
+                                  enable_singlescale,
+                                  enable_multiscale>(
+        grad_shape_params,
+        grad_color_params,
+        grad_density_params,
+        grad_x,
+        grad_density_output,
+        grad_color_output,
+        x,
+        radius,
+        viewdir,
+        shape_params,
+        color_params,
+        density_params,
+        row_offsets,
+        stroke_indices,
+        idx_point,
+        n_strokes,
+        n_samples_per_ray,
+        n_shape_params,
+        n_color_params,
+        sdf_delta,
+        use_laplace_transform,
+        inv_scale_radius,
+        min_transmittance);
+}
+
+template <uint32_t id>
+void stroke_compose_backward_warpper(float *grad_shape_params,
+                                     float *grad_color_params,
+                                     float *grad_density_params,
+                                     float *grad_x,
+                                     const float *grad_density_output,
+                                     const float *grad_color_output,
+                                     const float *x,
+                                     const float *radius,
+                                     const float *viewdir,
+                                     const float *shape_params,
+                                     const float *color_params,
+                                     const float *density_params,
+                                     const int64_t *row_offsets,
+                                     const int32_t *stroke_indices,
+                                     const int64_t n_points,
+                                     const int64_t n_strokes,
+                                     const int64_t n_samples_per_ray,
+                                     const int64_t n_shape_params,
+                                     const int64_t n_color_params,
+                                     const float sdf_delta,
+                                     const bool use_laplace_transform,
+                                     const bool inv_scale_radius,
+                                     const float min_transmittance)
+{
+    using Traits = StrokeFnTraits<id>;
+    constexpr int64_t n_threads = 256;
+    const int64_t n_blocks = div_round_up(n_points, n_threads);
+    if (n_blocks == 0)
+        return;
+
+    at::cuda::CUDAStream stream = at::cuda::getCurrentCUDAStream();
+    stroke_compose_backward_kernel<
+        Traits::base_sdf_type,
+        Traits::color_type,
+        Traits::enable_translation,
+        Traits::enable_rotation,
+        Traits::enable_singlescale,
+        Traits::enable_multiscale>
+        <<<n_blocks, n_threads, 0, stream>>>(
+            grad_shape_params,
+            grad_color_params,
+            grad_density_params,
+            grad_x,
+            grad_density_output,
+            grad_color_output,
+            x,
+            radius,
+            viewdir,
+            shape_params,
+            color_params,
+            density_params,
+            row_offsets,
+            stroke_indices,
+            n_points,
+            n_strokes,
+            n_samples_per_ray,
+            n_shape_params,
+            n_color_params,
+            sdf_delta,
+            use_laplace_transform,
+            inv_scale_radius,
+            min_transmittance);
+}
+
+DECLARE_INT_TEMPLATE_ARG_LUT(stroke_compose_backward_warpper)
+void stroke_compose_backward_cuda(at::Tensor grad_shape_params,
+                                  at::Tensor grad_color_params,
+                                  at::Tensor grad_density_params,
+                                  at::Tensor grad_x,
+                                  const at::Tensor grad_density_output,
+                                  const at::Tensor grad_color_output,
+                                  const at::Tensor x,
+                                  const at::Tensor radius,
+                                  const at::Tensor viewdir,
+                                  const at::Tensor shape_params,
+                                  const at::Tensor color_params,
+                                  const at::Tensor density_params,
+                                  const at::Tensor row_offsets,
+                                  const at::Tensor stroke_indices,
+                                  const uint32_t sdf_id,
+                                  const uint32_t color_id,
+                                  const float sdf_delta,
+                                  const bool use_laplace_transform,
+                                  const bool inv_scale_radius,
+                                  const float min_transmittance)
+{
+    CHECK_FLOAT_INPUT(grad_shape_params);
+    CHECK_FLOAT_INPUT(grad_color_params);
+    CHECK_FLOAT_INPUT(grad_density_params);
+    CHECK_FLOAT_INPUT(grad_x);
+    CHECK_FLOAT_INPUT(grad_density_output);
+    CHECK_FLOAT_INPUT(grad_color_output);
+    CHECK_FLOAT_INPUT(x);
+    CHECK_FLOAT_INPUT(radius);
+    CHECK_FLOAT_INPUT(viewdir);
+    CHECK_FLOAT_INPUT(shape_params);
+    CHECK_FLOAT_INPUT(color_params);
+    CHECK_FLOAT_INPUT(density_params);
+    CHECK_LONG_INPUT(row_offsets);
+    CHECK_INT_INPUT(stroke_indices);
+
+    const int64_t n_points = x.size(0);
+    const int64_t n_viewdirs = viewdir.size(0);
+    const int64_t n_samples_per_ray = n_points / n_viewdirs;
+    const int64_t n_strokes = shape_params.size(0);
+    const int64_t n_shape_params = shape_params.size(1);
+    const int64_t n_color_params = color_params.size(1);
+    const bool use_rows = row_offsets.numel() > 0;
+
+    constexpr uint32_t num_fn_ids = NB_BASE_SDFS * 16 * NB_COLORS;
+    const uint32_t fn_id = sdf_id * NB_COLORS + color_id;
+    TORCH_CHECK(fn_id < num_fn_ids, "fn_id must be in [0, num_fn_ids]")
+    static const auto fn_table = MAKE_INT_TEMPLATE_ARG_LUT(stroke_compose_backward_warpper, num_fn_ids);
+    TORCH_CHECK(fn_table[fn_id] != nullptr, "stroke function ", fn_id, " is not compiled, add it to STROKELIB_KERNELS");
+
+    fn_table[fn_id](
+        grad_shape_params.data_ptr<float>(),
+        grad_color_params.data_ptr<float>(),
+        grad_density_params.data_ptr<float>(),
+        grad_x.numel() ? grad_x.data_ptr<float>() : nullptr,
+        grad_density_output.data_ptr<float>(),
+        grad_color_output.data_ptr<float>(),
+        x.data_ptr<float>(),
+        radius.data_ptr<float>(),
+        viewdir.data_ptr<float>(),
+        shape_params.data_ptr<float>(),
+        color_params.data_ptr<float>(),
+        density_params.data_ptr<float>(),
+        use_rows ? row_offsets.data_ptr<int64_t>() : nullptr,
+        use_rows ? stroke_indices.data_ptr<int32_t>() : nullptr,
+        n_points,
+        n_strokes,
+        n_samples_per_ray,
+        n_shape_params,
+        n_color_params,
+        sdf_delta,
+        use_laplace_transform,
+        inv_scale_radius,
+        min_transmittance);
+}
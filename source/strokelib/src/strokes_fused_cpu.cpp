@@ -0,0 +1,299 @@
+#include "strokes.h"
+#include "strokes_fused_kernel.h"
+#include <ATen/Parallel.h>
+#include <array>
+#include <utility>
+#include <vector>
+
+/////////////////////////////////////////////////////////////////////
+// Forward
+/////////////////////////////////////////////////////////////////////
+
+template <uint32_t id>
+void stroke_compose_forward_cpu_warpper(float *density_output,
+                                        float *color_output,
+                                        const float *x,
+                                        const float *radius,
+                                        const float *viewdir,
+                                        const float *shape_params,
+                                        const float *color_params,
+                                        const float *density_params,
+                                        const int64_t *row_offsets,
+                                        const int32_t *stroke_indices,
+                                        const int64_t n_points,
+                                        const int64_t n_strokes,
+                                        const int64_t n_samples_per_ray,
+                                        const int64_t n_shape_params,
+                                        const int64_t n_color_params,
+                                        const float sdf_delta,
+                                        const bool use_laplace_transform,
+                                        const bool inv_scale_radius,
+                                        const float min_transmittance)
+{
+    using Traits = StrokeFnTraits<id>;
+    constexpr int64_t grain_size = 16;
+
+    at::parallel_for(0, n_points, grain_size, [&](int64_t begin, int64_t end) {
+        for (int64_t idx_point = begin; idx_point < end; ++idx_point)
+        {
+            stroke_compose_forward_point<Traits::base_sdf_type,
+                                         Traits::color_type,
+                                         Traits::enable_translation,
+                                         Traits::enable_rotation,
+                                         Traits::enable_singlescale,
+                                         Traits::enable_multiscale>(
+                density_output,
+                color_output,
+                x,
+                radius,
+                viewdir,
+                shape_params,
+                color_params,
+                density_params,
+                row_offsets,
+                stroke_indices,
+                idx_point,
+                n_strokes,
+                n_samples_per_ray,
+                n_shape_params,
+                n_color_params,
+                sdf_delta,
+                use_laplace_transform,
+                inv_scale_radius,
+                min_transmittance);
+        }
+    });
+}
+
+DECLARE_INT_TEMPLATE_ARG_LUT(stroke_compose_forward_cpu_warpper)
+void stroke_compose_forward_cpu(at::Tensor density_output,
+                                at::Tensor color_output,
+                                const at::Tensor x,
+                                const at::Tensor radius,
+                                const at::Tensor viewdir,
+                                const at::Tensor shape_params,
+                                const at::Tensor color_params,
+                                const at::Tensor density_params,
+                                const at::Tensor row_offsets,
+                                const at::Tensor stroke_indices,
+                                const uint32_t sdf_id,
+                                const uint32_t color_id,
+                                const float sdf_delta,
+                                const bool use_laplace_transform,
+                                const bool inv_scale_radius,
+                                const float min_transmittance)
+{
+    CHECK_FLOAT_CPU_INPUT(density_output);
+    CHECK_FLOAT_CPU_INPUT(color_output);
+    CHECK_FLOAT_CPU_INPUT(x);
+    CHECK_FLOAT_CPU_INPUT(radius);
+    CHECK_FLOAT_CPU_INPUT(viewdir);
+    CHECK_FLOAT_CPU_INPUT(shape_params);
+    CHECK_FLOAT_CPU_INPUT(color_params);
+    CHECK_FLOAT_CPU_INPUT(density_params);
+    CHECK_LONG_CPU_INPUT(row_offsets);
+    CHECK_INT_CPU_INPUT(stroke_indices);
+
+    const int64_t n_points = x.size(0);
+    const int64_t n_viewdirs = viewdir.size(0);
+    const int64_t n_samples_per_ray = n_points / n_viewdirs;
+    const int64_t n_strokes = shape_params.size(0);
+    const int64_t n_shape_params = shape_params.size(1);
+    const int64_t n_color_params = color_params.size(1);
+    const bool use_rows = row_offsets.numel() > 0;
+
+    constexpr uint32_t num_fn_ids = NB_BASE_SDFS * 16 * NB_COLORS;
+    const uint32_t fn_id = sdf_id * NB_COLORS + color_id;
+    TORCH_CHECK(fn_id < num_fn_ids, "fn_id must be in [0, num_fn_ids]")
+    static const auto fn_table = MAKE_INT_TEMPLATE_ARG_LUT(stroke_compose_forward_cpu_warpper, num_fn_ids);
+    TORCH_CHECK(fn_table[fn_id] != nullptr, "stroke function ", fn_id, " is not compiled, add it to STROKELIB_KERNELS");
+
+    fn_table[fn_id](
+        density_output.data_ptr<float>(),
+        color_output.data_ptr<float>(),
+        x.data_ptr<float>(),
+        radius.data_ptr<float>(),
+        viewdir.data_ptr<float>(),
+        shape_params.data_ptr<float>(),
+        color_params.data_ptr<float>(),
+        density_params.data_ptr<float>(),
+        use_rows ? row_offsets.data_ptr<int64_t>() : nullptr,
+        use_rows ? stroke_indices.data_ptr<int32_t>() : nullptr,
+        n_points,
+        n_strokes,
+        n_samples_per_ray,
+        n_shape_params,
+        n_color_params,
+        sdf_delta,
+        use_laplace_transform,
+        inv_scale_radius,
+        min_transmittance);
+}
+
+/////////////////////////////////////////////////////////////////////
+// Backward
+/////////////////////////////////////////////////////////////////////
+
+template <uint32_t id>
+void stroke_compose_backward_cpu_warpper(float *grad_shape_params,
+                                         float *grad_color_params,
+                                         float *grad_density_params,
+                                         float *grad_x,
+                                         const float *grad_density_output,
+                                         const float *grad_color_output,
+                                         const float *x,
+                                         const float *radius,
+                                         const float *viewdir,
+                                         const float *shape_params,
+                                         const float *color_params,
+                                         const float *density_params,
+                                         const int64_t *row_offsets,
+                                         const int32_t *stroke_indices,
+                                         const int64_t n_points,
+                                         const int64_t n_strokes,
+                                         const int64_t n_samples_per_ray,
+                                         const int64_t n_shape_params,
+                                         const int64_t n_color_params,
+                                         const float sdf_delta,
+                                         const bool use_laplace_transform,
+                                         const bool inv_scale_radius,
+                                         const float min_transmittance)
+{
+    using Traits = StrokeFnTraits<id>;
+    constexpr int64_t grain_size = 16;
+
+    // Points are split among threads so that grad_x is written by a single thread,
+    // while parameter gradients are reduced from thread-private buffers.
+    const int64_t n_threads = at::get_num_threads();
+    const int64_t grad_shape_size = n_strokes * n_shape_params;
+    const int64_t grad_color_size = n_strokes * n_color_params;
+    std::vector<float> grad_shape_buffer(n_threads * grad_shape_size, 0.0f);
+    std::vector<float> grad_color_buffer(n_threads * grad_color_size, 0.0f);
+    std::vector<float> grad_density_buffer(n_threads * n_strokes, 0.0f);
+
+    at::parallel_for(0, n_points, grain_size, [&](int64_t begin, int64_t end) {
+        const int64_t idx_thread = at::get_thread_num();
+        float *thread_grad_shape_params = grad_shape_buffer.data() + idx_thread * grad_shape_size;
+        float *thread_grad_color_params = grad_color_buffer.data() + idx_thread * grad_color_size;
+        float *thread_grad_density_params = grad_density_buffer.data() + idx_thread * n_strokes;
+        for (int64_t idx_point = begin; idx_point < end; ++idx_point)
+        {
+            stroke_compose_backward_point<Traits::base_sdf_type,
+                                          Traits::color_type,
+                                          Traits::enable_translation,
+                                          Traits::enable_rotation,
+                                          Traits::enable_singlescale,
+                                          Traits::enable_multiscale>(
+                thread_grad_shape_params,
+                thread_grad_color_params,
+                thread_grad_density_params,
+                grad_x,
+                grad_density_output,
+                grad_color_output,
+                x,
+                radius,
+                viewdir,
+                shape_params,
+                color_params,
+                density_params,
+                row_offsets,
+                stroke_indices,
+                idx_point,
+                n_strokes,
+                n_samples_per_ray,
+                n_shape_params,
+                n_color_params,
+                sdf_delta,
+                use_laplace_transform,
+                inv_scale_radius,
+                min_transmittance);
+        }
+    });
+
+    for (int64_t t = 0; t < n_threads; ++t)
+    {
+        for (int64_t i = 0; i < grad_shape_size; ++i)
+            grad_shape_params[i] += grad_shape_buffer[t * grad_shape_size + i];
+        for (int64_t i = 0; i < grad_color_size; ++i)
+            grad_color_params[i] += grad_color_buffer[t * grad_color_size + i];
+        for (int64_t i = 0; i < n_strokes; ++i)
+            grad_density_params[i] += grad_density_buffer[t * n_strokes + i];
+    }
+}
+
+DECLARE_INT_TEMPLATE_ARG_LUT(stroke_compose_backward_cpu_warpper)
+void stroke_compose_backward_cpu(at::Tensor grad_shape_params,
+                                 at::Tensor grad_color_params,
+                                 at::Tensor grad_density_params,
+                                 at::Tensor grad_x,
+                                 const at::Tensor grad_density_output,
+                                 const at::Tensor grad_color_output,
+                                 const at::Tensor x,
+                                 const at::Tensor radius,
+                                 const at::Tensor viewdir,
+                                 const at::Tensor shape_params,
+                                 const at::Tensor color_params,
+                                 const at::Tensor density_params,
+                                 const at::Tensor row_offsets,
+                                 const at::Tensor stroke_indices,
+                                 const uint32_t sdf_id,
+                                 const uint32_t color_id,
+                                 const float sdf_delta,
+                                 const bool use_laplace_transform,
+                                 const bool inv_scale_radius,
+                                 const float min_transmittance)
+{
+    CHECK_FLOAT_CPU_INPUT(grad_shape_params);
+    CHECK_FLOAT_CPU_INPUT(grad_color_params);
+    CHECK_FLOAT_CPU_INPUT(grad_density_params);
+    CHECK_FLOAT_CPU_INPUT(grad_x);
+    CHECK_FLOAT_CPU_INPUT(grad_density_output);
+    CHECK_FLOAT_CPU_INPUT(grad_color_output);
+    CHECK_FLOAT_CPU_INPUT(x);
+    CHECK_FLOAT_CPU_INPUT(radius);
+    CHECK_FLOAT_CPU_INPUT(viewdir);
+    CHECK_FLOAT_CPU_INPUT(shape_params);
+    CHECK_FLOAT_CPU_INPUT(color_params);
+    CHECK_FLOAT_CPU_INPUT(density_params);
+    CHECK_LONG_CPU_INPUT(row_offsets);
+    CHECK_INT_CPU_INPUT(stroke_indices);
+
+    const int64_t n_points = x.size(0);
+    const int64_t n_viewdirs = viewdir.size(0);
+    const int64_t n_samples_per_ray = n_points / n_viewdirs;
+    const int64_t n_strokes = shape_params.size(0);
+    const int64_t n_shape_params = shape_params.size(1);
+    const int64_t n_color_params = color_params.size(1);
+    const bool use_rows = row_offsets.numel() > 0;
+
+    constexpr uint32_t num_fn_ids = NB_BASE_SDFS * 16 * NB_COLORS;
+    const uint32_t fn_id = sdf_id * NB_COLORS + color_id;
+    TORCH_CHECK(fn_id < num_fn_ids, "fn_id must be in [0, num_fn_ids]")
+    static const auto fn_table = MAKE_INT_TEMPLATE_ARG_LUT(stroke_compose_backward_cpu_warpper, num_fn_ids);
+    TORCH_CHECK(fn_table[fn_id] != nullptr, "stroke function ", fn_id, " is not compiled, add it to STROKELIB_KERNELS");
+
+    fn_table[fn_id](
+        grad_shape_params.data_ptr<float>(),
+        grad_color_params.data_ptr<float>(),
+        grad_density_params.data_ptr<float>(),
+        grad_x.numel() ? grad_x.data_ptr<float>() : nullptr,
+        grad_density_output.data_ptr<float>(),
+        grad_color_output.data_ptr<float>(),
+        x.data_ptr<float>(),
+        radius.data_ptr<float>(),
+        viewdir.data_ptr<float>(),
+        shape_params.data_ptr<float>(),
+        color_params.data_ptr<float>(),
+        density_params.data_ptr<float>(),
+        use_rows ? row_offsets.data_ptr<int64_t>() : nullptr,
+        use_rows ? stroke_indices.data_ptr<int32_t>() : nullptr,
+        n_points,
+        n_strokes,
+        n_samples_per_ray,
+        n_shape_params,
+        n_color_params,
+        sdf_delta,
+        use_laplace_transform,
+        inv_scale_radius,
+        min_transmittance);
+}
@@ -0,0 +1,294 @@
+#pragma once
+#include <cstdint>
+#include "common.h"
+#include "helper_math.h"
+#include "strokes_kernel.h"
+
+// Per point stroke evaluation fused with "over" composition, shared by the CUDA
+// kernels and the CPU loops. Per-stroke alpha and color only live in registers.
+
+/////////////////////////////////////////////////////////////////////
+// Forward
+/////////////////////////////////////////////////////////////////////
+
+template <BaseSDFType sdf_type,
+          ColorType color_type,
+          bool enable_translation,
+          bool enable_rotation,
+          bool enable_singlescale,
+          bool enable_multiscale>
+__device__ inline void stroke_compose_forward_point(float *__restrict__ density_output,
+                                                    float *__restrict__ color_output,
+                                                    const float *__restrict__ x,
+                                                    const float *__restrict__ radius,
+                                                    const float *__restrict__ viewdir,
+                                                    const float *__restrict__ shape_params,
+                                                    const float *__restrict__ color_params,
+                                                    const float *__restrict__ density_params,
+                                                    const int64_t *__restrict__ row_offsets,
+                                                    const int32_t *__restrict__ stroke_indices,
+                                                    const int64_t idx_point,
+                                                    const int64_t n_strokes,
+                                                    const int64_t n_samples_per_ray,
+                                                    const int64_t n_shape_params,
+                                                    const int64_t n_color_params,
+                                                    const float sdf_delta,
+                                                    const bool use_laplace_transform,
+                                                    const bool inv_scale_radius,
+                                                    const float min_transmittance)
+{
+    constexpr int color_dim = ColorField<color_type>::color_dim;
+
+    // Strokes of this point are either all strokes, or a CSR row of candidate strokes
+    const int64_t entry_begin = row_offsets ? row_offsets[idx_point] : 0;
+    const int64_t entry_end = row_offsets ? row_offsets[idx_point + 1] : n_strokes;
+
+    // Initialize T, density and color
+    float T = 1.0f;
+    float density = 0.0f;
+    float color[color_dim];
+#pragma unroll
+    for (int i = 0; i < color_dim; ++i)
+        color[i] = 0.0f;
+
+    // Evaluate and accumulate strokes from front to back
+    for (int64_t idx_entry = entry_end - 1; idx_entry >= entry_begin; --idx_entry)
+    {
+        const int64_t idx_stroke = stroke_indices ? stroke_indices[idx_entry] : idx_entry;
+        float alpha;
+        float stroke_color[color_dim];
+        stroke_forward_point<sdf_type,
+                             color_type,
+                             enable_translation,
+                             enable_rotation,
+                             enable_singlescale,
+                             enable_multiscale>(
+            &alpha,
+            stroke_color,
+            nullptr,
+            nullptr,
+            x,
+            radius,
+            viewdir,
+            shape_params,
+            color_params,
+            idx_point,
+            idx_stroke,
+            0,
+            n_samples_per_ray,
+            n_shape_params,
+            n_color_params,
+            sdf_delta,
+            use_laplace_transform,
+            inv_scale_radius);
+        if (alpha == 0.0f) // skip zero alpha for speedup
+            continue;
+
+        const float weight = alpha * T;
+        T *= (1.0f - alpha);
+        density += density_params[idx_stroke] * weight;
+#pragma unroll
+        for (int i = 0; i < color_dim; ++i)
+            color[i] += stroke_color[i] * weight;
+
+        // Strokes behind are (almost) fully occluded, stop early
+        if (T < min_transmittance)
+            break;
+    }
+
+    // Compute final color
+    float final_color_scale = 1.0f / (1.0f + 1e-6f - T); // 1 / (1 - T_n)
+#pragma unroll
+    for (int i = 0; i < color_dim; ++i)
+        color[i] = clamp(color[i] * final_color_scale, 0.0f, 1.0f);
+
+    // Store density and color
+    density_output[idx_point] = density;
+#pragma unroll
+    for (int i = 0; i < color_dim; ++i)
+        color_output[idx_point * color_dim + i] = color[i];
+}
+
+/////////////////////////////////////////////////////////////////////
+// Backward
+/////////////////////////////////////////////////////////////////////
+
+template <BaseSDFType sdf_type,
+          ColorType color_type,
+          bool enable_translation,
+          bool enable_rotation,
+          bool enable_singlescale,
+          bool enable_multiscale>
+__device__ inline void stroke_compose_backward_point(float *__restrict__ grad_shape_params,
+                                                     float *__restrict__ grad_color_params,
+                                                     float *__restrict__ grad_density_params,
+                                                     float *__restrict__ grad_x,
+                                                     const float *__restrict__ grad_density_output,
+                                                     const float *__restrict__ grad_color_output,
+                                                     const float *__restrict__ x,
+                                                     const float *__restrict__ radius,
+                                                     const float *__restrict__ viewdir,
+                                                     const float *__restrict__ shape_params,
+                                                     const float *__restrict__ color_params,
+                                                     const float *__restrict__ density_params,
+                                                     const int64_t *__restrict__ row_offsets,
+                                                     const int32_t *__restrict__ stroke_indices,
+                                                     const int64_t idx_point,
+                                                     const int64_t n_strokes,
+                                                     const int64_t n_samples_per_ray,
+                                                     const int64_t n_shape_params,
+                                                     const int64_t n_color_params,
+                                                     const float sdf_delta,
+                                                     const bool use_laplace_transform,
+                                                     const bool inv_scale_radius,
+                                                     const float min_transmittance)
+{
+    constexpr int color_dim = ColorField<color_type>::color_dim;
+    const int64_t entry_begin = row_offsets ? row_offsets[idx_point] : 0;
+    const int64_t entry_end = row_offsets ? row_offsets[idx_point + 1] : n_strokes;
+
+    auto eval_stroke = [&](float &alpha, float *stroke_color, int64_t idx_stroke) {
+        stroke_forward_point<sdf_type,
+                             color_type,
+                             enable_translation,
+                             enable_rotation,
+                             enable_singlescale,
+                             enable_multiscale>(
+            &alpha,
+            stroke_color,
+            nullptr,
+            nullptr,
+            x,
+            radius,
+            viewdir,
+            shape_params,
+            color_params,
+            idx_point,
+            idx_stroke,
+            0,
+            n_samples_per_ray,
+            n_shape_params,
+            n_color_params,
+            sdf_delta,
+            use_laplace_transform,
+            inv_scale_radius);
+    };
+
+    // Recompute density and color outputs
+    float T = 1.0f;
+    float density = 0.0f;
+    float color[color_dim];
+#pragma unroll
+    for (int i = 0; i < color_dim; ++i)
+        color[i] = 0.0f;
+    for (int64_t idx_entry = entry_end - 1; idx_entry >= entry_begin; --idx_entry)
+    {
+        const int64_t idx_stroke = stroke_indices ? stroke_indices[idx_entry] : idx_entry;
+        float alpha;
+        float stroke_color[color_dim];
+        eval_stroke(alpha, stroke_color, idx_stroke);
+        if (alpha == 0.0f) // skip zero alpha for speedup
+            continue;
+
+        const float weight = alpha * T;
+        T *= (1.0f - alpha);
+        density += density_params[idx_stroke] * weight;
+#pragma unroll
+        for (int i = 0; i < color_dim; ++i)
+            color[i] += stroke_color[i] * weight;
+
+        // Strokes behind are (almost) fully occluded, stop early
+        if (T < min_transmittance)
+            break;
+    }
+
+    // Load gradients
+    float dL_ddensity = grad_density_output[idx_point];
+    float dL_dcolor[color_dim];
+    float final_opacity = 1.0f + 1e-6f - T;         // (1 - T_n)
+    float final_color_scale = 1.0f / final_opacity; // 1 / (1 - T_n)
+#pragma unroll
+    for (int i = 0; i < color_dim; ++i)
+    {
+        float scaled_color = color[i] * final_color_scale;
+        bool in_range = 0.0f <= scaled_color && scaled_color <= 1.0f;
+        dL_dcolor[i] = in_range ? grad_color_output[idx_point * color_dim + i] : 0.0f;
+    }
+
+    // Re-evaluate strokes, and backpropagate through composition and stroke evaluation.
+    // Zero alpha strokes get no gradient from either of them, thus they are skipped.
+    T = 1.0f;
+    float density2 = 0.0f;
+    float color2[color_dim];
+#pragma unroll
+    for (int i = 0; i < color_dim; ++i)
+        color2[i] = 0.0f;
+    for (int64_t idx_entry = entry_end - 1; idx_entry >= entry_begin; --idx_entry)
+    {
+        const int64_t idx_stroke = stroke_indices ? stroke_indices[idx_entry] : idx_entry;
+        float alpha;
+        float stroke_color[color_dim];
+        eval_stroke(alpha, stroke_color, idx_stroke);
+        if (alpha == 0.0f)
+            continue;
+
+        // Calculate gradients for density_params and colors
+        const float weight = alpha * T;
+        T *= (1.0f - alpha);
+        density2 += density_params[idx_stroke] * weight;
+        float dL_dstroke_color[color_dim];
+#pragma unroll
+        for (int i = 0; i < color_dim; ++i)
+        {
+            color2[i] += stroke_color[i] * weight;
+            dL_dstroke_color[i] = dL_dcolor[i] * final_color_scale * weight;
+        }
+        atomicAdd(grad_density_params + idx_stroke, dL_ddensity * weight);
+
+        // Calculate gradients for alphas
+        float scale_dT_dalpha = 1.0f / max(1.0f - alpha, 1e-6f);
+        float density_suffix = density - density2;
+        float dL_dalpha = dL_ddensity * (T * density_params[idx_stroke] - density_suffix) * scale_dT_dalpha;
+
+        scale_dT_dalpha *= final_color_scale * final_color_scale;
+#pragma unroll
+        for (int i = 0; i < color_dim; ++i)
+        {
+            float color_suffix = color[i] - color2[i];
+            dL_dalpha += dL_dcolor[i] * (T * stroke_color[i] * (final_opacity - alpha) - color_suffix) * scale_dT_dalpha;
+        }
+
+        // Backpropagate to stroke parameters and the sample position
+        stroke_backward_point<sdf_type,
+                              color_type,
+                              enable_translation,
+                              enable_rotation,
+                              enable_singlescale,
+                              enable_multiscale>(
+            grad_shape_params,
+            grad_color_params,
+            grad_x,
+            &dL_dalpha,
+            dL_dstroke_color,
+            nullptr,
+            x,
+            radius,
+            viewdir,
+            &alpha,
+            shape_params,
+            color_params,
+            idx_point,
+            idx_stroke,
+            0,
+            n_samples_per_ray,
+            n_shape_params,
+            n_color_params,
+            sdf_delta,
+            use_laplace_transform,
+            inv_scale_radius);
+
+        // Strokes behind the forward cutoff do not contribute
+        if (T < min_transmittance)
+            break;
+    }
+}
@@ -0,0 +1,267 @@
+#pragma once
+#include <cstdint>
+#include "common.h"
+#include "helper_math.h"
+#include "strokes_sdf.h"
+#include "strokes_color.h"
+
+// Per (point, stroke) evaluation shared by the CUDA kernels and the CPU loops.
+
+template <uint32_t id>
+struct StrokeFnTraits
+{
+    static constexpr uint32_t sdf_id = id / NB_COLORS;
+    static constexpr uint32_t color_id = id % NB_COLORS;
+    static constexpr ColorType color_type = ColorType(color_id);
+    static constexpr BaseSDFType base_sdf_type = BaseSDFType(sdf_id >> 4);
+    static constexpr bool enable_translation = (sdf_id & 0b0001) != 0;
+    static constexpr bool enable_rotation = (sdf_id & 0b0010) != 0;
+    static constexpr bool enable_singlescale = (sdf_id & 0b0100) != 0;
+    static constexpr bool enable_multiscale = (sdf_id & 0b1000) != 0;
+};
+
+/////////////////////////////////////////////////////////////////////
+// Forward
+/////////////////////////////////////////////////////////////////////
+
+template <BaseSDFType sdf_type,
+          ColorType color_type,
+          bool enable_translation,
+          bool enable_rotation,
+          bool enable_singlescale,
+          bool enable_multiscale>
+__device__ inline void stroke_forward_point(float *__restrict__ alpha_output,
+                                            float *__restrict__ color_output,
+                                            float *__restrict__ sdf_output,
+                                            float *__restrict__ texcoord_output,
+                                            const float *__restrict__ x,
+                                            const float *__restrict__ radius,
+                                            const float *__restrict__ viewdir,
+                                            const float *__restrict__ shape_params,
+                                            const float *__restrict__ color_params,
+                                            const int64_t idx_point,
+                                            const int64_t idx_stroke,
+                                            const int64_t idx_output,
+                                            const int64_t n_samples_per_ray,
+                                            const int64_t n_shape_params,
+                                            const int64_t n_color_params,
+                                            const float sdf_delta,
+                                            const bool use_laplace_transform,
+                                            const bool inv_scale_radius)
+{
+    alpha_output += idx_output;
+    color_output += idx_output * ColorField<color_type>::color_dim;
+    shape_params += idx_stroke * n_shape_params;
+    color_params += idx_stroke * n_color_params;
+
+    float3 pos = ((const float3 *)x)[idx_point];
+    float  radii = radius[idx_point];
+    float3 dir = ColorField<color_type>::use_viewdir ? ((const float3 *)viewdir)[idx_point / n_samples_per_ray]
+                                                     : make_float3(0.0f);
+    if constexpr (!ColorField<color_type>::use_unit_pos)
+    {
+        // Compute the color output with raw pos and color parameters
+        ColorField<color_type>::get_color(color_output, pos, dir, color_params, idx_stroke);
+    }
+
+    // Apply inverse shape transformation if required
+    const float *sp_reverse = shape_params + n_shape_params;
+    pos = inverse_transform<enable_translation,
+                            enable_rotation,
+                            enable_singlescale,
+                            enable_multiscale>(pos, sp_reverse);
+
+    // Query unit space SDF value with shape parameters
+    float sdf_value = BaseSDF<sdf_type>::sdf(pos, shape_params);
+    if (sdf_output)
+        sdf_output[idx_output] = sdf_value;
+
+    // scale radii if singlescale or multiscale is enabled
+    if (inv_scale_radius) {
+        if constexpr (enable_singlescale) {
+            float scale = sp_reverse[0];
+            radii /= scale;
+        } else if constexpr (enable_multiscale) {
+            // For multiscale transform, we need to find the direction of sdf gradient
+            // and compute the scale factor from this gradient direction
+            float3 sdf_grad = BaseSDF<sdf_type>::grad_sdf(nullptr, 0.0f, pos, shape_params);
+            // Compute the scale factor from the gradient direction
+            float3 scale = *(const float3 *)(sp_reverse);
+            float3 sdf_grad_scaled = sdf_grad * scale;
+            radii /= (length(sdf_grad_scaled) / length(sdf_grad));
+        }
+    }
+
+    // Transform the SDF to compute the blending weight alpha
+    const float sdf_scale = (use_laplace_transform ? 2.0f : 0.5f) / (sdf_delta * radii);
+    float alpha = sdf_delta > 0.0f ? (use_laplace_transform
+                                          ? laplace_cdf(-sdf_value * sdf_scale)
+                                          : clamp(-sdf_value * sdf_scale + 0.5f, 0.0f, 0.9999f))
+                                   : float(sdf_value <= 0.0f);
+    *alpha_output = alpha;
+
+    if constexpr (ColorField<color_type>::use_unit_pos)
+    {
+        if constexpr (ColorField<color_type>::use_viewdir)
+        {
+            // Transform the viewdir to unit space
+            const float *sp_reverse = shape_params + n_shape_params;
+            dir = inverse_transform_direction<enable_rotation, enable_multiscale>(dir, sp_reverse);
+        }
+
+        // Compute the color output with unit pos and color parameters
+        ColorField<color_type>::get_color(color_output, pos, dir, color_params, idx_stroke);
+    }
+
+    if (texcoord_output) {
+        float2 uv = BaseSDF<sdf_type>::template texcoord<enable_multiscale>(pos, shape_params);
+        *(float2 *)(texcoord_output + idx_output * 2) = uv;
+    }
+}
+
+/////////////////////////////////////////////////////////////////////
+// Backward
+/////////////////////////////////////////////////////////////////////
+
+template <BaseSDFType sdf_type,
+          ColorType color_type,
+          bool enable_translation,
+          bool enable_rotation,
+          bool enable_singlescale,
+          bool enable_multiscale>
+__device__ inline void stroke_backward_point(float *__restrict__ grad_shape_params,
+                                             float *__restrict__ grad_color_params,
+                                             float *__restrict__ grad_x,
+                                             const float *__restrict__ grad_alpha,
+                                             const float *__restrict__ grad_color,
+                                             const float *__restrict__ grad_sdf,
+                                             const float *__restrict__ x,
+                                             const float *__restrict__ radius,
+                                             const float *__restrict__ viewdir,
+                                             const float *__restrict__ alpha,
+                                             const float *__restrict__ shape_params,
+                                             const float *__restrict__ color_params,
+                                             const int64_t idx_point,
+                                             const int64_t idx_stroke,
+                                             const int64_t idx_output,
+                                             const int64_t n_samples_per_ray,
+                                             const int64_t n_shape_params,
+                                             const int64_t n_color_params,
+                                             const float sdf_delta,
+                                             const bool use_laplace_transform,
+                                             const bool inv_scale_radius)
+{
+    grad_shape_params += idx_stroke * n_shape_params;
+    grad_color_params += idx_stroke * n_color_params;
+    grad_color += idx_output * ColorField<color_type>::color_dim;
+    shape_params += idx_stroke * n_shape_params;
+    color_params += idx_stroke * n_color_params;
+
+    float3 pos = ((const float3 *)x)[idx_point];
+    float  radii = radius[idx_point];
+    float3 dir = ColorField<color_type>::use_viewdir ? ((const float3 *)viewdir)[idx_point / n_samples_per_ray]
+                                                     : make_float3(0.0f);
+    if constexpr (!ColorField<color_type>::use_unit_pos)
+    {
+        // Compute dL/dColorParams from dL/dColor with raw pos
+        ColorField<color_type>::grad_color(grad_color_params, grad_color, pos, dir, color_params, idx_stroke);
+    }
+
+    // Apply inverse shape transformation if required
+    const float *sp_reverse = shape_params + n_shape_params;
+    pos = inverse_transform<enable_translation,
+                            enable_rotation,
+                            enable_singlescale,
+                            enable_multiscale>(pos, sp_reverse);
+
+    // scale radii if singlescale or multiscale is enabled
+    if (inv_scale_radius) {
+        if constexpr (enable_singlescale) {
+            float scale = sp_reverse[0];
+            radii /= scale;
+        } else if constexpr (enable_multiscale) {
+            // For multiscale transform, we need to find the direction of sdf gradient
+            // and compute the scale factor from this gradient direction
+            float3 sdf_grad = BaseSDF<sdf_type>::grad_sdf(nullptr, 0.0f, pos, shape_params);
+            // Compute the scale factor from the gradient direction
+            float3 scale = *(const float3 *)(sp_reverse);
+            float3 sdf_grad_scaled = sdf_grad * scale;
+            radii /= (length(sdf_grad_scaled) / length(sdf_grad));
+        }
+    }
+
+    // Compute dL/dSDF from dL/dAlpha
+    const float sdf_scale = (use_laplace_transform ? 2.0f : 0.5f) / (sdf_delta * radii);
+    float dAlpha_dSDF = 0.0f;
+    if (sdf_delta > 0.0f)
+    {
+        float alpha_val = alpha[idx_output];
+        if (use_laplace_transform)
+            dAlpha_dSDF = (alpha_val < 0.5f ? alpha_val : 1.0f - alpha_val) * -sdf_scale;
+        else
+            dAlpha_dSDF = 0.0f < alpha_val && alpha_val < 0.9999f ? -sdf_scale : 0.0f;
+    }
+    float dL_dSDF = grad_alpha[idx_output] * dAlpha_dSDF + (grad_sdf ? grad_sdf[idx_output] : 0.0f);
+
+    if constexpr (ColorField<color_type>::use_unit_pos)
+    {
+        if constexpr (ColorField<color_type>::use_viewdir)
+        {
+            // Transform the viewdir to unit space
+            const float *sp_reverse = shape_params + n_shape_params;
+            dir = inverse_transform_direction<enable_rotation, enable_multiscale>(dir, sp_reverse);
+        }
+
+        // Compute dL/dColorParams from dL/dColor with raw pos
+        ColorField<color_type>::grad_color(grad_color_params, grad_color, pos, dir, color_params, idx_stroke);
+    }
+
+    // Compute dL/dShapeParams and dL/dPos from dL/dSDF
+    float3 dSDF_dPos = BaseSDF<sdf_type>::grad_sdf(grad_shape_params, dL_dSDF, pos, shape_params);
+    float3 dL_dPos = dL_dSDF * dSDF_dPos;
+
+    // Compute dL/dShapeParams from dL/dPos, by forward transformation
+    float *grad_sp_reverse = grad_shape_params + (sp_reverse - shape_params);
+    if constexpr (enable_singlescale)
+    {
+        float scale = *sp_reverse;
+        dL_dPos /= scale;
+        float3 dL_dScale = -dL_dPos * pos;
+        pos *= scale;
+        atomicAdd(grad_sp_reverse, dL_dScale.x + dL_dScale.y + dL_dScale.z);
+        sp_reverse += 1;
+        grad_sp_reverse += 1;
+    }
+    else if constexpr (enable_multiscale)
+    {
+        float3 scale = *(const float3 *)sp_reverse;
+        dL_dPos /= scale;
+        float3 dL_dScale = -dL_dPos * pos;
+        pos *= scale;
+        atomicAdd3(grad_sp_reverse, dL_dScale);
+        sp_reverse += 3;
+        grad_sp_reverse += 3;
+    }
+    if constexpr (enable_rotation)
+    {
+        float3 eular_angle = *(const float3 *)sp_reverse;
+        pos = rotate_point<false>(pos, eular_angle);
+        float3 dL_dAngle = grad_angle_rotate_point(dL_dPos, pos, eular_angle);
+        dL_dPos = grad_point_rotate_point(dL_dPos, pos, eular_angle);
+        atomicAdd3(grad_sp_reverse, dL_dAngle);
+        sp_reverse += 3;
+        grad_sp_reverse += 3;
+    }
+    if constexpr (enable_translation)
+    {
+        float3 translation = *(const float3 *)sp_reverse;
+        pos += translation;
+        float3 dL_dTranslation = -dL_dPos;
+        atomicAdd3(grad_sp_reverse, dL_dTranslation);
+        sp_reverse += 3;
+        grad_sp_reverse += 3;
+    }
+
+    if (grad_x)
+        atomicAdd3(grad_x + idx_point * 3, dL_dPos);
+}
@@ -0,0 +1,145 @@
+#include <cstdint>
+#include "common.h"
+#include "helper_math.h"
+#include "volume_rendering.h"
+#include "volume_rendering_kernel.h"
+
+__global__ void volume_render_forward_kernel(float *__restrict__ weights_output,
+                                            float *__restrict__ color_output,
+                                            float *__restrict__ acc_output,
+                                            float *__restrict__ depth_output,
+                                            const float *__restrict__ density,
+                                            const float *__restrict__ tdist,
+                                            const float *__restrict__ dir_norms,
+                                            const float *__restrict__ colors,
+                                            const float *__restrict__ bg_colors,
+                                            const int64_t n_rays,
+                                            const int64_t n_samples,
+                                            const bool opaque_background)
+{
+    const int64_t idx_ray = threadIdx.x + blockIdx.x * (int64_t)blockDim.x;
+    if (idx_ray >= n_rays)
+        return;
+
+    volume_render_forward_ray(weights_output, color_output, acc_output, depth_output, density, tdist, dir_norms,
+                              colors, bg_colors, idx_ray, n_samples, opaque_background);
+}
+
+__global__ void volume_render_backward_kernel(float *__restrict__ grad_density,
+                                             float *__restrict__ grad_colors,
+                                             const float *__restrict__ grad_weights_output,
+                                             const float *__restrict__ grad_color_output,
+                                             const float *__restrict__ grad_acc_output,
+                                             const float *__restrict__ grad_depth_output,
+                                             const float *__restrict__ density,
+                                             const float *__restrict__ tdist,
+                                             const float *__restrict__ dir_norms,
+                                             const float *__restrict__ colors,
+                                             const float *__restrict__ bg_colors,
+                                             const float *__restrict__ weights,
+                                             const int64_t n_rays,
+                                             const int64_t n_samples,
+                                             const bool opaque_background)
+{
+    const int64_t idx_ray = threadIdx.x + blockIdx.x * (int64_t)blockDim.x;
+    if (idx_ray >= n_rays)
+        return;
+
+    volume_render_backward_ray(grad_density, grad_colors, grad_weights_output, grad_color_output, grad_acc_output,
+                               grad_depth_output, density, tdist, dir_norms, colors, bg_colors, weights, idx_ray,
+                               n_samples, opaque_background);
+}
+
+void volume_render_forward_cuda(at::Tensor weights_output,
+                                at::Tensor color_output,
+                                at::Tensor acc_output,
+                                at::Tensor depth_output,
+                                const at::Tensor density,
+                                const at::Tensor tdist,
+                                const at::Tensor dir_norms,
+                                const at::Tensor colors,
+                                const at::Tensor bg_colors,
+                                const bool opaque_background)
+{
+    CHECK_FLOAT_INPUT(weights_output);
+    CHECK_FLOAT_INPUT(color_output);
+    CHECK_FLOAT_INPUT(acc_output);
+    CHECK_FLOAT_INPUT(depth_output);
+    CHECK_FLOAT_INPUT(density);
+    CHECK_FLOAT_INPUT(tdist);
+    CHECK_FLOAT_INPUT(dir_norms);
+    CHECK_FLOAT_INPUT(colors);
+    CHECK_FLOAT_INPUT(bg_colors);
+    TORCH_CHECK(colors.size(colors.dim() - 1) == 3, "colors must be RGB");
+
+    const int64_t n_rays = density.size(0);
+    const int64_t n_samples = density.size(1);
+
+    constexpr int64_t n_threads = 256;
+    const int64_t n_blocks = div_round_up(n_rays, n_threads);
+    at::cuda::CUDAStream stream = at::cuda::getCurrentCUDAStream();
+    volume_render_forward_kernel<<<n_blocks, n_threads, 0, stream>>>(
+        weights_output.data_ptr<float>(),
+        color_output.data_ptr<float>(),
+        acc_output.data_ptr<float>(),
+        depth_output.data_ptr<float>(),
+        density.data_ptr<float>(),
+        tdist.data_ptr<float>(),
+        dir_norms.data_ptr<float>(),
+        colors.data_ptr<float>(),
+        bg_colors.data_ptr<float>(),
+        n_rays,
+        n_samples,
+        opaque_background);
+}
+
+void volume_render_backward_cuda(at::Tensor grad_density,
+                                 at::Tensor grad_colors,
+                                 const at::Tensor grad_weights_output,
+                                 const at::Tensor grad_color_output,
+                                 const at::Tensor grad_acc_output,
+                                 const at::Tensor grad_depth_output,
+                                 const at::Tensor density,
+                                 const at::Tensor tdist,
+                                 const at::Tensor dir_norms,
+                                 const at::Tensor colors,
+                                 const at::Tensor bg_colors,
+                                 const at::Tensor weights,
+                                 const bool opaque_background)
+{
+    CHECK_FLOAT_INPUT(grad_density);
+    CHECK_FLOAT_INPUT(grad_colors);
+    CHECK_FLOAT_INPUT(grad_weights_output);
+    CHECK_FLOAT_INPUT(grad_color_output);
+    CHECK_FLOAT_INPUT(grad_acc_output);
+    CHECK_FLOAT_INPUT(grad_depth_output);
+    CHECK_FLOAT_INPUT(density);
+    CHECK_FLOAT_INPUT(tdist);
+    CHECK_FLOAT_INPUT(dir_norms);
+    CHECK_FLOAT_INPUT(colors);
+    CHECK_FLOAT_INPUT(bg_colors);
+    CHECK_FLOAT_INPUT(weights);
+
+    const int64_t n_rays = density.size(0);
+    const int64_t n_samples = density.size(1);
+
+    constexpr int64_t n_threads = 256;
+    const int64_t n_blocks = div_round_up(n_rays, n_threads);
+    at::cuda::CUDAStream stream = at::cuda::getCurrentCUDAStream();
+    volume_render_backward_kernel<<<n_blocks, n_threads, 0, stream>>>(
+        grad_density.data_ptr<float>(),
+        grad_colors.data_ptr<float>(),
+        grad_weights_output.data_ptr<float>(),
+        grad_color_output.data_ptr<float>(),
+        grad_acc_output.data_ptr<float>(),
+        grad_depth_output.data_ptr<float>(),
+        density.data_ptr<float>(),
+        tdist.data_ptr<float>(),
+        dir_norms.data_ptr<float>(),
+        colors.data_ptr<float>(),
+        bg_colors.data_ptr<float>(),
+        weights.data_ptr<float>(),
+        n_rays,
+        n_samples,
+        opaque_background);
+}
@@ -0,0 +1,96 @@
+#pragma once
+
+#include <cstdint>
+#include <torch/torch.h>
+
+// weights_output: [N_Rays, N_Samples], float
+// color_output: [N_Rays, 3], float
+// acc_output: [N_Rays], float
+// depth_output: [N_Rays], float
+// density: [N_Rays, N_Samples], float
+// tdist: [N_Rays, N_Samples + 1], float, distances of the interval endpoints along the rays
+// dir_norms: [N_Rays], float, norms of the ray directions
+// colors: [N_Rays, N_Samples, 3], float
+// bg_colors: [N_Rays, 3], float
+// opaque_background: make the last interval of each ray infinitely wide
+void volume_render_forward(at::Tensor weights_output,
+                           at::Tensor color_output,
+                           at::Tensor acc_output,
+                           at::Tensor depth_output,
+                           const at::Tensor density,
+                           const at::Tensor tdist,
+                           const at::Tensor dir_norms,
+                           const at::Tensor colors,
+                           const at::Tensor bg_colors,
+                           const bool opaque_background);
+
+void volume_render_forward_cuda(at::Tensor weights_output,
+                                at::Tensor color_output,
+                                at::Tensor acc_output,
+                                at::Tensor depth_output,
+                                const at::Tensor density,
+                                const at::Tensor tdist,
+                                const at::Tensor dir_norms,
+                                const at::Tensor colors,
+                                const at::Tensor bg_colors,
+                                const bool opaque_background);
+
+void volume_render_forward_cpu(at::Tensor weights_output,
+                               at::Tensor color_output,
+                               at::Tensor acc_output,
+                               at::Tensor depth_output,
+                               const at::Tensor density,
+                               const at::Tensor tdist,
+                               const at::Tensor dir_norms,
+                               const at::Tensor colors,
+                               const at::Tensor bg_colors,
+                               const bool opaque_background);
+
+// grad_density: [N_Rays, N_Samples], float
+// grad_colors: [N_Rays, N_Samples, 3], float
+// grad_weights_output, grad_color_output, grad_acc_output, grad_depth_output: float,
+//     same shapes as the outputs of volume_render_forward
+// density, tdist, dir_norms, colors, bg_colors: same as in volume_render_forward
+// weights: [N_Rays, N_Samples], float, the weights output of volume_render_forward
+// opaque_background: bool, same as in forward
+void volume_render_backward(at::Tensor grad_density,
+                            at::Tensor grad_colors,
+                            const at::Tensor grad_weights_output,
+                            const at::Tensor grad_color_output,
+                            const at::Tensor grad_acc_output,
+                            const at::Tensor grad_depth_output,
+                            const at::Tensor density,
+                            const at::Tensor tdist,
+                            const at::Tensor dir_norms,
+                            const at::Tensor colors,
+                            const at::Tensor bg_colors,
+                            const at::Tensor weights,
+                            const bool opaque_background);
+
+void volume_render_backward_cuda(at::Tensor grad_density,
+                                 at::Tensor grad_colors,
+                                 const at::Tensor grad_weights_output,
+                                 const at::Tensor grad_color_output,
+                                 const at::Tensor grad_acc_output,
+                                 const at::Tensor grad_depth_output,
+                                 const at::Tensor density,
+                                 const at::Tensor tdist,
+                                 const at::Tensor dir_norms,
+                                 const at::Tensor colors,
+                                 const at::Tensor bg_colors,
+                                 const at::Tensor weights,
+                                 const bool opaque_background);
+
+void volume_render_backward_cpu(at::Tensor grad_density,
+                                at::Tensor grad_colors,
+                                const at::Tensor grad_weights_output,
+                                const at::Tensor grad_color_output,
+                                const at::Tensor grad_acc_output,
+                                const at::Tensor grad_depth_output,
+                                const at::Tensor density,
+                                const at::Tensor tdist,
+                                const at::Tensor dir_norms,
+                                const at::Tensor colors,
+                                const at::Tensor bg_colors,
+                                const at::Tensor weights,
+                                const bool opaque_background);
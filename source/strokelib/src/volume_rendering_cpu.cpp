@@ -0,0 +1,140 @@
+#include <cstdint>
+#include "common.h"
+#include "helper_math.h"
+#include "volume_rendering.h"
+#include "volume_rendering_kernel.h"
+#include <ATen/Parallel.h>
+
+void volume_render_forward_cpu_kernel(float *weights_output,
+                                      float *color_output,
+                                      float *acc_output,
+                                      float *depth_output,
+                                      const float *density,
+                                      const float *tdist,
+                                      const float *dir_norms,
+                                      const float *colors,
+                                      const float *bg_colors,
+                                      const int64_t n_rays,
+                                      const int64_t n_samples,
+                                      const bool opaque_background)
+{
+    constexpr int64_t grain_size = 64;
+    at::parallel_for(0, n_rays, grain_size, [&](int64_t begin, int64_t end) {
+        for (int64_t idx_ray = begin; idx_ray < end; ++idx_ray)
+            volume_render_forward_ray(weights_output, color_output, acc_output, depth_output, density, tdist,
+                                      dir_norms, colors, bg_colors, idx_ray, n_samples, opaque_background);
+    });
+}
+
+void volume_render_backward_cpu_kernel(float *grad_density,
+                                       float *grad_colors,
+                                       const float *grad_weights_output,
+                                       const float *grad_color_output,
+                                       const float *grad_acc_output,
+                                       const float *grad_depth_output,
+                                       const float *density,
+                                       const float *tdist,
+                                       const float *dir_norms,
+                                       const float *colors,
+                                       const float *bg_colors,
+                                       const float *weights,
+                                       const int64_t n_rays,
+                                       const int64_t n_samples,
+                                       const bool opaque_background)
+{
+    constexpr int64_t grain_size = 64;
+    at::parallel_for(0, n_rays, grain_size, [&](int64_t begin, int64_t end) {
+        for (int64_t idx_ray = begin; idx_ray < end; ++idx_ray)
+            volume_render_backward_ray(grad_density, grad_colors, grad_weights_output, grad_color_output,
+                                       grad_acc_output, grad_depth_output, density, tdist, dir_norms, colors,
+                                       bg_colors, weights, idx_ray, n_samples, opaque_background);
+    });
+}
+
+void volume_render_forward_cpu(at::Tensor weights_output,
+                               at::Tensor color_output,
+                               at::Tensor acc_output,
+                               at::Tensor depth_output,
+                               const at::Tensor density,
+                               const at::Tensor tdist,
+                               const at::Tensor dir_norms,
+                               const at::Tensor colors,
+                               const at::Tensor bg_colors,
+                               const bool opaque_background)
+{
+    CHECK_FLOAT_CPU_INPUT(weights_output);
+    CHECK_FLOAT_CPU_INPUT(color_output);
+    CHECK_FLOAT_CPU_INPUT(acc_output);
+    CHECK_FLOAT_CPU_INPUT(depth_output);
+    CHECK_FLOAT_CPU_INPUT(density);
+    CHECK_FLOAT_CPU_INPUT(tdist);
+    CHECK_FLOAT_CPU_INPUT(dir_norms);
+    CHECK_FLOAT_CPU_INPUT(colors);
+    CHECK_FLOAT_CPU_INPUT(bg_colors);
+    TORCH_CHECK(colors.size(colors.dim() - 1) == 3, "colors must be RGB");
+
+    const int64_t n_rays = density.size(0);
+    const int64_t n_samples = density.size(1);
+
+    volume_render_forward_cpu_kernel(
+        weights_output.data_ptr<float>(),
+        color_output.data_ptr<float>(),
+        acc_output.data_ptr<float>(),
+        depth_output.data_ptr<float>(),
+        density.data_ptr<float>(),
+        tdist.data_ptr<float>(),
+        dir_norms.data_ptr<float>(),
+        colors.data_ptr<float>(),
+        bg_colors.data_ptr<float>(),
+        n_rays,
+        n_samples,
+        opaque_background);
+}
+
+void volume_render_backward_cpu(at::Tensor grad_density,
+                                at::Tensor grad_colors,
+                                const at::Tensor grad_weights_output,
+                                const at::Tensor grad_color_output,
+                                const at::Tensor grad_acc_output,
+                                const at::Tensor grad_depth_output,
+                                const at::Tensor density,
+                                const at::Tensor tdist,
+                                const at::Tensor dir_norms,
+                                const at::Tensor colors,
+                                const at::Tensor bg_colors,
+                                const at::Tensor weights,
+                                const bool opaque_background)
+{
+    CHECK_FLOAT_CPU_INPUT(grad_density);
+    CHECK_FLOAT_CPU_INPUT(grad_colors);
+    CHECK_FLOAT_CPU_INPUT(grad_weights_output);
+    CHECK_FLOAT_CPU_INPUT(grad_color_output);
+    CHECK_FLOAT_CPU_INPUT(grad_acc_output);
+    CHECK_FLOAT_CPU_INPUT(grad_depth_output);
+    CHECK_FLOAT_CPU_INPUT(density);
+    CHECK_FLOAT_CPU_INPUT(tdist);
+    CHECK_FLOAT_CPU_INPUT(dir_norms);
+    CHECK_FLOAT_CPU_INPUT(colors);
+    CHECK_FLOAT_CPU_INPUT(bg_colors);
+    CHECK_FLOAT_CPU_INPUT(weights);
+
+    const int64_t n_rays = density.size(0);
+    const int64_t n_samples = density.size(1);
+
+    volume_render_backward_cpu_kernel(
+        grad_density.data_ptr<float>(),
+        grad_colors.data_ptr<float>(),
+        grad_weights_output.data_ptr<float>(),
+        grad_color_output.data_ptr<float>(),
+        grad_acc_output.data_ptr<float>(),
+        grad_depth_output.data_ptr<float>(),
+        density.data_ptr<float>(),
+        tdist.data_ptr<float>(),
+        dir_norms.data_ptr<float>(),
+        colors.data_ptr<float>(),
+        bg_colors.data_ptr<float>(),
+        weights.data_ptr<float>(),
+        n_rays,
+        n_samples,
+        opaque_background);
+}
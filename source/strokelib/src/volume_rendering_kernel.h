@@ -0,0 +1,142 @@
+#pragma once
+#include <cstdint>
+#include <cmath>
+#include "common.h"
+#include "helper_math.h"
+
+// Per ray volume rendering shared by the CUDA kernels and the CPU loops, the same as
+// compute_alpha_weights followed by volumetric_rendering in source/utils/render.py.
+// The forward only writes the weights and the per ray outputs. The backward reads the
+// weights back and recomputes the transmittance from the densities, so that no other
+// per sample temporaries are kept for autograd.
+// Gradients only flow to the densities and colors, the distances are treated as constants.
+
+constexpr float VOLUME_RENDER_EPS = 1.1920929e-7f; // torch.finfo(torch.float32).eps
+
+__device__ inline void volume_render_forward_ray(float *__restrict__ weights_output,
+                                                 float *__restrict__ color_output,
+                                                 float *__restrict__ acc_output,
+                                                 float *__restrict__ depth_output,
+                                                 const float *__restrict__ density,
+                                                 const float *__restrict__ tdist,
+                                                 const float *__restrict__ dir_norms,
+                                                 const float *__restrict__ colors,
+                                                 const float *__restrict__ bg_colors,
+                                                 const int64_t idx_ray,
+                                                 const int64_t n_samples,
+                                                 const bool opaque_background)
+{
+    const float *ray_density = density + idx_ray * n_samples;
+    const float *ray_tdist = tdist + idx_ray * (n_samples + 1);
+    const float *ray_colors = colors + idx_ray * n_samples * 3;
+    float *ray_weights = weights_output + idx_ray * n_samples;
+    const float dir_norm = dir_norms[idx_ray];
+
+    // Accumulate the weights, color and depth front to back
+    float optical_depth = 0.0f; // sum of density * delta of the samples in front
+    float acc = 0.0f;
+    float depth = 0.0f;
+    float3 color = make_float3(0.0f, 0.0f, 0.0f);
+    for (int64_t i = 0; i < n_samples; ++i)
+    {
+        const float delta = (ray_tdist[i + 1] - ray_tdist[i]) * dir_norm;
+        const float density_delta = ray_density[i] * delta;
+        // An opaque background makes the last interval infinitely wide
+        const bool is_opaque = opaque_background && i == n_samples - 1;
+        const float alpha = is_opaque ? 1.0f : 1.0f - expf(-density_delta);
+        const float weight = alpha * expf(-optical_depth);
+        optical_depth += density_delta;
+
+        ray_weights[i] = weight;
+        acc += weight;
+        depth += weight * 0.5f * (ray_tdist[i] + ray_tdist[i + 1]);
+        color += weight * make_float3(ray_colors[i * 3 + 0], ray_colors[i * 3 + 1], ray_colors[i * 3 + 2]);
+    }
+
+    // Composite the background and normalize the depth
+    const float bg_weight = fmaxf(1.0f - acc, 0.0f);
+    color_output[idx_ray * 3 + 0] = color.x + bg_weight * bg_colors[idx_ray * 3 + 0];
+    color_output[idx_ray * 3 + 1] = color.y + bg_weight * bg_colors[idx_ray * 3 + 1];
+    color_output[idx_ray * 3 + 2] = color.z + bg_weight * bg_colors[idx_ray * 3 + 2];
+    acc_output[idx_ray] = acc;
+    depth_output[idx_ray] = clamp(depth / fmaxf(acc, VOLUME_RENDER_EPS), ray_tdist[0], ray_tdist[n_samples]);
+}
+
+__device__ inline void volume_render_backward_ray(float *__restrict__ grad_density,
+                                                  float *__restrict__ grad_colors,
+                                                  const float *__restrict__ grad_weights_output,
+                                                  const float *__restrict__ grad_color_output,
+                                                  const float *__restrict__ grad_acc_output,
+                                                  const float *__restrict__ grad_depth_output,
+                                                  const float *__restrict__ density,
+                                                  const float *__restrict__ tdist,
+                                                  const float *__restrict__ dir_norms,
+                                                  const float *__restrict__ colors,
+                                                  const float *__restrict__ bg_colors,
+                                                  const float *__restrict__ weights,
+                                                  const int64_t idx_ray,
+                                                  const int64_t n_samples,
+                                                  const bool opaque_background)
+{
+    const float *ray_density = density + idx_ray * n_samples;
+    const float *ray_tdist = tdist + idx_ray * (n_samples + 1);
+    const float *ray_colors = colors + idx_ray * n_samples * 3;
+    const float *ray_weights = weights + idx_ray * n_samples;
+    const float *ray_grad_weights = grad_weights_output + idx_ray * n_samples;
+    const float dir_norm = dir_norms[idx_ray];
+
+    // Recompute acc and depth from the weights
+    float acc = 0.0f;
+    float depth_sum = 0.0f;
+    for (int64_t i = 0; i < n_samples; ++i)
+    {
+        acc += ray_weights[i];
+        depth_sum += ray_weights[i] * 0.5f * (ray_tdist[i] + ray_tdist[i + 1]);
+    }
+    const float acc_clamped = fmaxf(acc, VOLUME_RENDER_EPS);
+    const float depth = depth_sum / acc_clamped;
+
+    // The gradient w.r.t. weight_i is grad_weight_i + grad_color . color_i + grad_depth_t * t_mid_i + grad_const
+    const float3 grad_color = make_float3(grad_color_output[idx_ray * 3 + 0], grad_color_output[idx_ray * 3 + 1],
+                                          grad_color_output[idx_ray * 3 + 2]);
+    const float3 bg_color = make_float3(bg_colors[idx_ray * 3 + 0], bg_colors[idx_ray * 3 + 1],
+                                        bg_colors[idx_ray * 3 + 2]);
+    float grad_const = grad_acc_output[idx_ray];
+    if (1.0f - acc >= 0.0f)
+        grad_const -= dot(grad_color, bg_color);
+    float grad_depth_t = 0.0f;
+    if (ray_tdist[0] <= depth && depth <= ray_tdist[n_samples])
+    {
+        grad_depth_t = grad_depth_output[idx_ray] / acc_clamped;
+        if (acc >= VOLUME_RENDER_EPS)
+            grad_const -= grad_depth_output[idx_ray] * depth / acc_clamped;
+    }
+    auto grad_weight = [&](const int64_t i) {
+        const float3 c = make_float3(ray_colors[i * 3 + 0], ray_colors[i * 3 + 1], ray_colors[i * 3 + 2]);
+        return ray_grad_weights[i] + dot(grad_color, c) + grad_depth_t * 0.5f * (ray_tdist[i] + ray_tdist[i + 1]) +
+               grad_const;
+    };
+
+    float total = 0.0f; // sum of grad_weight_i * weight_i over all samples
+    for (int64_t i = 0; i < n_samples; ++i)
+        total += grad_weight(i) * ray_weights[i];
+
+    // d weight_i / d density_delta_k is trans_{k+1} for i == k, and -weight_i for i > k
+    float optical_depth = 0.0f;
+    float prefix = 0.0f; // sum of grad_weight_i * weight_i over the samples up to k
+    for (int64_t k = 0; k < n_samples; ++k)
+    {
+        const float delta = (ray_tdist[k + 1] - ray_tdist[k]) * dir_norm;
+        const float grad_weight_k = grad_weight(k);
+        optical_depth += ray_density[k] * delta;
+        prefix += grad_weight_k * ray_weights[k];
+
+        // The infinitely wide last interval of an opaque background has no gradient
+        const bool is_opaque = opaque_background && k == n_samples - 1;
+        const float grad_density_delta = is_opaque ? 0.0f : grad_weight_k * expf(-optical_depth) - (total - prefix);
+        grad_density[idx_ray * n_samples + k] = grad_density_delta * delta;
+        grad_colors[(idx_ray * n_samples + k) * 3 + 0] = grad_color.x * ray_weights[k];
+        grad_colors[(idx_ray * n_samples + k) * 3 + 1] = grad_color.y * ray_weights[k];
+        grad_colors[(idx_ray * n_samples + k) * 3 + 2] = grad_color.z * ray_weights[k];
+    }
+}
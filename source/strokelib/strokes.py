@@ -1,109 +1,80 @@
 import math
+import os
+import warnings
 import torch
 from torch.autograd import Function
 from torch.autograd.function import once_differentiable
 from torch.cuda.amp import custom_bwd, custom_fwd
 
-try:
-    import _strokelib as _backend
-except ImportError:
-    from .backend import _backend
-
-_base_sdf_id = {
-    'unit_sphere': 0,
-    'unit_cube': 1,
-    'unit_round_cube': 2,
-    'unit_capped_torus': 3,
-    'unit_capsule': 4,
-    'unit_line': 5,
-    'unit_triprism': 6,
-    'unit_octahedron': 7,
-    'unit_tetrahedron': 8,
-    'quadratic_bezier': 9,
-    'cubic_bezier': 10,
-    'catmull_rom': 11,
-}
+from .reference import _euler_rotation_matrix, stroke_reference, over_composition_reference, \
+    sparse_over_composition_reference, volume_render_reference
+from .shapes import _sdf_dict, _color_dict, _color_dim, _make_sdf_id, get_stroke_fn_id
 
-def _make_spline_init_fn(num_control_points, num_radius):
-    def _init_fn(args):
-        (scale_min, scale_max, sample_coord) = args
-        scales = torch.rand(1) * (scale_max - scale_min) + scale_min
-        control_points = []
-        for i in range(num_control_points):
-            P = sample_coord + (torch.rand(3) - 0.5) * scales
-            control_points.append(P)
-        radius = (0.2 + 0.2 * torch.rand(num_radius)) * scales
-        return torch.cat(control_points + [radius])
-    
-    return _init_fn
-
-_sdf_dict = {
-    'sphere': ('unit_sphere', [], None, True, False, True, False),
-    'ellipsoid': ('unit_sphere', [], None, True, True, False, True),
-    'aacube': ('unit_cube', [], None, True, False, True, False),
-    'cube': ('unit_cube', [], None, True, True, True, False),
-    'aabb': ('unit_cube', [], None, True, False, False, True),
-    'obb': ('unit_cube', [], None, True, True, False, True),
-    'roundcube': ('unit_round_cube', [(0, 1)], lambda _: 0.8 * torch.rand(1), True, True, True, False),
-    'roundbox': ('unit_round_cube', [(0, 1)], lambda _: 0.8 * torch.rand(1), True, True, False, True),
-    'cappedtorus':
-    ('unit_capped_torus', [(0, 2 * torch.acos(torch.tensor(0.0))),
-                           (0, None)], lambda _: torch.rand(2), True, True, True, False),
-    'capsule':
-    ('unit_capsule', [(0.25, None)], lambda _: torch.rand(1) + 0.25, True, True, True, False),
-    'scapsule':
-    ('unit_capsule', [(0.25, None)], lambda _: torch.rand(1) + 0.25, True, True, False, True),
-    'line': ('unit_line', [
-        (0.25, None), (-0.8, 0.8)
-    ], lambda _: torch.cat([torch.rand(1) + 0.25, torch.rand(1) - 0.5]), True, True, True, False),
-    'triprism': ('unit_triprism', [(0, None)], lambda _: torch.rand(1), True, True, True, False),
-    'octahedron': ('unit_octahedron', [], None, True, True, True, False),
-    'tetrahedron': ('unit_tetrahedron', [], None, True, True, True, False),
-    'quadratic_bezier':
-    ('quadratic_bezier', [(-1, 1), (-1, 1), (-1, 1), 
-                          (-1, 1), (-1, 1), (-1, 1), 
-                          (-1, 1), (-1, 1), (-1, 1), 
-                          (0.001, 0.2), (0.001, 0.2)],
-     _make_spline_init_fn(3, 2), False, False, False, False),
-    'cubic_bezier':
-    ('cubic_bezier', [(-1, 1), (-1, 1), (-1, 1), 
-                      (-1, 1), (-1, 1), (-1, 1), 
-                      (-1, 1), (-1, 1), (-1, 1), 
-                      (-1, 1), (-1, 1), (-1, 1),
-                      (0.001, 0.2), (0.001, 0.2)],
-     _make_spline_init_fn(4, 2), False, False, False, False),
-    'catmull_rom':
-    ('catmull_rom', [(-1, 1), (-1, 1), (-1, 1), 
-                      (-1, 1), (-1, 1), (-1, 1), 
-                      (-1, 1), (-1, 1), (-1, 1), 
-                      (-1, 1), (-1, 1), (-1, 1),
-                      (0.001, 0.2), (0.001, 0.2)],
-     _make_spline_init_fn(4, 2), False, False, False, False),
-}
+# STROKELIB_BACKEND=torch skips the native build and uses the PyTorch reference everywhere.
+_backend = None
+if os.environ.get('STROKELIB_BACKEND', 'native') != 'torch':
+    try:
+        import _strokelib as _backend
+    except ImportError:
+        try:
+            from .backend import _backend
+        except Exception as e:
+            warnings.warn(f'Failed to load the native strokelib backend, using the PyTorch reference: {e}')
 
-_color_dict = {
-    'constant_rgb': (0, [(0, 1)] * 3, lambda: torch.rand(3)),
-    'gradient_rgb': (1, [(-1, 1)] * 6 + [(0, 1)] * 6,
-                     lambda: torch.cat([torch.rand(6) - 0.5, torch.rand(6)], dim=-1)),
-    'constant_sh2': (2, [(None, None)] * 12, lambda: torch.randn(12)),
-    'constant_sh3': (3, [(None, None)] * 27, lambda: torch.randn(27)),
-}
 
-_color_dim = [3, 3, 3, 3]
+# The number of stroke outputs evaluated at a time in float when they are stored in half precision.
+_STORAGE_CHUNK_SIZE = 1 << 22
 
 
-def _make_sdf_id(base_sdf_name: str, enable_translation: bool, enable_rotation: bool,
-                 enable_singlescale: bool, enable_multiscale: bool) -> int:
-    sdf_id = _base_sdf_id[base_sdf_name] << 4
-    if enable_translation:
-        sdf_id = sdf_id | (1 << 0)
-    if enable_rotation:
-        sdf_id = sdf_id | (1 << 1)
-    if enable_singlescale:
-        sdf_id = sdf_id | (1 << 2)
-    if enable_multiscale:
-        sdf_id = sdf_id | (1 << 3)
-    return sdf_id
+def _stroke_forward_chunked(alpha_output, color_output, sdf_output, texcoord_output, x, radius, viewdir,
+                            shape_params, color_params, point_indices, stroke_indices, pair_output, *args):
+    """_backend.stroke_forward into half precision alpha, color and texcoord outputs.
+
+    The kernels write float, so the outputs are evaluated in chunks of rays (or of candidate pairs
+    for pair outputs) into float buffers that are copied into the outputs. Only one chunk of float
+    outputs is alive at a time. The sdf output stays float and is written in place.
+    """
+    use_pairs = point_indices.numel() > 0
+    if pair_output:
+        num_items = point_indices.shape[0]
+        chunk_size = _STORAGE_CHUNK_SIZE
+    else:
+        num_items = viewdir.shape[0]
+        num_samples = x.shape[0] // num_items
+        chunk_size = max(_STORAGE_CHUNK_SIZE // (num_samples * shape_params.shape[0]), 1)
+    for i in range(0, num_items, chunk_size):
+        j = min(i + chunk_size, num_items)
+        if pair_output:
+            # Pair outputs are indexed by pair, the pairs index into all the samples.
+            start, end = i, j
+            chunk_x, chunk_radius, chunk_viewdir = x, radius, viewdir
+            chunk_points, chunk_strokes = point_indices[i:j], stroke_indices[i:j]
+        else:
+            start, end = i * num_samples, j * num_samples
+            chunk_x, chunk_radius, chunk_viewdir = x[start:end], radius[start:end], viewdir[i:j]
+            chunk_points, chunk_strokes = point_indices, stroke_indices
+            if use_pairs:
+                # Pairs are sorted by sample, the pairs of the chunk are contiguous.
+                bounds = torch.tensor([start, end], dtype=point_indices.dtype, device=point_indices.device)
+                pair_start, pair_end = torch.searchsorted(point_indices, bounds).tolist()
+                if pair_start == pair_end:
+                    continue
+                chunk_points = point_indices[pair_start:pair_end] - start
+                chunk_strokes = stroke_indices[pair_start:pair_end]
+
+        empty_fn = torch.zeros if use_pairs else torch.empty  # Pairs leave the rest as empty space
+        float_chunk = lambda output: empty_fn(output[start:end].shape, dtype=torch.float32, device=x.device) \
+            if output.numel() > 0 else output
+        alpha_chunk, color_chunk, texcoord_chunk = \
+            float_chunk(alpha_output), float_chunk(color_output), float_chunk(texcoord_output)
+        sdf_chunk = sdf_output[start:end] if sdf_output.numel() > 0 else sdf_output
+        _backend.stroke_forward(alpha_chunk, color_chunk, sdf_chunk, texcoord_chunk, chunk_x, chunk_radius,
+                                chunk_viewdir, shape_params, color_params, chunk_points, chunk_strokes, pair_output,
+                                *args)
+        alpha_output[start:end] = alpha_chunk
+        color_output[start:end] = color_chunk
+        if texcoord_output.numel() > 0:
+            texcoord_output[start:end] = texcoord_chunk
 
 
 class _stroke_fn(Function):
@@ -121,7 +92,11 @@ class _stroke_fn(Function):
                 use_laplace_transform: bool = False,
                 inv_scale_radius: bool = False,
                 no_sdf: bool = True,
-                return_texcoord: bool = False):
+                return_texcoord: bool = False,
+                point_indices: torch.Tensor = None,
+                stroke_indices: torch.Tensor = None,
+                pair_output: bool = False,
+                storage_dtype: torch.dtype = None):
         """Compute the SDF value and the base coordinates of a batch of strokes.
 
         Args:
@@ -138,7 +113,16 @@ class _stroke_fn(Function):
             inv_scale_radius (bool): Inverse scale radius according to scaling transform?
             return_texcoord (bool): Return 3d texture coordinates (u,v,t) for color?
             no_sdf (bool): Return None for raw sdf values?
-            
+            point_indices (torch.Tensor): Optional flattened sample indices of the candidate
+                (sample, stroke) pairs of shape [num_pairs], sorted by sample. Pairs not listed
+                are treated as outside of the stroke (zero alpha and color).
+            stroke_indices (torch.Tensor): Optional stroke indices of the candidate pairs of
+                shape [num_pairs].
+            pair_output (bool): Return outputs of the candidate pairs of shape [num_pairs, ...]
+                instead of dense outputs of shape [..., num_strokes, ...]?
+            storage_dtype (torch.dtype): Optional type of the alpha, color and texcoord outputs, e.g.
+                torch.float16. Strokes are evaluated in float chunks written into the outputs.
+
         Returns:
             alpha (torch.Tensor): Alpha values in range [0,1] of shape [..., num_strokes].
             sdf (torch.Tensor): Signed distance function values of shape [..., num_strokes].
@@ -155,27 +139,59 @@ class _stroke_fn(Function):
         shape_params = shape_params.contiguous().float()
         color_params = color_params.contiguous().float()
         num_strokes = shape_params.shape[0]
+        storage_dtype = x.dtype if storage_dtype is None else storage_dtype
 
         alpha_shape = (x.shape[0], num_strokes)
         color_shape = (x.shape[0], num_strokes, _color_dim[color_id])
         sdf_shape = (x.shape[0], num_strokes)
         texcoord_shape = (x.shape[0], num_strokes, 2)
-        alpha_output = torch.empty(alpha_shape, dtype=x.dtype, device=x.device)
-        color_output = torch.empty(color_shape, dtype=x.dtype, device=x.device)
-        sdf_output = torch.empty(0 if no_sdf else sdf_shape, dtype=x.dtype, device=x.device)
-        texcoord_output = torch.empty(0 if not return_texcoord else texcoord_shape, dtype=x.dtype, device=x.device)
-        _backend.stroke_forward(alpha_output, color_output, sdf_output, texcoord_output, x, radius, 
-                                viewdir, shape_params, color_params, sdf_id, color_id, sdf_delta, 
-                                use_laplace_transform, inv_scale_radius)
+        use_pairs = point_indices is not None
+        assert use_pairs or not pair_output, 'pair_output requires candidate pairs'
+        if pair_output:
+            num_pairs = point_indices.shape[0]
+            alpha_shape = (num_pairs, )
+            color_shape = (num_pairs, _color_dim[color_id])
+            sdf_shape = (num_pairs, )
+            texcoord_shape = (num_pairs, 2)
+        if use_pairs:
+            # Only the candidate pairs are evaluated, the rest are left as empty space
+            assert stroke_indices is not None and point_indices.shape == stroke_indices.shape, \
+                'point_indices and stroke_indices must have the same shape [num_pairs]'
+            point_indices = point_indices.contiguous().int()
+            stroke_indices = stroke_indices.contiguous().int()
+            alpha_output = torch.zeros(alpha_shape, dtype=storage_dtype, device=x.device)
+            color_output = torch.zeros(color_shape, dtype=storage_dtype, device=x.device)
+            sdf_output = torch.full((0,) if no_sdf else sdf_shape, torch.inf, dtype=x.dtype, device=x.device)
+            texcoord_output = torch.zeros(0 if not return_texcoord else texcoord_shape, dtype=storage_dtype,
+                                          device=x.device)
+        else:
+            point_indices = torch.empty(0, dtype=torch.int32, device=x.device)
+            stroke_indices = torch.empty(0, dtype=torch.int32, device=x.device)
+            alpha_output = torch.empty(alpha_shape, dtype=storage_dtype, device=x.device)
+            color_output = torch.empty(color_shape, dtype=storage_dtype, device=x.device)
+            sdf_output = torch.empty(0 if no_sdf else sdf_shape, dtype=x.dtype, device=x.device)
+            texcoord_output = torch.empty(0 if not return_texcoord else texcoord_shape, dtype=storage_dtype,
+                                          device=x.device)
+        if alpha_output.numel() > 0 and (not use_pairs or point_indices.numel() > 0):
+            forward_fn = _backend.stroke_forward if storage_dtype == x.dtype else _stroke_forward_chunked
+            forward_fn(alpha_output, color_output, sdf_output, texcoord_output, x, radius, viewdir,
+                       shape_params, color_params, point_indices, stroke_indices, pair_output, sdf_id,
+                       color_id, sdf_delta, use_laplace_transform, inv_scale_radius)
         if ctx.needs_input_grad[0] or ctx.needs_input_grad[3] or ctx.needs_input_grad[4]:
-            ctx.save_for_backward(x, radius, viewdir, alpha_output, shape_params, color_params)
+            ctx.save_for_backward(x, radius, viewdir, alpha_output, shape_params, color_params,
+                                  point_indices, stroke_indices)
             ctx.sdf_id = sdf_id
             ctx.color_id = color_id
             ctx.sdf_delta = sdf_delta
             ctx.use_laplace_transform = use_laplace_transform
             ctx.inv_scale_radius = inv_scale_radius
             ctx.pre_shape = pre_shape
+            ctx.use_all_pairs = not use_pairs
+            ctx.pair_output = pair_output
 
+        if pair_output:
+            return alpha_output, color_output, None if no_sdf else sdf_output, \
+                texcoord_output if return_texcoord else None
         alpha_output = alpha_output.reshape(*pre_shape, num_strokes)
         color_output = color_output.reshape(*pre_shape, num_strokes, -1)
         sdf_output = None if no_sdf else sdf_output.reshape(*pre_shape, num_strokes)
@@ -191,9 +207,11 @@ class _stroke_fn(Function):
                  grad_sdf: torch.Tensor = None,
                  grad_texcoord: torch.Tensor = None):
         if not ctx.needs_input_grad[0] and not ctx.needs_input_grad[3] and not ctx.needs_input_grad[4]:
-            return None, None, None, None, None, None, None, None, None, None, None, None
+            return None, None, None, None, None, None, None, None, None, None, None, None, None, None, None
         
-        x, radius, viewdir, alpha_output, shape_params, color_params = ctx.saved_tensors
+        x, radius, viewdir, alpha_output, shape_params, color_params, \
+            point_indices, stroke_indices = ctx.saved_tensors
+        alpha_output = alpha_output.float()  # Saved in the storage type
         num_strokes = shape_params.shape[0]
         sdf_id = ctx.sdf_id
         color_id = ctx.color_id
@@ -202,10 +220,13 @@ class _stroke_fn(Function):
         inv_scale_radius = ctx.inv_scale_radius
         pre_shape = ctx.pre_shape
 
-        grad_alpha = grad_alpha.contiguous().float().reshape(-1, num_strokes)
-        grad_color = grad_color.contiguous().float().reshape(-1, num_strokes, _color_dim[color_id])
+        # Gradients are laid out as the outputs, either per candidate pair or per (point, stroke)
+        has_pairs = alpha_output.numel() > 0 and (ctx.use_all_pairs or point_indices.numel() > 0)
+        output_shape = (-1, ) if ctx.pair_output else (x.shape[0], num_strokes)
+        grad_alpha = grad_alpha.contiguous().float().reshape(*output_shape)
+        grad_color = grad_color.contiguous().float().reshape(*output_shape, _color_dim[color_id])
         if grad_sdf is not None:
-            grad_sdf = grad_sdf.contiguous().float().reshape(-1, num_strokes)
+            grad_sdf = grad_sdf.contiguous().float().reshape(*output_shape)
         else:
             grad_sdf = torch.zeros(0, dtype=x.dtype, device=x.device)
 
@@ -214,18 +235,155 @@ class _stroke_fn(Function):
         grad_x = torch.zeros(x.shape if ctx.needs_input_grad[0] else 0,
                              dtype=x.dtype,
                              device=x.device)
-        _backend.stroke_backward(grad_shape_params, grad_color_params, grad_x, grad_alpha, grad_color, 
-                                 grad_sdf, x, radius, viewdir, alpha_output, shape_params, color_params, 
-                                 sdf_id, color_id, sdf_delta, use_laplace_transform, inv_scale_radius)
+        if has_pairs:
+            _backend.stroke_backward(grad_shape_params, grad_color_params, grad_x, grad_alpha, grad_color, 
+                                     grad_sdf, x, radius, viewdir, alpha_output, shape_params, color_params, 
+                                     point_indices, stroke_indices, ctx.pair_output, sdf_id, color_id, 
+                                     sdf_delta, use_laplace_transform, inv_scale_radius)
+        if ctx.needs_input_grad[0]:
+            grad_x = grad_x.reshape(*pre_shape, 3)
+        else:
+            grad_x = None
+        return grad_x, None, None, grad_shape_params, grad_color_params, None, None, None, None, None, None, None, \
+            None, None, None, None
+
+
+class _stroke_compose_fn(Function):
+    @staticmethod
+    @custom_fwd
+    def forward(ctx,
+                x: torch.Tensor,
+                radius: torch.Tensor,
+                viewdir: torch.Tensor,
+                shape_params: torch.Tensor,
+                color_params: torch.Tensor,
+                density_params: torch.Tensor,
+                sdf_id: int,
+                color_id: int,
+                sdf_delta: float,
+                use_laplace_transform: bool = False,
+                inv_scale_radius: bool = False,
+                row_offsets: torch.Tensor = None,
+                stroke_indices: torch.Tensor = None,
+                min_transmittance: float = 0.0):
+        """Evaluate a batch of strokes and composite them with the "over" operator in one pass.
+
+        Args:
+            ctx: Function context.
+            x (torch.Tensor): Sample coordinates of shape [..., num_samples, 3].
+            radius (torch.Tensor): Sample radius of shape [..., num_samples].
+            viewdir (torch.Tensor): View direction of shape [..., 3].
+            shape_params (torch.Tensor): Shape parameters of shape [num_strokes, num_params].
+            color_params (torch.Tensor): Color parameters of shape [num_strokes, num_params].
+            density_params (torch.Tensor): Density parameters of shape [num_strokes].
+            sdf_id (int): Composite id of the signed distance function to use.
+            color_id (int): Id of the color function to use.
+            sdf_delta (float): Delta value for the clamping signed distance function.
+            use_laplace_transform (bool): Use sigmoid clamping or linear clamping?
+            inv_scale_radius (bool): Inverse scale radius according to scaling transform?
+            row_offsets (torch.Tensor): Optional CSR row offsets of candidate strokes over the
+                flattened samples of shape [num_samples_total + 1]. Other strokes are skipped.
+            stroke_indices (torch.Tensor): Candidate strokes of shape [num_entries], ascending
+                within each row.
+            min_transmittance (float): Stop compositing once the transmittance drops below it.
+
+        Returns:
+            density (torch.Tensor): Density values of shape [..., num_samples].
+            color (torch.Tensor): Color values of shape [..., num_samples, color_dim].
+        """
+        assert x.shape[-1] == 3, 'x must have shape [..., num_samples, 3]'
+        assert viewdir.shape[:-1] == x.shape[:-2] and viewdir.shape[-1] == 3, 'viewdir must have shape [..., 3]'
+        assert shape_params.ndim == 2, 'params must have shape [num_strokes, num_shape_params]'
+        assert color_params.ndim == 2, 'color_params must have shape [num_strokes, num_color_params]'
+        assert shape_params.shape[0] == color_params.shape[0] == density_params.shape[0], \
+            'num_strokes must be the same'
+        pre_shape = x.shape[:-1]
+        x = x.contiguous().reshape(-1, 3).float()
+        radius = radius.contiguous().reshape(-1).float()
+        viewdir = viewdir.contiguous().reshape(-1, 3).float()
+        shape_params = shape_params.contiguous().float()
+        color_params = color_params.contiguous().float()
+        density_params = density_params.contiguous().float()
+        if row_offsets is not None:
+            row_offsets = row_offsets.contiguous().long()
+            stroke_indices = stroke_indices.contiguous().int()
+        else:
+            row_offsets = torch.empty(0, dtype=torch.long, device=x.device)
+            stroke_indices = torch.empty(0, dtype=torch.int32, device=x.device)
+
+        density_output = torch.empty(x.shape[0], dtype=x.dtype, device=x.device)
+        color_output = torch.empty((x.shape[0], _color_dim[color_id]), dtype=x.dtype, device=x.device)
+        _backend.stroke_compose_forward(density_output, color_output, x, radius, viewdir, shape_params,
+                                        color_params, density_params, row_offsets, stroke_indices, sdf_id,
+                                        color_id, sdf_delta, use_laplace_transform, inv_scale_radius,
+                                        min_transmittance)
+        # Only the inputs are saved, per-stroke alphas and colors are recomputed in backward
+        ctx.save_for_backward(x, radius, viewdir, shape_params, color_params, density_params,
+                              row_offsets, stroke_indices)
+        ctx.sdf_id = sdf_id
+        ctx.color_id = color_id
+        ctx.sdf_delta = sdf_delta
+        ctx.use_laplace_transform = use_laplace_transform
+        ctx.inv_scale_radius = inv_scale_radius
+        ctx.min_transmittance = min_transmittance
+        ctx.pre_shape = pre_shape
+
+        density_output = density_output.reshape(*pre_shape)
+        color_output = color_output.reshape(*pre_shape, -1)
+        return density_output, color_output
+
+    @staticmethod
+    @once_differentiable
+    @custom_bwd
+    def backward(ctx, grad_density: torch.Tensor, grad_color: torch.Tensor):
+        x, radius, viewdir, shape_params, color_params, density_params, \
+            row_offsets, stroke_indices = ctx.saved_tensors
+        pre_shape = ctx.pre_shape
+
+        grad_density = grad_density.contiguous().float().reshape(-1)
+        grad_color = grad_color.contiguous().float().reshape(-1, _color_dim[ctx.color_id])
+        grad_shape_params = torch.zeros_like(shape_params)
+        grad_color_params = torch.zeros_like(color_params)
+        grad_density_params = torch.zeros_like(density_params)
+        grad_x = torch.zeros(x.shape if ctx.needs_input_grad[0] else 0,
+                             dtype=x.dtype,
+                             device=x.device)
+        _backend.stroke_compose_backward(grad_shape_params, grad_color_params, grad_density_params, grad_x,
+                                         grad_density, grad_color, x, radius, viewdir, shape_params,
+                                         color_params, density_params, row_offsets, stroke_indices,
+                                         ctx.sdf_id, ctx.color_id, ctx.sdf_delta, ctx.use_laplace_transform,
+                                         ctx.inv_scale_radius, ctx.min_transmittance)
         if ctx.needs_input_grad[0]:
             grad_x = grad_x.reshape(*pre_shape, 3)
         else:
             grad_x = None
-        return grad_x, None, None, grad_shape_params, grad_color_params, None, None, None, None, None, None, None
+        return grad_x, None, None, grad_shape_params, grad_color_params, grad_density_params, \
+            None, None, None, None, None, None, None, None
 
 
-def get_stroke(shape_type: str, color_type: str, init_type: str):
+def _resolve_backend(backend: str, fn_id: int):
+    """Resolve the stroke backend, None prefers the native kernels when they are available."""
+    # Builds restricted by STROKELIB_KERNELS only contain some of the stroke functions
+    has_native = _backend is not None and getattr(_backend, 'has_stroke_fn', lambda _: True)(fn_id)
+    if backend is None:
+        if _backend is not None and not has_native:
+            warnings.warn(f'Stroke function {fn_id} is not compiled, using the PyTorch reference')
+        backend = 'native' if has_native else 'torch'
+    assert backend in ('native', 'torch'), f'Unknown stroke backend {backend}'
+    assert backend == 'torch' or has_native, \
+        f'Stroke function {fn_id} is not available in the native strokelib backend, see STROKELIB_KERNELS'
+    return backend
+
+
+def get_stroke(shape_type: str, color_type: str, init_type: str, backend: str = None,
+               storage_dtype: torch.dtype = None):
     """Get the stroke function.
+
+    Args:
+        backend (str): 'native' for the compiled kernels, 'torch' for the PyTorch reference with
+            autograd gradients, or None to prefer 'native' when it is available.
+        storage_dtype (torch.dtype): If given (e.g. torch.float16 or torch.bfloat16), the alpha, color
+            and texcoord outputs are stored in this type. Strokes are still evaluated in float.
     
     Returns:
         stroke_fn (callable): Stroke function.
@@ -233,8 +391,9 @@ def get_stroke(shape_type: str, color_type: str, init_type: str):
         dim_color (int): Dimension of color parameters.
         shape_param_ranges (list): List of shape parameter ranges.
         color_param_ranges (list): List of color parameter ranges.
-        shape_sampler (callable): Shape parameter sampler.
-        color_sampler (callable): Color parameter sampler.
+        shape_sampler (callable): Shape parameter sampler, called as
+            shape_sampler(num, stroke_step, error_coord=None, device=None).
+        color_sampler (callable): Color parameter sampler, called as color_sampler(num, device=None).
     """
     base_sdf_name, shape_param_ranges, shape_base_sampler, enable_translation, enable_rotation, \
         enable_singlescale, enable_multiscale = _sdf_dict[shape_type]
@@ -242,6 +401,7 @@ def get_stroke(shape_type: str, color_type: str, init_type: str):
     sdf_id = _make_sdf_id(base_sdf_name, enable_translation, enable_rotation, enable_singlescale,
                           enable_multiscale)
 
+    shape_param_ranges = list(shape_param_ranges)
     if enable_singlescale:
         shape_param_ranges += [(0.01, 0.5)]
     elif enable_multiscale:
@@ -251,12 +411,17 @@ def get_stroke(shape_type: str, color_type: str, init_type: str):
     if enable_translation:
         shape_param_ranges += [(-1.0, 1.0)] * 3
 
-    def shape_sampler(stroke_step, error_coord=None):
-        decay_t = math.exp(-stroke_step / 200)
+    def shape_sampler(num, stroke_step, error_coord=None, device=None):
+        """Sample shape parameters of shape [num, dim_shape] for strokes added at stroke_step.
+
+        stroke_step is an int or a tensor of shape [num], error_coord is None or of shape [num, 3].
+        """
+        stroke_step = torch.as_tensor(stroke_step, dtype=torch.float32, device=device).expand(num)
+        decay_t = torch.exp(-stroke_step / 200)[:, None]
         
         if init_type == 'recon':
-            trans_min = torch.tensor([-0.5, -0.5, -0.5])
-            trans_max = torch.tensor([0.5, 0.5, 0.5])
+            trans_min = torch.tensor([-0.5, -0.5, -0.5], device=device)
+            trans_max = torch.tensor([0.5, 0.5, 0.5], device=device)
             trans_range = torch.abs(trans_max - trans_min)
             scale_range = torch.square(trans_range).sum().sqrt()
             scale_min = 0.02 + 0.12 * decay_t
@@ -265,59 +430,300 @@ def get_stroke(shape_type: str, color_type: str, init_type: str):
             scale_max = scale_max * scale_range
             
             if error_coord is not None:
-                sample_coord = error_coord
+                sample_coord = error_coord.to(device)
             else:
-                sample_coord = trans_min + (trans_max - trans_min) * torch.rand(3)
+                sample_coord = trans_min + (trans_max - trans_min) * torch.rand(num, 3, device=device)
         elif init_type == 'gen_box':
-            trans_min = torch.tensor([-0.6, -0.6, -0.6])
-            trans_max = torch.tensor([0.6, 0.6, 0.6])
+            trans_min = torch.tensor([-0.6, -0.6, -0.6], device=device)
+            trans_max = torch.tensor([0.6, 0.6, 0.6], device=device)
             trans_range = torch.abs(trans_max - trans_min)
             scale_range = torch.square(trans_range).sum().sqrt()
-            sample_coord = trans_min + (trans_max - trans_min) * torch.rand(3)
-            scale_dist = 1 - 2. * torch.square(sample_coord).sum().sqrt() / scale_range
+            sample_coord = trans_min + (trans_max - trans_min) * torch.rand(num, 3, device=device)
+            scale_dist = 1 - 2. * torch.square(sample_coord).sum(-1, keepdim=True).sqrt() / scale_range
             scale_min = 0.05 * scale_range * (4 ** -scale_dist)
             scale_max = 0.10 * scale_range * (4 ** -scale_dist)
         elif init_type == 'gen_sphere':
             scale_min = 0.04 + 0.06 * decay_t
             scale_max = 0.06 + 0.09 * decay_t
-            theta = torch.rand(1) * 2 * math.pi
-            phi = torch.rand(1) * 2 * math.pi
+            theta = torch.rand(num, 1, device=device) * 2 * math.pi
+            phi = torch.rand(num, 1, device=device) * 2 * math.pi
             radius = 1.0 * (1 - decay_t)
             sample_coord = torch.cat([
                 radius * torch.sin(phi) * torch.cos(theta),
                 radius * torch.sin(phi) * torch.sin(theta),
                 radius * torch.cos(phi),
-            ])
+            ], dim=-1)
             
         params = []
         if shape_base_sampler is not None:
-            params.append(shape_base_sampler((scale_min, scale_max, sample_coord)))
+            params.append(shape_base_sampler(scale_min, scale_max, sample_coord))
         if enable_singlescale:
-            params.append(torch.rand(1) * (scale_max - scale_min) + scale_min)
+            params.append(torch.rand(num, 1, device=device) * (scale_max - scale_min) + scale_min)
         elif enable_multiscale:
-            params.append(torch.rand(3) * (scale_max - scale_min) + scale_min)
+            params.append(torch.rand(num, 3, device=device) * (scale_max - scale_min) + scale_min)
         if enable_rotation:
-            params.append((torch.rand(3) * 2 - 1) * torch.pi)
+            params.append((torch.rand(num, 3, device=device) * 2 - 1) * torch.pi)
         if enable_translation:
             params.append(sample_coord)
 
         if len(params) > 0:
             return torch.cat(params, dim=-1)
         else:
-            return torch.empty(0)
+            return torch.empty(num, 0, device=device)
+
+    if _resolve_backend(backend, get_stroke_fn_id(shape_type, color_type)) == 'torch':
+        stroke_fn = lambda x, radius, viewdir, shape_params, color_params, *args: \
+            stroke_reference(x, radius, viewdir, shape_params, color_params, base_sdf_name, enable_translation,
+                             enable_rotation, enable_singlescale, enable_multiscale, color_id, *args)
+        if storage_dtype is not None and storage_dtype != torch.float32:
+            float_stroke_fn = stroke_fn
 
-    stroke_fn = lambda x, radius, viewdir, shape_params, color_params, *args: \
-        _stroke_fn.apply(x, radius, viewdir, shape_params, color_params, sdf_id, color_id, *args)
+            def stroke_fn(*args):
+                alpha, color, sdf, texcoord = float_stroke_fn(*args)
+                return alpha.to(storage_dtype), color.to(storage_dtype), sdf, \
+                    texcoord.to(storage_dtype) if texcoord is not None else None
+    else:
+        def stroke_fn(x, radius, viewdir, shape_params, color_params, sdf_delta, use_laplace_transform=False,
+                      inv_scale_radius=False, no_sdf=True, return_texcoord=False, point_indices=None,
+                      stroke_indices=None, pair_output=False):
+            # The native kernels write the outputs in the storage type directly.
+            return _stroke_fn.apply(x, radius, viewdir, shape_params, color_params, sdf_id, color_id, sdf_delta,
+                                    use_laplace_transform, inv_scale_radius, no_sdf, return_texcoord, point_indices,
+                                    stroke_indices, pair_output, storage_dtype)
     dim_shape = len(shape_param_ranges)
     dim_color = len(color_param_ranges)
     return stroke_fn, dim_shape, dim_color, shape_param_ranges, color_param_ranges, shape_sampler, color_sampler
 
 
+def get_stroke_compose(shape_type: str, color_type: str, backend: str = None):
+    """Get the stroke function fused with "over" composition.
+
+    With the 'torch' backend, see get_stroke, strokes are evaluated by the PyTorch reference and
+    composited afterwards, so per-stroke intermediates are not avoided.
+
+    Returns:
+        stroke_compose_fn (callable): Called as stroke_compose_fn(x, radius, viewdir, shape_params,
+            color_params, density_params, sdf_delta, use_laplace_transform, inv_scale_radius,
+            row_offsets, stroke_indices, min_transmittance), returns density and color.
+    """
+    base_sdf_name, _, _, enable_translation, enable_rotation, enable_singlescale, enable_multiscale = \
+        _sdf_dict[shape_type]
+    color_id = _color_dict[color_type][0]
+    sdf_id = _make_sdf_id(base_sdf_name, enable_translation, enable_rotation, enable_singlescale,
+                          enable_multiscale)
+
+    if _resolve_backend(backend, get_stroke_fn_id(shape_type, color_type)) == 'torch':
+        stroke_fn = lambda x, radius, viewdir, shape_params, color_params, *args: \
+            stroke_reference(x, radius, viewdir, shape_params, color_params, base_sdf_name, enable_translation,
+                             enable_rotation, enable_singlescale, enable_multiscale, color_id, *args)
+
+        def stroke_compose_fn(x, radius, viewdir, shape_params, color_params, density_params, sdf_delta,
+                              use_laplace_transform=False, inv_scale_radius=False, row_offsets=None,
+                              stroke_indices=None, min_transmittance=0.0):
+            if row_offsets is None:
+                alphas, colors, _, _ = stroke_fn(x, radius, viewdir, shape_params, color_params, sdf_delta,
+                                                 use_laplace_transform, inv_scale_radius)
+                return over_composition_reference(alphas, colors, density_params, min_transmittance)
+            counts = row_offsets[1:] - row_offsets[:-1]
+            point_indices = torch.repeat_interleave(torch.arange(counts.shape[0], device=x.device), counts)
+            alphas, colors, _, _ = stroke_fn(x, radius, viewdir, shape_params, color_params, sdf_delta,
+                                             use_laplace_transform, inv_scale_radius, True, False, point_indices,
+                                             stroke_indices, True)
+            density, color = sparse_over_composition_reference(alphas, colors, density_params, row_offsets,
+                                                               stroke_indices, min_transmittance)
+            return density.reshape(x.shape[:-1]), color.reshape(*x.shape[:-1], -1)
+    else:
+        stroke_compose_fn = lambda x, radius, viewdir, shape_params, color_params, density_params, *args: \
+            _stroke_compose_fn.apply(x, radius, viewdir, shape_params, color_params, density_params, sdf_id,
+                                     color_id, *args)
+    return stroke_compose_fn
+
+
+def _catmull_rom_to_bezier(p0, p1, p2, p3):
+    """Convert centripetal catmull-rom segments (p1 -> p2) to cubic bezier control points."""
+    t01 = torch.sqrt(torch.linalg.norm(p0 - p1, dim=-1, keepdim=True) + 1e-8)
+    t12 = torch.sqrt(torch.linalg.norm(p1 - p2, dim=-1, keepdim=True) + 1e-8)
+    t23 = torch.sqrt(torch.linalg.norm(p2 - p3, dim=-1, keepdim=True) + 1e-8)
+    m1 = p2 - p1 + t12 * ((p1 - p0) / t01 - (p2 - p0) / (t01 + t12))
+    m2 = p2 - p1 + t12 * ((p3 - p2) / t23 - (p3 - p1) / (t12 + t23))
+    a = 2.0 * (p1 - p2) + m1 + m2
+    b = 3.0 * (p2 - p1) - 2.0 * m1 - m2
+    return p1, p1 + m1 / 3.0, p1 + (2.0 * m1 + b) / 3.0, a + b + m1 + p1
+
+
+def _unit_sdf_bounds(base_sdf_name: str, base_params: torch.Tensor, band: torch.Tensor):
+    """Bounds of the region {sdf < band} of the base shapes in their unit space.
+
+    Args:
+        base_sdf_name (str): Name of the base signed distance function.
+        base_params (torch.Tensor): Base shape parameters of shape [num_strokes, num_base_params].
+        band (torch.Tensor): Unit space sdf band of shape [num_strokes].
+
+    Returns:
+        lower (torch.Tensor): Lower bounds of shape [num_strokes, 3].
+        upper (torch.Tensor): Upper bounds of shape [num_strokes, 3].
+    """
+    t = band[:, None]
+    ones = torch.ones_like(t)
+    if base_sdf_name in ('unit_sphere', 'unit_cube'):
+        half = (1 + t).expand(-1, 3)
+    elif base_sdf_name == 'unit_round_cube':
+        half = (1 + base_params[:, 0:1] + t).expand(-1, 3)
+    elif base_sdf_name == 'unit_capped_torus':
+        r = base_params[:, 1:2]
+        half = torch.cat([1 + r + t, 1 + r + t, r + t], dim=-1)
+    elif base_sdf_name == 'unit_capsule':
+        h = base_params[:, 0:1]
+        half = torch.cat([1 + t, h + 1 + t, 1 + t], dim=-1)
+    elif base_sdf_name == 'unit_line':
+        h, r_diff = base_params[:, 0:1], base_params[:, 1:2].abs()
+        half = torch.cat([1 + r_diff + t, h + 1 + r_diff + t, 1 + r_diff + t], dim=-1)
+    elif base_sdf_name == 'unit_triprism':
+        h = base_params[:, 0:1]
+        lower = torch.cat([-1.7320508 * (0.5 + t), -(h + t), -(0.5 + t)], dim=-1)
+        upper = torch.cat([1.7320508 * (0.5 + t), h + t, 1 + 2 * t], dim=-1)
+        return lower, upper
+    elif base_sdf_name in ('unit_octahedron', 'unit_tetrahedron'):
+        half = (1 + 1.7320508 * t).expand(-1, 3)
+    elif base_sdf_name in ('quadratic_bezier', 'cubic_bezier', 'catmull_rom'):
+        num_points = 3 if base_sdf_name == 'quadratic_bezier' else 4
+        points = base_params[:, :num_points * 3].reshape(-1, num_points, 3)
+        if base_sdf_name == 'catmull_rom':
+            points = torch.stack(_catmull_rom_to_bezier(*points.unbind(1)), dim=1)
+        radius = base_params[:, num_points * 3:num_points * 3 + 2].amax(-1, keepdim=True)
+        # Splines lie in the convex hull of their bezier control points
+        return points.amin(1) - radius - t, points.amax(1) + radius + t
+    else:
+        assert 0, f"Unknown base sdf {base_sdf_name}"
+    return -half * ones, half * ones
+
+
+def _stroke_bounds(shape_type: str,
+                   shape_params: torch.Tensor,
+                   sdf_band: float,
+                   inv_scale_radius: bool = False):
+    """Compute world space bounds of strokes dilated by a sdf band.
+
+    Args:
+        shape_type (str): The type of shape function.
+        shape_params (torch.Tensor): Shape parameters of shape [num_strokes, num_params].
+        sdf_band (float): Maximum sdf value that still counts as inside, before scaling.
+        inv_scale_radius (bool): Whether the band is inversely scaled by the stroke scale.
+
+    Returns:
+        center (torch.Tensor): Center of the bounds of shape [num_strokes, 3].
+        half_extent (torch.Tensor): Half side lengths of the axis aligned box of shape [num_strokes, 3].
+        sphere_radius (torch.Tensor): Radius of the bounding sphere around center of shape [num_strokes].
+    """
+    base_sdf_name, base_param_ranges, _, enable_translation, enable_rotation, \
+        enable_singlescale, enable_multiscale = _sdf_dict[shape_type]
+    shape_params = shape_params.float()
+    num_strokes = shape_params.shape[0]
+    num_base_params = len(base_param_ranges)
+    sp_reverse = shape_params[:, num_base_params:]
+
+    if enable_singlescale:
+        scale = sp_reverse[:, 0:1].expand(-1, 3)
+        sp_reverse = sp_reverse[:, 1:]
+    elif enable_multiscale:
+        scale = sp_reverse[:, 0:3]
+        sp_reverse = sp_reverse[:, 3:]
+    else:
+        scale = shape_params.new_ones(num_strokes, 3)
+    band = shape_params.new_full((num_strokes,), sdf_band)
+    if inv_scale_radius and (enable_singlescale or enable_multiscale):
+        band = band / scale.amin(-1)
+
+    lower, upper = _unit_sdf_bounds(base_sdf_name, shape_params[:, :num_base_params], band)
+    center = (lower + upper) * 0.5 * scale
+    half = (upper - lower) * 0.5 * scale
+    # The sphere around the unrotated box is invariant to the rotation
+    sphere_radius = torch.linalg.norm(half, dim=-1)
+    if enable_rotation:
+        rotation = _euler_rotation_matrix(sp_reverse[:, 0:3])
+        center = torch.einsum('sij,sj->si', rotation, center)
+        half = torch.einsum('sij,sj->si', rotation.abs(), half)
+        sp_reverse = sp_reverse[:, 3:]
+    if enable_translation:
+        center = center + sp_reverse[:, 0:3]
+    return center, half, sphere_radius
+
+
+def _stroke_aabb(shape_type: str,
+                 shape_params: torch.Tensor,
+                 sdf_band: float,
+                 inv_scale_radius: bool = False):
+    """Compute world space axis aligned bounding boxes of strokes dilated by a sdf band.
+
+    Returns:
+        aabb_min (torch.Tensor): Lower corners of shape [num_strokes, 3].
+        aabb_max (torch.Tensor): Upper corners of shape [num_strokes, 3].
+    """
+    center, half, _ = _stroke_bounds(shape_type, shape_params, sdf_band, inv_scale_radius)
+    return center - half, center + half
+
+
+def stroke_alpha_band(sdf_delta: float, use_laplace_transform: bool = False, alpha_eps: float = 1e-4):
+    """Multiplier c such that alpha is (almost) zero for sdf >= c * sdf_delta * radius.
+
+    The linear transform is exactly zero outside the band. The laplace transform never reaches
+    zero, so its band is cut where alpha drops below alpha_eps.
+    """
+    if sdf_delta <= 0:
+        return 0.0
+    if use_laplace_transform:
+        return sdf_delta * 0.5 * math.log(0.5 / alpha_eps)
+    return sdf_delta
+
+
+def get_stroke_bounds(shape_type: str,
+                      shape_params: torch.Tensor,
+                      sdf_delta: float = 0.0,
+                      radius: float = 0.0,
+                      use_laplace_transform: bool = False,
+                      inv_scale_radius: bool = False,
+                      alpha_eps: float = 1e-4,
+                      return_sphere: bool = False):
+    """Get conservative world space bounds of a batch of strokes.
+
+    The bounds contain every point where the stroke alpha is non-zero (or above alpha_eps for the
+    laplace transform), i.e. the shape dilated by the sdf_delta band of samples with the given radius.
+    Runs batched on the device of shape_params.
+
+    Args:
+        shape_type (str): The type of shape function.
+        shape_params (torch.Tensor): Shape parameters of shape [num_strokes, num_params].
+        sdf_delta (float): Delta value for the clamping signed distance function.
+        radius (float): The largest sample radius the bounds should hold for.
+        use_laplace_transform (bool): Use sigmoid clamping or linear clamping?
+        inv_scale_radius (bool): Inverse scale radius according to scaling transform?
+        alpha_eps (float): Alpha below which laplace strokes are treated as empty.
+        return_sphere (bool): Whether to also return bounding spheres.
+
+    Returns:
+        aabb_min (torch.Tensor): Lower corners of shape [num_strokes, 3].
+        aabb_max (torch.Tensor): Upper corners of shape [num_strokes, 3].
+        sphere_center (torch.Tensor): Sphere centers of shape [num_strokes, 3], if return_sphere.
+        sphere_radius (torch.Tensor): Sphere radii of shape [num_strokes], if return_sphere.
+    """
+    sdf_band = stroke_alpha_band(sdf_delta, use_laplace_transform, alpha_eps) * radius
+    center, half, sphere_radius = _stroke_bounds(shape_type, shape_params.detach(), sdf_band, inv_scale_radius)
+    if return_sphere:
+        return center - half, center + half, center, sphere_radius
+    return center - half, center + half
+
+
+def _compositing_dtype(dtype: torch.dtype):
+    """Storage type of alphas and colors in the composition kernels, which accumulate in float."""
+    return dtype if dtype in (torch.float16, torch.bfloat16) else torch.float32
+
+
 class _compositing_fn(Function):
     @staticmethod
     @custom_fwd
-    def forward(ctx, alphas: torch.Tensor, colors: torch.Tensor, density_params: torch.Tensor):
-        """Composite a batch of strokes."""
+    def forward(ctx, alphas: torch.Tensor, colors: torch.Tensor, density_params: torch.Tensor,
+                min_transmittance: float = 0.0):
+        """Composite a batch of strokes front to back, until transmittance drops below min_transmittance."""
         assert alphas.ndim >= 2, 'alphas must have shape [..., num_strokes]'
         assert colors.ndim >= 3, 'colors must have shape [..., num_strokes, color_dim]'
         assert density_params.ndim == 1, 'density_params must have shape [num_strokes]'
@@ -328,18 +734,23 @@ class _compositing_fn(Function):
 
         pre_shape = alphas.shape[:-1]
         num_strokes = density_params.shape[0]
-        alphas = alphas.contiguous().reshape(-1, num_strokes).float()
-        colors = colors.contiguous().reshape(-1, num_strokes, colors.shape[-1]).float()
+        storage_dtype = _compositing_dtype(alphas.dtype)
+        alphas = alphas.contiguous().reshape(-1, num_strokes).to(storage_dtype)
+        colors = colors.contiguous().reshape(-1, num_strokes, colors.shape[-1]).to(storage_dtype)
         density_params = density_params.contiguous().float()
 
-        density_output = torch.empty(alphas.shape[0], dtype=alphas.dtype, device=alphas.device)
+        density_output = torch.empty(alphas.shape[0], dtype=torch.float32, device=alphas.device)
         color_output = torch.empty((colors.shape[0], colors.shape[-1]),
-                                   dtype=colors.dtype,
+                                   dtype=torch.float32,
                                    device=colors.device)
-        _backend.compose_forward(density_output, color_output, alphas, colors, density_params)
+        empty_offsets = torch.empty(0, dtype=torch.long, device=alphas.device)
+        empty_indices = torch.empty(0, dtype=torch.int32, device=alphas.device)
+        _backend.compose_forward(density_output, color_output, alphas, colors, density_params,
+                                 empty_offsets, empty_indices, min_transmittance)
         if ctx.needs_input_grad[0] or ctx.needs_input_grad[1] or ctx.needs_input_grad[2]:
             ctx.save_for_backward(alphas, colors, density_params)
             ctx.pre_shape = pre_shape
+            ctx.min_transmittance = min_transmittance
 
         density_output = density_output.reshape(*pre_shape)
         color_output = color_output.reshape(*pre_shape, -1)
@@ -354,39 +765,277 @@ class _compositing_fn(Function):
         num_strokes = density_params.shape[0]
 
         if grad_density is not None:
-            grad_density = grad_density.reshape(-1)
+            grad_density = grad_density.contiguous().reshape(-1).float()
         else:
-            grad_density = torch.zeros(0, dtype=alphas.dtype, device=alphas.device)
+            grad_density = torch.zeros(0, dtype=torch.float32, device=alphas.device)
         if grad_color is not None:
-            grad_color = grad_color.reshape(-1, colors.shape[-1])
+            grad_color = grad_color.contiguous().reshape(-1, colors.shape[-1]).float()
         else:
-            grad_color = torch.zeros(0, dtype=colors.dtype, device=colors.device)
+            grad_color = torch.zeros(0, dtype=torch.float32, device=colors.device)
 
         grad_alphas = torch.zeros_like(alphas)
         grad_colors = torch.zeros_like(colors)
         grad_density_params = torch.zeros_like(density_params)
+        empty_offsets = torch.empty(0, dtype=torch.long, device=alphas.device)
+        empty_indices = torch.empty(0, dtype=torch.int32, device=alphas.device)
         _backend.compose_backward(grad_alphas, grad_colors, grad_density_params, grad_density,
-                                  grad_color, alphas, colors, density_params)
+                                  grad_color, alphas, colors, density_params, empty_offsets, empty_indices,
+                                  ctx.min_transmittance)
 
         grad_alphas = grad_alphas.reshape(*pre_shape, num_strokes)
         grad_colors = grad_colors.reshape(*pre_shape, num_strokes, colors.shape[-1])
-        return grad_alphas, grad_colors, grad_density_params
+        return grad_alphas, grad_colors, grad_density_params, None
+
+
+class _sparse_compositing_fn(Function):
+    @staticmethod
+    @custom_fwd
+    def forward(ctx, alphas: torch.Tensor, colors: torch.Tensor, density_params: torch.Tensor,
+                row_offsets: torch.Tensor, stroke_indices: torch.Tensor, min_transmittance: float = 0.0):
+        """Composite a batch of strokes stored as CSR rows of non-zero entries."""
+        assert alphas.ndim == 1, 'alphas must have shape [num_entries]'
+        assert colors.ndim == 2, 'colors must have shape [num_entries, color_dim]'
+        assert density_params.ndim == 1, 'density_params must have shape [num_strokes]'
+        assert alphas.shape[0] == colors.shape[0] == stroke_indices.shape[0], \
+            'alphas, colors and stroke_indices must have the same number of entries'
+
+        storage_dtype = _compositing_dtype(alphas.dtype)
+        alphas = alphas.contiguous().to(storage_dtype)
+        colors = colors.contiguous().to(storage_dtype)
+        density_params = density_params.contiguous().float()
+        row_offsets = row_offsets.contiguous().long()
+        stroke_indices = stroke_indices.contiguous().int()
+
+        num_points = row_offsets.shape[0] - 1
+        density_output = torch.empty(num_points, dtype=torch.float32, device=alphas.device)
+        color_output = torch.empty((num_points, colors.shape[-1]), dtype=torch.float32, device=colors.device)
+        _backend.compose_forward(density_output, color_output, alphas, colors, density_params,
+                                 row_offsets, stroke_indices, min_transmittance)
+        if ctx.needs_input_grad[0] or ctx.needs_input_grad[1] or ctx.needs_input_grad[2]:
+            ctx.save_for_backward(alphas, colors, density_params, row_offsets, stroke_indices)
+            ctx.min_transmittance = min_transmittance
+        return density_output, color_output
+
+    @staticmethod
+    @once_differentiable
+    @custom_bwd
+    def backward(ctx, grad_density: torch.Tensor, grad_color: torch.Tensor):
+        alphas, colors, density_params, row_offsets, stroke_indices = ctx.saved_tensors
+
+        grad_density = grad_density.contiguous().float()
+        grad_color = grad_color.contiguous().float()
+        grad_alphas = torch.zeros_like(alphas)
+        grad_colors = torch.zeros_like(colors)
+        grad_density_params = torch.zeros_like(density_params)
+        _backend.compose_backward(grad_alphas, grad_colors, grad_density_params, grad_density,
+                                  grad_color, alphas, colors, density_params, row_offsets, stroke_indices,
+                                  ctx.min_transmittance)
+        return grad_alphas, grad_colors, grad_density_params, None, None, None
+
+
+# Composition types evaluated by compose_reduce_forward, see ReduceCompositionType
+_reduce_composition_id = {
+    'max': 0,
+    'max_density_weighted': 1,
+    'softmax': 2,
+    'softmax_density_weighted': 3,
+}
+_softmax_inv_temperature = 1.0 / 0.05
+
+
+class _reduce_compositing_fn(Function):
+    @staticmethod
+    @custom_fwd
+    def forward(ctx, alphas: torch.Tensor, colors: torch.Tensor, density_params: torch.Tensor,
+                composition_type: str, row_offsets: torch.Tensor = None, stroke_indices: torch.Tensor = None):
+        """Composite a batch of strokes with max or softmax in a single pass per point, dense or sparse.
 
+        Only the inputs are saved for backward, no per-stroke temporaries are kept.
+        """
+        assert density_params.ndim == 1, 'density_params must have shape [num_strokes]'
+        is_sparse = row_offsets is not None
+        pre_shape = (row_offsets.shape[0] - 1, ) if is_sparse else alphas.shape[:-1]
+        storage_dtype = _compositing_dtype(alphas.dtype)
+        if is_sparse:
+            assert alphas.ndim == 1 and colors.ndim == 2, 'sparse alphas and colors must have shape [num_entries, ...]'
+            alphas = alphas.contiguous().to(storage_dtype)
+            colors = colors.contiguous().to(storage_dtype)
+            row_offsets = row_offsets.contiguous().long()
+            stroke_indices = stroke_indices.contiguous().int()
+        else:
+            assert alphas.shape[:-1] == colors.shape[:-2], \
+                'alphas and colors must have the same shape except the last two dimensions'
+            assert alphas.shape[-1] == colors.shape[-2] == density_params.shape[0], \
+                'alphas, colors and density_params must have the same number of strokes'
+            alphas = alphas.contiguous().reshape(-1, density_params.shape[0]).to(storage_dtype)
+            colors = colors.contiguous().reshape(-1, density_params.shape[0], colors.shape[-1]).to(storage_dtype)
+            row_offsets = torch.empty(0, dtype=torch.long, device=alphas.device)
+            stroke_indices = torch.empty(0, dtype=torch.int32, device=alphas.device)
+        density_params = density_params.contiguous().float()
 
-def compose_strokes(alphas: torch.Tensor, colors: torch.Tensor, density_params: torch.Tensor, composition_type: str):
+        composition_id = _reduce_composition_id[composition_type]
+        num_points = alphas.shape[0] if not is_sparse else pre_shape[0]
+        density_output = torch.empty(num_points, dtype=torch.float32, device=alphas.device)
+        color_output = torch.empty((num_points, colors.shape[-1]), dtype=torch.float32, device=colors.device)
+        _backend.compose_reduce_forward(density_output, color_output, alphas, colors, density_params, row_offsets,
+                                        stroke_indices, composition_id, _softmax_inv_temperature)
+        if ctx.needs_input_grad[0] or ctx.needs_input_grad[1] or ctx.needs_input_grad[2]:
+            ctx.save_for_backward(alphas, colors, density_params, row_offsets, stroke_indices)
+            ctx.composition_id = composition_id
+            ctx.pre_shape = None if is_sparse else pre_shape
+
+        density_output = density_output.reshape(*pre_shape)
+        color_output = color_output.reshape(*pre_shape, -1)
+        return density_output, color_output
+
+    @staticmethod
+    @once_differentiable
+    @custom_bwd
+    def backward(ctx, grad_density: torch.Tensor, grad_color: torch.Tensor):
+        alphas, colors, density_params, row_offsets, stroke_indices = ctx.saved_tensors
+
+        grad_density = grad_density.contiguous().reshape(-1).float()
+        grad_color = grad_color.contiguous().reshape(-1, colors.shape[-1]).float()
+        grad_alphas = torch.zeros_like(alphas)
+        grad_colors = torch.zeros_like(colors)
+        grad_density_params = torch.zeros_like(density_params)
+        _backend.compose_reduce_backward(grad_alphas, grad_colors, grad_density_params, grad_density, grad_color,
+                                         alphas, colors, density_params, row_offsets, stroke_indices,
+                                         ctx.composition_id, _softmax_inv_temperature)
+
+        if ctx.pre_shape is not None:
+            grad_alphas = grad_alphas.reshape(*ctx.pre_shape, -1)
+            grad_colors = grad_colors.reshape(*ctx.pre_shape, *colors.shape[-2:])
+        return grad_alphas, grad_colors, grad_density_params, None, None, None
+
+
+def compact_stroke_pairs(alphas: torch.Tensor,
+                         colors: torch.Tensor,
+                         texcoords: torch.Tensor,
+                         point_indices: torch.Tensor,
+                         stroke_indices: torch.Tensor,
+                         num_points: int):
+    """Drop the zero alpha entries of candidate pairs and build CSR rows over points.
+
+    Args:
+        alphas (torch.Tensor): Alpha values of the pairs of shape [num_pairs].
+        colors (torch.Tensor): Color values of the pairs of shape [num_pairs, color_dim].
+        texcoords (torch.Tensor): Texture coordinates of shape [num_pairs, 2], or None.
+        point_indices (torch.Tensor): Point indices of the pairs of shape [num_pairs], sorted.
+        stroke_indices (torch.Tensor): Stroke indices of the pairs of shape [num_pairs].
+        num_points (int): Number of points.
+
+    Returns:
+        alphas (torch.Tensor): Alpha values of the entries of shape [num_entries].
+        colors (torch.Tensor): Color values of the entries of shape [num_entries, color_dim].
+        texcoords (torch.Tensor): Texture coordinates of shape [num_entries, 2], or None.
+        row_offsets (torch.Tensor): CSR row offsets of shape [num_points + 1], long.
+        stroke_indices (torch.Tensor): Stroke indices of the entries of shape [num_entries], int32.
+    """
+    nonzero = torch.nonzero(alphas.detach() > 0).squeeze(1)
+    alphas = alphas[nonzero]
+    colors = colors[nonzero]
+    texcoords = texcoords[nonzero] if texcoords is not None else None
+    row_offsets = make_row_offsets(point_indices[nonzero], num_points)
+    stroke_indices = stroke_indices[nonzero].int()
+    return alphas, colors, texcoords, row_offsets, stroke_indices
+
+
+def make_row_offsets(point_indices: torch.Tensor, num_points: int):
+    """CSR row offsets of shape [num_points + 1] from sorted point indices of shape [num_entries]."""
+    row_offsets = torch.zeros(num_points + 1, dtype=torch.long, device=point_indices.device)
+    row_offsets[1:] = torch.cumsum(torch.bincount(point_indices.long(), minlength=num_points), 0)
+    return row_offsets
+
+
+def _compose_sparse_strokes(alphas: torch.Tensor, colors: torch.Tensor, density_params: torch.Tensor,
+                            composition_type: str, row_offsets: torch.Tensor, stroke_indices: torch.Tensor,
+                            min_transmittance: float = 0.0):
+    """Sparse counterpart of compose_strokes, strokes missing from a row have zero alpha."""
+    if composition_type == "over":
+        if _backend is None:
+            return sparse_over_composition_reference(alphas, colors, density_params, row_offsets, stroke_indices,
+                                                     min_transmittance)
+        return _sparse_compositing_fn.apply(alphas, colors, density_params, row_offsets, stroke_indices,
+                                            min_transmittance)
+    if composition_type in _reduce_composition_id and _backend is not None:
+        return _reduce_compositing_fn.apply(alphas, colors, density_params, composition_type, row_offsets,
+                                            stroke_indices)
+
+    num_points = row_offsets.shape[0] - 1
+    num_entries = alphas.shape[0]
+    num_strokes = density_params.shape[0]
+    counts = row_offsets[1:] - row_offsets[:-1]
+    row_ids = torch.repeat_interleave(torch.arange(num_points, device=alphas.device), counts)
+    entry_density = density_params[stroke_indices.long()]
+
+    if composition_type in ("max", "max_density_weighted"):
+        keys = alphas if composition_type == "max" else alphas * entry_density
+        keys = keys.detach()
+        row_max = keys.new_zeros(num_points).scatter_reduce(0, row_ids, keys, 'amax', include_self=False)
+        # Select the first entry (lowest stroke index) that reaches the row maximum, as argmax does
+        entry_ids = torch.arange(num_entries, device=alphas.device)
+        is_max = keys == row_max[row_ids]
+        selected = torch.full((num_points, ), num_entries, dtype=torch.long, device=alphas.device)
+        selected = selected.scatter_reduce(0, row_ids[is_max], entry_ids[is_max], 'amin')
+        # Empty rows select a padding entry with zero alpha and color
+        alphas_padded = torch.cat([alphas, alphas.new_zeros(1)])
+        colors_padded = torch.cat([colors, colors.new_zeros(1, colors.shape[-1])])
+        density_padded = torch.cat([entry_density, entry_density.new_zeros(1)])
+        density = alphas_padded[selected] * density_padded[selected]
+        color = colors_padded[selected]
+        return density, color
+    elif composition_type in ("softmax", "softmax_density_weighted"):
+        inv_temp = _softmax_inv_temperature
+        keys = alphas if composition_type == "softmax" else alphas * entry_density
+        logits = keys * inv_temp
+        # Missing strokes have zero logits, they only contribute to the normalizer
+        row_max = logits.new_zeros(num_points).scatter_reduce(0, row_ids, logits.detach(), 'amax')
+        weights = torch.exp(logits - row_max[row_ids])
+        normalizer = torch.zeros_like(row_max).index_add(0, row_ids, weights) + \
+            (num_strokes - counts) * torch.exp(-row_max)
+        weights = weights / normalizer[row_ids]
+        density = torch.zeros_like(row_max).index_add(0, row_ids, weights * alphas * entry_density)
+        color = colors.new_zeros(num_points, colors.shape[-1]).index_add(0, row_ids, weights[:, None] * colors)
+        return density, color
+    else:
+        assert 0, f"Unknown composition type {composition_type}"
+
+
+def compose_strokes(alphas: torch.Tensor, colors: torch.Tensor, density_params: torch.Tensor, composition_type: str,
+                    row_offsets: torch.Tensor = None, stroke_indices: torch.Tensor = None,
+                    min_transmittance: float = 0.0):
     """Composite a batch of strokes.
 
     Args:
-        alphas (torch.Tensor): Alpha values of shape [..., num_strokes].
-        colors (torch.Tensor): Color values of shape [..., num_strokes, color_dim].
+        alphas (torch.Tensor): Alpha values of shape [..., num_strokes], or [num_entries] if sparse.
+        colors (torch.Tensor): Color values of shape [..., num_strokes, color_dim], or [num_entries, color_dim].
         density_params (torch.Tensor): Density parameters of shape [num_strokes].
+        row_offsets (torch.Tensor): If given, alphas and colors are CSR rows of shape [num_points + 1],
+            see compact_stroke_pairs.
+        stroke_indices (torch.Tensor): Stroke indices of the sparse entries of shape [num_entries].
+        min_transmittance (float): For "over", strokes are composited front to back (from the last
+            stroke to the first) and compositing stops once the transmittance drops below this.
+
+    With the native backend, every composition type runs in a single pass over the strokes of each
+    point, and only the inputs are kept for backward. Half precision alphas and colors are kept in
+    half precision, while transmittance and gradients are accumulated in float.
         
     Returns:
-        density (torch.Tensor): Density values of shape [...].
-        color (torch.Tensor): Color values of shape [..., color_dim].
+        density (torch.Tensor): Density values of shape [...], or [num_points] if sparse.
+        color (torch.Tensor): Color values of shape [..., color_dim], or [num_points, color_dim].
     """
+    if _backend is None:
+        alphas, colors = alphas.float(), colors.float()
+    if row_offsets is not None:
+        return _compose_sparse_strokes(alphas, colors, density_params, composition_type, row_offsets,
+                                       stroke_indices, min_transmittance)
     if composition_type == "over":
-        return _compositing_fn.apply(alphas, colors, density_params)
+        if _backend is None:
+            return over_composition_reference(alphas, colors, density_params, min_transmittance)
+        return _compositing_fn.apply(alphas, colors, density_params, min_transmittance)
+    elif composition_type in _reduce_composition_id and _backend is not None:
+        return _reduce_compositing_fn.apply(alphas, colors, density_params, composition_type)
     elif composition_type == "max":
         alphas_indices = torch.argmax(alphas, dim=-1, keepdim=True)
         alphas = torch.take_along_dim(alphas, alphas_indices, dim=-1).squeeze(-1)
@@ -401,14 +1050,14 @@ def compose_strokes(alphas: torch.Tensor, colors: torch.Tensor, density_params:
         color = torch.take_along_dim(colors, alphas_indices[..., None], dim=-2).squeeze(-2)
         return density, color
     elif composition_type == "softmax":
-        inv_temp = 1.0 / 0.05
+        inv_temp = _softmax_inv_temperature
         alphas_softmax = torch.softmax(alphas * inv_temp, dim=-1)
         weighted_density = alphas * torch.broadcast_to(density_params, alphas.shape)
         density = torch.einsum('...s,...s->...', alphas_softmax, weighted_density)
         color = torch.einsum('...s,...sc->...c', alphas_softmax, colors)
         return density, color
     elif composition_type == "softmax_density_weighted":
-        inv_temp = 1.0 / 0.05
+        inv_temp = _softmax_inv_temperature
         alphas_density_weighted = alphas * torch.broadcast_to(density_params, alphas.shape)
         alphas_softmax = torch.softmax(alphas_density_weighted * inv_temp, dim=-1)
         weighted_density = alphas * torch.broadcast_to(density_params, alphas.shape)
@@ -417,3 +1066,313 @@ def compose_strokes(alphas: torch.Tensor, colors: torch.Tensor, density_params:
         return density, color
     else:
         assert 0, f"Unknown composition type {composition_type}"
+
+
+def compose_transmittance(alphas: torch.Tensor, row_offsets: torch.Tensor = None, stroke_indices: torch.Tensor = None):
+    """Transmittance left behind a batch of strokes under "over" composition.
+
+    Args:
+        alphas (torch.Tensor): Alpha values of shape [..., num_strokes], or [num_entries] if sparse.
+        row_offsets (torch.Tensor): If given, alphas are CSR rows of shape [num_points + 1].
+        stroke_indices (torch.Tensor): Unused, accepted to match the arguments of compose_strokes.
+
+    Returns:
+        transmittance (torch.Tensor): Transmittance of shape [...], or [num_points] if sparse.
+    """
+    alphas = alphas.float()  # Accumulate in float for half precision alphas
+    if row_offsets is None:
+        return torch.prod(1 - alphas, dim=-1)
+    num_points = row_offsets.shape[0] - 1
+    counts = row_offsets[1:] - row_offsets[:-1]
+    row_ids = torch.repeat_interleave(torch.arange(num_points, device=alphas.device), counts)
+    log_transmittance = alphas.new_zeros(num_points).index_add(0, row_ids, torch.log1p(-alphas.clamp(max=1 - 1e-6)))
+    return torch.exp(log_transmittance)
+
+
+def merge_over_composition(density: torch.Tensor, color: torch.Tensor, transmittance: torch.Tensor,
+                           back_density: torch.Tensor, back_color_sum: torch.Tensor,
+                           back_transmittance: torch.Tensor):
+    """Place a composited group of strokes in front of another one with the "over" operator.
+
+    Args:
+        density (torch.Tensor): Density of the front group of shape [...].
+        color (torch.Tensor): Color of the front group as returned by compose_strokes of shape [..., color_dim].
+        transmittance (torch.Tensor): Transmittance of the front group of shape [...].
+        back_density (torch.Tensor): Density of the back group of shape [...].
+        back_color_sum (torch.Tensor): Unnormalized color (sum of weighted colors) of the back group
+            of shape [..., color_dim].
+        back_transmittance (torch.Tensor): Transmittance of the back group of shape [...].
+
+    Returns:
+        density (torch.Tensor): Density of both groups of shape [...].
+        color (torch.Tensor): Color of both groups of shape [..., color_dim].
+    """
+    color_sum = color * (1 + 1e-6 - transmittance)[..., None]
+    density = density + transmittance * back_density
+    color_sum = color_sum + transmittance[..., None] * back_color_sum
+    color = color_sum / (1 + 1e-6 - transmittance * back_transmittance)[..., None]
+    return density, color.clamp(0, 1)
+
+
+def _compose_over_block(alphas: torch.Tensor, colors: torch.Tensor, density_params: torch.Tensor,
+                        transmittance: torch.Tensor):
+    """Composite a block of strokes with the "over" operator behind the given transmittance.
+
+    Strokes are composited front to back, from the last stroke of the block to the first.
+
+    Returns:
+        density (torch.Tensor): Density of the block of shape [...].
+        color_sum (torch.Tensor): Unnormalized color of the block of shape [..., color_dim].
+        block_transmittance (torch.Tensor): Transmittance through the block alone of shape [...].
+    """
+    alphas = alphas.flip(-1)
+    colors = colors.flip(-2)
+    density_params = density_params.flip(-1)
+    trans = torch.cumprod(1 - alphas, dim=-1)
+    trans_exclusive = torch.cat([torch.ones_like(trans[..., :1]), trans[..., :-1]], dim=-1)
+    weights = alphas * trans_exclusive * transmittance[..., None]
+    density = (weights * density_params).sum(-1)
+    color_sum = (weights[..., None] * colors).sum(-2)
+    return density, color_sum, trans[..., -1]
+
+
+class _chunked_compose_fn(Function):
+    @staticmethod
+    def forward(ctx, eval_fn, chunk_size: int, num_fixed: int, x: torch.Tensor, radius: torch.Tensor,
+                viewdir: torch.Tensor, shape_params: torch.Tensor, color_params: torch.Tensor,
+                density_params: torch.Tensor):
+        """Composite strokes block by block, carrying the running composite between blocks.
+
+        Only the inputs and the final composite are saved. Backward walks the blocks again in the same
+        order and recomputes each of them, so memory is bounded by the block size.
+        """
+        num_strokes = shape_params.shape[0]
+        pre_shape = x.shape[:-1]
+        transmittance = x.new_ones(pre_shape)
+        density = x.new_zeros(pre_shape)
+        color_sum = None
+        for end in range(num_strokes, 0, -chunk_size):
+            start = max(end - chunk_size, 0)
+            alphas, colors = eval_fn(x, radius, viewdir, shape_params[start:end], color_params[start:end])
+            block_density, block_color_sum, block_transmittance = _compose_over_block(
+                alphas, colors, density_params[start:end], transmittance)
+            density = density + block_density
+            color_sum = block_color_sum if color_sum is None else color_sum + block_color_sum
+            transmittance = transmittance * block_transmittance
+        if color_sum is None:
+            color_sum = x.new_zeros(*pre_shape, 3)
+
+        ctx.save_for_backward(x, radius, viewdir, shape_params, color_params, density_params, density, color_sum,
+                              transmittance)
+        ctx.eval_fn = eval_fn
+        ctx.chunk_size = chunk_size
+        ctx.num_fixed = num_fixed
+        color = color_sum / (1 + 1e-6 - transmittance)[..., None]
+        return density, color.clamp(0, 1)
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_density: torch.Tensor, grad_color: torch.Tensor):
+        x, radius, viewdir, shape_params, color_params, density_params, density, color_sum, \
+            transmittance = ctx.saved_tensors
+        num_strokes = shape_params.shape[0]
+        needs_grad_x = ctx.needs_input_grad[3]
+
+        # Gradients w.r.t. the final unnormalized color and transmittance
+        color_scale = 1 / (1 + 1e-6 - transmittance)
+        in_range = ((color_sum * color_scale[..., None]) >= 0) & ((color_sum * color_scale[..., None]) <= 1)
+        grad_color = grad_color * in_range
+        grad_color_sum = grad_color * color_scale[..., None]
+        grad_transmittance = (grad_color * color_sum).sum(-1) * color_scale**2
+
+        grad_shape_params = torch.zeros_like(shape_params)
+        grad_color_params = torch.zeros_like(color_params)
+        grad_density_params = torch.zeros_like(density_params)
+        grad_x = torch.zeros_like(x) if needs_grad_x else None
+
+        # The composite behind a block only scales with the block transmittance, so its gradient
+        # w.r.t. the block is rest * dlog(T_block), with rest = total - everything up to the block.
+        prefix_transmittance = x.new_ones(x.shape[:-1])
+        prefix_density = torch.zeros_like(density)
+        prefix_color_sum = torch.zeros_like(color_sum)
+        for end in range(num_strokes, 0, -ctx.chunk_size):
+            start = max(end - ctx.chunk_size, 0)
+            needs_grad_params = end > ctx.num_fixed
+            with torch.set_grad_enabled(needs_grad_params or needs_grad_x):
+                x_block = x.detach().requires_grad_(needs_grad_x)
+                params = [shape_params[start:end].detach().requires_grad_(needs_grad_params),
+                          color_params[start:end].detach().requires_grad_(needs_grad_params),
+                          density_params[start:end].detach().requires_grad_(needs_grad_params)]
+                alphas, colors = ctx.eval_fn(x_block, radius, viewdir, params[0], params[1])
+                block_density, block_color_sum, block_transmittance = _compose_over_block(
+                    alphas, colors, params[2], prefix_transmittance)
+                if needs_grad_params or needs_grad_x:
+                    rest_density = density - prefix_density - block_density.detach()
+                    rest_color_sum = color_sum - prefix_color_sum - block_color_sum.detach()
+                    log_transmittance = torch.log1p(-alphas.clamp(max=1 - 1e-6)).sum(-1)
+                    objective = (grad_density * (block_density + rest_density * log_transmittance)).sum() + \
+                        (grad_color_sum * (block_color_sum + rest_color_sum * log_transmittance[..., None])).sum() + \
+                        (grad_transmittance * transmittance * log_transmittance).sum()
+                    inputs = (params if needs_grad_params else []) + ([x_block] if needs_grad_x else [])
+                    grads = list(torch.autograd.grad(objective, inputs, allow_unused=True))
+                    if needs_grad_params:
+                        for grad, grad_sum in zip(grads[:3], (grad_shape_params, grad_color_params,
+                                                              grad_density_params)):
+                            if grad is not None:
+                                grad_sum[start:end] += grad
+                        grads = grads[3:]
+                    if needs_grad_x and grads[0] is not None:
+                        grad_x += grads[0]
+            prefix_density = prefix_density + block_density.detach()
+            prefix_color_sum = prefix_color_sum + block_color_sum.detach()
+            prefix_transmittance = prefix_transmittance * block_transmittance.detach()
+
+        return None, None, None, grad_x, None, None, grad_shape_params, grad_color_params, grad_density_params
+
+
+def compose_strokes_chunked(stroke_fn,
+                            x: torch.Tensor,
+                            radius: torch.Tensor,
+                            viewdir: torch.Tensor,
+                            shape_params: torch.Tensor,
+                            color_params: torch.Tensor,
+                            density_params: torch.Tensor,
+                            sdf_delta: float,
+                            use_laplace_transform: bool = False,
+                            inv_scale_radius: bool = False,
+                            chunk_size: int = 256,
+                            texture_fn=None,
+                            num_fixed: int = 0):
+    """Evaluate and composite strokes with the "over" operator in blocks of chunk_size strokes.
+
+    Only one block of per-stroke alphas and colors is alive at a time, in forward and in backward,
+    so peak memory does not grow with the number of strokes.
+
+    Args:
+        stroke_fn (callable): Stroke function returned by get_stroke.
+        x (torch.Tensor): Sample coordinates of shape [..., num_samples, 3].
+        radius (torch.Tensor): Sample radius of shape [..., num_samples].
+        viewdir (torch.Tensor): View direction of shape [..., 3].
+        shape_params (torch.Tensor): Shape parameters of shape [num_strokes, num_params].
+        color_params (torch.Tensor): Color parameters of shape [num_strokes, num_params].
+        density_params (torch.Tensor): Density parameters of shape [num_strokes].
+        sdf_delta (float): Delta value for the clamping signed distance function.
+        use_laplace_transform (bool): Use sigmoid clamping or linear clamping?
+        inv_scale_radius (bool): Inverse scale radius according to scaling transform?
+        chunk_size (int): Number of strokes evaluated at once.
+        texture_fn (callable): Optional stroke texture, called as texture_fn(texcoords, colors, alphas).
+        num_fixed (int): The first num_fixed strokes need no gradients, their blocks are only recomputed.
+
+    Returns:
+        density (torch.Tensor): Density values of shape [..., num_samples].
+        color (torch.Tensor): Color values of shape [..., num_samples, color_dim].
+    """
+    def eval_fn(x, radius, viewdir, shape_params, color_params):
+        alphas, colors, _, texcoords = stroke_fn(x, radius, viewdir, shape_params, color_params, sdf_delta,
+                                                 use_laplace_transform, inv_scale_radius, True,
+                                                 texture_fn is not None)
+        if texture_fn is not None:
+            colors, alphas = texture_fn(texcoords, colors, alphas)
+        # Only one block is alive at a time, so blocks are always composited in float
+        return alphas.float(), colors.float()
+
+    return _chunked_compose_fn.apply(eval_fn, chunk_size, num_fixed, x, radius, viewdir, shape_params, color_params,
+                                     density_params)
+
+
+class _volume_render_fn(Function):
+    @staticmethod
+    @custom_fwd
+    def forward(ctx, density: torch.Tensor, tdist: torch.Tensor, dir_norms: torch.Tensor, colors: torch.Tensor,
+                bg_colors: torch.Tensor, opaque_background: bool = False):
+        """Composite the samples along a batch of rays into weights, color, opacity and depth."""
+        assert tdist.shape[:-1] == density.shape[:-1] and tdist.shape[-1] == density.shape[-1] + 1, \
+            'tdist must have shape [..., num_samples + 1]'
+        assert colors.shape[:-1] == density.shape and colors.shape[-1] == 3, \
+            'colors must have shape [..., num_samples, 3]'
+
+        pre_shape = density.shape[:-1]
+        num_samples = density.shape[-1]
+        density = density.contiguous().reshape(-1, num_samples).float()
+        tdist = tdist.contiguous().reshape(-1, num_samples + 1).float()
+        dir_norms = dir_norms.contiguous().reshape(-1).float()
+        colors = colors.contiguous().reshape(-1, num_samples, 3).float()
+        bg_colors = bg_colors.contiguous().reshape(-1, 3).float()
+
+        num_rays = density.shape[0]
+        weights = torch.empty_like(density)
+        color = torch.empty((num_rays, 3), dtype=torch.float32, device=density.device)
+        acc = torch.empty(num_rays, dtype=torch.float32, device=density.device)
+        depth = torch.empty(num_rays, dtype=torch.float32, device=density.device)
+        _backend.volume_render_forward(weights, color, acc, depth, density, tdist, dir_norms, colors, bg_colors,
+                                       opaque_background)
+        if ctx.needs_input_grad[0] or ctx.needs_input_grad[3]:
+            # The weights are an output, saving them keeps no additional memory
+            ctx.save_for_backward(density, tdist, dir_norms, colors, bg_colors, weights)
+            ctx.pre_shape = pre_shape
+            ctx.opaque_background = opaque_background
+
+        return weights.reshape(*pre_shape, num_samples), color.reshape(*pre_shape, 3), \
+            acc.reshape(pre_shape), depth.reshape(pre_shape)
+
+    @staticmethod
+    @once_differentiable
+    @custom_bwd
+    def backward(ctx, grad_weights: torch.Tensor, grad_color: torch.Tensor, grad_acc: torch.Tensor,
+                 grad_depth: torch.Tensor):
+        density, tdist, dir_norms, colors, bg_colors, weights = ctx.saved_tensors
+        pre_shape = ctx.pre_shape
+        num_rays, num_samples = density.shape
+
+        prepare_grad = lambda grad, shape: torch.zeros(shape, dtype=torch.float32, device=density.device) \
+            if grad is None else grad.contiguous().reshape(shape).float()
+        grad_weights = prepare_grad(grad_weights, (num_rays, num_samples))
+        grad_color = prepare_grad(grad_color, (num_rays, 3))
+        grad_acc = prepare_grad(grad_acc, (num_rays, ))
+        grad_depth = prepare_grad(grad_depth, (num_rays, ))
+
+        grad_density = torch.empty_like(density)
+        grad_colors = torch.empty_like(colors)
+        _backend.volume_render_backward(grad_density, grad_colors, grad_weights, grad_color, grad_acc, grad_depth,
+                                        density, tdist, dir_norms, colors, bg_colors, weights,
+                                        ctx.opaque_background)
+
+        grad_density = grad_density.reshape(*pre_shape, num_samples)
+        grad_colors = grad_colors.reshape(*pre_shape, num_samples, 3)
+        return grad_density, None, None, grad_colors, None, None
+
+
+def volume_render(density: torch.Tensor,
+                  tdist: torch.Tensor,
+                  directions: torch.Tensor,
+                  colors: torch.Tensor,
+                  bg_colors,
+                  opaque_background: bool = False):
+    """Volume render a batch of rays in a single pass over their samples.
+
+    Computes the weights of compute_alpha_weights and the color, opacity and depth of
+    volumetric_rendering (source/utils/render.py) in one fused kernel. The backward is analytic and
+    recomputes the transmittance, so no per sample temporaries are kept for autograd besides the
+    weights. Gradients only flow to density and colors, tdist is treated as a constant.
+
+    Args:
+        density (torch.Tensor): Sample densities of shape [..., num_samples].
+        tdist (torch.Tensor): Interval endpoint distances of shape [..., num_samples + 1].
+        directions (torch.Tensor): Ray directions of shape [..., 3], which scale the distances.
+        colors (torch.Tensor): Sample colors of shape [..., num_samples, 3].
+        bg_colors (torch.Tensor or float): Background colors broadcastable to [..., 3].
+        opaque_background (bool): Make the last interval of each ray infinitely wide?
+
+    Returns:
+        weights (torch.Tensor): Alpha compositing weights of shape [..., num_samples].
+        color (torch.Tensor): Composited colors over the background of shape [..., 3].
+        acc (torch.Tensor): Accumulated opacities of shape [...].
+        depth (torch.Tensor): Expected distances, clipped to the ray intervals, of shape [...].
+    """
+    dir_norms = torch.norm(directions, dim=-1)
+    bg_colors = torch.as_tensor(bg_colors, dtype=torch.float32, device=density.device)
+    bg_colors = bg_colors.expand(density.shape[:-1] + (3, ))
+    if _backend is None:
+        return volume_render_reference(density.float(), tdist.float(), dir_norms.float(), colors.float(),
+                                       bg_colors, opaque_background)
+    return _volume_render_fn.apply(density, tdist, dir_norms, colors, bg_colors, opaque_background)
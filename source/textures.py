@@ -12,19 +12,25 @@ def get_stroke_texture(config: configs.Config):
         return None
     if config.stroke_texture == 'image':
         return ImageTexture(config.texture_image_path, config.texture_image_size)
+    if config.stroke_texture == 'atlas':
+        return AtlasTexture(config.texture_atlas_paths, config.texture_image_size)
     else:
         assert 0, f'Unknown stroke texture {config.stroke_texture}'
 
 
 class StrokeTexture(nn.Module):
     @abc.abstractmethod
-    def forward(self, texcoords: torch.Tensor, colors: torch.Tensor, alphas: torch.Tensor):
+    def forward(self, texcoords: torch.Tensor, colors: torch.Tensor, alphas: torch.Tensor,
+                footprint: torch.Tensor = None, skip_empty: bool = False, texture_ids: torch.Tensor = None):
         """
         Query a stroke 3d texture from the given texcoord.
         Args:
             texcoords: UV texture coordinates in [0,1] of shape (..., 2).
             colors: RGB colors of strokes of shape (..., 3).
             alphas: Alpha values of strokes of shape (...,).
+            footprint: Optional sample size in texture coordinates broadcastable to (...,).
+            skip_empty: Whether zero alpha entries may be left untextured.
+            texture_ids: Optional per-entry texture index for atlases broadcastable to (...,).
         Returns:
             new_colors: textured RGB colors of shape (..., 3).
             new_alphas: textured Alpha values of shape (...,).
@@ -36,40 +42,117 @@ class StrokeTexture(nn.Module):
 class ImageTexture(StrokeTexture):
     modulate_alpha: bool = False  # Whether to modulate alpha with texture
     tint_ratio: float = 1.0  # The amount of original color to tint with
+    use_mipmap: bool = True  # Whether to filter minified strokes with a mip pyramid chosen by footprint
+    lod_bias: float = 0.0  # Offset added to the mip level, positive values blur more
     
-    def __init__(self, tint_image_path: str, texture_size: tuple[int, int], **kwargs):
+    def __init__(self, tint_image_path, texture_size: tuple[int, int], **kwargs):
         super().__init__()
         for k, v in kwargs.items():
             setattr(self, k, v)
-            
-        image = torch.from_numpy(misc.load_img(tint_image_path))
-        if image.ndim == 2:
-            image = image.unsqueeze(-1)
-        image = (image  / 255.).permute(2, 0, 1).unsqueeze(0)  # [N, C, H, W]
-        image = F.interpolate(image, texture_size, mode='area')
-        self.register_buffer('image_texture', image, persistent=False)
+
+        # Several images are stacked as the textures of an atlas, see AtlasTexture
+        paths = [tint_image_path] if isinstance(tint_image_path, str) else list(tint_image_path)
+        images = []
+        for path in paths:
+            image = torch.from_numpy(misc.load_img(path))
+            if image.ndim == 2:
+                image = image.unsqueeze(-1)
+            image = (image  / 255.).permute(2, 0, 1).unsqueeze(0)  # [N, C, H, W]
+            images.append(F.interpolate(image, texture_size, mode='area'))
+        num_channels = max(image.shape[1] for image in images)
+        image = torch.cat([image.expand(-1, num_channels, -1, -1) for image in images])  # [T, C, H, W]
+        self.num_textures = image.shape[0]
+
+        # Mip pyramid down to a single texel, levels are flattened into one texel table
+        levels = [image]
+        while self.use_mipmap and max(levels[-1].shape[-2:]) > 1:
+            h, w = levels[-1].shape[-2:]
+            levels.append(F.interpolate(levels[-1], (max(h // 2, 1), max(w // 2, 1)), mode='area'))
+        level_shapes = torch.tensor([level.shape[-2:] for level in levels])  # [L, 2]
+        level_sizes = level_shapes.prod(-1) * self.num_textures
+        level_offsets = torch.cumsum(level_sizes, 0) - level_sizes  # [L]
+        texels = torch.cat([level.permute(0, 2, 3, 1).reshape(-1, num_channels) for level in levels])
+        self.register_buffer('texels', texels.float(), persistent=False)  # [num_texels, C]
+        self.register_buffer('level_shapes', level_shapes, persistent=False)
+        self.register_buffer('level_offsets', level_offsets, persistent=False)
+
+    def sample_level(self, texcoords: torch.Tensor, level: torch.Tensor, texture_ids: torch.Tensor = None):
+        """Bilinearly sample the given mip levels, texel centers at the borders as with align_corners.
+        Args:
+            texcoords: UV texture coordinates in [0,1] of shape (N, 2).
+            level: Mip level of each texcoord of shape (N,), long.
+            texture_ids: Optional texture of each texcoord of shape (N,), long, the first if None.
+        Returns:
+            texvalues: RGB colors of shape (N, C).
+        """
+        h, w = self.level_shapes[level, 0], self.level_shapes[level, 1]
+        offset = self.level_offsets[level]
+        if texture_ids is not None:
+            offset = offset + texture_ids * h * w
+        texcoords = texcoords.float()  # Half precision texcoords are not precise enough for texel indices
+        x = texcoords[:, 0].clamp(0, 1) * (w - 1)
+        y = texcoords[:, 1].clamp(0, 1) * (h - 1)
+        x0, y0 = x.floor().long(), y.floor().long()
+        x1, y1 = torch.minimum(x0 + 1, w - 1), torch.minimum(y0 + 1, h - 1)
+        fx, fy = (x - x0)[:, None], (y - y0)[:, None]
+        row0 = offset + y0 * w
+        row1 = offset + y1 * w
+        top = self.texels[row0 + x0] * (1 - fx) + self.texels[row0 + x1] * fx
+        bottom = self.texels[row1 + x0] * (1 - fx) + self.texels[row1 + x1] * fx
+        return top * (1 - fy) + bottom * fy
         
-    def sample_texture(self, texcoords: torch.Tensor):
+    def sample_texture(self, texcoords: torch.Tensor, footprint: torch.Tensor = None,
+                       texture_ids: torch.Tensor = None):
         """Sample texture from the given texcoords.
         Args:
             texcoords: UV texture coordinates in [0,1] of shape (N, 2).
+            footprint: Optional sample size in texture coordinates of shape (N,), which selects
+                the mip level. Samples the full resolution texture if None.
+            texture_ids: Optional texture of each texcoord of shape (N,), the first if None.
         Returns:
             texvalues: RGB colors of shape (N, C).
         """
-        uvs = texcoords.reshape(1, 1, -1, 2) * 2 - 1  # [1, 1, N, 2]
-        texvalues = F.grid_sample(self.image_texture, uvs, align_corners=True)  # [1, C, 1, N]
-        texvalues = texvalues[0, :, 0, :].permute(1, 0)  # [N, C]
-        return texvalues
+        if footprint is None or not self.use_mipmap:
+            level = torch.zeros_like(texcoords[:, 0], dtype=torch.long)
+            return self.sample_level(texcoords, level, texture_ids)
+
+        num_levels = self.level_shapes.shape[0]
+        lod = torch.log2(footprint * self.level_shapes[0].max() + 1e-12) + self.lod_bias
+        lod = lod.clamp(0, num_levels - 1)
+        level0 = lod.floor().long()
+        level1 = (level0 + 1).clamp(max=num_levels - 1)
+        t = (lod - level0)[:, None]
+        return self.sample_level(texcoords, level0, texture_ids) * (1 - t) + \
+            self.sample_level(texcoords, level1, texture_ids) * t
         
-    def forward(self, texcoords: torch.Tensor, colors: torch.Tensor, alphas: torch.Tensor):
+    def forward(self, texcoords: torch.Tensor, colors: torch.Tensor, alphas: torch.Tensor,
+                footprint: torch.Tensor = None, skip_empty: bool = False, texture_ids: torch.Tensor = None):
+        """See StrokeTexture.forward.
+        Args:
+            footprint: Optional sample size in texture coordinates broadcastable to alphas.
+            skip_empty: Only sample entries with non-zero alpha, the others get a white tint.
+                Only valid if zero alpha entries do not contribute, as for "over" composition.
+            texture_ids: Optional texture of each entry broadcastable to alphas, the first if None.
+        """
         assert colors.shape[-1] == 3, 'Colors should be RGB for ImageTexture'
         pre_shape = colors.shape[:-1]
         texcoords = texcoords.reshape(-1, 2)  # [N, 2]
         colors = colors.reshape(-1, 3)  # [N, 3]
         alphas = alphas.reshape(-1)  # [N]
+        if footprint is not None:
+            footprint = footprint.expand(pre_shape).reshape(-1)  # [N]
+        if texture_ids is not None:
+            texture_ids = texture_ids.expand(pre_shape).reshape(-1)  # [N]
         
-        tint = self.sample_texture(texcoords)  # [N, C]
+        if skip_empty:
+            nonzero = torch.nonzero(alphas.detach() > 0).squeeze(1)
+            tint = self.sample_texture(texcoords[nonzero], None if footprint is None else footprint[nonzero],
+                                       None if texture_ids is None else texture_ids[nonzero])
+            tint = tint.new_ones(texcoords.shape[0], tint.shape[-1]).index_put((nonzero, ), tint)
+        else:
+            tint = self.sample_texture(texcoords, footprint, texture_ids)  # [N, C]
         assert tint.shape[-1] == 3 or tint.shape[-1] == 1, 'Texture should be RGB or grayscale'
+        tint = tint.to(colors.dtype)
         
         # Interpolate between pure white and texture
         # tint = (1 - alphas.unsqueeze(1)) * tint + alphas.unsqueeze(1)
@@ -80,4 +163,14 @@ class ImageTexture(StrokeTexture):
             alphas = alphas * tint.mean(-1)
         
         return colors.reshape(*pre_shape, 3), alphas.reshape(*pre_shape)
-    
+
+
+@gin.configurable
+class AtlasTexture(ImageTexture):
+    """Several brush textures packed into one texel table, each stroke samples its own texture.
+
+    The texture of each stroke is given as texture_ids, all strokes and samples are looked up at once.
+    """
+    def __init__(self, tint_image_paths: tuple[str, ...], texture_size: tuple[int, int], **kwargs):
+        assert len(tint_image_paths) > 0, 'AtlasTexture needs at least one texture image'
+        super().__init__(tint_image_paths, texture_size, **kwargs)
@@ -1,5 +1,6 @@
 import torch
 from . import stepfun
+from source.strokelib import volume_render
 
 
 def cast_rays(tdist, origins, directions, radii):
@@ -88,29 +89,64 @@ def volumetric_rendering(rgbs,
     rendering['acc'] = acc
 
     if compute_extras:
-        if extras is not None:
-            for k, v in extras.items():
-                if v is not None:
-                    rendering[k] = (weights[..., None] * v).sum(dim=-2)
-
-        expectation = lambda x: (weights * x).sum(dim=-1) / acc.clamp_min(eps)
-        # For numerical stability this expectation is computing using log-distance.
-        rendering['distance_mean'] = (
-            torch.clip(
-                torch.nan_to_num(torch.exp(expectation(torch.log(t_mids))), torch.inf),
-                tdist[..., 0], tdist[..., -1]))
-
-        # Add an extra fencepost with the far distance at the end of each ray, with
-        # whatever weight is needed to make the new weight vector sum to exactly 1
-        # (`weights` is only guaranteed to sum to <= 1, not == 1).
-        t_aug = torch.cat([tdist, t_far], dim=-1)
-        weights_aug = torch.cat([weights, bg_w], dim=-1)
-
-        ps = [5, 50, 95]
-        distance_percentiles = stepfun.weighted_percentile(t_aug, weights_aug, ps)
-
-        for i, p in enumerate(ps):
-            s = 'median' if p == 50 else 'percentile_' + str(p)
-            rendering['distance_' + s] = distance_percentiles[..., i]
+        rendering.update(rendering_extras(weights, tdist, acc, t_far, eps, extras))
+
+    return rendering
+
+
+def fused_volumetric_rendering(density,
+                               rgbs,
+                               tdist,
+                               dirs,
+                               bg_rgbs,
+                               t_far,
+                               compute_extras,
+                               opaque_background=False,
+                               extras=None):
+    """compute_alpha_weights followed by volumetric_rendering, with the weights, rgb, acc and depth
+    computed by a single fused op that keeps no per sample temporaries for autograd.
+
+    No gradients flow to tdist, see strokelib.volume_render.
+
+    Returns:
+        weights: [batch_size, num_samples], the alpha compositing weights.
+        rendering: the same as volumetric_rendering.
+    """
+    weights, rgb, acc, depth = volume_render(density, tdist, dirs, rgbs, bg_rgbs, opaque_background)
+    rendering = {'rgb': rgb, 'depth': depth, 'acc': acc}
+    if compute_extras:
+        rendering.update(rendering_extras(weights, tdist, acc, t_far, torch.finfo(weights.dtype).eps, extras))
+    return weights, rendering
+
+
+def rendering_extras(weights, tdist, acc, t_far, eps, extras=None):
+    """Extra quantities of volumetric_rendering besides color, such as distance percentiles."""
+    rendering = {}
+    bg_w = (1 - acc[..., None]).clamp_min(0.)  # The weight of the background.
+    t_mids = 0.5 * (tdist[..., :-1] + tdist[..., 1:])
+    if extras is not None:
+        for k, v in extras.items():
+            if v is not None:
+                rendering[k] = (weights[..., None] * v).sum(dim=-2)
+
+    expectation = lambda x: (weights * x).sum(dim=-1) / acc.clamp_min(eps)
+    # For numerical stability this expectation is computing using log-distance.
+    rendering['distance_mean'] = (
+        torch.clip(
+            torch.nan_to_num(torch.exp(expectation(torch.log(t_mids))), torch.inf),
+            tdist[..., 0], tdist[..., -1]))
+
+    # Add an extra fencepost with the far distance at the end of each ray, with
+    # whatever weight is needed to make the new weight vector sum to exactly 1
+    # (`weights` is only guaranteed to sum to <= 1, not == 1).
+    t_aug = torch.cat([tdist, t_far], dim=-1)
+    weights_aug = torch.cat([weights, bg_w], dim=-1)
+
+    ps = [5, 50, 95]
+    distance_percentiles = stepfun.weighted_percentile(t_aug, weights_aug, ps)
+
+    for i, p in enumerate(ps):
+        s = 'median' if p == 50 else 'percentile_' + str(p)
+        rendering['distance_' + s] = distance_percentiles[..., i]
 
     return rendering
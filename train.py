@@ -134,6 +134,7 @@ def train():
 
             # apply loss functions
             loss, stats = apply_loss(batch, renderings, ray_history, module, cfg)
+            module.update_error_field(batch, renderings, ray_history)
 
             # accelerator automatically handle the scale
             accelerator.backward(loss)
@@ -218,7 +219,7 @@ def apply_loss(batch, renderings, ray_history, module, cfg) -> tuple[torch.Tenso
         losses['hash_decay'] = loss_fn.hash_decay_loss(ray_history, cfg)
         
     # error field loss
-    if cfg.error_loss_mult > 0:
+    if cfg.error_loss_mult > 0 and module.error_field_type == 'mlp':
         losses['error'] = loss_fn.error_loss(batch, renderings, ray_history, cfg)
         
     # density regularization loss